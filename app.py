@@ -3,6 +3,7 @@ import os
 #from flask import Flask, request, jsonify, session
 import mysql.connector
 from mysql.connector import Error
+from mysql.connector.errors import PoolError
 import hashlib
 import secrets
 import datetime
@@ -16,20 +17,50 @@ import os
 import redis
 import json
 import uuid
+import socket
 import struct
 import hmac
 import zlib
 import urllib.error
 import urllib.parse
 import urllib.request
+import threading
+import functools
+import heapq
+import weakref
+import signal
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 try:
     import httpx
     HAS_HTTPX = True
 except ImportError:
     HAS_HTTPX = False
     print("[警告] httpx 未安装，SRS 信令转发功能将使用 urllib（同步方式）")
+try:
+    import h2  # httpx 的 HTTP/2 支持依赖 h2
+    HAS_H2 = h2 is not None
+except ImportError:
+    HAS_H2 = False
+try:
+    import msgpack
+    HAS_MSGPACK = True
+except ImportError:
+    HAS_MSGPACK = False
+try:
+    import orjson
+    HAS_ORJSON = True
+except ImportError:
+    HAS_ORJSON = False
+try:
+    import redis.asyncio as aioredis
+    HAS_REDIS_ASYNCIO = True
+except ImportError:
+    HAS_REDIS_ASYNCIO = False
+    print("[警告] redis 版本过低（缺少 redis.asyncio），集群模式不可用")
 from fastapi import FastAPI, Query
-from typing import Any, List, Dict, Optional, Union
+from typing import Any, List, Dict, NamedTuple, Optional, Tuple, Union
 #import session
 from logging.handlers import TimedRotatingFileHandler
 from typing import Dict
@@ -40,6 +71,7 @@ from aliyunsdkcore.request import CommonRequest
 from fastapi import Request
 from starlette.middleware.base import BaseHTTPMiddleware
 from starlette.requests import ClientDisconnect
+from starlette.websockets import WebSocketState
 from fastapi.encoders import jsonable_encoder
 from dotenv import load_dotenv
 try:
@@ -90,27 +122,83 @@ print(f"[启动检查] SRS 服务器配置: 协议={'HTTPS' if SRS_USE_HTTPS els
 # ===== 停止事件，用于控制心跳协程退出 =====
 stop_event = asyncio.Event()
 
-# ===== 心跳检测函数 =====
+# ===== 心跳检测 =====
+HEARTBEAT_TIMEOUT = float(os.getenv("HEARTBEAT_TIMEOUT", "30"))  # 超过该秒数没有 ping 视为掉线
+HEARTBEAT_CHECK_INTERVAL = float(os.getenv("HEARTBEAT_CHECK_INTERVAL", "10"))  # 检测协程最长休眠时间（秒）
+HEARTBEAT_RESOLUTION = float(os.getenv("HEARTBEAT_RESOLUTION", "1"))  # 最短休眠时间，到期时间相近的连接合并成一批处理
+
+
+class HeartbeatScheduler:
+    """
+    按截止时间的小顶堆做心跳超时检测，每个连接在堆里只有一项 (last_heartbeat + timeout)。
+    ping 只更新 last_heartbeat，不动堆；堆顶到期时再看一眼最新的 last_heartbeat，没超时就按新截止时间放回。
+    每轮只处理已到期的连接，超时的连接并发关闭。已断开或被新连接替换的项在到期时直接丢弃。
+    """
+
+    def __init__(self, timeout: float = HEARTBEAT_TIMEOUT, check_interval: float = HEARTBEAT_CHECK_INTERVAL,
+                 resolution: float = HEARTBEAT_RESOLUTION):
+        self._timeout = timeout
+        self._check_interval = check_interval
+        self._resolution = min(resolution, check_interval)
+        self._heap: List[tuple] = []
+        self._seq = 0
+        self.stats = {"expired": 0, "rescheduled": 0}
+
+    def track(self, user_id: str, conn: Dict[str, Any]) -> None:
+        """新连接登记到堆里（conn 为 connections[user_id] 对应的字典）"""
+        self._push(conn["last_heartbeat"] + self._timeout, user_id, conn)
+
+    def _push(self, deadline: float, user_id: str, conn: Dict[str, Any]) -> None:
+        self._seq += 1
+        heapq.heappush(self._heap, (deadline, self._seq, user_id, conn))
+
+    def _pop_expired(self, now: float) -> List[tuple]:
+        expired = []
+        while self._heap and self._heap[0][0] <= now:
+            _, _, uid, conn = heapq.heappop(self._heap)
+            if connections.get(uid) is not conn:
+                continue
+            deadline = conn["last_heartbeat"] + self._timeout
+            if deadline > now:
+                self._push(deadline, uid, conn)
+                self.stats["rescheduled"] += 1
+                continue
+            expired.append((uid, conn))
+        return expired
+
+    async def _expire(self, expired: List[tuple]) -> None:
+        # 连接条目在这里就被移除，会话自己的 finally 不会再做清理，所以集群登记、录音也在这里一并处理
+        cleanups = []
+        for uid, conn in expired:
+            print(f"用户 {uid} 心跳超时，断开连接")
+            connections.pop(uid, None)
+            # 只移除成员，不因心跳超时解散房间
+            cleanups.append(temp_rooms.leave_all(uid, "心跳超时"))
+            cleanups.append(safe_close(conn["ws"], 1001, "Heartbeat timeout"))
+            cleanups.append(hub.unregister(uid))
+            cleanups.append(voice_recorder.abort(uid))
+            presence.went_offline(uid)
+        self.stats["expired"] += len(expired)
+        await asyncio.gather(*cleanups, return_exceptions=True)
+
+    async def run(self) -> None:
+        while not stop_event.is_set():
+            expired = self._pop_expired(time.time())
+            if expired:
+                await self._expire(expired)
+            delay = self._heap[0][0] - time.time() if self._heap else self._check_interval
+            await asyncio.sleep(min(self._check_interval, max(self._resolution, delay)))
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {"tracked": len(self._heap), "timeout": self._timeout, **self.stats}
+
+
+heartbeat_scheduler = HeartbeatScheduler()
+
+
 async def heartbeat_checker():
     try:
-        while not stop_event.is_set():
-            now = time.time()
-            to_remove = []
-            for uid, conn in list(connections.items()):
-                if now - conn["last_heartbeat"] > 30:
-                    print(f"用户 {uid} 心跳超时，断开连接")
-                    await safe_close(conn["ws"], 1001, "Heartbeat timeout")
-                    to_remove.append(uid)
-            for uid in to_remove:
-                connections.pop(uid, None)  # 安全移除
-                # 清理用户从所有临时房间的成员列表中移除
-                # 注意：不再因为心跳超时自动解散房间，只移除成员，房间是否解散由业务消息控制（如 temp_room_owner_leave）
-                for group_id, room_info in list(active_temp_rooms.items()):
-                    members = room_info.get("members", [])
-                    if uid in members:
-                        members.remove(uid)
-                        print(f"[webrtc] 心跳超时：用户 {uid} 离开房间 {group_id}，当前成员数={len(members)}")
-            await asyncio.sleep(10)
+        await heartbeat_scheduler.run()
     except asyncio.CancelledError:
         print("heartbeat_checker 已安全退出")
 
@@ -121,23 +209,50 @@ async def lifespan(app: FastAPI):
     global stop_event
     stop_event.clear()
 
-    # 启动时从数据库加载仍然活跃的临时语音房间
-    load_active_temp_rooms_from_db()
+    # 启动时在后台从数据库加载仍然活跃的临时语音房间，完成前 /readyz 返回 503
+    hydrate_task = asyncio.create_task(temp_room_hydration.run())
 
     # 启动心跳检测任务
     hb_task = asyncio.create_task(heartbeat_checker())
+    lag_task = asyncio.create_task(loop_lag_monitor.run())
+    await hub.start()
+    await temp_rooms.start()
+    await presence.start()
+    await srs_client.start()
+    await temp_room_reconciler.start()
+    drainer.install_sigterm_handler()
     print("🚀 应用启动，心跳检测已启动")
 
     yield  # 应用运行中
 
     # 应用关闭逻辑
     print("🛑 应用关闭，准备停止心跳检测")
+    if connections:
+        # 没有经过 /admin/drain 或 SIGTERM 排空、连接还在时兜底执行一次
+        drainer.start("shutdown")
+        await drainer.wait()
     stop_event.set()  # 通知心跳退出
     hb_task.cancel()  # 强制取消
     try:
         await hb_task
     except asyncio.CancelledError:
         print("heartbeat_checker 已安全停掉")
+    lag_task.cancel()
+    hydrate_task.cancel()
+    # 排空退出时不立即宣告离线：客户端会重连到其他 worker，在线标记由重连覆盖或按 TTL 过期
+    await presence.stop(flush_offline=not drainer.draining)
+    await temp_room_reconciler.stop()
+    await temp_rooms.stop()
+    await hub.stop()
+    await srs_client.stop()
+    if _voice_store_tasks:
+        # 等待还没入库的离线语音写完，再关闭线程池
+        await asyncio.gather(*list(_voice_store_tasks), return_exceptions=True)
+    if _prepare_class_tasks:
+        # 课前准备推送失败时需要回写未读，同样在关闭线程池前等待
+        await asyncio.gather(*list(_prepare_class_tasks), return_exceptions=True)
+    db_executor.shutdown()
+    voice_recorder.shutdown()
 
 app = FastAPI(lifespan=lifespan)
 
@@ -146,6 +261,519 @@ connections: Dict[str, Dict] = {}  # {user_id: {"ws": WebSocket, "last_heartbeat
 active_temp_rooms: Dict[str, Dict[str, Any]] = {}  # {group_id: {...room info...}}
 
 
+# 多 worker 部署时临时房间状态以 Redis 为准（默认跟随 HUB_CLUSTER_MODE；集群配置在后面定义，这里直接读环境变量）
+TEMP_ROOM_REDIS = os.getenv("TEMP_ROOM_REDIS", os.getenv("HUB_CLUSTER_MODE", "false")).lower() in ("1", "true", "yes")
+_TEMP_ROOM_FIELDS = ("room_id", "group_id", "owner_id", "owner_name", "owner_icon", "publish_url", "play_url",
+                     "whip_url", "whep_url", "stream_name", "timestamp")
+
+
+class TempRoomRegistry:
+    """
+    临时语音房间表。房间信息仍放在 active_temp_rooms 里（只读访问照旧），
+    但房间的增删和成员进出都走这里：room_info["members"] 是 set，另维护 user_id -> {group_id} 反向索引，
+    用户离开/断线清理只触及该用户所在的房间，而不是遍历全部房间。
+    HTTP 接口和启动恢复在 DB 线程池里登记房间（add_room_if_absent），所有本地修改加锁。
+
+    开启 TEMP_ROOM_REDIS 后以 Redis 为准，active_temp_rooms 是本 worker 的完整副本：
+    - temproom:{rooms}:room:<group_id>（hash）房间信息，temproom:{rooms}:groups（set）全部群，
+      temproom:{rooms}:index（zset，分数都为 0）成员索引：每个成员两条 g\\0<group_id>\\0<user_id> 和
+      u\\0<user_id>\\0<group_id>，按前缀 ZRANGEBYLEX 分别查群成员和用户所在的群；key 数量固定，脚本不用临时拼 key
+    - 建房、进出、解散各是一段 Lua 脚本，检查和修改在 Redis 里原子完成，同一脚本里发布到 temproom:events；
+      其他 worker 订阅后把变更应用到自己的副本，（重新）订阅成功时整体同步一次
+    - 副本可能比 Redis 晚几毫秒，get()/get_many() 本地没有时回查 Redis（读穿透）
+    Redis 出错时记录日志，退回只改本地副本。
+    """
+
+    # 所有 key 带同一个 hash tag {rooms}，在 Redis Cluster 里落在同一个 slot；脚本用到的 key 全部经 KEYS 传入
+    _ROOMS_KEY = "temproom:{rooms}:groups"
+    _INDEX_KEY = "temproom:{rooms}:index"
+    _CHANNEL = "temproom:events"
+    # KEYS: 房间 hash、成员索引、全部群 set；ARGV: group_id、仅不存在时创建、事件、字段数 n、n 对字段/值、成员...
+    _PUT_LUA = r"""
+if ARGV[2] == '1' and redis.call('exists', KEYS[1]) == 1 then return 0 end
+local g = 'g\0' .. ARGV[1] .. '\0'
+for _, e in ipairs(redis.call('zrangebylex', KEYS[2], '[' .. g, '(g\0' .. ARGV[1] .. '\1')) do
+    redis.call('zrem', KEYS[2], e, 'u\0' .. string.sub(e, #g + 1) .. '\0' .. ARGV[1])
+end
+redis.call('del', KEYS[1])
+local n = tonumber(ARGV[4])
+redis.call('hset', KEYS[1], unpack(ARGV, 5, 4 + 2 * n))
+for i = 5 + 2 * n, #ARGV do
+    redis.call('zadd', KEYS[2], 0, g .. ARGV[i], 0, 'u\0' .. ARGV[i] .. '\0' .. ARGV[1])
+end
+redis.call('sadd', KEYS[3], ARGV[1])
+redis.call('publish', 'temproom:events', ARGV[3])
+return 1
+"""
+    # KEYS 同上；ARGV: group_id、事件、room_id（为空表示不校验）
+    _DELETE_LUA = r"""
+if redis.call('exists', KEYS[1]) == 0 then return 0 end
+if ARGV[3] ~= '' and redis.call('hget', KEYS[1], 'room_id') ~= ARGV[3] then return 0 end
+local g = 'g\0' .. ARGV[1] .. '\0'
+for _, e in ipairs(redis.call('zrangebylex', KEYS[2], '[' .. g, '(g\0' .. ARGV[1] .. '\1')) do
+    redis.call('zrem', KEYS[2], e, 'u\0' .. string.sub(e, #g + 1) .. '\0' .. ARGV[1])
+end
+redis.call('del', KEYS[1])
+redis.call('srem', KEYS[3], ARGV[1])
+redis.call('publish', 'temproom:events', ARGV[2])
+return 1
+"""
+    # KEYS: 房间 hash、成员索引；ARGV: group_id、user_id、事件。房间不存在 -1，已是成员 0，加入 1
+    _JOIN_LUA = r"""
+if redis.call('exists', KEYS[1]) == 0 then return -1 end
+if redis.call('zadd', KEYS[2], 0, 'g\0' .. ARGV[1] .. '\0' .. ARGV[2]) == 0 then return 0 end
+redis.call('zadd', KEYS[2], 0, 'u\0' .. ARGV[2] .. '\0' .. ARGV[1])
+redis.call('publish', 'temproom:events', ARGV[3])
+return 1
+"""
+    # KEYS: 成员索引；ARGV: group_id、user_id、事件
+    _LEAVE_LUA = r"""
+if redis.call('zrem', KEYS[1], 'g\0' .. ARGV[1] .. '\0' .. ARGV[2]) == 0 then return 0 end
+redis.call('zrem', KEYS[1], 'u\0' .. ARGV[2] .. '\0' .. ARGV[1])
+redis.call('publish', 'temproom:events', ARGV[3])
+return 1
+"""
+    # KEYS: 成员索引；ARGV: user_id、事件。返回离开的 group_id 列表
+    _LEAVE_ALL_LUA = r"""
+local u = 'u\0' .. ARGV[1] .. '\0'
+local groups = {}
+for i, e in ipairs(redis.call('zrangebylex', KEYS[1], '[' .. u, '(u\0' .. ARGV[1] .. '\1')) do
+    groups[i] = string.sub(e, #u + 1)
+    redis.call('zrem', KEYS[1], e, 'g\0' .. groups[i] .. '\0' .. ARGV[1])
+end
+if #groups > 0 then redis.call('publish', 'temproom:events', ARGV[2]) end
+return groups
+"""
+
+    def __init__(self, rooms: Dict[str, Dict[str, Any]], use_redis: bool = TEMP_ROOM_REDIS):
+        if use_redis and not HAS_REDIS_ASYNCIO:
+            app_logger.error("[temp_room] 已开启 TEMP_ROOM_REDIS，但 redis.asyncio 不可用，房间状态只保存在本进程")
+        self.use_redis = use_redis and HAS_REDIS_ASYNCIO
+        self.rooms = rooms
+        self._user_rooms: Dict[str, set] = {}
+        self._lock = threading.RLock()
+        self._redis = None
+        self._task: Optional[asyncio.Task] = None
+        self.synced = asyncio.Event()  # 副本已与 Redis 同步（未开启 Redis 时 start() 直接置位）
+        self.stats = {"redis_reads": 0, "redis_errors": 0, "events_applied": 0, "resyncs": 0}
+
+    @staticmethod
+    def _room_key(group_id: str) -> str:
+        return f"temproom:{{rooms}}:room:{group_id}"
+
+    @staticmethod
+    def _group_range(group_id: str) -> Tuple[str, str]:
+        """成员索引里某个群全部成员的 ZRANGEBYLEX 区间（g\\0<group_id>\\0 前缀）"""
+        return f"[g\0{group_id}\0", f"(g\0{group_id}\1"
+
+    async def start(self) -> None:
+        if not self.use_redis:
+            self.synced.set()
+            return
+        self._redis = aioredis.Redis(host=REDIS_HOST, port=REDIS_PORT, decode_responses=True)
+        self._task = asyncio.create_task(self._subscribe())
+        app_logger.info("[temp_room] Redis 房间状态已启动")
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            task, self._task = self._task, None
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+        if self._redis is not None:
+            try:
+                await self._redis.aclose()
+            except Exception as e:
+                app_logger.warning(f"[temp_room] 关闭 Redis 连接失败: {e}")
+
+    # ----- 本地副本 -----
+    def _put_local(self, group_id: str, room_info: Dict[str, Any]) -> Dict[str, Any]:
+        with self._lock:
+            self._drop_local(group_id)
+            members = set(room_info.get("members") or ())
+            room_info["members"] = members
+            self.rooms[group_id] = room_info
+            for uid in members:
+                self._user_rooms.setdefault(uid, set()).add(group_id)
+        return room_info
+
+    def _drop_local(self, group_id: str, room_id: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            room_info = self.rooms.get(group_id)
+            if room_info is None or (room_id and room_info.get("room_id") != room_id):
+                return None
+            del self.rooms[group_id]
+            for uid in room_info.get("members", ()):
+                self._unindex(uid, group_id)
+            return room_info
+
+    def _unindex(self, user_id: str, group_id: str) -> None:
+        rooms = self._user_rooms.get(user_id)
+        if rooms is not None:
+            rooms.discard(group_id)
+            if not rooms:
+                del self._user_rooms[user_id]
+
+    def _join_local(self, group_id: str, user_id: str) -> bool:
+        with self._lock:
+            room_info = self.rooms.get(group_id)
+            if room_info is None or user_id in room_info["members"]:
+                return False
+            room_info["members"].add(user_id)
+            self._user_rooms.setdefault(user_id, set()).add(group_id)
+            return True
+
+    def _leave_local(self, group_id: str, user_id: str) -> bool:
+        with self._lock:
+            room_info = self.rooms.get(group_id)
+            if room_info is None or user_id not in room_info["members"]:
+                return False
+            room_info["members"].discard(user_id)
+            self._unindex(user_id, group_id)
+            return True
+
+    def _leave_all_local(self, user_id: str, reason: str) -> List[str]:
+        with self._lock:
+            group_ids = self._user_rooms.pop(user_id, set())
+            left = []
+            for group_id in group_ids:
+                room_info = self.rooms.get(group_id)
+                if room_info is None:
+                    continue
+                room_info["members"].discard(user_id)
+                left.append(group_id)
+                app_logger.info(f"[webrtc] 用户 {user_id} 离开房间 {group_id}（{reason}），当前成员数={len(room_info['members'])}")
+                print(f"[webrtc] 用户 {user_id} 离开房间 {group_id}（{reason}），当前成员数={len(room_info['members'])}")
+            return left
+
+    # ----- Redis -----
+    def _event(self, op: str, group_id: str = "", user_id: str = "", **extra) -> str:
+        return json.dumps({"w": hub.worker_id, "op": op, "g": group_id, "u": user_id, **extra}, ensure_ascii=False)
+
+    def _put_args(self, group_id: str, room_info: Dict[str, Any], if_absent: bool) -> tuple:
+        room = {name: room_info.get(name) for name in _TEMP_ROOM_FIELDS}
+        room["group_id"] = group_id
+        fields = []
+        for name, value in room.items():
+            if value is not None:
+                fields += [name, str(value)]
+        members = [str(uid) for uid in (room_info.get("members") or ())]
+        event = self._event("put", group_id, room={**room, "members": members})
+        return (self._PUT_LUA, 3, self._room_key(group_id), self._INDEX_KEY, self._ROOMS_KEY,
+                group_id, "1" if if_absent else "0", event, len(fields) // 2, *fields, *members)
+
+    @staticmethod
+    def _room_from(fields: Dict[str, Any], members) -> Dict[str, Any]:
+        room_info = {name: fields.get(name) for name in _TEMP_ROOM_FIELDS}
+        try:
+            room_info["timestamp"] = float(room_info["timestamp"]) if room_info["timestamp"] is not None else time.time()
+        except (TypeError, ValueError):
+            room_info["timestamp"] = time.time()
+        room_info["members"] = set(members or ())
+        return room_info
+
+    def _redis_error(self, action: str, error: Exception) -> None:
+        self.stats["redis_errors"] += 1
+        app_logger.error(f"[temp_room] Redis {action}失败，只修改本地副本: {error}")
+
+    async def _fetch(self, group_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+        self.stats["redis_reads"] += 1
+        pipe = self._redis.pipeline(transaction=False)
+        for group_id in group_ids:
+            pipe.hgetall(self._room_key(group_id))
+            pipe.zrangebylex(self._INDEX_KEY, *self._group_range(group_id))
+        values = await pipe.execute()
+        return {group_id: self._room_from(values[2 * i], [e[len(group_id) + 3:] for e in values[2 * i + 1]])
+                for i, group_id in enumerate(group_ids) if values[2 * i]}
+
+    async def _resync(self) -> None:
+        group_ids = list(await self._redis.smembers(self._ROOMS_KEY))
+        loaded: Dict[str, Dict[str, Any]] = {}
+        for i in range(0, len(group_ids), 500):
+            loaded.update(await self._fetch(group_ids[i:i + 500]))
+        with self._lock:
+            for group_id in list(self.rooms):
+                if group_id not in loaded:
+                    self._drop_local(group_id)
+            for group_id, room_info in loaded.items():
+                self._put_local(group_id, room_info)
+        self.stats["resyncs"] += 1
+        self.synced.set()
+        app_logger.info(f"[temp_room] 已从 Redis 同步 {len(loaded)} 个临时房间")
+
+    async def _subscribe(self) -> None:
+        while True:
+            pubsub = self._redis.pubsub()
+            try:
+                await pubsub.subscribe(self._CHANNEL)
+                # 先订阅再全量同步，同步期间的变更留在订阅里，不会漏掉
+                await self._resync()
+                async for message in pubsub.listen():
+                    if message.get("type") != "message":
+                        continue
+                    try:
+                        self._apply(json.loads(message["data"]))
+                    except (ValueError, KeyError, TypeError) as e:
+                        app_logger.warning(f"[temp_room] 忽略无法解析的房间事件: {e}")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                app_logger.error(f"[temp_room] 订阅房间事件异常，1 秒后重连: {e}")
+                await asyncio.sleep(1)
+            finally:
+                try:
+                    await pubsub.aclose()
+                except Exception:
+                    pass
+
+    def _apply(self, event: Dict[str, Any]) -> None:
+        """把其他 worker 发布的变更应用到本地副本（本 worker 的修改已在本地完成）"""
+        if event.get("w") == hub.worker_id:
+            return
+        op, group_id, user_id = event["op"], event.get("g"), event.get("u")
+        self.stats["events_applied"] += 1
+        if op == "put":
+            room = event["room"]
+            self._put_local(group_id, self._room_from(room, room.get("members")))
+        elif op == "del":
+            self._drop_local(group_id, event.get("rid") or None)
+        elif op == "join":
+            self._join_local(group_id, user_id)
+        elif op == "leave":
+            self._leave_local(group_id, user_id)
+        elif op == "leave_all":
+            self._leave_all_local(user_id, event.get("reason") or "其他 worker")
+
+    # ----- 对外接口 -----
+    async def get(self, group_id: str) -> Optional[Dict[str, Any]]:
+        """房间信息；本地副本没有且开启了 Redis 时回查 Redis"""
+        room_info = self.rooms.get(group_id)
+        if room_info is not None or not self.use_redis or not group_id:
+            return room_info
+        return (await self.get_many([group_id])).get(group_id)
+
+    async def get_many(self, group_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+        found = {group_id: self.rooms[group_id] for group_id in group_ids if group_id in self.rooms}
+        missing = [group_id for group_id in group_ids if group_id not in found]
+        if missing and self.use_redis:
+            try:
+                loaded = await self._fetch(missing)
+            except Exception as e:
+                self.stats["redis_errors"] += 1
+                app_logger.error(f"[temp_room] 从 Redis 读取房间失败: {e}")
+                return found
+            for group_id, room_info in loaded.items():
+                found[group_id] = self._put_local(group_id, room_info)
+        return found
+
+    async def add_room(self, group_id: str, room_info: Dict[str, Any]) -> Dict[str, Any]:
+        """登记（或替换）一个房间，room_info["members"] 可以是任意可迭代对象"""
+        if self.use_redis:
+            try:
+                await self._redis.eval(*self._put_args(group_id, room_info, False))
+            except Exception as e:
+                self._redis_error("登记房间", e)
+        return self._put_local(group_id, room_info)
+
+    def add_room_if_absent(self, group_id: str, room_info: Dict[str, Any]) -> bool:
+        """群里还没有房间时才登记，返回是否登记。在线程池中调用，开启 Redis 时用同步客户端"""
+        if self.use_redis:
+            try:
+                created = r.eval(*self._put_args(group_id, room_info, True))
+            except Exception as e:
+                self._redis_error("登记房间", e)
+            else:
+                if created:
+                    self._put_local(group_id, room_info)
+                return bool(created)
+        with self._lock:
+            if group_id in self.rooms:
+                return False
+            self._put_local(group_id, room_info)
+            return True
+
+    async def remove_room(self, group_id: str, room_id: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        """解散房间，返回被解散的房间信息；指定 room_id 时只在群里仍是这个房间时解散"""
+        if self.use_redis:
+            local = self.rooms.get(group_id)
+            expected = room_id or (local.get("room_id") if local else "") or ""
+            try:
+                removed = await self._redis.eval(self._DELETE_LUA, 3, self._room_key(group_id), self._INDEX_KEY,
+                                                 self._ROOMS_KEY, group_id, self._event("del", group_id, rid=expected),
+                                                 expected)
+            except Exception as e:
+                self._redis_error("解散房间", e)
+            else:
+                room_info = self._drop_local(group_id, room_id)
+                # 已被其他 worker 解散（或群里换成了新房间）时只清掉本地旧副本，不算本次解散
+                return room_info if removed else None
+        return self._drop_local(group_id, room_id)
+
+    async def join(self, group_id: str, user_id: str) -> bool:
+        """加入房间；房间不存在或已是成员时返回 False"""
+        if self.use_redis:
+            try:
+                result = await self._redis.eval(self._JOIN_LUA, 2, self._room_key(group_id), self._INDEX_KEY,
+                                                group_id, user_id, self._event("join", group_id, user_id))
+            except Exception as e:
+                self._redis_error("加入房间", e)
+            else:
+                if result >= 0 and await self.get(group_id) is not None:
+                    self._join_local(group_id, user_id)
+                return result == 1
+        return self._join_local(group_id, user_id)
+
+    async def leave(self, group_id: str, user_id: str) -> bool:
+        if self.use_redis:
+            try:
+                result = await self._redis.eval(self._LEAVE_LUA, 1, self._INDEX_KEY,
+                                                group_id, user_id, self._event("leave", group_id, user_id))
+            except Exception as e:
+                self._redis_error("离开房间", e)
+            else:
+                self._leave_local(group_id, user_id)
+                return result == 1
+        return self._leave_local(group_id, user_id)
+
+    async def leave_all(self, user_id: str, reason: str = "") -> List[str]:
+        """
+        把用户从其所在的所有房间移除，返回离开的 group_id 列表。
+        只移除成员，不解散房间，房间是否解散由业务消息控制（如 temp_room_owner_leave）。
+        """
+        if self.use_redis:
+            try:
+                groups = await self._redis.eval(self._LEAVE_ALL_LUA, 1, self._INDEX_KEY, user_id,
+                                                self._event("leave_all", "", user_id, reason=reason))
+            except Exception as e:
+                self._redis_error("离开全部房间", e)
+            else:
+                left = self._leave_all_local(user_id, reason)
+                return list(dict.fromkeys([*left, *groups]))
+        return self._leave_all_local(user_id, reason)
+
+    def rooms_of(self, user_id: str) -> List[str]:
+        with self._lock:
+            return list(self._user_rooms.get(user_id, ()))
+
+    def is_member(self, group_id: str, user_id: str) -> bool:
+        room_info = self.rooms.get(group_id)
+        return room_info is not None and user_id in room_info["members"]
+
+    def members(self, group_id: str) -> List[str]:
+        """成员列表副本（可直接 JSON 序列化）"""
+        with self._lock:
+            room_info = self.rooms.get(group_id)
+            return list(room_info["members"]) if room_info else []
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {"redis": self.use_redis, "synced": self.synced.is_set(), "rooms": len(self.rooms),
+                "members": sum(len(room_info["members"]) for room_info in list(self.rooms.values())),
+                "indexed_users": len(self._user_rooms), **self.stats}
+
+
+temp_rooms = TempRoomRegistry(active_temp_rooms)
+
+
+@app.get("/metrics/temp_rooms")
+async def temp_rooms_metrics():
+    """临时房间表：房间数、成员数，开启 Redis 时的同步状态、回查与事件统计"""
+    return JSONResponse({"data": temp_rooms.snapshot(), "code": 200})
+
+
+def load_temp_rooms_from_db(missing: List[str]) -> List[Dict[str, Any]]:
+    """/temp_rooms/query 内存中没有的群，查数据库中仍活跃（status=1）的房间及成员；在数据库线程池中执行"""
+    results = []
+    connection = get_db_connection()
+    if connection and connection.is_connected():
+        print(f"[temp_rooms/query] ✅ 数据库连接成功，开始查询")
+        app_logger.info(f"[temp_rooms/query] ✅ 数据库连接成功，开始查询")
+        try:
+            cursor = connection.cursor(dictionary=True)
+            query = """
+                SELECT room_id, group_id, owner_id, owner_name, owner_icon,
+                       whip_url, whep_url, stream_name, status, create_time
+                FROM temp_voice_rooms
+                WHERE status = 1 AND group_id IN ({})
+            """.format(", ".join(["%s"] * len(missing)))
+            print(f"[temp_rooms/query] 执行SQL查询: {query[:200]}... (参数: {missing})")
+            app_logger.info(f"[temp_rooms/query] 执行SQL查询，参数: {missing}")
+            cursor.execute(query, missing)
+            rows = cursor.fetchall() or []
+            print(f"[temp_rooms/query] 数据库查询结果: 找到 {len(rows)} 条记录")
+            app_logger.info(f"[temp_rooms/query] 数据库查询结果: 找到 {len(rows)} 条记录")
+
+            # 拉取成员
+            room_ids = [r.get("room_id") for r in rows if r.get("room_id")]
+            print(f"[temp_rooms/query] 需要查询成员的 room_ids: {room_ids} (数量: {len(room_ids)})")
+            app_logger.info(f"[temp_rooms/query] 需要查询成员的 room_ids: {room_ids} (数量: {len(room_ids)})")
+            
+            members_map: Dict[str, list] = {}
+            if room_ids:
+                member_query = """
+                    SELECT room_id, user_id
+                    FROM temp_voice_room_members
+                    WHERE status = 1 AND room_id IN ({})
+                """.format(", ".join(["%s"] * len(room_ids)))
+                print(f"[temp_rooms/query] 执行成员查询SQL: {member_query[:200]}... (参数: {room_ids})")
+                app_logger.info(f"[temp_rooms/query] 执行成员查询SQL，参数: {room_ids}")
+                cursor.execute(member_query, room_ids)
+                member_rows = cursor.fetchall() or []
+                print(f"[temp_rooms/query] 成员查询结果: 找到 {len(member_rows)} 条成员记录")
+                app_logger.info(f"[temp_rooms/query] 成员查询结果: 找到 {len(member_rows)} 条成员记录")
+                
+                for m in member_rows:
+                    rid = m.get("room_id")
+                    uid = m.get("user_id")
+                    if rid and uid:
+                        members_map.setdefault(rid, []).append(uid)
+                print(f"[temp_rooms/query] 成员映射结果: {json.dumps(members_map, ensure_ascii=False)}")
+                app_logger.info(f"[temp_rooms/query] 成员映射结果: {json.dumps(members_map, ensure_ascii=False)}")
+
+            db_results_count = 0
+            for r in rows:
+                gid = r.get("group_id")
+                stream = r.get("stream_name")
+                publish_url = f"{SRS_WEBRTC_API_URL}/rtc/v1/publish/?app={SRS_APP}&stream={stream}"
+                play_url = f"{SRS_WEBRTC_API_URL}/rtc/v1/play/?app={SRS_APP}&stream={stream}"
+                rid = r.get("room_id")
+                room_data = {
+                    "group_id": gid,
+                    "room_id": rid,
+                    "publish_url": publish_url,
+                    "play_url": play_url,
+                    "stream_name": stream,
+                    "owner_id": r.get("owner_id"),
+                    "owner_name": r.get("owner_name"),
+                    "owner_icon": r.get("owner_icon"),
+                    "members": members_map.get(rid, [])
+                }
+                results.append(room_data)
+                db_results_count += 1
+                print(f"[temp_rooms/query] ✅ 从数据库找到房间: group_id={gid}, room_id={rid}, members={len(members_map.get(rid, []))}")
+                app_logger.info(f"[temp_rooms/query] ✅ 从数据库找到房间: group_id={gid}, room_id={rid}, members={len(members_map.get(rid, []))}")
+            
+            print(f"[temp_rooms/query] 数据库查询完成，找到 {db_results_count} 个房间")
+        except Exception as db_error:
+            error_msg = f"数据库查询失败: {db_error}"
+            print(f"[temp_rooms/query] ❌ {error_msg}")
+            app_logger.error(f"[temp_rooms/query] ❌ {error_msg}", exc_info=True)
+        finally:
+            try:
+                if 'cursor' in locals() and cursor:
+                    cursor.close()
+                    print(f"[temp_rooms/query] ✅ 数据库游标已关闭")
+                if connection and connection.is_connected():
+                    connection.close()
+                    print(f"[temp_rooms/query] ✅ 数据库连接已关闭")
+            except Exception as close_error:
+                print(f"[temp_rooms/query] ⚠️ 关闭数据库资源时出错: {close_error}")
+                app_logger.warning(f"[temp_rooms/query] ⚠️ 关闭数据库资源时出错: {close_error}")
+    else:
+        error_msg = "数据库连接失败或未连接"
+        print(f"[temp_rooms/query] ❌ {error_msg}")
+        app_logger.error(f"[temp_rooms/query] ❌ {error_msg}")
+    return results
+
+
 @app.post("/temp_rooms/query")
 async def query_temp_rooms(request: Request):
     """
@@ -213,13 +841,14 @@ async def query_temp_rooms(request: Request):
     results = []
     memory_results_count = 0
 
-    # 先从内存 active_temp_rooms 读取
+    # 先从内存 active_temp_rooms 读取（开启 TEMP_ROOM_REDIS 时本地副本没有的再批量回查 Redis）
     print(f"[temp_rooms/query] 开始从内存 active_temp_rooms 查询，当前内存中的房间数: {len(active_temp_rooms)}")
     print(f"[temp_rooms/query] 内存中的房间 group_ids: {list(active_temp_rooms.keys())}")
     app_logger.info(f"[temp_rooms/query] 开始从内存查询，内存房间数: {len(active_temp_rooms)}, 查询的 group_ids: {group_ids}")
-    
+    memory_rooms = await temp_rooms.get_many(group_ids)
+
     for gid in group_ids:
-        room = active_temp_rooms.get(gid)
+        room = memory_rooms.get(gid)
         if room:
             memory_results_count += 1
             room_data = {
@@ -231,7 +860,7 @@ async def query_temp_rooms(request: Request):
                 "owner_id": room.get("owner_id"),
                 "owner_name": room.get("owner_name"),
                 "owner_icon": room.get("owner_icon"),
-                "members": room.get("members", [])
+                "members": temp_rooms.members(gid)
             }
             results.append(room_data)
             print(f"[temp_rooms/query] ✅ 从内存找到房间: group_id={gid}, room_id={room.get('room_id')}, members={len(room.get('members', []))}")
@@ -243,100 +872,12 @@ async def query_temp_rooms(request: Request):
     print(f"[temp_rooms/query] 内存查询完成，找到 {memory_results_count} 个房间")
 
     # 对于内存中不存在的，再查数据库（status=1）
-    missing = [gid for gid in group_ids if gid not in active_temp_rooms]
+    missing = [gid for gid in group_ids if gid not in memory_rooms]
     print(f"[temp_rooms/query] 需要从数据库查询的 group_ids: {missing} (数量: {len(missing)})")
     app_logger.info(f"[temp_rooms/query] 需要从数据库查询的 group_ids: {missing} (数量: {len(missing)})")
     
     if missing:
-        connection = get_db_connection()
-        if connection and connection.is_connected():
-            print(f"[temp_rooms/query] ✅ 数据库连接成功，开始查询")
-            app_logger.info(f"[temp_rooms/query] ✅ 数据库连接成功，开始查询")
-            try:
-                cursor = connection.cursor(dictionary=True)
-                query = """
-                    SELECT room_id, group_id, owner_id, owner_name, owner_icon,
-                           whip_url, whep_url, stream_name, status, create_time
-                    FROM temp_voice_rooms
-                    WHERE status = 1 AND group_id IN ({})
-                """.format(", ".join(["%s"] * len(missing)))
-                print(f"[temp_rooms/query] 执行SQL查询: {query[:200]}... (参数: {missing})")
-                app_logger.info(f"[temp_rooms/query] 执行SQL查询，参数: {missing}")
-                cursor.execute(query, missing)
-                rows = cursor.fetchall() or []
-                print(f"[temp_rooms/query] 数据库查询结果: 找到 {len(rows)} 条记录")
-                app_logger.info(f"[temp_rooms/query] 数据库查询结果: 找到 {len(rows)} 条记录")
-
-                # 拉取成员
-                room_ids = [r.get("room_id") for r in rows if r.get("room_id")]
-                print(f"[temp_rooms/query] 需要查询成员的 room_ids: {room_ids} (数量: {len(room_ids)})")
-                app_logger.info(f"[temp_rooms/query] 需要查询成员的 room_ids: {room_ids} (数量: {len(room_ids)})")
-                
-                members_map: Dict[str, list] = {}
-                if room_ids:
-                    member_query = """
-                        SELECT room_id, user_id
-                        FROM temp_voice_room_members
-                        WHERE status = 1 AND room_id IN ({})
-                    """.format(", ".join(["%s"] * len(room_ids)))
-                    print(f"[temp_rooms/query] 执行成员查询SQL: {member_query[:200]}... (参数: {room_ids})")
-                    app_logger.info(f"[temp_rooms/query] 执行成员查询SQL，参数: {room_ids}")
-                    cursor.execute(member_query, room_ids)
-                    member_rows = cursor.fetchall() or []
-                    print(f"[temp_rooms/query] 成员查询结果: 找到 {len(member_rows)} 条成员记录")
-                    app_logger.info(f"[temp_rooms/query] 成员查询结果: 找到 {len(member_rows)} 条成员记录")
-                    
-                    for m in member_rows:
-                        rid = m.get("room_id")
-                        uid = m.get("user_id")
-                        if rid and uid:
-                            members_map.setdefault(rid, []).append(uid)
-                    print(f"[temp_rooms/query] 成员映射结果: {json.dumps(members_map, ensure_ascii=False)}")
-                    app_logger.info(f"[temp_rooms/query] 成员映射结果: {json.dumps(members_map, ensure_ascii=False)}")
-
-                db_results_count = 0
-                for r in rows:
-                    gid = r.get("group_id")
-                    stream = r.get("stream_name")
-                    publish_url = f"{SRS_WEBRTC_API_URL}/rtc/v1/publish/?app={SRS_APP}&stream={stream}"
-                    play_url = f"{SRS_WEBRTC_API_URL}/rtc/v1/play/?app={SRS_APP}&stream={stream}"
-                    rid = r.get("room_id")
-                    room_data = {
-                        "group_id": gid,
-                        "room_id": rid,
-                        "publish_url": publish_url,
-                        "play_url": play_url,
-                        "stream_name": stream,
-                        "owner_id": r.get("owner_id"),
-                        "owner_name": r.get("owner_name"),
-                        "owner_icon": r.get("owner_icon"),
-                        "members": members_map.get(rid, [])
-                    }
-                    results.append(room_data)
-                    db_results_count += 1
-                    print(f"[temp_rooms/query] ✅ 从数据库找到房间: group_id={gid}, room_id={rid}, members={len(members_map.get(rid, []))}")
-                    app_logger.info(f"[temp_rooms/query] ✅ 从数据库找到房间: group_id={gid}, room_id={rid}, members={len(members_map.get(rid, []))}")
-                
-                print(f"[temp_rooms/query] 数据库查询完成，找到 {db_results_count} 个房间")
-            except Exception as db_error:
-                error_msg = f"数据库查询失败: {db_error}"
-                print(f"[temp_rooms/query] ❌ {error_msg}")
-                app_logger.error(f"[temp_rooms/query] ❌ {error_msg}", exc_info=True)
-            finally:
-                try:
-                    if 'cursor' in locals() and cursor:
-                        cursor.close()
-                        print(f"[temp_rooms/query] ✅ 数据库游标已关闭")
-                    if connection and connection.is_connected():
-                        connection.close()
-                        print(f"[temp_rooms/query] ✅ 数据库连接已关闭")
-                except Exception as close_error:
-                    print(f"[temp_rooms/query] ⚠️ 关闭数据库资源时出错: {close_error}")
-                    app_logger.warning(f"[temp_rooms/query] ⚠️ 关闭数据库资源时出错: {close_error}")
-        else:
-            error_msg = "数据库连接失败或未连接"
-            print(f"[temp_rooms/query] ❌ {error_msg}")
-            app_logger.error(f"[temp_rooms/query] ❌ {error_msg}")
+        results.extend(await run_db(load_temp_rooms_from_db, missing))
 
     # 构建响应
     response_data = {"data": {"rooms": results, "count": len(results)}, "code": 200}
@@ -350,87 +891,120 @@ async def query_temp_rooms(request: Request):
 
 
 
-def load_active_temp_rooms_from_db() -> None:
+def load_active_temp_rooms_from_db() -> int:
     """
-    应用启动时，从数据库加载仍然处于活跃状态的临时语音房间到内存 active_temp_rooms。
-    防止程序重启后丢失房间信息。
+    从数据库恢复仍处于活跃状态的临时语音房间到内存 active_temp_rooms，防止程序重启后丢失房间信息。
+    房间和在线成员用一条 LEFT JOIN 查出，不再每个房间单独查一次成员表，耗时不随房间数线性增长。
+    在数据库线程池中执行；返回恢复的房间数，数据库错误向上抛出由调用方重试。
     """
-    try:
-        connection = get_db_connection()
-        if connection is None or not connection.is_connected():
-            print("[temp_room][startup] 数据库连接失败，无法从数据库加载临时语音房间")
-            app_logger.error("[temp_room][startup] 数据库连接失败，无法从数据库加载临时语音房间")
-            return
-
+    with db_connection() as connection:
         cursor = connection.cursor(dictionary=True)
+        try:
+            # 按创建时间排序：同一个群有多条活跃记录时以最新的房间为准
+            cursor.execute("""
+                SELECT r.room_id, r.group_id, r.owner_id, r.owner_name, r.owner_icon,
+                       r.whip_url, r.whep_url, r.stream_name, m.user_id AS member_id
+                FROM temp_voice_rooms r
+                LEFT JOIN temp_voice_room_members m ON m.room_id = r.room_id AND m.status = 1
+                WHERE r.status = 1
+                ORDER BY r.create_time, r.room_id
+            """)
+            rows = cursor.fetchall() or []
+        finally:
+            cursor.close()
 
-        # 查询所有状态为活跃的临时语音房间
-        query_rooms = """
-            SELECT room_id, group_id, owner_id, owner_name, owner_icon,
-                   whip_url, whep_url, stream_name, status, create_time
-            FROM temp_voice_rooms
-            WHERE status = 1
-        """
-        cursor.execute(query_rooms)
-        rooms = cursor.fetchall() or []
-
-        if not rooms:
-            print("[temp_room][startup] 数据库中没有状态为活跃的临时语音房间")
-            app_logger.info("[temp_room][startup] 数据库中没有状态为活跃的临时语音房间")
-            return
+    rooms: Dict[str, Dict[str, Any]] = {}
+    for row in rows:
+        room_id = row.get("room_id")
+        if not room_id or not row.get("group_id") or not row.get("stream_name"):
+            continue
+        room = rooms.get(room_id)
+        if room is None:
+            room = rooms[room_id] = {**row, "members": []}
+            room.pop("member_id", None)
+        if row.get("member_id"):
+            room["members"].append(row["member_id"])
+
+    loaded_count = 0
+    for room in rooms.values():
+        group_id = room["group_id"]
+        stream_name = room["stream_name"]
+        # 根据 stream_name 重新生成传统 WebRTC 推流/拉流地址
+        publish_url = f"{SRS_WEBRTC_API_URL}/rtc/v1/publish/?app={SRS_APP}&stream={stream_name}"
+        play_url = f"{SRS_WEBRTC_API_URL}/rtc/v1/play/?app={SRS_APP}&stream={stream_name}"
+        # 恢复期间服务已在接收请求，群里新建的房间比库里的旧记录新，不覆盖
+        if temp_rooms.add_room_if_absent(group_id, {
+            "room_id": room["room_id"],
+            "publish_url": publish_url,
+            "play_url": play_url,
+            "whip_url": room.get("whip_url"),
+            "whep_url": room.get("whep_url"),
+            "stream_name": stream_name,
+            "owner_id": room.get("owner_id"),
+            "owner_name": room.get("owner_name"),
+            "owner_icon": room.get("owner_icon"),
+            "group_id": group_id,
+            "timestamp": time.time(),
+            "members": room["members"],
+        }):
+            loaded_count += 1
+    return loaded_count
 
-        loaded_count = 0
-        for room in rooms:
-            group_id = room.get("group_id")
-            room_id = room.get("room_id")
-            stream_name = room.get("stream_name")
-            if not group_id or not room_id or not stream_name:
-                continue
 
-            # 根据 stream_name 重新生成传统 WebRTC 推流/拉流地址
-            publish_url = f"{SRS_WEBRTC_API_URL}/rtc/v1/publish/?app={SRS_APP}&stream={stream_name}"
-            play_url = f"{SRS_WEBRTC_API_URL}/rtc/v1/play/?app={SRS_APP}&stream={stream_name}"
+TEMP_ROOM_HYDRATE_RETRIES = int(os.getenv("TEMP_ROOM_HYDRATE_RETRIES", "3"))  # 启动恢复临时房间失败时的重试次数
 
-            # 查询房间成员
-            members_query = """
-                SELECT user_id, user_name, status
-                FROM temp_voice_room_members
-                WHERE room_id = %s AND status = 1
-            """
-            cursor.execute(members_query, (room_id,))
-            member_rows = cursor.fetchall() or []
-            members = [m.get("user_id") for m in member_rows if m.get("user_id")]
 
-            active_temp_rooms[group_id] = {
-                "room_id": room_id,
-                "publish_url": publish_url,
-                "play_url": play_url,
-                "whip_url": room.get("whip_url"),
-                "whep_url": room.get("whep_url"),
-                "stream_name": stream_name,
-                "owner_id": room.get("owner_id"),
-                "owner_name": room.get("owner_name"),
-                "owner_icon": room.get("owner_icon"),
-                "group_id": group_id,
-                "timestamp": time.time(),
-                "members": members,
-            }
-            loaded_count += 1
+class TempRoomHydration:
+    """
+    启动时在后台恢复临时语音房间，lifespan 不再等它，服务立即开始接收连接。
+    恢复完成（或重试用尽）前 /readyz 返回 503，负载均衡据此在恢复完成后才把流量切过来；
+    这期间 /temp_rooms/query 对内存里没有的群仍会回查数据库。
+    """
 
-        print(f"[temp_room][startup] 已从数据库加载 {loaded_count} 个临时语音房间到内存")
-        app_logger.info(f"[temp_room][startup] 已从数据库加载 {loaded_count} 个临时语音房间到内存")
+    def __init__(self):
+        self.done = asyncio.Event()
+        self.rooms = 0
+        self.attempts = 0
+        self.elapsed_ms: Optional[float] = None
+        self.error: Optional[str] = None
 
-    except Exception as e:
-        print(f"[temp_room][startup] 从数据库加载临时语音房间失败: {e}")
-        app_logger.error(f"[temp_room][startup] 从数据库加载临时语音房间失败: {e}", exc_info=True)
-    finally:
+    async def run(self) -> None:
+        started = time.perf_counter()
         try:
-            if 'cursor' in locals() and cursor:
-                cursor.close()
-            if 'connection' in locals() and connection and connection.is_connected():
-                connection.close()
-        except Exception:
-            pass
+            for attempt in range(1, TEMP_ROOM_HYDRATE_RETRIES + 2):
+                self.attempts = attempt
+                try:
+                    self.rooms = await run_db(load_active_temp_rooms_from_db)
+                    self.error = None
+                    break
+                except Exception as e:
+                    self.error = str(e)
+                    app_logger.error(f"[temp_room][startup] 从数据库加载临时语音房间失败（第 {attempt} 次）: {e}")
+                    if attempt <= TEMP_ROOM_HYDRATE_RETRIES:
+                        await asyncio.sleep(min(2 ** attempt, 10))
+        finally:
+            self.elapsed_ms = round((time.perf_counter() - started) * 1000, 1)
+            self.done.set()
+        print(f"[temp_room][startup] 已从数据库加载 {self.rooms} 个临时语音房间到内存，耗时 {self.elapsed_ms}ms")
+        app_logger.info(f"[temp_room][startup] 已从数据库加载 {self.rooms} 个临时语音房间到内存，"
+                        f"耗时 {self.elapsed_ms}ms，尝试 {self.attempts} 次，error={self.error}")
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {"done": self.done.is_set(), "rooms": self.rooms, "attempts": self.attempts,
+                "elapsed_ms": self.elapsed_ms, "error": self.error}
+
+
+temp_room_hydration = TempRoomHydration()
+
+
+@app.get("/readyz")
+async def readyz():
+    """就绪检查：临时房间恢复完成（开启 Redis 时副本已同步）且没有在排空时返回 200，否则 503"""
+    checks = {"temp_rooms_hydrated": temp_room_hydration.done.is_set(), "temp_rooms_synced": temp_rooms.synced.is_set(),
+              "draining": drainer.draining}
+    ready = checks["temp_rooms_hydrated"] and checks["temp_rooms_synced"] and not checks["draining"]
+    return JSONResponse({"data": {"ready": ready, **checks, "hydration": temp_room_hydration.snapshot()},
+                         "code": 200 if ready else 503}, status_code=200 if ready else 503)
 
 
 async def notify_temp_room_closed(group_id: str, room_info: Dict[str, Any], reason: str, initiator: str):
@@ -454,17 +1028,13 @@ async def notify_temp_room_closed(group_id: str, room_info: Dict[str, Any], reas
         "initiator": initiator,
         "message": "临时房间已解散，请立即停止推流/拉流"
     }
-    notification_json = json.dumps(notification, ensure_ascii=False)
 
-    for member_id in members_snapshot:
-        target_conn = connections.get(member_id)
-        if not target_conn:
-            continue
-        try:
-            await target_conn["ws"].send_text(notification_json)
-            app_logger.info(f"[temp_room] 已通知成员停止推拉流 - group_id={group_id}, member_id={member_id}, reason={reason}")
-        except Exception as notify_error:
-            app_logger.warning(f"[temp_room] 通知成员停止推拉流失败 - group_id={group_id}, member_id={member_id}, error={notify_error}")
+    targets = await hub.lookup_many(members_snapshot)
+    if not targets:
+        return
+    result = await hub.fan_out(targets, notification)
+    app_logger.info(f"[temp_room] 已通知成员停止推拉流 - group_id={group_id}, reason={reason}, 在线={result.recipients}, "
+                    f"成功={result.delivered}, 失败={result.failed}, 超时={result.timed_out}, 耗时={result.elapsed_ms:.1f}ms")
 
 if not os.path.exists('logs'):
     os.makedirs('logs')
@@ -494,10 +1064,11 @@ app_logger.addHandler(file_handler)
 app_logger.propagate = False
 
 DB_CONFIG = {
-    'host': 'rm-uf65y451aa995i174io.mysql.rds.aliyuncs.com',
-    'database': 'teacher_assistant',
-    'user': 'ta_user',
-    'password': 'Ta_0909DB&'
+    'host': os.getenv('DB_HOST', 'rm-uf65y451aa995i174io.mysql.rds.aliyuncs.com'),
+    'port': int(os.getenv('DB_PORT', '3306')),
+    'database': os.getenv('DB_NAME', 'teacher_assistant'),
+    'user': os.getenv('DB_USER', 'ta_user'),
+    'password': os.getenv('DB_PASSWORD', 'Ta_0909DB&')
 }
 
 # 短信服务配置 (模拟)
@@ -812,64 +1383,648 @@ def resolve_local_avatar_file_path(avatar_path: Optional[str]) -> Optional[str]:
 def safe_json_response(data: dict, status_code: int = 200):
     return JSONResponse(jsonable_encoder(data), status_code=status_code)
 
+# ===== 数据库连接池 =====
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))  # 常驻连接数
+DB_POOL_MAX_OVERFLOW = int(os.getenv("DB_POOL_MAX_OVERFLOW", "20"))  # 高峰期允许额外创建的连接数，归还时关闭
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "5"))  # 借用连接最长等待秒数，超时抛 PoolError
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "3600"))  # 连接最长存活秒数，超过后借出前重建
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() == "true"  # 借出前是否检查连接可用
+DB_POOL_PING_INTERVAL = float(os.getenv("DB_POOL_PING_INTERVAL", "30"))  # 空闲超过该秒数才 ping，避免每次借用多一次往返
+DB_POOL_LEASE_WARN = float(os.getenv("DB_POOL_LEASE_WARN", "10"))  # 单次借用超过该秒数记录告警
+
+
+class PooledDBConnection:
+    """
+    池化连接包装：close() 把连接归还到连接池而不是断开，其余属性透传给真实连接。
+    调用方沿用原来的 get_db_connection() / connection.close() 写法即可。
+    忘记 close() 的包装被回收时由 finalizer 关闭真实连接并释放名额，泄漏的连接不会永久占住连接池。
+    """
+
+    def __init__(self, pool: "DBConnectionPool", raw, created_at: float):
+        self._pool = pool
+        self._raw = raw
+        self._created_at = created_at
+        self._leased_at = time.monotonic()
+        self._released = False
+        # finalizer 不能引用 self，只持有连接池和真实连接
+        self._finalizer = weakref.finalize(self, pool._reclaim_leaked, raw, self._leased_at)
+
+    def __getattr__(self, name):
+        return getattr(self._raw, name)
+
+    def is_connected(self) -> bool:
+        if self._released:
+            return False
+        try:
+            return self._raw.is_connected()
+        except Exception:
+            return False
+
+    def close(self) -> None:
+        # 重复 close 直接忽略，兼容各处 finally 里的多次关闭
+        if self._released:
+            return
+        self._released = True
+        self._finalizer.detach()
+        self._pool._release(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+
+class DBConnectionPool:
+    """
+    线程安全的 MySQL 连接池。
+    - size: 常驻空闲连接上限；max_overflow: 峰值时额外允许的连接数
+    - timeout: 池满时借用的最长等待时间
+    - recycle / pre_ping: 借出前重建过期连接、探活空闲较久的连接
+    """
+
+    def __init__(self, config: Dict[str, Any], size: int, max_overflow: int, timeout: float,
+                 recycle: int, pre_ping: bool, ping_interval: float):
+        self._config = dict(config)
+        self._size = max(1, size)
+        self._max_overflow = max(0, max_overflow)
+        self._timeout = timeout
+        self._recycle = recycle
+        self._pre_ping = pre_ping
+        self._ping_interval = ping_interval
+        self._idle = deque()  # [(raw, created_at, last_used)]，后进先出，热连接优先复用
+        self._cond = threading.Condition()
+        self._total = 0  # 已创建且未关闭的连接数（空闲 + 借出）
+        self._in_use = 0
+        self._stats = {
+            "acquires": 0,
+            "waits": 0,
+            "wait_ms_total": 0.0,
+            "wait_ms_max": 0.0,
+            "timeouts": 0,
+            "created": 0,
+            "recycled": 0,
+            "ping_failures": 0,
+            "discarded": 0,
+            "leaked": 0,
+            "hold_ms_max": 0.0,
+        }
+
+    def _connect(self):
+        return mysql.connector.connect(**self._config)
+
+    def acquire(self, timeout: Optional[float] = None) -> PooledDBConnection:
+        """借用一个连接；池满且等待超时抛 PoolError，建连失败抛 mysql.connector.Error。"""
+        timeout = self._timeout if timeout is None else timeout
+        start = time.monotonic()
+        deadline = start + timeout
+        waited = False
+        idle_entry = None
+        with self._cond:
+            while True:
+                if self._idle:
+                    idle_entry = self._idle.pop()
+                    break
+                if self._total < self._size + self._max_overflow:
+                    self._total += 1  # 先占位，锁外建连
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._stats["timeouts"] += 1
+                    raise PoolError(f"数据库连接池已耗尽（等待 {timeout:.1f}s 超时，total={self._total}）")
+                waited = True
+                self._cond.wait(remaining)
+            self._in_use += 1
+            wait_ms = (time.monotonic() - start) * 1000
+            self._stats["acquires"] += 1
+            if waited:
+                self._stats["waits"] += 1
+            self._stats["wait_ms_total"] += wait_ms
+            if wait_ms > self._stats["wait_ms_max"]:
+                self._stats["wait_ms_max"] = wait_ms
+
+        try:
+            raw, created_at = self._checkout(idle_entry)
+        except Exception:
+            with self._cond:
+                self._in_use -= 1
+                self._total -= 1
+                self._cond.notify()
+            raise
+        return PooledDBConnection(self, raw, created_at)
+
+    def _checkout(self, idle_entry):
+        """校验空闲连接（过期重建、空闲过久 ping），没有空闲连接时新建。"""
+        now = time.monotonic()
+        if idle_entry is not None:
+            raw, created_at, last_used = idle_entry
+            if self._recycle > 0 and now - created_at > self._recycle:
+                self._bump("recycled")
+                self._close_quietly(raw)
+            elif self._pre_ping and now - last_used > self._ping_interval:
+                try:
+                    raw.ping(reconnect=False)
+                    return raw, created_at
+                except Exception as e:
+                    self._bump("ping_failures")
+                    app_logger.warning(f"[db_pool] 空闲连接探活失败，重建连接: {e}")
+                    self._close_quietly(raw)
+            else:
+                return raw, created_at
+        raw = self._connect()
+        self._bump("created")
+        return raw, time.monotonic()
+
+    def _bump(self, key: str) -> None:
+        # _checkout 在锁外建连/探活，计数仍要在锁内累加，避免多线程并发 += 丢失更新
+        with self._cond:
+            self._stats[key] += 1
+
+    def _release(self, pooled: PooledDBConnection) -> None:
+        raw = pooled._raw
+        hold_ms = (time.monotonic() - pooled._leased_at) * 1000
+        reusable = True
+        try:
+            if raw.is_connected():
+                # 丢弃未读结果并回滚未提交事务，保证下一个借用者拿到干净的会话
+                if getattr(raw, "unread_result", False):
+                    raw.consume_results()
+                raw.rollback()
+            else:
+                reusable = False
+        except Exception:
+            reusable = False
+
+        to_close = None
+        with self._cond:
+            self._in_use -= 1
+            if hold_ms > self._stats["hold_ms_max"]:
+                self._stats["hold_ms_max"] = hold_ms
+            if reusable and len(self._idle) < self._size:
+                self._idle.append((raw, pooled._created_at, time.monotonic()))
+            else:
+                self._total -= 1
+                if not reusable:
+                    self._stats["discarded"] += 1
+                to_close = raw
+            self._cond.notify()
+        if to_close is not None:
+            self._close_quietly(to_close)
+        if hold_ms > DB_POOL_LEASE_WARN * 1000:
+            app_logger.warning(f"[db_pool] 连接借用时间过长: {hold_ms:.0f}ms")
+
+    def _reclaim_leaked(self, raw, leased_at: float) -> None:
+        """借出的连接没有 close() 就被回收：会话状态未知（可能有未提交事务），直接断开并释放名额"""
+        with self._cond:
+            self._in_use -= 1
+            self._total -= 1
+            self._stats["leaked"] += 1
+            self._cond.notify()
+        self._close_quietly(raw)
+        app_logger.warning(f"[db_pool] 回收未归还的连接，借出 {time.monotonic() - leased_at:.1f}s，请检查调用方是否漏了 close()")
+
+    @staticmethod
+    def _close_quietly(raw) -> None:
+        try:
+            raw.close()
+        except Exception:
+            pass
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            acquires = self._stats["acquires"]
+            return {
+                "size": self._size,
+                "max_overflow": self._max_overflow,
+                "total": self._total,
+                "idle": len(self._idle),
+                "in_use": self._in_use,
+                "overflow": max(0, self._total - self._size),
+                "acquires": acquires,
+                "waits": self._stats["waits"],
+                "timeouts": self._stats["timeouts"],
+                "wait_ms_avg": round(self._stats["wait_ms_total"] / acquires, 3) if acquires else 0.0,
+                "wait_ms_max": round(self._stats["wait_ms_max"], 3),
+                "hold_ms_max": round(self._stats["hold_ms_max"], 3),
+                "created": self._stats["created"],
+                "recycled": self._stats["recycled"],
+                "ping_failures": self._stats["ping_failures"],
+                "discarded": self._stats["discarded"],
+                "leaked": self._stats["leaked"],
+            }
+
+
+db_pool = DBConnectionPool(
+    DB_CONFIG,
+    size=DB_POOL_SIZE,
+    max_overflow=DB_POOL_MAX_OVERFLOW,
+    timeout=DB_POOL_TIMEOUT,
+    recycle=DB_POOL_RECYCLE,
+    pre_ping=DB_POOL_PRE_PING,
+    ping_interval=DB_POOL_PING_INTERVAL,
+)
+
+
 def get_db_connection():
-    """获取数据库连接"""
+    """从连接池借用数据库连接，用完调用 close() 归还；失败返回 None"""
     try:
-        connection = mysql.connector.connect(**DB_CONFIG)
-        app_logger.info("Database connection established.")
-        return connection
+        return db_pool.acquire()
     except Error as e:
         app_logger.error(f"Error connecting to MySQL: {e}")
         return None
 
 
-def build_tencent_request_url(
-    identifier: Optional[str] = None,
-    usersig: Optional[str] = None,
-    *,
-    url_override: Optional[str] = None,
-    path_override: Optional[str] = None,
-    base_override: Optional[str] = None
-) -> Optional[str]:
+@contextmanager
+def db_connection():
     """
-    生成腾讯 REST API 的完整请求 URL。
-    优先使用 TENCENT_API_URL，其次使用 base + path + query 参数。
+    with db_connection() as connection: 借用池化连接，退出 with 自动归还。
+    池耗尽或数据库不可用时抛出 mysql.connector.Error。
     """
-    if url_override is not None:
-        selected_url = url_override
-    elif path_override is not None:
-        selected_url = None
-    else:
-        selected_url = TENCENT_API_URL
-    selected_base = base_override or TENCENT_API_BASE_URL
-    selected_path = path_override if path_override is not None else TENCENT_API_PATH
+    connection = db_pool.acquire()
+    try:
+        yield connection
+    finally:
+        connection.close()
 
-    effective_identifier = identifier or TENCENT_API_IDENTIFIER
-    effective_usersig = usersig or TENCENT_API_USER_SIG
 
-    extra_query: Dict[str, str] = {}
+def call_with_connection_released(connection: "PooledDBConnection", func, *args, **kwargs):
+    """
+    同步路由里调用腾讯IM 等外部 HTTP 接口前先把连接还给连接池，调用结束后重新借一个，
+    网络等待期间不占用连接。返回 (func 的结果, 新连接)，重新借用失败时新连接为 None。
+    归还时连接池会回滚未提交的事务，只能在还没有写入时调用；旧连接上的游标随之失效，需要重新创建。
+    """
+    connection.close()
+    result = func(*args, **kwargs)
+    return result, get_db_connection()
 
-    if selected_url:
-        parsed = urllib.parse.urlparse(selected_url)
-        if parsed.scheme and parsed.netloc:
-            existing_query = urllib.parse.parse_qs(parsed.query, keep_blank_values=True)
 
-            def pick_single(values):
-                if isinstance(values, list):
-                    return values[0] if values else ""
-                return values
+class LazyDBConnection:
+    """
+    按需借用的数据库连接：查库用 await run(func, ...)（或先 await lease()）从连接池借出，release() 归还。
+    WebSocket 会话在每条消息处理完后归还，持有的连接数随消息速率增长，而不是随在线人数。
+    借用（等待空闲连接、pre-ping、建连）放到线程里做，不阻塞事件循环；
+    未 lease() 就直接访问连接属性时退回同步借用，但不等待（池满立即抛 PoolError）。
+    """
 
-            normalized_query: Dict[str, str] = {k: pick_single(v) for k, v in existing_query.items()}
+    def __init__(self):
+        self._conn: Optional[PooledDBConnection] = None
 
-            def ensure_query_param(key: str, value: Optional[str], force: bool = False):
-                if value is not None:
-                    if force or (key not in normalized_query or not normalized_query[key]):
-                        normalized_query[key] = value
+    async def lease(self) -> PooledDBConnection:
+        if self._conn is None:
+            # 不走 run_db：数据库线程池满载时借连接不应排在它们后面，由 DB_POOL_LOOP_RESERVE 预留的连接兜底
+            fut = asyncio.ensure_future(asyncio.to_thread(db_pool.acquire))
+            try:
+                self._conn = await asyncio.shield(fut)
+            except asyncio.CancelledError:
+                # 会话被取消时线程里的借用仍会完成，借到后立即归还
+                fut.add_done_callback(lambda f: f.cancelled() or f.exception() or f.result().close())
+                raise
+        return self._conn
 
-            ensure_query_param("sdkappid", TENCENT_API_SDK_APP_ID)
-            # 强制覆盖 identifier 和 usersig，确保使用传入的值
-            ensure_query_param("identifier", effective_identifier, force=True)
-            ensure_query_param("usersig", effective_usersig, force=True)
+    def _lease(self) -> PooledDBConnection:
+        if self._conn is None:
+            self._conn = db_pool.acquire(timeout=0)
+        return self._conn
+
+    async def run(self, func, *args, **kwargs):
+        """
+        借出连接后在数据库线程池中执行 func(connection, *args, **kwargs)，查询和提交都不在事件循环上做。
+        会话被取消时线程里的 func 可能还在用这个连接，等它结束后再归还，不能让 release() 提前还给连接池。
+        """
+        conn = await self.lease()
+        fut = asyncio.ensure_future(run_db(func, conn, *args, **kwargs))
+        try:
+            return await asyncio.shield(fut)
+        except asyncio.CancelledError:
+            self._conn = None
+
+            def _return(f: asyncio.Future) -> None:
+                if not f.cancelled():
+                    f.exception()  # 取走异常，避免 "exception was never retrieved"
+                conn.close()
+
+            fut.add_done_callback(_return)
+            raise
+
+    def __getattr__(self, name):
+        return getattr(self._lease(), name)
+
+    def is_connected(self) -> bool:
+        # 未借出时视为未连接，避免 rollback/close 之类的清理代码为此专门借一个连接
+        return self._conn is not None and self._conn.is_connected()
+
+    def release(self) -> None:
+        if self._conn is not None:
+            conn, self._conn = self._conn, None
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                conn.close()
+                return
+            # 归还时连接池要 rollback 一次（网络往返），同样放到线程里做
+            fut = loop.run_in_executor(None, conn.close)
+            fut.add_done_callback(lambda f: f.cancelled() or f.exception())
+
+
+@app.get("/metrics/db_pool")
+async def db_pool_metrics():
+    """数据库连接池状态与借用等待统计"""
+    return JSONResponse({"data": db_pool.stats(), "code": 200})
+
+
+# ===== 数据库专用线程池：同步 mysql.connector 调用不再阻塞事件循环 =====
+DB_POOL_LOOP_RESERVE = int(os.getenv("DB_POOL_LOOP_RESERVE", "4"))  # 给 WebSocket 会话（LazyDBConnection）预留的连接数
+# 每个线程最多持有一个连接，线程数小于连接池上限，线程池打满时 WebSocket 会话仍有连接可借
+DB_EXECUTOR_WORKERS = int(os.getenv(
+    "DB_EXECUTOR_WORKERS", str(max(1, DB_POOL_SIZE + DB_POOL_MAX_OVERFLOW - DB_POOL_LOOP_RESERVE))
+))
+DB_EXECUTOR_MAX_QUEUE = int(os.getenv("DB_EXECUTOR_MAX_QUEUE", "200"))  # 排队任务上限，超过直接拒绝（503）
+LOOP_LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", "0.5"))  # 事件循环延迟采样间隔（秒）
+LOOP_LAG_WARN_MS = float(os.getenv("LOOP_LAG_WARN_MS", "200"))  # 单次延迟超过该值记录告警
+
+
+class DBExecutorBusy(Exception):
+    """数据库线程池排队已满"""
+
+
+class DBExecutor:
+    """有界的数据库线程池：执行中 + 排队任务数超过上限时立即拒绝，而不是无限堆积。"""
+
+    def __init__(self, workers: int, max_queue: int):
+        self._workers = max(1, workers)
+        self._max_queue = max(0, max_queue)
+        self._executor = ThreadPoolExecutor(max_workers=self._workers, thread_name_prefix="db")
+        self._lock = threading.Lock()
+        self._pending = 0  # 已提交未完成（排队 + 执行中）
+        self._running = 0
+        self._stats = {
+            "submitted": 0,
+            "rejected": 0,
+            "pending_max": 0,
+            "queue_ms_total": 0.0,
+            "queue_ms_max": 0.0,
+            "run_ms_max": 0.0,
+        }
+
+    async def run(self, func, *args, **kwargs):
+        with self._lock:
+            if self._pending >= self._workers + self._max_queue:
+                self._stats["rejected"] += 1
+                raise DBExecutorBusy(f"数据库线程池繁忙（pending={self._pending}）")
+            self._pending += 1
+            self._stats["submitted"] += 1
+            if self._pending > self._stats["pending_max"]:
+                self._stats["pending_max"] = self._pending
+        submitted_at = time.monotonic()
+
+        def call():
+            started_at = time.monotonic()
+            with self._lock:
+                self._running += 1
+                queue_ms = (started_at - submitted_at) * 1000
+                self._stats["queue_ms_total"] += queue_ms
+                if queue_ms > self._stats["queue_ms_max"]:
+                    self._stats["queue_ms_max"] = queue_ms
+            try:
+                return func(*args, **kwargs)
+            finally:
+                run_ms = (time.monotonic() - started_at) * 1000
+                with self._lock:
+                    self._running -= 1
+                    self._pending -= 1
+                    if run_ms > self._stats["run_ms_max"]:
+                        self._stats["run_ms_max"] = run_ms
+
+        return await asyncio.get_running_loop().run_in_executor(self._executor, call)
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=False)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            submitted = self._stats["submitted"]
+            return {
+                "workers": self._workers,
+                "max_queue": self._max_queue,
+                "running": self._running,
+                "queued": self._pending - self._running,
+                "pending_max": self._stats["pending_max"],
+                "submitted": submitted,
+                "rejected": self._stats["rejected"],
+                "queue_ms_avg": round(self._stats["queue_ms_total"] / submitted, 3) if submitted else 0.0,
+                "queue_ms_max": round(self._stats["queue_ms_max"], 3),
+                "run_ms_max": round(self._stats["run_ms_max"], 3),
+            }
+
+
+db_executor = DBExecutor(DB_EXECUTOR_WORKERS, DB_EXECUTOR_MAX_QUEUE)
+
+
+async def run_db(func, *args, **kwargs):
+    """在数据库线程池中执行同步函数（func 内部自行 get_db_connection）"""
+    return await db_executor.run(func, *args, **kwargs)
+
+
+class BufferedRequest:
+    """
+    已在事件循环上读完请求体的 Request 替身，供线程池中的同步路由使用：
+    json()/body() 改为同步方法，其它属性（query_params、headers、client...）透传原请求。
+    """
+
+    def __init__(self, request: Request, body: bytes):
+        self._request = request
+        self._body = body
+
+    @classmethod
+    async def load(cls, request: Request) -> "BufferedRequest":
+        return cls(request, await request.body())
+
+    def body(self) -> bytes:
+        return self._body
+
+    def json(self):
+        return json.loads(self._body)
+
+    def __getattr__(self, name):
+        return getattr(self._request, name)
+
+
+def offload_db(func):
+    """
+    路由装饰器：被装饰的同步实现在数据库线程池中执行，不阻塞事件循环。
+    Request 参数会先在事件循环上读完请求体并替换为 BufferedRequest（request.json() 不需要 await）。
+    用法：
+        @app.post("/login")
+        @offload_db
+        def login(request: Request): ...
+    """
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        args = [await BufferedRequest.load(a) if isinstance(a, Request) else a for a in args]
+        for key, value in list(kwargs.items()):
+            if isinstance(value, Request):
+                kwargs[key] = await BufferedRequest.load(value)
+        return await run_db(func, *args, **kwargs)
+    return wrapper
+
+
+@app.exception_handler(DBExecutorBusy)
+async def db_executor_busy_handler(request: Request, exc: DBExecutorBusy):
+    app_logger.warning(f"[db_executor] 拒绝请求 {request.url.path}: {exc}")
+    return JSONResponse({'data': {'message': '服务繁忙，请稍后重试', 'code': 503}}, status_code=503)
+
+
+class LoopLagMonitor:
+    """周期性 sleep 并测量实际唤醒延迟，反映事件循环被同步代码阻塞的程度。"""
+
+    def __init__(self, interval: float, window: int = 600):
+        self._interval = interval
+        self._samples = deque(maxlen=window)
+        self._max_ms = 0.0
+
+    async def run(self) -> None:
+        loop = asyncio.get_running_loop()
+        try:
+            while not stop_event.is_set():
+                start = loop.time()
+                await asyncio.sleep(self._interval)
+                lag_ms = max(0.0, (loop.time() - start - self._interval) * 1000)
+                self._samples.append(lag_ms)
+                if lag_ms > self._max_ms:
+                    self._max_ms = lag_ms
+                if lag_ms > LOOP_LAG_WARN_MS:
+                    app_logger.warning(f"[loop_lag] 事件循环延迟 {lag_ms:.1f}ms")
+        except asyncio.CancelledError:
+            pass
+
+    def stats(self) -> Dict[str, Any]:
+        samples = sorted(self._samples)
+        if not samples:
+            return {"samples": 0, "interval_s": self._interval}
+        return {
+            "samples": len(samples),
+            "interval_s": self._interval,
+            "last_ms": round(self._samples[-1], 3),
+            "p50_ms": round(samples[len(samples) // 2], 3),
+            "p99_ms": round(samples[min(len(samples) - 1, int(len(samples) * 0.99))], 3),
+            "max_ms": round(self._max_ms, 3),
+        }
+
+
+loop_lag_monitor = LoopLagMonitor(LOOP_LAG_INTERVAL)
+
+
+class LatencyHistogram:
+    """固定桶（毫秒）的耗时直方图，分位数按桶上界估算，observe 为 O(桶数)"""
+
+    BOUNDS_MS = (0.5, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BOUNDS_MS) + 1)
+        self.total = 0
+        self.sum_ms = 0.0
+        self.max_ms = 0.0
+
+    def observe(self, ms: float) -> None:
+        index = 0
+        for bound in self.BOUNDS_MS:
+            if ms <= bound:
+                break
+            index += 1
+        self.counts[index] += 1
+        self.total += 1
+        self.sum_ms += ms
+        if ms > self.max_ms:
+            self.max_ms = ms
+
+    def _quantile(self, q: float) -> float:
+        rank = q * self.total
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return self.BOUNDS_MS[index] if index < len(self.BOUNDS_MS) else round(self.max_ms, 3)
+        return round(self.max_ms, 3)
+
+    def snapshot(self) -> Dict[str, Any]:
+        if not self.total:
+            return {"count": 0}
+        return {
+            "count": self.total,
+            "avg_ms": round(self.sum_ms / self.total, 3),
+            "p50_ms": self._quantile(0.5),
+            "p95_ms": self._quantile(0.95),
+            "p99_ms": self._quantile(0.99),
+            "max_ms": round(self.max_ms, 3),
+        }
+
+
+@app.get("/metrics/db_executor")
+async def db_executor_metrics():
+    """数据库线程池排队与执行统计"""
+    return JSONResponse({"data": db_executor.stats(), "code": 200})
+
+
+@app.get("/metrics/loop_lag")
+async def loop_lag_metrics():
+    """事件循环延迟（最近采样窗口）"""
+    return JSONResponse({"data": loop_lag_monitor.stats(), "code": 200})
+
+
+@app.get("/metrics/heartbeat")
+async def heartbeat_metrics():
+    """心跳堆大小与超时断开统计"""
+    return JSONResponse({"data": heartbeat_scheduler.snapshot(), "code": 200})
+
+
+def build_tencent_request_url(
+    identifier: Optional[str] = None,
+    usersig: Optional[str] = None,
+    *,
+    url_override: Optional[str] = None,
+    path_override: Optional[str] = None,
+    base_override: Optional[str] = None
+) -> Optional[str]:
+    """
+    生成腾讯 REST API 的完整请求 URL。
+    优先使用 TENCENT_API_URL，其次使用 base + path + query 参数。
+    """
+    if url_override is not None:
+        selected_url = url_override
+    elif path_override is not None:
+        selected_url = None
+    else:
+        selected_url = TENCENT_API_URL
+    selected_base = base_override or TENCENT_API_BASE_URL
+    selected_path = path_override if path_override is not None else TENCENT_API_PATH
+
+    effective_identifier = identifier or TENCENT_API_IDENTIFIER
+    effective_usersig = usersig or TENCENT_API_USER_SIG
+
+    extra_query: Dict[str, str] = {}
+
+    if selected_url:
+        parsed = urllib.parse.urlparse(selected_url)
+        if parsed.scheme and parsed.netloc:
+            existing_query = urllib.parse.parse_qs(parsed.query, keep_blank_values=True)
+
+            def pick_single(values):
+                if isinstance(values, list):
+                    return values[0] if values else ""
+                return values
+
+            normalized_query: Dict[str, str] = {k: pick_single(v) for k, v in existing_query.items()}
+
+            def ensure_query_param(key: str, value: Optional[str], force: bool = False):
+                if value is not None:
+                    if force or (key not in normalized_query or not normalized_query[key]):
+                        normalized_query[key] = value
+
+            ensure_query_param("sdkappid", TENCENT_API_SDK_APP_ID)
+            # 强制覆盖 identifier 和 usersig，确保使用传入的值
+            ensure_query_param("identifier", effective_identifier, force=True)
+            ensure_query_param("usersig", effective_usersig, force=True)
             ensure_query_param("contenttype", "json")
             if "random" not in normalized_query or not normalized_query["random"]:
                 normalized_query["random"] = str(random.randint(1, 2**31 - 1))
@@ -1731,7 +2886,8 @@ async def notify_tencent_group_sync(user_id: str, groups: List[Dict[str, Any]])
 
 
 @app.post("/tencent/callback")
-async def tencent_im_callback(request: Request):
+@offload_db
+def tencent_im_callback(request: Request):
     """
     腾讯IM回调接口
     接收腾讯IM的各种事件通知，包括群组解散、成员变动等
@@ -1748,7 +2904,7 @@ async def tencent_im_callback(request: Request):
     app_logger.info(f"[tencent/callback] 请求来源IP: {request.client.host if request.client else 'Unknown'}")
     
     try:
-        body = await request.json()
+        body = request.json()
         print(f"[tencent/callback] 收到腾讯IM回调数据:")
         print(f"[tencent/callback] {json.dumps(body, ensure_ascii=False, indent=2)}")
         app_logger.info(f"[tencent/callback] 收到腾讯IM回调数据: {json.dumps(body, ensure_ascii=False)}")
@@ -2348,7 +3504,8 @@ def save_seat_arrangement(
 
 # ===== 课程表 API =====
 @app.post("/course-schedule/save")
-async def api_save_course_schedule(request: Request):
+@offload_db
+def api_save_course_schedule(request: Request):
     """
     保存/更新课程表
     请求体 JSON:
@@ -2365,7 +3522,7 @@ async def api_save_course_schedule(request: Request):
     }
     """
     try:
-        data = await request.json()
+        data = request.json()
     except Exception:
         return safe_json_response({'message': '无效的 JSON 请求体', 'code': 400}, status_code=400)
 
@@ -2395,7 +3552,8 @@ async def api_save_course_schedule(request: Request):
         return safe_json_response({'message': result.get('message', '保存失败'), 'code': 500}, status_code=500)
 
 # ===== 座位安排 API =====
-async def _handle_save_seat_arrangement_payload(data: Dict[str, Any]):
+@offload_db
+def _handle_save_seat_arrangement_payload(data: Dict[str, Any]):
     class_id = data.get('class_id')
     seats = data.get('seats', [])
 
@@ -2456,7 +3614,8 @@ async def api_save_seat_arrangement_alias(request: Request):
     return await _handle_save_seat_arrangement_payload(data)
 
 @app.get("/seat-arrangement")
-async def api_get_seat_arrangement(
+@offload_db
+def api_get_seat_arrangement(
     request: Request,
     class_id: str = Query(..., description="班级ID")
 ):
@@ -2543,7 +3702,8 @@ async def api_get_seat_arrangement(
             app_logger.info("Database connection closed after getting seat arrangement.")
 
 @app.get("/course-schedule")
-async def api_get_course_schedule(
+@offload_db
+def api_get_course_schedule(
     request: Request,
     class_id: str = Query(..., description="班级ID"),
     term: Optional[str] = Query(None, description="学期，如 2025-2026-1。如果不传或为空，则返回该班级所有学期的课表")
@@ -3879,7 +5039,8 @@ async def api_save_student_scores(request: Request):
             if fn == excel_file_name and (not ef.get('url')):
                 ef['url'] = excel_file_url
 
-    result = save_student_scores(
+    result = await run_db(
+        save_student_scores,
         class_id=class_id,
         exam_name=exam_name,
         term=term,
@@ -3902,7 +5063,8 @@ async def api_save_student_scores(request: Request):
         return safe_json_response({'message': result.get('message', '保存失败'), 'code': 500}, status_code=500)
 
 @app.get("/student-scores")
-async def api_get_student_scores(
+@offload_db
+def api_get_student_scores(
     request: Request,
     class_id: str = Query(..., description="班级ID"),
     exam_name: Optional[str] = Query(None, description="考试名称（兼容字段：不再作为查询条件）"),
@@ -4185,7 +5347,8 @@ async def api_get_student_scores(
             app_logger.info("Database connection closed after fetching student scores.")
 
 @app.get("/student-scores/get")
-async def api_get_student_score(
+@offload_db
+def api_get_student_score(
     class_id: str = Query(..., description="班级ID"),
     exam_name: Optional[str] = Query(None, description="考试名称（兼容字段：不再作为查询条件）"),
     term: str = Query(..., description="学期，如'2025-2026-1'")
@@ -4471,7 +5634,8 @@ async def api_get_student_score(
             app_logger.info(f"[student-scores/get] 数据库连接已关闭 - class_id: {class_id}")
 
 @app.post("/student-scores/set-comment")
-async def api_set_student_score_comment(request: Request):
+@offload_db
+def api_set_student_score_comment(request: Request):
     """
     设置特定学生特定属性的注释
     请求体 JSON:
@@ -4491,7 +5655,7 @@ async def api_set_student_score_comment(request: Request):
     print("[student-scores/set-comment] ========== 收到设置注释请求 ==========")
     
     try:
-        body = await request.json()
+        body = request.json()
         score_header_id = body.get('score_header_id')
         student_name = body.get('student_name')
         student_id = body.get('student_id')  # 可选
@@ -4681,7 +5845,8 @@ async def api_set_student_score_comment(request: Request):
 
 
 @app.post("/student-scores/set-score")
-async def api_set_student_score_value(request: Request):
+@offload_db
+def api_set_student_score_value(request: Request):
     """
     设置/更新特定学生特定字段的分数（更新 ta_student_score_detail.scores_json）
 
@@ -4858,7 +6023,7 @@ async def api_set_student_score_value(request: Request):
         return float(s)
 
     try:
-        body = await request.json()
+        body = request.json()
         score_header_id = body.get('score_header_id')
         student_name = body.get('student_name')
         student_id = body.get('student_id')  # 可选
@@ -5993,7 +7158,8 @@ async def api_save_group_scores(request: Request):
     app_logger.info(f"[group-scores/save] ========== 调用 save_group_scores 函数 ==========")
     
     try:
-        result = save_group_scores(
+        result = await run_db(
+            save_group_scores,
             class_id=class_id,
             exam_name=exam_name,
             term=term,
@@ -6031,7 +7197,8 @@ async def api_save_group_scores(request: Request):
         return safe_json_response({'message': error_msg, 'code': 500}, status_code=500)
 
 @app.get("/group-scores")
-async def api_get_group_scores(
+@offload_db
+def api_get_group_scores(
     request: Request,
     class_id: str = Query(..., description="班级ID"),
     exam_name: Optional[str] = Query(None, description="考试名称，可选"),
@@ -6440,7 +7607,9 @@ def verify_code_from_memory(input_phone, input_code):
 
 
 # Redis 连接
-r = redis.Redis(host='127.0.0.1', port=6379, decode_responses=True)
+REDIS_HOST = os.getenv("REDIS_HOST", "127.0.0.1")
+REDIS_PORT = int(os.getenv("REDIS_PORT", "6379"))
+r = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, decode_responses=True)
 
 def get_max_code_from_mysql(connection):
     #"""从 MySQL 找最大号码"""
@@ -6511,7 +7680,8 @@ def generate_unique_code():
 #import base64, os, datetime
 
 @app.get("/unique6digit")
-async def unique_code_api():
+@offload_db
+def unique_code_api():
     try:
         code = generate_unique_code()
         return JSONResponse({"code": code, "status": "ok"})
@@ -6520,7 +7690,8 @@ async def unique_code_api():
 
 
 @app.get("/schools")
-async def list_schools(request: Request):
+@offload_db
+def list_schools(request: Request):
     connection = get_db_connection()
     if connection is None:
         app_logger.error("List schools failed: Database connection error.")
@@ -6562,64 +7733,17 @@ async def list_schools(request: Request):
             app_logger.info("Database connection closed after fetching schools.")
 
 
-@app.post("/updateUserInfo")
-async def updateUserInfo(request: Request):
-    print("=" * 80)
-    print("[updateUserInfo] 收到更新用户信息请求")
-    print(f"[updateUserInfo] 请求方法: {request.method}")
-    print(f"[updateUserInfo] 请求URL: {request.url}")
-    print(f"[updateUserInfo] 请求头: {dict(request.headers)}")
+def update_user_avatar_record(id_number: str, phone: Optional[str], avatar_url: str
+                              ) -> Tuple[Optional[JSONResponse], Optional[Dict[str, Any]], Optional[str]]:
+    """
+    /updateUserInfo 的数据库部分：更新头像、查询用户资料、解析腾讯标识符，在数据库线程池中执行。
+    返回 (错误响应, user_details, tencent_identifier)，成功时错误响应为 None。
+    """
     connection = None
     cursor = None
     user_details: Optional[Dict[str, Any]] = None
     tencent_identifier: Optional[str] = None
-    avatar_url = None  # 存入数据库的值（可能是URL或相对路径）
-    avatar_sync_url = None  # 发给腾讯或前端的可访问URL
-    
     try:
-        # 步骤1: 解析请求数据
-        print("[updateUserInfo] 步骤1: 开始解析请求JSON数据...")
-        print(f"[updateUserInfo] 步骤1: 请求内容类型: {request.headers.get('content-type', '未指定')}")
-        try:
-            body = await request.body()
-            print(f"[updateUserInfo] 步骤1: 原始请求体大小: {len(body)} bytes")
-            if body:
-                print(f"[updateUserInfo] 步骤1: 原始请求体前200字符: {body[:200]}")
-            
-            data = await request.json()
-            print(f"[updateUserInfo] 步骤1完成: 成功解析JSON, payload keys: {list(data.keys()) if data else 'None'}")
-            print(f"[updateUserInfo] 步骤1: 完整payload: {data}")
-        except Exception as e:
-            print(f"[updateUserInfo] 步骤1失败: JSON解析错误 - {type(e).__name__}: {str(e)}")
-            app_logger.error(f"UpdateUserInfo failed: JSON parse error - {type(e).__name__}: {str(e)}")
-            print(f"[updateUserInfo] 异常堆栈:\n{traceback.format_exc()}")
-            return JSONResponse({'data': {'message': f'请求数据解析失败: {str(e)}', 'code': 400}}, status_code=400)
-        
-        print(f"[updateUserInfo] Received payload: {data}")
-        try:
-            phone = data.get('phone')
-            id_number = data.get('id_number')
-            avatar = data.get('avatar')
-            print(f"[updateUserInfo] 提取的字段 - phone: {phone}, id_number: {id_number}, avatar_length: {len(avatar) if avatar else 0}, avatar_type: {type(avatar)}")
-            print(f"[updateUserInfo] 所有字段列表: {list(data.keys())}")
-            for key, value in data.items():
-                if key != 'avatar':  # 头像数据太长，不完整打印
-                    print(f"[updateUserInfo]   - {key}: {value} (type: {type(value).__name__})")
-        except Exception as e:
-            print(f"[updateUserInfo] 提取字段时出错: {type(e).__name__}: {str(e)}")
-            print(f"[updateUserInfo] 异常堆栈:\n{traceback.format_exc()}")
-            raise
-
-        # 步骤2: 验证必需字段
-        print("[updateUserInfo] 步骤2: 验证必需字段...")
-        print(f"[updateUserInfo] 步骤2: id_number检查 - 值: {id_number}, 类型: {type(id_number).__name__}, 是否为空: {not id_number}")
-        print(f"[updateUserInfo] 步骤2: avatar检查 - 值长度: {len(avatar) if avatar else 0}, 类型: {type(avatar).__name__}, 是否为空: {not avatar}")
-        if not id_number or not avatar:
-            app_logger.warning("UpdateUserInfo failed: Missing id_number or avatar.")
-            print(f"[updateUserInfo] 步骤2失败: Missing id_number or avatar -> id_number={id_number}, avatar_present={avatar is not None}")
-            return JSONResponse({'data': {'message': '身份证号码和头像必须提供', 'code': 400}}, status_code=400)
-        print("[updateUserInfo] 步骤2完成: 必需字段验证通过")
-
         # 步骤3: 连接数据库
         print("[updateUserInfo] 步骤3: 连接数据库...")
         try:
@@ -6630,7 +7754,7 @@ async def updateUserInfo(request: Request):
             if connection is None or not connection.is_connected():
                 app_logger.error("UpdateUserInfo failed: Database connection error.")
                 print("[updateUserInfo] 步骤3失败: 数据库连接失败或未连接")
-                return JSONResponse({'data': {'message': '数据库连接失败', 'code': 500}}, status_code=500)
+                return JSONResponse({'data': {'message': '数据库连接失败', 'code': 500}}, status_code=500), None, None
             print("[updateUserInfo] 步骤3完成: 数据库连接成功")
         except Exception as e:
             print(f"[updateUserInfo] 步骤3异常: 连接数据库时出错 - {type(e).__name__}: {str(e)}")
@@ -6638,58 +7762,6 @@ async def updateUserInfo(request: Request):
             app_logger.error(f"UpdateUserInfo failed: Database connection exception - {type(e).__name__}: {str(e)}")
             raise
 
-        # 步骤4: 解码头像数据
-        print("[updateUserInfo] 步骤4: 解码Base64头像数据...")
-        print(f"[updateUserInfo] 步骤4: avatar前100字符: {avatar[:100] if avatar else 'None'}...")
-        try:
-            # 确保avatar是字符串
-            if not isinstance(avatar, str):
-                print(f"[updateUserInfo] 步骤4: avatar不是字符串类型，当前类型: {type(avatar).__name__}, 值: {avatar}")
-                avatar = str(avatar)
-            # 移除可能的前缀
-            if avatar.startswith('data:image'):
-                print("[updateUserInfo] 步骤4: 检测到data URL前缀，移除前缀...")
-                avatar = avatar.split(',', 1)[1]
-            avatar_bytes = base64.b64decode(avatar)
-            print(f"[updateUserInfo] 步骤4完成: 头像解码成功, 大小: {len(avatar_bytes)} bytes")
-        except Exception as e:
-            app_logger.error(f"UpdateUserInfo failed: Avatar decode error for {id_number}: {e}")
-            print(f"[updateUserInfo] 步骤4失败: Avatar decode error for id_number={id_number}: {type(e).__name__}: {str(e)}")
-            print(f"[updateUserInfo] avatar字符串长度: {len(avatar) if avatar else 0}")
-            print(f"[updateUserInfo] avatar字符串类型: {type(avatar).__name__}")
-            print(f"[updateUserInfo] 异常堆栈:\n{traceback.format_exc()}")
-            return JSONResponse({'data': {'message': f'头像数据解析失败: {str(e)}', 'code': 400}}, status_code=400)
-
-        # 步骤5: 上传头像到OSS
-        print("[updateUserInfo] 步骤5: 上传头像到OSS...")
-        print(f"[updateUserInfo] 步骤5: avatar_bytes类型: {type(avatar_bytes).__name__}, 大小: {len(avatar_bytes) if avatar_bytes else 0} bytes")
-        object_name = f"avatars/{id_number}_{int(time.time())}.png"
-        print(f"[updateUserInfo] 步骤5: OSS对象名称: {object_name}")
-        print(f"[updateUserInfo] 步骤5: 检查upload_avatar_to_oss函数是否可用...")
-        try:
-            print(f"[updateUserInfo] 步骤5: 调用upload_avatar_to_oss(avatar_bytes长度={len(avatar_bytes)}, object_name={object_name})...")
-            avatar_url = upload_avatar_to_oss(avatar_bytes, object_name)
-            avatar_sync_url = avatar_url
-            print(f"[updateUserInfo] 步骤5: upload_avatar_to_oss返回: {avatar_url}, 类型: {type(avatar_url).__name__}")
-            if not avatar_url:
-                print("[updateUserInfo] 步骤5: OSS 上传失败，尝试本地兜底存储...")
-                local_path = save_avatar_locally(avatar_bytes, object_name)
-                if not local_path:
-                    app_logger.error("UpdateUserInfo failed: OSS 和本地保存均失败")
-                    print("[updateUserInfo] 步骤5失败: save_avatar_locally返回None")
-                    return JSONResponse({'data': {'message': '头像上传失败，请稍后再试', 'code': 500}}, status_code=500)
-                avatar_url = local_path
-                avatar_sync_url = build_public_url_from_local_path(local_path) or local_path
-                print(f"[updateUserInfo] 步骤5: 本地兜底成功, relative_path={local_path}, sync_url={avatar_sync_url}")
-            else:
-                print(f"[updateUserInfo] 步骤5完成: 头像上传成功, URL: {avatar_url}")
-        except Exception as e:
-            app_logger.error(f"UpdateUserInfo failed: OSS upload error for {id_number}: {e}")
-            print(f"[updateUserInfo] 步骤5失败: OSS上传异常 - {type(e).__name__}: {str(e)}")
-            print(f"[updateUserInfo] 步骤5: 异常参数: {e.args}")
-            print(f"[updateUserInfo] 步骤5异常堆栈:\n{traceback.format_exc()}")
-            return JSONResponse({'data': {'message': f'头像上传失败: {str(e)}', 'code': 500}}, status_code=500)
-
         # 步骤6: 更新数据库
         print("[updateUserInfo] 步骤6: 更新数据库中的头像URL...")
         print(f"[updateUserInfo] 步骤6: 准备更新，avatar_url={avatar_url}, id_number={id_number}")
@@ -6736,7 +7808,7 @@ async def updateUserInfo(request: Request):
                     print(f"[updateUserInfo] 最终未找到用户记录, id_number={id_number}, existing_avatar={existing_avatar}")
                     connection.commit()
                     app_logger.warning(f"UpdateUserInfo: No user_details record found for id_number={id_number}")
-                    return JSONResponse({'data': {'message': '未找到对应的用户信息', 'code': 404}}, status_code=404)
+                    return JSONResponse({'data': {'message': '未找到对应的用户信息', 'code': 404}}, status_code=404), None, None
                 else:
                     print("[updateUserInfo] 找到用户记录但UPDATE未影响行, 继续处理...")
             else:
@@ -6769,7 +7841,7 @@ async def updateUserInfo(request: Request):
                 except Exception as rollback_e:
                     print(f"[updateUserInfo] 回滚失败: {str(rollback_e)}")
             print(f"[updateUserInfo] 异常堆栈:\n{traceback.format_exc()}")
-            return JSONResponse({'data': {'message': f'数据库更新失败: {str(e)}', 'code': 500}}, status_code=500)
+            return JSONResponse({'data': {'message': f'数据库更新失败: {str(e)}', 'code': 500}}, status_code=500), None, None
         except Exception as e:
             app_logger.error(f"Unexpected error during database update for {phone}: {type(e).__name__}: {str(e)}")
             print(f"[updateUserInfo] 步骤6失败: 意外错误 - {type(e).__name__}: {str(e)}")
@@ -6780,7 +7852,7 @@ async def updateUserInfo(request: Request):
                 except Exception as rollback_e:
                     print(f"[updateUserInfo] 回滚失败: {str(rollback_e)}")
             print(f"[updateUserInfo] 异常堆栈:\n{traceback.format_exc()}")
-            return JSONResponse({'data': {'message': f'数据库操作失败: {str(e)}', 'code': 500}}, status_code=500)
+            return JSONResponse({'data': {'message': f'数据库操作失败: {str(e)}', 'code': 500}}, status_code=500), None, None
 
         # 步骤7: 解析腾讯标识符
         print("[updateUserInfo] 步骤7: 解析腾讯用户标识符...")
@@ -6791,44 +7863,177 @@ async def updateUserInfo(request: Request):
         except Exception as e:
             app_logger.error(f"UpdateUserInfo failed: resolve_tencent_identifier error for {id_number}: {type(e).__name__}: {str(e)}")
             print(f"[updateUserInfo] 步骤7失败: resolve_tencent_identifier异常 - {type(e).__name__}: {str(e)}")
-            import traceback
             print(f"[updateUserInfo] 步骤7异常堆栈:\n{traceback.format_exc()}")
             tencent_identifier = None  # 确保变量被设置
             print(f"[updateUserInfo] 步骤7: 使用None作为fallback，将继续使用id_number")
             # 继续执行，使用id_number作为fallback
 
-        # 步骤8: 准备同步数据
-        print("[updateUserInfo] 步骤8: 准备腾讯同步数据...")
-        print(f"[updateUserInfo] 步骤8: user_details状态: {user_details}")
-        print(f"[updateUserInfo] 步骤8: avatar_url状态: {avatar_url}")
-        name_for_sync = None
-        avatar_for_sync = None
-        try:
-            if user_details:
-                name_for_sync = user_details.get("name")
-                avatar_from_db = user_details.get("avatar")
-                avatar_for_sync = avatar_sync_url or avatar_from_db or avatar_url
-                print(f"[updateUserInfo] 步骤8: 从user_details获取 - name={name_for_sync}, avatar_db={avatar_from_db}, avatar_for_sync={avatar_for_sync}")
-            else:
-                avatar_for_sync = avatar_sync_url or avatar_url
-                print(f"[updateUserInfo] 步骤8: user_details为空，使用上传的头像URL: {avatar_for_sync}")
-            print(f"[updateUserInfo] 步骤8: 最终同步数据 - name_for_sync={name_for_sync}, avatar_for_sync={avatar_for_sync}")
-            print("[updateUserInfo] 步骤8完成")
-        except Exception as e:
-            print(f"[updateUserInfo] 步骤8异常: 准备同步数据时出错 - {type(e).__name__}: {str(e)}")
-            print(f"[updateUserInfo] 步骤8异常堆栈:\n{traceback.format_exc()}")
-            raise
-
-        # 步骤9: 同步到腾讯
-        print("[updateUserInfo] 步骤9: 同步用户信息到腾讯...")
-        final_identifier = tencent_identifier or id_number
-        print(f"[updateUserInfo] 步骤9: 最终使用的identifier={final_identifier} (tencent_identifier={tencent_identifier}, id_number={id_number})")
-        print(f"[updateUserInfo] 步骤9: 同步参数 - identifier={final_identifier}, name={name_for_sync}, avatar_url={avatar_for_sync}")
-        print(f"[updateUserInfo] Tencent sync request -> identifier={final_identifier}, "
-              f"name={name_for_sync}, avatar={avatar_for_sync}")
-        app_logger.info(
-            f"updateUserInfo: 准备同步腾讯用户资料 identifier={final_identifier}, "
-            f"name={name_for_sync}, avatar={avatar_for_sync}"
+        return None, user_details, tencent_identifier
+    finally:
+        print("[updateUserInfo] 清理资源...")
+        if cursor:
+            try:
+                cursor.close()
+                print("[updateUserInfo] 游标已关闭")
+            except Exception as e:
+                print(f"[updateUserInfo] 关闭游标时出错: {str(e)}")
+        if connection and connection.is_connected():
+            try:
+                connection.close()
+                print("[updateUserInfo] 数据库连接已关闭")
+                app_logger.info(f"Database connection closed after updating user info.")
+            except Exception as e:
+                print(f"[updateUserInfo] 关闭数据库连接时出错: {str(e)}")
+        print("[updateUserInfo] 资源清理完成")
+
+
+@app.post("/updateUserInfo")
+async def updateUserInfo(request: Request):
+    print("=" * 80)
+    print("[updateUserInfo] 收到更新用户信息请求")
+    print(f"[updateUserInfo] 请求方法: {request.method}")
+    print(f"[updateUserInfo] 请求URL: {request.url}")
+    print(f"[updateUserInfo] 请求头: {dict(request.headers)}")
+    user_details: Optional[Dict[str, Any]] = None
+    tencent_identifier: Optional[str] = None
+    avatar_url = None  # 存入数据库的值（可能是URL或相对路径）
+    avatar_sync_url = None  # 发给腾讯或前端的可访问URL
+    
+    try:
+        # 步骤1: 解析请求数据
+        print("[updateUserInfo] 步骤1: 开始解析请求JSON数据...")
+        print(f"[updateUserInfo] 步骤1: 请求内容类型: {request.headers.get('content-type', '未指定')}")
+        try:
+            body = await request.body()
+            print(f"[updateUserInfo] 步骤1: 原始请求体大小: {len(body)} bytes")
+            if body:
+                print(f"[updateUserInfo] 步骤1: 原始请求体前200字符: {body[:200]}")
+            
+            data = await request.json()
+            print(f"[updateUserInfo] 步骤1完成: 成功解析JSON, payload keys: {list(data.keys()) if data else 'None'}")
+            print(f"[updateUserInfo] 步骤1: 完整payload: {data}")
+        except Exception as e:
+            print(f"[updateUserInfo] 步骤1失败: JSON解析错误 - {type(e).__name__}: {str(e)}")
+            app_logger.error(f"UpdateUserInfo failed: JSON parse error - {type(e).__name__}: {str(e)}")
+            print(f"[updateUserInfo] 异常堆栈:\n{traceback.format_exc()}")
+            return JSONResponse({'data': {'message': f'请求数据解析失败: {str(e)}', 'code': 400}}, status_code=400)
+        
+        print(f"[updateUserInfo] Received payload: {data}")
+        try:
+            phone = data.get('phone')
+            id_number = data.get('id_number')
+            avatar = data.get('avatar')
+            print(f"[updateUserInfo] 提取的字段 - phone: {phone}, id_number: {id_number}, avatar_length: {len(avatar) if avatar else 0}, avatar_type: {type(avatar)}")
+            print(f"[updateUserInfo] 所有字段列表: {list(data.keys())}")
+            for key, value in data.items():
+                if key != 'avatar':  # 头像数据太长，不完整打印
+                    print(f"[updateUserInfo]   - {key}: {value} (type: {type(value).__name__})")
+        except Exception as e:
+            print(f"[updateUserInfo] 提取字段时出错: {type(e).__name__}: {str(e)}")
+            print(f"[updateUserInfo] 异常堆栈:\n{traceback.format_exc()}")
+            raise
+
+        # 步骤2: 验证必需字段
+        print("[updateUserInfo] 步骤2: 验证必需字段...")
+        print(f"[updateUserInfo] 步骤2: id_number检查 - 值: {id_number}, 类型: {type(id_number).__name__}, 是否为空: {not id_number}")
+        print(f"[updateUserInfo] 步骤2: avatar检查 - 值长度: {len(avatar) if avatar else 0}, 类型: {type(avatar).__name__}, 是否为空: {not avatar}")
+        if not id_number or not avatar:
+            app_logger.warning("UpdateUserInfo failed: Missing id_number or avatar.")
+            print(f"[updateUserInfo] 步骤2失败: Missing id_number or avatar -> id_number={id_number}, avatar_present={avatar is not None}")
+            return JSONResponse({'data': {'message': '身份证号码和头像必须提供', 'code': 400}}, status_code=400)
+        print("[updateUserInfo] 步骤2完成: 必需字段验证通过")
+
+        # 步骤4: 解码头像数据
+        print("[updateUserInfo] 步骤4: 解码Base64头像数据...")
+        print(f"[updateUserInfo] 步骤4: avatar前100字符: {avatar[:100] if avatar else 'None'}...")
+        try:
+            # 确保avatar是字符串
+            if not isinstance(avatar, str):
+                print(f"[updateUserInfo] 步骤4: avatar不是字符串类型，当前类型: {type(avatar).__name__}, 值: {avatar}")
+                avatar = str(avatar)
+            # 移除可能的前缀
+            if avatar.startswith('data:image'):
+                print("[updateUserInfo] 步骤4: 检测到data URL前缀，移除前缀...")
+                avatar = avatar.split(',', 1)[1]
+            avatar_bytes = base64.b64decode(avatar)
+            print(f"[updateUserInfo] 步骤4完成: 头像解码成功, 大小: {len(avatar_bytes)} bytes")
+        except Exception as e:
+            app_logger.error(f"UpdateUserInfo failed: Avatar decode error for {id_number}: {e}")
+            print(f"[updateUserInfo] 步骤4失败: Avatar decode error for id_number={id_number}: {type(e).__name__}: {str(e)}")
+            print(f"[updateUserInfo] avatar字符串长度: {len(avatar) if avatar else 0}")
+            print(f"[updateUserInfo] avatar字符串类型: {type(avatar).__name__}")
+            print(f"[updateUserInfo] 异常堆栈:\n{traceback.format_exc()}")
+            return JSONResponse({'data': {'message': f'头像数据解析失败: {str(e)}', 'code': 400}}, status_code=400)
+
+        # 步骤5: 上传头像到OSS
+        print("[updateUserInfo] 步骤5: 上传头像到OSS...")
+        print(f"[updateUserInfo] 步骤5: avatar_bytes类型: {type(avatar_bytes).__name__}, 大小: {len(avatar_bytes) if avatar_bytes else 0} bytes")
+        object_name = f"avatars/{id_number}_{int(time.time())}.png"
+        print(f"[updateUserInfo] 步骤5: OSS对象名称: {object_name}")
+        print(f"[updateUserInfo] 步骤5: 检查upload_avatar_to_oss函数是否可用...")
+        try:
+            print(f"[updateUserInfo] 步骤5: 调用upload_avatar_to_oss(avatar_bytes长度={len(avatar_bytes)}, object_name={object_name})...")
+            avatar_url = await asyncio.to_thread(upload_avatar_to_oss, avatar_bytes, object_name)
+            avatar_sync_url = avatar_url
+            print(f"[updateUserInfo] 步骤5: upload_avatar_to_oss返回: {avatar_url}, 类型: {type(avatar_url).__name__}")
+            if not avatar_url:
+                print("[updateUserInfo] 步骤5: OSS 上传失败，尝试本地兜底存储...")
+                local_path = await asyncio.to_thread(save_avatar_locally, avatar_bytes, object_name)
+                if not local_path:
+                    app_logger.error("UpdateUserInfo failed: OSS 和本地保存均失败")
+                    print("[updateUserInfo] 步骤5失败: save_avatar_locally返回None")
+                    return JSONResponse({'data': {'message': '头像上传失败，请稍后再试', 'code': 500}}, status_code=500)
+                avatar_url = local_path
+                avatar_sync_url = build_public_url_from_local_path(local_path) or local_path
+                print(f"[updateUserInfo] 步骤5: 本地兜底成功, relative_path={local_path}, sync_url={avatar_sync_url}")
+            else:
+                print(f"[updateUserInfo] 步骤5完成: 头像上传成功, URL: {avatar_url}")
+        except Exception as e:
+            app_logger.error(f"UpdateUserInfo failed: OSS upload error for {id_number}: {e}")
+            print(f"[updateUserInfo] 步骤5失败: OSS上传异常 - {type(e).__name__}: {str(e)}")
+            print(f"[updateUserInfo] 步骤5: 异常参数: {e.args}")
+            print(f"[updateUserInfo] 步骤5异常堆栈:\n{traceback.format_exc()}")
+            return JSONResponse({'data': {'message': f'头像上传失败: {str(e)}', 'code': 500}}, status_code=500)
+
+        # 步骤6-7: 更新数据库、解析腾讯标识符。放到数据库线程池里执行，头像上传和腾讯同步期间都不占用数据库连接
+        error_response, user_details, tencent_identifier = await run_db(
+            update_user_avatar_record, id_number, phone, avatar_url
+        )
+        if error_response is not None:
+            return error_response
+
+        # 步骤8: 准备同步数据
+        print("[updateUserInfo] 步骤8: 准备腾讯同步数据...")
+        print(f"[updateUserInfo] 步骤8: user_details状态: {user_details}")
+        print(f"[updateUserInfo] 步骤8: avatar_url状态: {avatar_url}")
+        name_for_sync = None
+        avatar_for_sync = None
+        try:
+            if user_details:
+                name_for_sync = user_details.get("name")
+                avatar_from_db = user_details.get("avatar")
+                avatar_for_sync = avatar_sync_url or avatar_from_db or avatar_url
+                print(f"[updateUserInfo] 步骤8: 从user_details获取 - name={name_for_sync}, avatar_db={avatar_from_db}, avatar_for_sync={avatar_for_sync}")
+            else:
+                avatar_for_sync = avatar_sync_url or avatar_url
+                print(f"[updateUserInfo] 步骤8: user_details为空，使用上传的头像URL: {avatar_for_sync}")
+            print(f"[updateUserInfo] 步骤8: 最终同步数据 - name_for_sync={name_for_sync}, avatar_for_sync={avatar_for_sync}")
+            print("[updateUserInfo] 步骤8完成")
+        except Exception as e:
+            print(f"[updateUserInfo] 步骤8异常: 准备同步数据时出错 - {type(e).__name__}: {str(e)}")
+            print(f"[updateUserInfo] 步骤8异常堆栈:\n{traceback.format_exc()}")
+            raise
+
+        # 步骤9: 同步到腾讯
+        print("[updateUserInfo] 步骤9: 同步用户信息到腾讯...")
+        final_identifier = tencent_identifier or id_number
+        print(f"[updateUserInfo] 步骤9: 最终使用的identifier={final_identifier} (tencent_identifier={tencent_identifier}, id_number={id_number})")
+        print(f"[updateUserInfo] 步骤9: 同步参数 - identifier={final_identifier}, name={name_for_sync}, avatar_url={avatar_for_sync}")
+        print(f"[updateUserInfo] Tencent sync request -> identifier={final_identifier}, "
+              f"name={name_for_sync}, avatar={avatar_for_sync}")
+        app_logger.info(
+            f"updateUserInfo: 准备同步腾讯用户资料 identifier={final_identifier}, "
+            f"name={name_for_sync}, avatar={avatar_for_sync}"
         )
         tencent_sync_summary = None
         try:
@@ -6844,7 +8049,6 @@ async def updateUserInfo(request: Request):
         except Exception as e:
             app_logger.error(f"UpdateUserInfo failed: notify_tencent_user_profile error: {type(e).__name__}: {str(e)}")
             print(f"[updateUserInfo] 步骤9失败: 腾讯同步异常 - {type(e).__name__}: {str(e)}")
-            import traceback
             print(f"[updateUserInfo] 步骤9异常堆栈:\n{traceback.format_exc()}")
             tencent_sync_summary = {'success': False, 'error': str(e)}
             print(f"[updateUserInfo] 步骤9: 设置tencent_sync_summary为: {tencent_sync_summary}")
@@ -6868,12 +8072,9 @@ async def updateUserInfo(request: Request):
         print(f"[updateUserInfo] 异常类型: {type(e).__name__}")
         print(f"[updateUserInfo] 异常消息: {str(e)}")
         print(f"[updateUserInfo] 异常参数: {e.args}")
-        import traceback
         exc_tb = traceback.format_exc()
         print(f"[updateUserInfo] 完整异常堆栈:\n{exc_tb}")
         print(f"[updateUserInfo] 当前变量状态:")
-        print(f"[updateUserInfo]   - connection: {connection}")
-        print(f"[updateUserInfo]   - cursor: {cursor}")
         print(f"[updateUserInfo]   - avatar_url: {avatar_url}")
         print(f"[updateUserInfo]   - user_details: {user_details}")
         print(f"[updateUserInfo]   - tencent_identifier: {tencent_identifier}")
@@ -6881,46 +8082,22 @@ async def updateUserInfo(request: Request):
         return JSONResponse({'data': {'message': f'更新失败: {str(e)}', 'code': 500}}, status_code=500)
     
     finally:
-        print("[updateUserInfo] 清理资源...")
-        if cursor:
-            try:
-                cursor.close()
-                print("[updateUserInfo] 游标已关闭")
-            except Exception as e:
-                print(f"[updateUserInfo] 关闭游标时出错: {str(e)}")
-        if connection and connection.is_connected():
-            try:
-                connection.close()
-                print("[updateUserInfo] 数据库连接已关闭")
-                app_logger.info(f"Database connection closed after updating user info.")
-            except Exception as e:
-                print(f"[updateUserInfo] 关闭数据库连接时出错: {str(e)}")
-        print("[updateUserInfo] 资源清理完成")
         print("=" * 80)
 
 
-@app.post("/updateUserName")
-async def update_user_name(request: Request):
-    data = await request.json()
-    print(f"[updateUserName] Received payload: {data}")
-    name = data.get('name')
-    id_number = data.get('id_number')
-    phone = data.get('phone')
-
-    if not name or (not id_number and not phone):
-        app_logger.warning("update_user_name failed: Missing name or identifier.")
-        return JSONResponse(
-            {'data': {'message': '姓名和身份证号码或手机号必须提供', 'code': 400}},
-            status_code=400
-        )
-
+def update_user_name_record(name: str, id_number: Optional[str], phone: Optional[str]
+                            ) -> Tuple[Optional[JSONResponse], Optional[Dict[str, Any]], Optional[str], Optional[str]]:
+    """
+    /updateUserName 的数据库部分，在数据库线程池中执行。
+    返回 (错误响应, user_details, effective_id_number, tencent_identifier)，成功时错误响应为 None。
+    """
     connection = get_db_connection()
     if connection is None:
         app_logger.error("update_user_name failed: Database connection error.")
         return JSONResponse(
             {'data': {'message': '数据库连接失败', 'code': 500}},
             status_code=500
-        )
+        ), None, None, None
 
     cursor = None
     user_details: Optional[Dict[str, Any]] = None
@@ -6952,7 +8129,7 @@ async def update_user_name(request: Request):
             return JSONResponse(
                 {'data': {'message': '未找到对应的用户信息', 'code': 404}},
                 status_code=404
-            )
+            ), None, None, None
 
         # 选填: 同步更新 ta_teacher 的姓名（如果存在）
         if effective_id_number:
@@ -6980,6 +8157,7 @@ async def update_user_name(request: Request):
             id_number=effective_id_number,
             phone=phone
         )
+        return None, user_details, effective_id_number, tencent_identifier
 
     except Error as e:
         connection.rollback()
@@ -6987,7 +8165,7 @@ async def update_user_name(request: Request):
         return JSONResponse(
             {'data': {'message': '用户名更新失败', 'code': 500}},
             status_code=500
-        )
+        ), None, None, None
     finally:
         if cursor:
             cursor.close()
@@ -6995,6 +8173,29 @@ async def update_user_name(request: Request):
             connection.close()
             app_logger.info(f"Database connection closed after update_user_name for {id_number or phone}.")
 
+
+@app.post("/updateUserName")
+async def update_user_name(request: Request):
+    data = await request.json()
+    print(f"[updateUserName] Received payload: {data}")
+    name = data.get('name')
+    id_number = data.get('id_number')
+    phone = data.get('phone')
+
+    if not name or (not id_number and not phone):
+        app_logger.warning("update_user_name failed: Missing name or identifier.")
+        return JSONResponse(
+            {'data': {'message': '姓名和身份证号码或手机号必须提供', 'code': 400}},
+            status_code=400
+        )
+
+    # 数据库部分在线程池中执行，腾讯同步时不占用数据库连接
+    error_response, user_details, effective_id_number, tencent_identifier = await run_db(
+        update_user_name_record, name, id_number, phone
+    )
+    if error_response is not None:
+        return error_response
+
     avatar_for_sync = None
     if user_details:
         avatar_for_sync = user_details.get("avatar")
@@ -7016,7 +8217,8 @@ async def update_user_name(request: Request):
     return JSONResponse({'data': {'message': '用户名更新成功', 'code': 200, 'tencent_sync': tencent_sync_summary}})
 
 
-async def _update_user_field(phone: Optional[str], field: str, value, field_label: str, id_number: Optional[str] = None):
+@offload_db
+def _update_user_field(phone: Optional[str], field: str, value, field_label: str, id_number: Optional[str] = None):
     if (not phone and not id_number) or value is None:
         return JSONResponse(
             {'data': {'message': f'手机号或身份证号以及{field_label}必须提供', 'code': 400}},
@@ -7197,7 +8399,8 @@ def _replace_user_teachings(cursor, phone: str, teachings: List[Dict[str, str]])
 
 
 @app.post("/updateUserTeachings")
-async def update_user_teachings(request: Request):
+@offload_db
+def update_user_teachings(request: Request):
     """
     更新“一个老师多条任教记录”（写入 ta_user_teachings）。
 
@@ -7216,7 +8419,7 @@ async def update_user_teachings(request: Request):
     返回：
     { "data": { "message": "...", "code": 200, "teachings": [...] } }
     """
-    data = await request.json()
+    data = request.json()
     phone = (data.get("phone") or "").strip()
     userid = data.get("userid")
 
@@ -7327,7 +8530,8 @@ async def update_user_grade_level(request: Request):
 
 
 @app.get("/userInfo")
-async def list_userInfo(request: Request):
+@offload_db
+def list_userInfo(request: Request):
     connection = get_db_connection()
     if connection is None:
         app_logger.error("Get User Info failed: Database connection error.")
@@ -7369,6 +8573,7 @@ async def list_userInfo(request: Request):
         # 附加任教关系列表（teachings[]），用于支持一个老师多个班级/科目
         for user in userinfo:
             teachings: List[Dict[str, Any]] = []
+            if phone_filter:
                 cursor.execute(
                     """
                     SELECT grade_level, grade, subject, class_taught, sort_order
@@ -7529,8 +8734,9 @@ def generate_class_code(connection, schoolid):
             cursor.close()
 
 @app.post("/updateClasses")
-async def updateClasses(request: Request):
-    data_list = await request.json()
+@offload_db
+def updateClasses(request: Request):
+    data_list = request.json()
     if not isinstance(data_list, list) or not data_list:
         return JSONResponse({'data': {'message': '必须提供班级数组数据', 'code': 400}}, status_code=400)
 
@@ -7775,10 +8981,14 @@ async def updateClasses(request: Request):
         traceback_str = traceback.format_exc()
         app_logger.error(f"Error stack: {traceback_str}")
         return JSONResponse({'data': {'message': f'操作失败: {str(e)}', 'code': 500}}, status_code=500)
+    finally:
+        # 出错分支也要归还连接（close 可重复调用）
+        connection.close()
 
 
 @app.post("/deleteClasses")
-async def delete_classes(request: Request):
+@offload_db
+def delete_classes(request: Request):
     """
     删除班级接口
     接收班级编号列表，从 ta_classes 表中删除对应的班级
@@ -7788,7 +8998,7 @@ async def delete_classes(request: Request):
     print("[deleteClasses] 收到删除班级请求")
     
     try:
-        data = await request.json()
+        data = request.json()
         print(f"[deleteClasses] 原始数据: {json.dumps(data, ensure_ascii=False, indent=2)}")
         
         # 支持多种格式：
@@ -7973,8 +9183,9 @@ async def delete_classes(request: Request):
 
 
 @app.post("/getClassesByPrefix")
-async def get_classes_by_prefix(request: Request):
-    data = await request.json()
+@offload_db
+def get_classes_by_prefix(request: Request):
+    data = request.json()
     prefix = data.get("prefix")
     if not prefix or len(prefix) != 6 or not prefix.isdigit():
         return JSONResponse({'data': {'message': '必须提供6位数字前缀', 'code': 400}}, status_code=400)
@@ -7999,11 +9210,14 @@ async def get_classes_by_prefix(request: Request):
     except Error as e:
         app_logger.error(f"查询失败: {e}")
         return JSONResponse({'data': {'message': '查询失败', 'code': 500}}, status_code=500)
+    finally:
+        connection.close()
 
 
 @app.post("/updateSchoolInfo")
-async def updateSchoolInfo(request: Request):
-    data = await request.json()
+@offload_db
+def updateSchoolInfo(request: Request):
+    data = request.json()
     id = data.get('id')
     name = data.get('name')
     address = data.get('address')
@@ -8113,8 +9327,9 @@ def generate_teacher_unique_id(school_id):
 
 
 @app.post("/add_teacher")
-async def add_teacher(request: Request):
-    data = await request.json()
+@offload_db
+def add_teacher(request: Request):
+    data = request.json()
     if not data or 'schoolId' not in data:
         return JSONResponse({'data': {'message': '缺少 schoolId', 'code': 400}}, status_code=400)
 
@@ -8253,8 +9468,9 @@ async def add_teacher(request: Request):
 
 
 @app.post("/delete_teacher")
-async def delete_teacher(request: Request):
-    data = await request.json()
+@offload_db
+def delete_teacher(request: Request):
+    data = request.json()
     if not data or "teacher_unique_id" not in data:
         return JSONResponse({'data': {'message': '缺少 teacher_unique_id', 'code': 400}}, status_code=400)
 
@@ -8282,7 +9498,8 @@ async def delete_teacher(request: Request):
 
 
 @app.get("/get_list_teachers")
-async def get_list_teachers(request: Request):
+@offload_db
+def get_list_teachers(request: Request):
     school_id = request.query_params.get("schoolId")
     final_query = "SELECT * FROM ta_teacher WHERE (%s IS NULL OR schoolId = %s)"
     params = (school_id, school_id)
@@ -8312,7 +9529,8 @@ async def get_list_teachers(request: Request):
 
 
 @app.get("/teachers")
-async def list_teachers(request: Request):
+@offload_db
+def list_teachers(request: Request):
     connection = get_db_connection()
     if connection is None:
         return JSONResponse({'data': {'message': '数据库连接失败', 'code': 500, 'teachers': []}}, status_code=500)
@@ -8357,7 +9575,8 @@ async def list_teachers(request: Request):
 
 
 @app.get("/messages/recent")
-async def get_recent_messages(request: Request):
+@offload_db
+def get_recent_messages(request: Request):
     connection = get_db_connection()
     if connection is None:
         return JSONResponse({'data': {'message': '数据库连接失败', 'code': 500, 'messages': []}}, status_code=500)
@@ -8419,7 +9638,8 @@ from fastapi.responses import JSONResponse
 from fastapi import Path
 
 @app.post("/messages")
-async def add_message(request: Request):
+@offload_db
+def add_message(request: Request):
     connection = get_db_connection()
     if not connection:
         return JSONResponse({
@@ -8446,7 +9666,7 @@ async def add_message(request: Request):
 
         # === 情况1: JSON 格式 - 发送文本消息 ===
         if content_type_header.startswith('application/json'):
-            data = await request.json()
+            data = request.json()
             if not data:
                 return JSONResponse({'data': {'message': '无效的 JSON 数据', 'code': 400, 'message': None}}, status_code=400)
 
@@ -8506,7 +9726,7 @@ async def add_message(request: Request):
             if msg_content_type != 'audio':
                 return JSONResponse({'data': {'message': 'content_type 必须为 audio', 'code': 400, 'message': None}}, status_code=400)
 
-            audio_data = await request.body()
+            audio_data = request.body()
             if not audio_data:
                 return JSONResponse({'data': {'message': '音频数据为空', 'code': 400, 'message': None}}, status_code=400)
 
@@ -8564,7 +9784,8 @@ async def add_message(request: Request):
 
 
 @app.get("/api/audio/{message_id}")
-async def get_audio(message_id: int = Path(..., description="音频消息ID")):
+@offload_db
+def get_audio(message_id: int = Path(..., description="音频消息ID")):
     connection = get_db_connection()
     if not connection:
         return JSONResponse({'message': 'Database error'}, status_code=500)
@@ -8590,14 +9811,15 @@ async def get_audio(message_id: int = Path(..., description="音频消息ID")):
 
 
 @app.post("/notifications")
-async def send_notification_to_class(request: Request):
+@offload_db
+def send_notification_to_class(request: Request):
     connection = get_db_connection()
     if connection is None:
         return JSONResponse({'data': {'message': '数据库连接失败', 'code': 500}}, status_code=500)
 
     cursor = None
     try:
-        data = await request.json()
+        data = request.json()
         sender_id = data.get('sender_id')
         class_id = data.get('class_id')
         content = data.get('content')
@@ -8643,7 +9865,8 @@ async def send_notification_to_class(request: Request):
 from fastapi import Path
 
 @app.get("/notifications/class/{class_id}")
-async def get_notifications_for_class(
+@offload_db
+def get_notifications_for_class(
     class_id: int = Path(..., description="班级ID"),
     request: Request = None
 ):
@@ -8746,7 +9969,8 @@ from fastapi.responses import JSONResponse
 import time, secrets
 
 @app.get("/wallpapers")
-async def list_wallpapers(request: Request):
+@offload_db
+def list_wallpapers(request: Request):
     """
     获取所有壁纸列表 (支持筛选、排序)
     Query Parameters:
@@ -8845,8 +10069,9 @@ async def send_verification_code(request: Request):
 
 
 @app.post("/register")
-async def register(request: Request):
-    data = await request.json()
+@offload_db
+def register(request: Request):
+    data = request.json()
     phone = data.get('phone')
     password = data.get('password')
     verification_code = data.get('verification_code')
@@ -8918,8 +10143,9 @@ def create_access_token(data: dict, expires_delta: int = 30):
 
 # ======= 登录接口 =======
 @app.post("/login")
-async def login(request: Request):
-    data = await request.json()
+@offload_db
+def login(request: Request):
+    data = request.json()
     login_type = data.get('login_type')
     
     print(f"[login] 收到登录请求，login_type={login_type}, data={data}")
@@ -9042,7 +10268,8 @@ async def login(request: Request):
 
 
 @app.get("/api/class/info")
-async def get_class_info(request: Request):
+@offload_db
+def get_class_info(request: Request):
     """获取班级信息接口（包含学校信息）"""
     class_code = request.query_params.get('class_code')
     
@@ -9132,9 +10359,10 @@ from fastapi.responses import JSONResponse
 import secrets
 
 @app.post("/verify_and_set_password")
-async def verify_and_set_password(request: Request):
+@offload_db
+def verify_and_set_password(request: Request):
     """忘记密码 - 验证并重置密码"""
-    data = await request.json()
+    data = request.json()
     phone = data.get('phone')
     verification_code = data.get('verification_code')
     new_password = data.get('new_password')
@@ -9531,7 +10759,7 @@ def get_groups_by_teacher(
                         "owner_id": room_info.get("owner_id"),
                         "owner_name": room_info.get("owner_name"),
                         "owner_icon": room_info.get("owner_icon"),
-                        "members": room_info.get("members", [])
+                        "members": temp_rooms.members(group_id)
                     }
                     app_logger.info(f"[groups/by-teacher] 群组 {group_id} 有临时语音房间（内存），已添加到返回信息")
                 else:
@@ -9576,7 +10804,7 @@ def get_groups_by_teacher(
                             }
                             
                             # 将房间信息恢复到内存中（可选，用于后续快速访问）
-                            active_temp_rooms[group_id] = {
+                            temp_rooms.add_room_if_absent(group_id, {
                                 "room_id": room_row.get("room_id"),
                                 "publish_url": publish_url,
                                 "play_url": play_url,
@@ -9589,7 +10817,7 @@ def get_groups_by_teacher(
                                 "group_id": group_id,
                                 "timestamp": time.time(),
                                 "members": members
-                            }
+                            })
                             
                             app_logger.info(f"[groups/by-teacher] 群组 {group_id} 有临时语音房间（数据库恢复），已添加到返回信息并恢复到内存")
                     except Exception as db_error:
@@ -10073,7 +11301,8 @@ def search_teachers(
         app_logger.info(f"[teachers/search] Database connection closed after search teachers attempt for schoolid={schoolid}.")
 
 @app.post("/groups/join")
-async def join_group(request: Request):
+@offload_db
+def join_group(request: Request):
     """
     用户申请加入群组
     接收客户端发送的 group_id, user_id, user_name, reason
@@ -10083,7 +11312,7 @@ async def join_group(request: Request):
     print("[groups/join] 收到加入群组请求")
     
     try:
-        data = await request.json()
+        data = request.json()
         print(f"[groups/join] 原始数据: {json.dumps(data, ensure_ascii=False, indent=2)}")
         
         group_id = data.get('group_id')
@@ -10266,7 +11495,17 @@ async def join_group(request: Request):
                                         "error": str(e)
                                     }
                             
-                            tencent_result = await asyncio.to_thread(_add_tencent_member)
+                            # 腾讯IM调用期间不占用数据库连接（此前只有查询）
+                            cursor.close()
+                            cursor = None
+                            tencent_result, connection = call_with_connection_released(connection, _add_tencent_member)
+                            if connection is None:
+                                app_logger.error("[groups/join] 腾讯IM调用后重新获取数据库连接失败")
+                                return JSONResponse({
+                                    "code": 500,
+                                    "message": "数据库连接失败"
+                                }, status_code=500)
+                            cursor = connection.cursor(dictionary=True)
                             
                             if tencent_result.get("status") == "success":
                                 response_data = tencent_result.get("response")
@@ -10351,6 +11590,8 @@ async def join_group(request: Request):
             # 提交事务
             connection.commit()
             print(f"[groups/join] 事务提交成功")
+            group_member_cache.invalidate(group_id)
+            group_roster_cache.invalidate(group_id)
             
             # 记录腾讯IM同步结果
             if not tencent_sync_success and tencent_error:
@@ -10424,7 +11665,8 @@ async def join_group(request: Request):
         print("=" * 80)
 
 @app.post("/groups/invite")
-async def invite_group_members(request: Request):
+@offload_db
+def invite_group_members(request: Request):
     """
     群主邀请成员加入群组
     接收客户端发送的 group_id 和 members 列表
@@ -10446,7 +11688,7 @@ async def invite_group_members(request: Request):
     print("[groups/invite] 收到邀请成员请求")
     
     try:
-        data = await request.json()
+        data = request.json()
         print(f"[groups/invite] 原始数据: {json.dumps(data, ensure_ascii=False, indent=2)}")
         
         group_id = data.get('group_id')
@@ -10694,7 +11936,18 @@ async def invite_group_members(request: Request):
                     app_logger.exception(f"[groups/invite] 腾讯接口未知异常: {exc}")
                     return {"status": "error", "http_status": None, "error": str(exc)}
             
-            tencent_result = await asyncio.to_thread(_invite_tencent_members)
+            # 腾讯接口调用期间不占用数据库连接：此前只有查询，先结束事务归还连接，调用结束后重新借用并开启事务
+            cursor.close()
+            cursor = None
+            tencent_result, connection = call_with_connection_released(connection, _invite_tencent_members)
+            if connection is None:
+                app_logger.error("[groups/invite] 腾讯接口调用后重新获取数据库连接失败")
+                return JSONResponse({
+                    "code": 500,
+                    "message": "数据库连接失败"
+                }, status_code=500)
+            connection.start_transaction()
+            cursor = connection.cursor(dictionary=True)
             
             # 检查腾讯接口调用结果
             if tencent_result.get('status') != 'success':
@@ -10793,6 +12046,8 @@ async def invite_group_members(request: Request):
             # 提交事务
             connection.commit()
             print(f"[groups/invite] 事务提交成功")
+            group_member_cache.invalidate(group_id)
+            group_roster_cache.invalidate(group_id)
             
             result = {
                 "code": 200,
@@ -10860,7 +12115,8 @@ async def invite_group_members(request: Request):
         print("=" * 80)
 
 @app.post("/groups/leave")
-async def leave_group(request: Request):
+@offload_db
+def leave_group(request: Request):
     """
     用户退出群组
     接收客户端发送的 group_id, user_id
@@ -10878,7 +12134,7 @@ async def leave_group(request: Request):
         # 解析请求体JSON数据
         try:
             # 先尝试读取原始body
-            body_bytes = await request.body()
+            body_bytes = request.body()
             print(f"[groups/leave] 读取到请求体长度: {len(body_bytes)} 字节")
             
             if not body_bytes:
@@ -11025,6 +12281,8 @@ async def leave_group(request: Request):
             # 提交事务
             connection.commit()
             print(f"[groups/leave] 事务提交成功")
+            group_member_cache.invalidate(group_id)
+            group_roster_cache.invalidate(group_id)
             
             result = {
                 "code": 200,
@@ -11088,7 +12346,8 @@ async def leave_group(request: Request):
         print("=" * 80)
 
 @app.post("/groups/remove-member")
-async def remove_member(request: Request):
+@offload_db
+def remove_member(request: Request):
     """
     群主踢出群成员
     接收客户端发送的 group_id 和 members 数组
@@ -11104,7 +12363,7 @@ async def remove_member(request: Request):
     print("[groups/remove-member] 收到踢出成员请求")
     
     try:
-        data = await request.json()
+        data = request.json()
         print(f"[groups/remove-member] 原始数据: {json.dumps(data, ensure_ascii=False, indent=2)}")
         
         group_id = data.get('group_id')
@@ -11346,7 +12605,18 @@ async def remove_member(request: Request):
                     app_logger.exception(f"[groups/remove-member] 腾讯接口未知异常: {exc}")
                     return {"status": "error", "http_status": None, "error": str(exc)}
             
-            tencent_result = await asyncio.to_thread(_delete_tencent_members)
+            # 腾讯接口调用期间不占用数据库连接：此前只有查询，先结束事务归还连接，调用结束后重新借用并开启事务
+            cursor.close()
+            cursor = None
+            tencent_result, connection = call_with_connection_released(connection, _delete_tencent_members)
+            if connection is None:
+                app_logger.error("[groups/remove-member] 腾讯接口调用后重新获取数据库连接失败")
+                return JSONResponse({
+                    "code": 500,
+                    "message": "数据库连接失败"
+                }, status_code=500)
+            connection.start_transaction()
+            cursor = connection.cursor(dictionary=True)
             
             # 打印腾讯接口响应详情
             print(f"[groups/remove-member] 腾讯接口响应状态: {tencent_result.get('status')}")
@@ -11422,6 +12692,8 @@ async def remove_member(request: Request):
             # 提交事务
             connection.commit()
             print(f"[groups/remove-member] 事务提交成功")
+            group_member_cache.invalidate(group_id)
+            group_roster_cache.invalidate(group_id)
             
             result = {
                 "code": 200,
@@ -11487,7 +12759,8 @@ async def remove_member(request: Request):
         print("=" * 80)
 
 @app.post("/groups/dismiss")
-async def dismiss_group(request: Request):
+@offload_db
+def dismiss_group(request: Request):
     """
     解散群组
     接收客户端发送的 group_id, user_id
@@ -11506,7 +12779,7 @@ async def dismiss_group(request: Request):
         # 解析请求体JSON数据
         try:
             # 先尝试读取原始body
-            body_bytes = await request.body()
+            body_bytes = request.body()
             print(f"[groups/dismiss] 读取到请求体长度: {len(body_bytes)} 字节")
             
             if not body_bytes:
@@ -11722,7 +12995,17 @@ async def dismiss_group(request: Request):
                                         "error": str(e)
                                     }
                             
-                            tencent_result = _destroy_tencent_group()
+                            # 腾讯IM调用期间不占用数据库连接（此前只有查询）
+                            cursor.close()
+                            cursor = None
+                            tencent_result, connection = call_with_connection_released(connection, _destroy_tencent_group)
+                            if connection is None:
+                                app_logger.error("[groups/dismiss] 腾讯IM调用后重新获取数据库连接失败")
+                                return JSONResponse({
+                                    "code": 500,
+                                    "message": "数据库连接失败"
+                                }, status_code=500)
+                            cursor = connection.cursor(dictionary=True)
                             
                             if tencent_result.get("status") == "success":
                                 response_data = tencent_result.get("response")
@@ -11794,6 +13077,8 @@ async def dismiss_group(request: Request):
             # 提交事务
             connection.commit()
             print(f"[groups/dismiss] 事务提交成功")
+            group_member_cache.invalidate(group_id)
+            group_roster_cache.invalidate(group_id)
             
             # 记录腾讯IM同步结果
             if not tencent_sync_success and tencent_error:
@@ -11867,7 +13152,8 @@ async def dismiss_group(request: Request):
         print("=" * 80)
 
 @app.post("/groups/set_admin_role")
-async def set_admin_role(request: Request):
+@offload_db
+def set_admin_role(request: Request):
     """
     设置群成员角色（管理员或成员）
     接收客户端发送的 group_id, user_id, role
@@ -11887,7 +13173,7 @@ async def set_admin_role(request: Request):
         # 解析请求体JSON数据
         try:
             # 先尝试读取原始body
-            body_bytes = await request.body()
+            body_bytes = request.body()
             print(f"[groups/set_admin_role] 读取到请求体长度: {len(body_bytes)} 字节")
             
             if not body_bytes:
@@ -12122,7 +13408,8 @@ async def set_admin_role(request: Request):
         print("=" * 80)
 
 @app.post("/groups/transfer_owner")
-async def transfer_owner(request: Request):
+@offload_db
+def transfer_owner(request: Request):
     """
     转让群主
     接收客户端发送的 group_id, old_owner_id, new_owner_id
@@ -12142,7 +13429,7 @@ async def transfer_owner(request: Request):
         # 解析请求体JSON数据
         try:
             # 先尝试读取原始body
-            body_bytes = await request.body()
+            body_bytes = request.body()
             print(f"[groups/transfer_owner] 读取到请求体长度: {len(body_bytes)} 字节")
             
             if not body_bytes:
@@ -12728,8 +14015,9 @@ def get_group_members(
             app_logger.info(f"Database connection closed after get_group_members attempt for {unique_group_id}.")
 
 @app.post("/updateGroupInfo")
-async def updateGroupInfo(request: Request):
-    data = await request.json()
+@offload_db
+def updateGroupInfo(request: Request):
+    data = request.json()
     unique_group_id = data.get('unique_group_id')
     avatar = data.get('avatar')
 
@@ -12794,357 +14082,592 @@ async def updateGroupInfo(request: Request):
             connection.close()
             app_logger.info(f"Database connection closed after updating group info for {unique_group_id}.")
 
-@app.post("/groups/sync")
-async def sync_groups(request: Request):
+def sync_groups_to_db(groups: List[Dict[str, Any]], user_id: str, classid, schoolid
+                      ) -> Tuple[Optional[JSONResponse], int, int]:
     """
-    同步腾讯群组数据到本地数据库
-    接收客户端发送的群组列表，插入到 groups 和 group_members 表
+    /groups/sync 的数据库部分：群组写入 groups / group_members，一个事务提交，在数据库线程池中执行。
+    返回 (错误响应, 成功数, 失败数)，成功时错误响应为 None。
     """
-    print("=" * 80)
-    print("[groups/sync] 收到同步请求")
+    # 数据库连接
+    print("[groups/sync] 开始连接数据库...")
+    connection = get_db_connection()
+    if connection is None or not connection.is_connected():
+        print("[groups/sync] 错误: 数据库连接失败")
+        app_logger.error("Database connection error in /groups/sync API.")
+        return JSONResponse({
+            'data': {
+                'message': '数据库连接失败',
+                'code': 500
+            }
+        }, status_code=500), 0, 0
+    print("[groups/sync] 数据库连接成功")
+    
+    cursor = None
     try:
-        data = await request.json()
-        print(f"[groups/sync] 原始数据: {json.dumps(data, ensure_ascii=False, indent=2)}")
-        groups = data.get('groups', [])
-        user_id = data.get('user_id')
-        # 客户端发送的字段名：classid 和 schoolid（不再是 class_id 和 school_id）
-        classid = data.get('classid')  # 从请求中获取 classid
-        schoolid = data.get('schoolid')  # 从请求中获取 schoolid
-        print(f"[groups/sync] 解析结果 - user_id: {user_id}, groups数量: {len(groups)}, classid: {classid}, schoolid: {schoolid}")
+        cursor = connection.cursor()
+        success_count = 0
+        error_count = 0
         
-        if not groups:
-            print("[groups/sync] 错误: 没有群组数据")
-            return JSONResponse({
-                'data': {
-                    'message': '没有群组数据需要同步',
-                    'code': 400
-                }
-            }, status_code=400)
+        # 检查表是否存在
+        print("[groups/sync] 检查表是否存在...")
+        cursor.execute("SHOW TABLES LIKE 'groups'")
+        groups_table_exists = cursor.fetchone()
+        cursor.execute("SHOW TABLES LIKE 'group_members'")
+        group_members_table_exists = cursor.fetchone()
+        print(f"[groups/sync] groups表存在: {groups_table_exists is not None}, group_members表存在: {group_members_table_exists is not None}")
         
-        if not user_id:
-            print("[groups/sync] 错误: 缺少 user_id")
-            return JSONResponse({
-                'data': {
-                    'message': '缺少 user_id 参数',
-                    'code': 400
-                }
-            }, status_code=400)
+        # 检查表结构
+        if groups_table_exists:
+            print("[groups/sync] 检查 groups 表结构...")
+            cursor.execute("DESCRIBE `groups`")
+            groups_columns = cursor.fetchall()
+            print(f"[groups/sync] groups 表字段信息:")
+            for col in groups_columns:
+                print(f"  {col}")
         
-        # 数据库连接
-        print("[groups/sync] 开始连接数据库...")
-        connection = get_db_connection()
-        if connection is None or not connection.is_connected():
-            print("[groups/sync] 错误: 数据库连接失败")
-            app_logger.error("Database connection error in /groups/sync API.")
-            return JSONResponse({
-                'data': {
-                    'message': '数据库连接失败',
-                    'code': 500
-                }
-            }, status_code=500)
-        print("[groups/sync] 数据库连接成功")
+        if group_members_table_exists:
+            print("[groups/sync] 检查 group_members 表结构...")
+            cursor.execute("DESCRIBE `group_members`")
+            group_members_columns = cursor.fetchall()
+            print(f"[groups/sync] group_members 表字段信息:")
+            for col in group_members_columns:
+                print(f"  {col}")
         
-        cursor = None
-        try:
-            cursor = connection.cursor()
-            success_count = 0
-            error_count = 0
-            
-            # 检查表是否存在
-            print("[groups/sync] 检查表是否存在...")
-            cursor.execute("SHOW TABLES LIKE 'groups'")
-            groups_table_exists = cursor.fetchone()
-            cursor.execute("SHOW TABLES LIKE 'group_members'")
-            group_members_table_exists = cursor.fetchone()
-            print(f"[groups/sync] groups表存在: {groups_table_exists is not None}, group_members表存在: {group_members_table_exists is not None}")
-            
-            # 检查表结构
-            if groups_table_exists:
-                print("[groups/sync] 检查 groups 表结构...")
-                cursor.execute("DESCRIBE `groups`")
-                groups_columns = cursor.fetchall()
-                print(f"[groups/sync] groups 表字段信息:")
-                for col in groups_columns:
-                    print(f"  {col}")
-            
-            if group_members_table_exists:
-                print("[groups/sync] 检查 group_members 表结构...")
-                cursor.execute("DESCRIBE `group_members`")
-                group_members_columns = cursor.fetchall()
-                print(f"[groups/sync] group_members 表字段信息:")
-                for col in group_members_columns:
-                    print(f"  {col}")
-            
-            # 遍历每个群组
-            for idx, group in enumerate(groups):
-                try:
-                    group_id = group.get('group_id')
-                    print(f"[groups/sync] 处理第 {idx+1}/{len(groups)} 个群组, group_id: {group_id}")
+        # 遍历每个群组
+        for idx, group in enumerate(groups):
+            try:
+                group_id = group.get('group_id')
+                print(f"[groups/sync] 处理第 {idx+1}/{len(groups)} 个群组, group_id: {group_id}")
+                
+                # 检查群组是否已存在
+                print(f"[groups/sync] 检查群组 {group_id} 是否已存在...")
+                cursor.execute("SELECT group_id FROM `groups` WHERE group_id = %s", (group_id,))
+                group_exists = cursor.fetchone()
+                print(f"[groups/sync] 群组 {group_id} 已存在: {group_exists is not None}")
+                
+                # 处理时间戳转换函数（在循环外定义，避免重复定义）
+                def timestamp_to_datetime(ts):
+                    if ts is None or ts == 0:
+                        return None
+                    try:
+                        # 如果是毫秒级时间戳，转换为秒
+                        if ts > 2147483647:  # 2038-01-19 03:14:07 的秒级时间戳
+                            ts = int(ts / 1000)
+                        else:
+                            ts = int(ts)
+                        
+                        # 转换为 datetime 对象
+                        dt = datetime.datetime.fromtimestamp(ts)
+                        # 格式化为 MySQL DATETIME 格式
+                        return dt.strftime('%Y-%m-%d %H:%M:%S')
+                    except (ValueError, OSError) as e:
+                        print(f"[groups/sync] 警告: 时间戳 {ts} 转换失败: {e}，设置为 NULL")
+                        return None
+                
+                # 插入或更新 groups 表
+                if group_exists:
+                    print(f"[groups/sync] 更新群组 {group_id} 的信息...")
+                    # 转换时间戳
+                    create_time_dt = timestamp_to_datetime(group.get('create_time'))
+                    last_msg_time_dt = timestamp_to_datetime(group.get('last_msg_time'))
+                    last_info_time_dt = timestamp_to_datetime(group.get('last_info_time'))
                     
-                    # 检查群组是否已存在
-                    print(f"[groups/sync] 检查群组 {group_id} 是否已存在...")
-                    cursor.execute("SELECT group_id FROM `groups` WHERE group_id = %s", (group_id,))
-                    group_exists = cursor.fetchone()
-                    print(f"[groups/sync] 群组 {group_id} 已存在: {group_exists is not None}")
+                    # 更新群组信息
+                    # 优先使用群组数据中的 classid 和 schoolid，如果没有则使用请求级别的
+                    # 注意：客户端发送的字段名是 classid 和 schoolid（不是 class_id 和 school_id）
+                    # 如果字段为空，则不更新数据库对应的字段
+                    group_classid = group.get('classid') or classid
+                    group_schoolid = group.get('schoolid') or schoolid
                     
-                    # 处理时间戳转换函数（在循环外定义，避免重复定义）
-                    def timestamp_to_datetime(ts):
-                        if ts is None or ts == 0:
-                            return None
-                        try:
-                            # 如果是毫秒级时间戳，转换为秒
-                            if ts > 2147483647:  # 2038-01-19 03:14:07 的秒级时间戳
-                                ts = int(ts / 1000)
-                            else:
-                                ts = int(ts)
-                            
-                            # 转换为 datetime 对象
-                            dt = datetime.datetime.fromtimestamp(ts)
-                            # 格式化为 MySQL DATETIME 格式
-                            return dt.strftime('%Y-%m-%d %H:%M:%S')
-                        except (ValueError, OSError) as e:
-                            print(f"[groups/sync] 警告: 时间戳 {ts} 转换失败: {e}，设置为 NULL")
-                            return None
+                    # 检查值是否为空（None、空字符串、空值）
+                    def is_empty(value):
+                        return value is None or value == '' or (isinstance(value, str) and value.strip() == '')
                     
-                    # 插入或更新 groups 表
-                    if group_exists:
-                        print(f"[groups/sync] 更新群组 {group_id} 的信息...")
-                        # 转换时间戳
-                        create_time_dt = timestamp_to_datetime(group.get('create_time'))
-                        last_msg_time_dt = timestamp_to_datetime(group.get('last_msg_time'))
-                        last_info_time_dt = timestamp_to_datetime(group.get('last_info_time'))
-                        
-                        # 更新群组信息
-                        # 优先使用群组数据中的 classid 和 schoolid，如果没有则使用请求级别的
-                        # 注意：客户端发送的字段名是 classid 和 schoolid（不是 class_id 和 school_id）
-                        # 如果字段为空，则不更新数据库对应的字段
-                        group_classid = group.get('classid') or classid
-                        group_schoolid = group.get('schoolid') or schoolid
-                        
-                        # 检查值是否为空（None、空字符串、空值）
-                        def is_empty(value):
-                            return value is None or value == '' or (isinstance(value, str) and value.strip() == '')
+                    # 构建 UPDATE SQL，只更新非空字段
+                    update_fields = [
+                        "group_name = %s", "group_type = %s", "face_url = %s", "detail_face_url = %s",
+                        "create_time = %s", "max_member_num = %s",
+                        "member_num = %s", "introduction = %s", "notification = %s", "searchable = %s",
+                        "visible = %s", "add_option = %s", "is_shutup_all = %s", "next_msg_seq = %s",
+                        "latest_seq = %s", "last_msg_time = %s", "last_info_time = %s",
+                        "info_seq = %s", "detail_info_seq = %s", "detail_group_id = %s",
+                        "detail_group_name = %s", "detail_group_type = %s", "detail_is_shutup_all = %s",
+                        "online_member_num = %s"
+                    ]
+                    update_params = [
+                        group.get('group_name'),
+                        group.get('group_type'),
+                        group.get('face_url'),
+                        group.get('detail_face_url'),
+                        create_time_dt,
+                        group.get('max_member_num'),
+                        group.get('member_num'),
+                        group.get('introduction'),
+                        group.get('notification'),
+                        group.get('searchable'),
+                        group.get('visible'),
+                        group.get('add_option'),
+                        group.get('is_shutup_all'),
+                        group.get('next_msg_seq'),
+                        group.get('latest_seq'),
+                        last_msg_time_dt,
+                        last_info_time_dt,
+                        group.get('info_seq'),
+                        group.get('detail_info_seq'),
+                        group.get('detail_group_id'),
+                        group.get('detail_group_name'),
+                        group.get('detail_group_type'),
+                        group.get('detail_is_shutup_all'),
+                        group.get('online_member_num')
+                    ]
+                    
+                    # 只有当 owner_identifier 不为空时才添加到更新语句中
+                    owner_identifier = group.get('owner_identifier')
+                    if not is_empty(owner_identifier):
+                        update_fields.append("owner_identifier = %s")
+                        update_params.append(owner_identifier)
+                        print(f"[groups/sync] 将更新 owner_identifier: {owner_identifier}")
+                    else:
+                        print(f"[groups/sync] owner_identifier 为空，跳过更新")
+                    
+                    # 只有当 classid 和 schoolid 不为空时才添加到更新语句中
+                    if not is_empty(group_classid):
+                        update_fields.append("classid = %s")
+                        update_params.append(group_classid)
+                        print(f"[groups/sync] 将更新 classid: {group_classid}")
+                    else:
+                        print(f"[groups/sync] classid 为空，跳过更新")
+                    
+                    if not is_empty(group_schoolid):
+                        update_fields.append("schoolid = %s")
+                        update_params.append(group_schoolid)
+                        print(f"[groups/sync] 将更新 schoolid: {group_schoolid}")
+                    else:
+                        print(f"[groups/sync] schoolid 为空，跳过更新")
+                    
+                    # 处理 is_class_group 字段（如果客户端传过来则更新，否则使用默认值1）
+                    is_class_group = group.get('is_class_group')
+                    if is_class_group is not None:
+                        update_fields.append("is_class_group = %s")
+                        update_params.append(is_class_group)
+                        print(f"[groups/sync] 将更新 is_class_group: {is_class_group}")
+                    else:
+                        print(f"[groups/sync] is_class_group 未提供，使用数据库默认值")
+                    
+                    update_params.append(group.get('group_id'))  # WHERE 条件参数
+                    
+                    update_group_sql = f"""
+                        UPDATE `groups` SET
+                            {', '.join(update_fields)}
+                        WHERE group_id = %s
+                    """
+                    print(f"[groups/sync] 更新参数: {update_params}")
+                    cursor.execute(update_group_sql, update_params)
+                    affected_rows = cursor.rowcount
+                    print(f"[groups/sync] 更新群组 {group_id} 完成, 影响行数: {affected_rows}")
+                else:
+                    # 插入新群组
+                    print(f"[groups/sync] 插入新群组 {group_id}...")
+                    # 转换时间戳
+                    create_time_dt = timestamp_to_datetime(group.get('create_time'))
+                    last_msg_time_dt = timestamp_to_datetime(group.get('last_msg_time'))
+                    last_info_time_dt = timestamp_to_datetime(group.get('last_info_time'))
+                    
+                    print(f"[groups/sync] 时间戳转换: create_time={create_time_dt}, last_msg_time={last_msg_time_dt}, last_info_time={last_info_time_dt}")
+                    
+                    # 优先使用群组数据中的 classid 和 schoolid，如果没有则使用请求级别的
+                    # 注意：客户端发送的字段名是 classid 和 schoolid（不是 class_id 和 school_id）
+                    # 如果字段为空，则插入 NULL
+                    group_classid = group.get('classid') or classid
+                    group_schoolid = group.get('schoolid') or schoolid
+                    
+                    # 检查值是否为空（None、空字符串、空值）
+                    def is_empty(value):
+                        return value is None or value == '' or (isinstance(value, str) and value.strip() == '')
+                    
+                    # 如果为空，则使用 None（插入 NULL）
+                    if is_empty(group_classid):
+                        group_classid = None
+                        print(f"[groups/sync] classid 为空，将插入 NULL")
+                    else:
+                        print(f"[groups/sync] 将插入 classid: {group_classid}")
+                    
+                    if is_empty(group_schoolid):
+                        group_schoolid = None
+                        print(f"[groups/sync] schoolid 为空，将插入 NULL")
+                    else:
+                        print(f"[groups/sync] 将插入 schoolid: {group_schoolid}")
+                    
+                    insert_group_sql = """
+                        INSERT INTO `groups` (
+                            group_id, group_name, group_type, face_url, detail_face_url,
+                            owner_identifier, create_time, max_member_num, member_num,
+                            introduction, notification, searchable, visible, add_option,
+                            is_shutup_all, next_msg_seq, latest_seq, last_msg_time,
+                            last_info_time, info_seq, detail_info_seq, detail_group_id,
+                            detail_group_name, detail_group_type, detail_is_shutup_all,
+                            online_member_num, classid, schoolid, is_class_group
+                        ) VALUES (
+                            %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s,
+                            %s, %s, %s, %s, %s, %s, %s, %s,
+                            %s, %s, %s, %s, %s, %s, %s, %s, %s, %s
+                        )
+                    """
+                    insert_params = (
+                        group.get('group_id'),
+                        group.get('group_name'),
+                        group.get('group_type'),
+                        group.get('face_url'),
+                        group.get('detail_face_url'),
+                        group.get('owner_identifier'),
+                        create_time_dt,  # 直接使用转换后的日期时间字符串
+                        group.get('max_member_num'),
+                        group.get('member_num'),
+                        group.get('introduction'),
+                        group.get('notification'),
+                        group.get('searchable'),
+                        group.get('visible'),
+                        group.get('add_option'),
+                        group.get('is_shutup_all'),
+                        group.get('next_msg_seq'),
+                        group.get('latest_seq'),
+                        last_msg_time_dt,  # 直接使用转换后的日期时间字符串
+                        last_info_time_dt,  # 直接使用转换后的日期时间字符串
+                        group.get('info_seq'),
+                        group.get('detail_info_seq'),
+                        group.get('detail_group_id'),
+                        group.get('detail_group_name'),
+                        group.get('detail_group_type'),
+                        group.get('detail_is_shutup_all'),
+                        group.get('online_member_num'),
+                        group_classid,  # 如果为空则为 None，插入 NULL
+                        group_schoolid,  # 如果为空则为 None，插入 NULL
+                        group.get('is_class_group', 1)  # 如果未提供则使用默认值1（班级群）
+                    )
+                    print(f"[groups/sync] 插入参数: {insert_params}")
+                    cursor.execute(insert_group_sql, insert_params)
+                    affected_rows = cursor.rowcount
+                    lastrowid = cursor.lastrowid
+                    print(f"[groups/sync] 插入群组 {group_id} 完成, 影响行数: {affected_rows}, lastrowid: {lastrowid}")
+                
+                # 处理群成员信息
+                # 1. 优先处理 member_info（群主，必须存在）
+                # 2. 然后处理 members 数组（管理员和其他成员）
+                members_list = group.get('members', [])
+                member_info = group.get('member_info')
+                print(f"[groups/sync] 群组 {group_id} 的成员信息: member_info={member_info is not None}, members数组={len(members_list)}个成员")
+                
+                # 记录已处理的成员ID，避免重复插入
+                processed_member_ids = set()
+                
+                # 第一步：处理 member_info（群主，必须存在）
+                if member_info:
+                    member_user_id = member_info.get('user_id')
+                    if member_user_id:
+                        print(f"[groups/sync] 处理 member_info（群主）: user_id={member_user_id}")
+                        member_user_name = member_info.get('user_name', '')
+                        member_self_role = member_info.get('self_role', 400)  # 默认群主
+                        member_join_time = timestamp_to_datetime(member_info.get('join_time')) or timestamp_to_datetime(group.get('create_time'))
+                        if not member_join_time:
+                            member_join_time = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
                         
-                        # 构建 UPDATE SQL，只更新非空字段
-                        update_fields = [
-                            "group_name = %s", "group_type = %s", "face_url = %s", "detail_face_url = %s",
-                            "create_time = %s", "max_member_num = %s",
-                            "member_num = %s", "introduction = %s", "notification = %s", "searchable = %s",
-                            "visible = %s", "add_option = %s", "is_shutup_all = %s", "next_msg_seq = %s",
-                            "latest_seq = %s", "last_msg_time = %s", "last_info_time = %s",
-                            "info_seq = %s", "detail_info_seq = %s", "detail_group_id = %s",
-                            "detail_group_name = %s", "detail_group_type = %s", "detail_is_shutup_all = %s",
-                            "online_member_num = %s"
-                        ]
-                        update_params = [
-                            group.get('group_name'),
-                            group.get('group_type'),
-                            group.get('face_url'),
-                            group.get('detail_face_url'),
-                            create_time_dt,
-                            group.get('max_member_num'),
-                            group.get('member_num'),
-                            group.get('introduction'),
-                            group.get('notification'),
-                            group.get('searchable'),
-                            group.get('visible'),
-                            group.get('add_option'),
-                            group.get('is_shutup_all'),
-                            group.get('next_msg_seq'),
-                            group.get('latest_seq'),
-                            last_msg_time_dt,
-                            last_info_time_dt,
-                            group.get('info_seq'),
-                            group.get('detail_info_seq'),
-                            group.get('detail_group_id'),
-                            group.get('detail_group_name'),
-                            group.get('detail_group_type'),
-                            group.get('detail_is_shutup_all'),
-                            group.get('online_member_num')
-                        ]
+                        # 检查成员是否已存在
+                        cursor.execute(
+                            "SELECT group_id FROM `group_members` WHERE group_id = %s AND user_id = %s",
+                            (group_id, member_user_id)
+                        )
+                        member_exists = cursor.fetchone()
                         
-                        # 只有当 owner_identifier 不为空时才添加到更新语句中
-                        owner_identifier = group.get('owner_identifier')
-                        if not is_empty(owner_identifier):
-                            update_fields.append("owner_identifier = %s")
-                            update_params.append(owner_identifier)
-                            print(f"[groups/sync] 将更新 owner_identifier: {owner_identifier}")
+                        if member_exists:
+                            # 更新群主信息
+                            print(f"[groups/sync] 更新群主 group_id={group_id}, user_id={member_user_id}, self_role={member_self_role}")
+                            update_member_sql = """
+                                UPDATE `group_members` SET
+                                    user_name = %s, self_role = %s, join_time = %s,
+                                    msg_flag = %s, self_msg_flag = %s, readed_seq = %s, unread_num = %s
+                                WHERE group_id = %s AND user_id = %s
+                            """
+                            update_params = (
+                                member_user_name if member_user_name else None,
+                                member_self_role,
+                                member_join_time,
+                                member_info.get('msg_flag', 0),
+                                member_info.get('self_msg_flag', 0),
+                                member_info.get('readed_seq', 0),
+                                member_info.get('unread_num', 0),
+                                group_id,
+                                member_user_id
+                            )
+                            cursor.execute(update_member_sql, update_params)
                         else:
-                            print(f"[groups/sync] owner_identifier 为空，跳过更新")
+                            # 插入群主
+                            print(f"[groups/sync] 插入群主 group_id={group_id}, user_id={member_user_id}, self_role={member_self_role}")
+                            insert_member_sql = """
+                                INSERT INTO `group_members` (
+                                    group_id, user_id, user_name, self_role, join_time, msg_flag,
+                                    self_msg_flag, readed_seq, unread_num
+                                ) VALUES (
+                                    %s, %s, %s, %s, %s, %s, %s, %s, %s
+                                )
+                            """
+                            insert_params = (
+                                group_id,
+                                member_user_id,
+                                member_user_name if member_user_name else None,
+                                member_self_role,
+                                member_join_time,
+                                member_info.get('msg_flag', 0),
+                                member_info.get('self_msg_flag', 0),
+                                member_info.get('readed_seq', 0),
+                                member_info.get('unread_num', 0)
+                            )
+                            cursor.execute(insert_member_sql, insert_params)
                         
-                        # 只有当 classid 和 schoolid 不为空时才添加到更新语句中
-                        if not is_empty(group_classid):
-                            update_fields.append("classid = %s")
-                            update_params.append(group_classid)
-                            print(f"[groups/sync] 将更新 classid: {group_classid}")
-                        else:
-                            print(f"[groups/sync] classid 为空，跳过更新")
+                        processed_member_ids.add(member_user_id)
+                    else:
+                        print(f"[groups/sync] 警告: member_info 缺少 user_id，跳过")
+                else:
+                    print(f"[groups/sync] 警告: 缺少 member_info（群主信息），这是必需的")
+                
+                # 第二步：处理 members 数组（管理员和其他成员）
+                if members_list:
+                    print(f"[groups/sync] 处理 members 数组，共 {len(members_list)} 个成员")
+                    for member_item in members_list:
+                        # 兼容新旧字段名
+                        member_user_id = member_item.get('user_id') or member_item.get('unique_member_id')
+                        member_user_name = member_item.get('user_name') or member_item.get('member_name', '')
                         
-                        if not is_empty(group_schoolid):
-                            update_fields.append("schoolid = %s")
-                            update_params.append(group_schoolid)
-                            print(f"[groups/sync] 将更新 schoolid: {group_schoolid}")
-                        else:
-                            print(f"[groups/sync] schoolid 为空，跳过更新")
+                        if not member_user_id:
+                            print(f"[groups/sync] 警告: 成员信息缺少 user_id/unique_member_id，跳过")
+                            continue
+                        
+                        # 如果该成员已经在 member_info 中处理过（群主），跳过避免重复
+                        if member_user_id in processed_member_ids:
+                            print(f"[groups/sync] 跳过已处理的成员（群主）: user_id={member_user_id}")
+                            continue
                         
-                        # 处理 is_class_group 字段（如果客户端传过来则更新，否则使用默认值1）
-                        is_class_group = group.get('is_class_group')
-                        if is_class_group is not None:
-                            update_fields.append("is_class_group = %s")
-                            update_params.append(is_class_group)
-                            print(f"[groups/sync] 将更新 is_class_group: {is_class_group}")
+                        # 处理 self_role：优先使用 self_role，否则从 group_role 转换
+                        if 'self_role' in member_item:
+                            member_self_role = member_item.get('self_role')
                         else:
-                            print(f"[groups/sync] is_class_group 未提供，使用数据库默认值")
+                            # 从 group_role 转换：400=群主，300=管理员，其他=普通成员(200)
+                            group_role = member_item.get('group_role')
+                            if group_role == 400:
+                                member_self_role = 400  # 群主（但应该已经在 member_info 中处理）
+                            elif group_role == 300:
+                                member_self_role = 300  # 管理员（保持300）
+                            else:
+                                member_self_role = 200  # 普通成员
                         
-                        update_params.append(group.get('group_id'))  # WHERE 条件参数
+                        # 处理 join_time：支持时间戳或直接使用当前时间
+                        member_join_time = timestamp_to_datetime(member_item.get('join_time')) or timestamp_to_datetime(group.get('create_time'))
+                        if not member_join_time:
+                            member_join_time = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
                         
-                        update_group_sql = f"""
-                            UPDATE `groups` SET
-                                {', '.join(update_fields)}
-                            WHERE group_id = %s
-                        """
-                        print(f"[groups/sync] 更新参数: {update_params}")
-                        cursor.execute(update_group_sql, update_params)
-                        affected_rows = cursor.rowcount
-                        print(f"[groups/sync] 更新群组 {group_id} 完成, 影响行数: {affected_rows}")
-                    else:
-                        # 插入新群组
-                        print(f"[groups/sync] 插入新群组 {group_id}...")
-                        # 转换时间戳
-                        create_time_dt = timestamp_to_datetime(group.get('create_time'))
-                        last_msg_time_dt = timestamp_to_datetime(group.get('last_msg_time'))
-                        last_info_time_dt = timestamp_to_datetime(group.get('last_info_time'))
+                        # 检查成员是否已存在
+                        cursor.execute(
+                            "SELECT group_id FROM `group_members` WHERE group_id = %s AND user_id = %s",
+                            (group_id, member_user_id)
+                        )
+                        member_exists = cursor.fetchone()
                         
-                        print(f"[groups/sync] 时间戳转换: create_time={create_time_dt}, last_msg_time={last_msg_time_dt}, last_info_time={last_info_time_dt}")
+                        if member_exists:
+                            # 更新成员信息
+                            print(f"[groups/sync] 更新成员 group_id={group_id}, user_id={member_user_id}, self_role={member_self_role}")
+                            update_member_sql = """
+                                UPDATE `group_members` SET
+                                    user_name = %s, self_role = %s, join_time = %s,
+                                    msg_flag = %s, self_msg_flag = %s, readed_seq = %s, unread_num = %s
+                                WHERE group_id = %s AND user_id = %s
+                            """
+                            update_params = (
+                                member_user_name if member_user_name else None,
+                                member_self_role,
+                                member_join_time,
+                                member_item.get('msg_flag', 0),
+                                member_item.get('self_msg_flag', 0),
+                                member_item.get('readed_seq', 0),
+                                member_item.get('unread_num', 0),
+                                group_id,
+                                member_user_id
+                            )
+                            cursor.execute(update_member_sql, update_params)
+                        else:
+                            # 插入新成员
+                            print(f"[groups/sync] 插入成员 group_id={group_id}, user_id={member_user_id}, self_role={member_self_role}")
+                            insert_member_sql = """
+                                INSERT INTO `group_members` (
+                                    group_id, user_id, user_name, self_role, join_time, msg_flag,
+                                    self_msg_flag, readed_seq, unread_num
+                                ) VALUES (
+                                    %s, %s, %s, %s, %s, %s, %s, %s, %s
+                                )
+                            """
+                            insert_params = (
+                                group_id,
+                                member_user_id,
+                                member_user_name if member_user_name else None,
+                                member_self_role,
+                                member_join_time,
+                                member_item.get('msg_flag', 0),
+                                member_item.get('self_msg_flag', 0),
+                                member_item.get('readed_seq', 0),
+                                member_item.get('unread_num', 0)
+                            )
+                            cursor.execute(insert_member_sql, insert_params)
                         
-                        # 优先使用群组数据中的 classid 和 schoolid，如果没有则使用请求级别的
-                        # 注意：客户端发送的字段名是 classid 和 schoolid（不是 class_id 和 school_id）
-                        # 如果字段为空，则插入 NULL
-                        group_classid = group.get('classid') or classid
-                        group_schoolid = group.get('schoolid') or schoolid
+                        processed_member_ids.add(member_user_id)
+                elif not member_info:
+                    group_id = group.get('group_id')
+                    member_user_id = member_info.get('user_id')
+                    
+                    # 检查成员是否已存在
+                    print(f"[groups/sync] 检查成员 group_id={group_id}, user_id={member_user_id} 是否已存在...")
+                    cursor.execute(
+                        "SELECT group_id FROM `group_members` WHERE group_id = %s AND user_id = %s",
+                        (group_id, member_user_id)
+                    )
+                    member_exists = cursor.fetchone()
+                    print(f"[groups/sync] 成员已存在: {member_exists is not None}")
+                    
+                    if member_exists:
+                        # 更新成员信息
+                        print(f"[groups/sync] 更新成员信息 group_id={group_id}, user_id={member_user_id}...")
+                        join_time_dt = timestamp_to_datetime(member_info.get('join_time'))
+                        member_user_name = member_info.get('user_name')  # 获取成员名称
                         
                         # 检查值是否为空（None、空字符串、空值）
                         def is_empty(value):
                             return value is None or value == '' or (isinstance(value, str) and value.strip() == '')
                         
-                        # 如果为空，则使用 None（插入 NULL）
-                        if is_empty(group_classid):
-                            group_classid = None
-                            print(f"[groups/sync] classid 为空，将插入 NULL")
-                        else:
-                            print(f"[groups/sync] 将插入 classid: {group_classid}")
+                        # 构建 UPDATE SQL，如果字段为空则不更新
+                        update_fields = [
+                            "self_role = %s", "join_time = %s", "msg_flag = %s",
+                            "self_msg_flag = %s", "readed_seq = %s", "unread_num = %s"
+                        ]
+                        update_params = [
+                            member_info.get('self_role'),
+                            join_time_dt,
+                            member_info.get('msg_flag'),
+                            member_info.get('self_msg_flag'),
+                            member_info.get('readed_seq'),
+                            member_info.get('unread_num')
+                        ]
                         
-                        if is_empty(group_schoolid):
-                            group_schoolid = None
-                            print(f"[groups/sync] schoolid 为空，将插入 NULL")
+                        # 如果 user_name 不为空，则更新该字段；为空则跳过更新
+                        if not is_empty(member_user_name):
+                            update_fields.append("user_name = %s")
+                            update_params.append(member_user_name)
+                            print(f"[groups/sync] 将更新 user_name: {member_user_name}")
                         else:
-                            print(f"[groups/sync] 将插入 schoolid: {group_schoolid}")
+                            print(f"[groups/sync] user_name 为空，跳过更新该字段")
                         
-                        insert_group_sql = """
-                            INSERT INTO `groups` (
-                                group_id, group_name, group_type, face_url, detail_face_url,
-                                owner_identifier, create_time, max_member_num, member_num,
-                                introduction, notification, searchable, visible, add_option,
-                                is_shutup_all, next_msg_seq, latest_seq, last_msg_time,
-                                last_info_time, info_seq, detail_info_seq, detail_group_id,
-                                detail_group_name, detail_group_type, detail_is_shutup_all,
-                                online_member_num, classid, schoolid, is_class_group
+                        update_params.extend([group_id, member_user_id])  # WHERE 条件参数
+                        
+                        update_member_sql = f"""
+                            UPDATE `group_members` SET
+                                {', '.join(update_fields)}
+                            WHERE group_id = %s AND user_id = %s
+                        """
+                        update_member_params = tuple(update_params)
+                        print(f"[groups/sync] 更新成员参数: {update_member_params}")
+                        cursor.execute(update_member_sql, update_member_params)
+                        affected_rows = cursor.rowcount
+                        print(f"[groups/sync] 更新成员完成, 影响行数: {affected_rows}")
+                    else:
+                        # 插入新成员
+                        print(f"[groups/sync] 插入新成员 group_id={group_id}, user_id={member_user_id}...")
+                        join_time_dt = timestamp_to_datetime(member_info.get('join_time'))
+                        member_user_name = member_info.get('user_name')  # 获取成员名称
+                        
+                        insert_member_sql = """
+                            INSERT INTO `group_members` (
+                                group_id, user_id, user_name, self_role, join_time, msg_flag,
+                                self_msg_flag, readed_seq, unread_num
                             ) VALUES (
-                                %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s,
-                                %s, %s, %s, %s, %s, %s, %s, %s,
-                                %s, %s, %s, %s, %s, %s, %s, %s, %s, %s
+                                %s, %s, %s, %s, %s, %s, %s, %s, %s
                             )
                         """
-                        insert_params = (
-                            group.get('group_id'),
-                            group.get('group_name'),
-                            group.get('group_type'),
-                            group.get('face_url'),
-                            group.get('detail_face_url'),
-                            group.get('owner_identifier'),
-                            create_time_dt,  # 直接使用转换后的日期时间字符串
-                            group.get('max_member_num'),
-                            group.get('member_num'),
-                            group.get('introduction'),
-                            group.get('notification'),
-                            group.get('searchable'),
-                            group.get('visible'),
-                            group.get('add_option'),
-                            group.get('is_shutup_all'),
-                            group.get('next_msg_seq'),
-                            group.get('latest_seq'),
-                            last_msg_time_dt,  # 直接使用转换后的日期时间字符串
-                            last_info_time_dt,  # 直接使用转换后的日期时间字符串
-                            group.get('info_seq'),
-                            group.get('detail_info_seq'),
-                            group.get('detail_group_id'),
-                            group.get('detail_group_name'),
-                            group.get('detail_group_type'),
-                            group.get('detail_is_shutup_all'),
-                            group.get('online_member_num'),
-                            group_classid,  # 如果为空则为 None，插入 NULL
-                            group_schoolid,  # 如果为空则为 None，插入 NULL
-                            group.get('is_class_group', 1)  # 如果未提供则使用默认值1（班级群）
+                        insert_member_params = (
+                            group_id,
+                            member_user_id,
+                            member_user_name,  # 如果为空则插入 NULL
+                            member_info.get('self_role'),
+                            join_time_dt,
+                            member_info.get('msg_flag'),
+                            member_info.get('self_msg_flag'),
+                            member_info.get('readed_seq'),
+                            member_info.get('unread_num')
                         )
-                        print(f"[groups/sync] 插入参数: {insert_params}")
-                        cursor.execute(insert_group_sql, insert_params)
+                        print(f"[groups/sync] 插入成员参数: user_name={member_user_name}")
+                        print(f"[groups/sync] 插入成员参数: {insert_member_params}")
+                        cursor.execute(insert_member_sql, insert_member_params)
                         affected_rows = cursor.rowcount
                         lastrowid = cursor.lastrowid
-                        print(f"[groups/sync] 插入群组 {group_id} 完成, 影响行数: {affected_rows}, lastrowid: {lastrowid}")
-                    
-                    # 处理群成员信息
-                    # 1. 优先处理 member_info（群主，必须存在）
-                    # 2. 然后处理 members 数组（管理员和其他成员）
-                    members_list = group.get('members', [])
-                    member_info = group.get('member_info')
-                    print(f"[groups/sync] 群组 {group_id} 的成员信息: member_info={member_info is not None}, members数组={len(members_list)}个成员")
-                    
-                    # 记录已处理的成员ID，避免重复插入
-                    processed_member_ids = set()
-                    
-                    # 第一步：处理 member_info（群主，必须存在）
-                    if member_info:
-                        member_user_id = member_info.get('user_id')
-                        if member_user_id:
-                            print(f"[groups/sync] 处理 member_info（群主）: user_id={member_user_id}")
-                            member_user_name = member_info.get('user_name', '')
-                            member_self_role = member_info.get('self_role', 400)  # 默认群主
-                            member_join_time = timestamp_to_datetime(member_info.get('join_time')) or timestamp_to_datetime(group.get('create_time'))
-                            if not member_join_time:
-                                member_join_time = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+                        print(f"[groups/sync] 插入成员完成, 影响行数: {affected_rows}, lastrowid: {lastrowid}")
+                else:
+                    # 如果没有成员信息，从 owner_identifier 获取群主信息并插入
+                    print(f"[groups/sync] 群组 {group_id} 没有成员信息，尝试从 owner_identifier 获取群主信息")
+                    owner_identifier = group.get('owner_identifier')
+                    if owner_identifier:
+                        print(f"[groups/sync] 群组 {group_id} 的 owner_identifier: {owner_identifier}")
+                        # 从 ta_teacher 表查询群主姓名
+                        cursor.execute(
+                            "SELECT name FROM ta_teacher WHERE teacher_unique_id = %s",
+                            (owner_identifier,)
+                        )
+                        teacher_result = cursor.fetchone()
+                        if teacher_result:
+                            # groups/sync 接口使用普通游标，返回元组格式
+                            teacher_name = teacher_result[0]
+                            print(f"[groups/sync] 从 ta_teacher 表获取到群主姓名: {teacher_name}")
                             
-                            # 检查成员是否已存在
+                            # 检查该成员是否已存在
                             cursor.execute(
                                 "SELECT group_id FROM `group_members` WHERE group_id = %s AND user_id = %s",
-                                (group_id, member_user_id)
+                                (group_id, owner_identifier)
                             )
                             member_exists = cursor.fetchone()
                             
                             if member_exists:
-                                # 更新群主信息
-                                print(f"[groups/sync] 更新群主 group_id={group_id}, user_id={member_user_id}, self_role={member_self_role}")
-                                update_member_sql = """
+                                # 更新群主信息（兼容已有的更新方法）
+                                print(f"[groups/sync] 更新群主信息 group_id={group_id}, user_id={owner_identifier}...")
+                                
+                                # 检查值是否为空（兼容已有的 is_empty 函数逻辑）
+                                def is_empty(value):
+                                    return value is None or value == '' or (isinstance(value, str) and value.strip() == '')
+                                
+                                # 构建 UPDATE SQL，如果字段为空则不更新（兼容已有的更新逻辑）
+                                update_fields = [
+                                    "self_role = %s"
+                                ]
+                                update_params = [
+                                    400  # self_role (群主)
+                                ]
+                                
+                                # 如果 user_name 不为空，则更新该字段；为空则跳过更新（兼容已有的更新逻辑）
+                                if not is_empty(teacher_name):
+                                    update_fields.append("user_name = %s")
+                                    update_params.append(teacher_name)
+                                    print(f"[groups/sync] 将更新 user_name: {teacher_name}")
+                                else:
+                                    print(f"[groups/sync] user_name 为空，跳过更新该字段")
+                                
+                                update_params.extend([group_id, owner_identifier])  # WHERE 条件参数
+                                
+                                update_owner_sql = f"""
                                     UPDATE `group_members` SET
-                                        user_name = %s, self_role = %s, join_time = %s,
-                                        msg_flag = %s, self_msg_flag = %s, readed_seq = %s, unread_num = %s
+                                        {', '.join(update_fields)}
                                     WHERE group_id = %s AND user_id = %s
                                 """
-                                update_params = (
-                                    member_user_name if member_user_name else None,
-                                    member_self_role,
-                                    member_join_time,
-                                    member_info.get('msg_flag', 0),
-                                    member_info.get('self_msg_flag', 0),
-                                    member_info.get('readed_seq', 0),
-                                    member_info.get('unread_num', 0),
-                                    group_id,
-                                    member_user_id
-                                )
-                                cursor.execute(update_member_sql, update_params)
+                                update_owner_params = tuple(update_params)
+                                print(f"[groups/sync] 更新群主参数: {update_owner_params}")
+                                cursor.execute(update_owner_sql, update_owner_params)
+                                affected_rows = cursor.rowcount
+                                print(f"[groups/sync] 更新群主完成, 影响行数: {affected_rows}")
                             else:
-                                # 插入群主
-                                print(f"[groups/sync] 插入群主 group_id={group_id}, user_id={member_user_id}, self_role={member_self_role}")
-                                insert_member_sql = """
+                                # 插入群主信息到 group_members 表（兼容已有的插入方法）
+                                insert_owner_sql = """
                                     INSERT INTO `group_members` (
                                         group_id, user_id, user_name, self_role, join_time, msg_flag,
                                         self_msg_flag, readed_seq, unread_num
@@ -13152,371 +14675,158 @@ async def sync_groups(request: Request):
                                         %s, %s, %s, %s, %s, %s, %s, %s, %s
                                     )
                                 """
-                                insert_params = (
+                                insert_owner_params = (
                                     group_id,
-                                    member_user_id,
-                                    member_user_name if member_user_name else None,
-                                    member_self_role,
-                                    member_join_time,
-                                    member_info.get('msg_flag', 0),
-                                    member_info.get('self_msg_flag', 0),
-                                    member_info.get('readed_seq', 0),
-                                    member_info.get('unread_num', 0)
+                                    owner_identifier,  # user_id
+                                    teacher_name,  # user_name
+                                    400,  # self_role (群主)
+                                    None,  # join_time
+                                    None,  # msg_flag
+                                    None,  # self_msg_flag
+                                    None,  # readed_seq
+                                    None   # unread_num
                                 )
-                                cursor.execute(insert_member_sql, insert_params)
-                            
-                            processed_member_ids.add(member_user_id)
+                                print(f"[groups/sync] 插入群主信息: group_id={group_id}, user_id={owner_identifier}, user_name={teacher_name}, self_role=400")
+                                print(f"[groups/sync] 插入群主参数: {insert_owner_params}")
+                                cursor.execute(insert_owner_sql, insert_owner_params)
+                                affected_rows = cursor.rowcount
+                                lastrowid = cursor.lastrowid
+                                print(f"[groups/sync] 插入群主完成, 影响行数: {affected_rows}, lastrowid: {lastrowid}")
                         else:
-                            print(f"[groups/sync] 警告: member_info 缺少 user_id，跳过")
+                            print(f"[groups/sync] 警告: 在 ta_teacher 表中未找到 teacher_unique_id={owner_identifier} 的记录")
                     else:
-                        print(f"[groups/sync] 警告: 缺少 member_info（群主信息），这是必需的")
-                    
-                    # 第二步：处理 members 数组（管理员和其他成员）
-                    if members_list:
-                        print(f"[groups/sync] 处理 members 数组，共 {len(members_list)} 个成员")
-                        for member_item in members_list:
-                            # 兼容新旧字段名
-                            member_user_id = member_item.get('user_id') or member_item.get('unique_member_id')
-                            member_user_name = member_item.get('user_name') or member_item.get('member_name', '')
-                            
-                            if not member_user_id:
-                                print(f"[groups/sync] 警告: 成员信息缺少 user_id/unique_member_id，跳过")
-                                continue
-                            
-                            # 如果该成员已经在 member_info 中处理过（群主），跳过避免重复
-                            if member_user_id in processed_member_ids:
-                                print(f"[groups/sync] 跳过已处理的成员（群主）: user_id={member_user_id}")
-                                continue
-                            
-                            # 处理 self_role：优先使用 self_role，否则从 group_role 转换
-                            if 'self_role' in member_item:
-                                member_self_role = member_item.get('self_role')
-                            else:
-                                # 从 group_role 转换：400=群主，300=管理员，其他=普通成员(200)
-                                group_role = member_item.get('group_role')
-                                if group_role == 400:
-                                    member_self_role = 400  # 群主（但应该已经在 member_info 中处理）
-                                elif group_role == 300:
-                                    member_self_role = 300  # 管理员（保持300）
-                                else:
-                                    member_self_role = 200  # 普通成员
-                            
-                            # 处理 join_time：支持时间戳或直接使用当前时间
-                            member_join_time = timestamp_to_datetime(member_item.get('join_time')) or timestamp_to_datetime(group.get('create_time'))
-                            if not member_join_time:
-                                member_join_time = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                            
-                            # 检查成员是否已存在
-                            cursor.execute(
-                                "SELECT group_id FROM `group_members` WHERE group_id = %s AND user_id = %s",
-                                (group_id, member_user_id)
-                            )
-                            member_exists = cursor.fetchone()
-                            
-                            if member_exists:
-                                # 更新成员信息
-                                print(f"[groups/sync] 更新成员 group_id={group_id}, user_id={member_user_id}, self_role={member_self_role}")
-                                update_member_sql = """
-                                    UPDATE `group_members` SET
-                                        user_name = %s, self_role = %s, join_time = %s,
-                                        msg_flag = %s, self_msg_flag = %s, readed_seq = %s, unread_num = %s
-                                    WHERE group_id = %s AND user_id = %s
-                                """
-                                update_params = (
-                                    member_user_name if member_user_name else None,
-                                    member_self_role,
-                                    member_join_time,
-                                    member_item.get('msg_flag', 0),
-                                    member_item.get('self_msg_flag', 0),
-                                    member_item.get('readed_seq', 0),
-                                    member_item.get('unread_num', 0),
-                                    group_id,
-                                    member_user_id
-                                )
-                                cursor.execute(update_member_sql, update_params)
-                            else:
-                                # 插入新成员
-                                print(f"[groups/sync] 插入成员 group_id={group_id}, user_id={member_user_id}, self_role={member_self_role}")
-                                insert_member_sql = """
-                                    INSERT INTO `group_members` (
-                                        group_id, user_id, user_name, self_role, join_time, msg_flag,
-                                        self_msg_flag, readed_seq, unread_num
-                                    ) VALUES (
-                                        %s, %s, %s, %s, %s, %s, %s, %s, %s
-                                    )
-                                """
-                                insert_params = (
-                                    group_id,
-                                    member_user_id,
-                                    member_user_name if member_user_name else None,
-                                    member_self_role,
-                                    member_join_time,
-                                    member_item.get('msg_flag', 0),
-                                    member_item.get('self_msg_flag', 0),
-                                    member_item.get('readed_seq', 0),
-                                    member_item.get('unread_num', 0)
-                                )
-                                cursor.execute(insert_member_sql, insert_params)
-                            
-                            processed_member_ids.add(member_user_id)
-                    elif not member_info:
-                        group_id = group.get('group_id')
-                        member_user_id = member_info.get('user_id')
-                        
-                        # 检查成员是否已存在
-                        print(f"[groups/sync] 检查成员 group_id={group_id}, user_id={member_user_id} 是否已存在...")
-                        cursor.execute(
-                            "SELECT group_id FROM `group_members` WHERE group_id = %s AND user_id = %s",
-                            (group_id, member_user_id)
-                        )
-                        member_exists = cursor.fetchone()
-                        print(f"[groups/sync] 成员已存在: {member_exists is not None}")
-                        
-                        if member_exists:
-                            # 更新成员信息
-                            print(f"[groups/sync] 更新成员信息 group_id={group_id}, user_id={member_user_id}...")
-                            join_time_dt = timestamp_to_datetime(member_info.get('join_time'))
-                            member_user_name = member_info.get('user_name')  # 获取成员名称
-                            
-                            # 检查值是否为空（None、空字符串、空值）
-                            def is_empty(value):
-                                return value is None or value == '' or (isinstance(value, str) and value.strip() == '')
-                            
-                            # 构建 UPDATE SQL，如果字段为空则不更新
-                            update_fields = [
-                                "self_role = %s", "join_time = %s", "msg_flag = %s",
-                                "self_msg_flag = %s", "readed_seq = %s", "unread_num = %s"
-                            ]
-                            update_params = [
-                                member_info.get('self_role'),
-                                join_time_dt,
-                                member_info.get('msg_flag'),
-                                member_info.get('self_msg_flag'),
-                                member_info.get('readed_seq'),
-                                member_info.get('unread_num')
-                            ]
-                            
-                            # 如果 user_name 不为空，则更新该字段；为空则跳过更新
-                            if not is_empty(member_user_name):
-                                update_fields.append("user_name = %s")
-                                update_params.append(member_user_name)
-                                print(f"[groups/sync] 将更新 user_name: {member_user_name}")
-                            else:
-                                print(f"[groups/sync] user_name 为空，跳过更新该字段")
-                            
-                            update_params.extend([group_id, member_user_id])  # WHERE 条件参数
-                            
-                            update_member_sql = f"""
-                                UPDATE `group_members` SET
-                                    {', '.join(update_fields)}
-                                WHERE group_id = %s AND user_id = %s
-                            """
-                            update_member_params = tuple(update_params)
-                            print(f"[groups/sync] 更新成员参数: {update_member_params}")
-                            cursor.execute(update_member_sql, update_member_params)
-                            affected_rows = cursor.rowcount
-                            print(f"[groups/sync] 更新成员完成, 影响行数: {affected_rows}")
-                        else:
-                            # 插入新成员
-                            print(f"[groups/sync] 插入新成员 group_id={group_id}, user_id={member_user_id}...")
-                            join_time_dt = timestamp_to_datetime(member_info.get('join_time'))
-                            member_user_name = member_info.get('user_name')  # 获取成员名称
-                            
-                            insert_member_sql = """
-                                INSERT INTO `group_members` (
-                                    group_id, user_id, user_name, self_role, join_time, msg_flag,
-                                    self_msg_flag, readed_seq, unread_num
-                                ) VALUES (
-                                    %s, %s, %s, %s, %s, %s, %s, %s, %s
-                                )
-                            """
-                            insert_member_params = (
-                                group_id,
-                                member_user_id,
-                                member_user_name,  # 如果为空则插入 NULL
-                                member_info.get('self_role'),
-                                join_time_dt,
-                                member_info.get('msg_flag'),
-                                member_info.get('self_msg_flag'),
-                                member_info.get('readed_seq'),
-                                member_info.get('unread_num')
-                            )
-                            print(f"[groups/sync] 插入成员参数: user_name={member_user_name}")
-                            print(f"[groups/sync] 插入成员参数: {insert_member_params}")
-                            cursor.execute(insert_member_sql, insert_member_params)
-                            affected_rows = cursor.rowcount
-                            lastrowid = cursor.lastrowid
-                            print(f"[groups/sync] 插入成员完成, 影响行数: {affected_rows}, lastrowid: {lastrowid}")
-                    else:
-                        # 如果没有成员信息，从 owner_identifier 获取群主信息并插入
-                        print(f"[groups/sync] 群组 {group_id} 没有成员信息，尝试从 owner_identifier 获取群主信息")
-                        owner_identifier = group.get('owner_identifier')
-                        if owner_identifier:
-                            print(f"[groups/sync] 群组 {group_id} 的 owner_identifier: {owner_identifier}")
-                            # 从 ta_teacher 表查询群主姓名
-                            cursor.execute(
-                                "SELECT name FROM ta_teacher WHERE teacher_unique_id = %s",
-                                (owner_identifier,)
-                            )
-                            teacher_result = cursor.fetchone()
-                            if teacher_result:
-                                # groups/sync 接口使用普通游标，返回元组格式
-                                teacher_name = teacher_result[0]
-                                print(f"[groups/sync] 从 ta_teacher 表获取到群主姓名: {teacher_name}")
-                                
-                                # 检查该成员是否已存在
-                                cursor.execute(
-                                    "SELECT group_id FROM `group_members` WHERE group_id = %s AND user_id = %s",
-                                    (group_id, owner_identifier)
-                                )
-                                member_exists = cursor.fetchone()
-                                
-                                if member_exists:
-                                    # 更新群主信息（兼容已有的更新方法）
-                                    print(f"[groups/sync] 更新群主信息 group_id={group_id}, user_id={owner_identifier}...")
-                                    
-                                    # 检查值是否为空（兼容已有的 is_empty 函数逻辑）
-                                    def is_empty(value):
-                                        return value is None or value == '' or (isinstance(value, str) and value.strip() == '')
-                                    
-                                    # 构建 UPDATE SQL，如果字段为空则不更新（兼容已有的更新逻辑）
-                                    update_fields = [
-                                        "self_role = %s"
-                                    ]
-                                    update_params = [
-                                        400  # self_role (群主)
-                                    ]
-                                    
-                                    # 如果 user_name 不为空，则更新该字段；为空则跳过更新（兼容已有的更新逻辑）
-                                    if not is_empty(teacher_name):
-                                        update_fields.append("user_name = %s")
-                                        update_params.append(teacher_name)
-                                        print(f"[groups/sync] 将更新 user_name: {teacher_name}")
-                                    else:
-                                        print(f"[groups/sync] user_name 为空，跳过更新该字段")
-                                    
-                                    update_params.extend([group_id, owner_identifier])  # WHERE 条件参数
-                                    
-                                    update_owner_sql = f"""
-                                        UPDATE `group_members` SET
-                                            {', '.join(update_fields)}
-                                        WHERE group_id = %s AND user_id = %s
-                                    """
-                                    update_owner_params = tuple(update_params)
-                                    print(f"[groups/sync] 更新群主参数: {update_owner_params}")
-                                    cursor.execute(update_owner_sql, update_owner_params)
-                                    affected_rows = cursor.rowcount
-                                    print(f"[groups/sync] 更新群主完成, 影响行数: {affected_rows}")
-                                else:
-                                    # 插入群主信息到 group_members 表（兼容已有的插入方法）
-                                    insert_owner_sql = """
-                                        INSERT INTO `group_members` (
-                                            group_id, user_id, user_name, self_role, join_time, msg_flag,
-                                            self_msg_flag, readed_seq, unread_num
-                                        ) VALUES (
-                                            %s, %s, %s, %s, %s, %s, %s, %s, %s
-                                        )
-                                    """
-                                    insert_owner_params = (
-                                        group_id,
-                                        owner_identifier,  # user_id
-                                        teacher_name,  # user_name
-                                        400,  # self_role (群主)
-                                        None,  # join_time
-                                        None,  # msg_flag
-                                        None,  # self_msg_flag
-                                        None,  # readed_seq
-                                        None   # unread_num
-                                    )
-                                    print(f"[groups/sync] 插入群主信息: group_id={group_id}, user_id={owner_identifier}, user_name={teacher_name}, self_role=400")
-                                    print(f"[groups/sync] 插入群主参数: {insert_owner_params}")
-                                    cursor.execute(insert_owner_sql, insert_owner_params)
-                                    affected_rows = cursor.rowcount
-                                    lastrowid = cursor.lastrowid
-                                    print(f"[groups/sync] 插入群主完成, 影响行数: {affected_rows}, lastrowid: {lastrowid}")
-                            else:
-                                print(f"[groups/sync] 警告: 在 ta_teacher 表中未找到 teacher_unique_id={owner_identifier} 的记录")
-                        else:
-                            print(f"[groups/sync] 群组 {group_id} 没有 owner_identifier 字段")
-                    
-                    success_count += 1
-                    print(f"[groups/sync] 群组 {group_id} 处理成功")
-                except Exception as e:
-                    error_msg = f"处理群组 {group.get('group_id')} 时出错: {e}"
-                    print(f"[groups/sync] {error_msg}")
-                    import traceback
-                    traceback_str = traceback.format_exc()
-                    print(f"[groups/sync] 错误堆栈: {traceback_str}")
-                    app_logger.error(f"{error_msg}\n{traceback_str}")
-                    error_count += 1
-                    continue
-            
-            # 提交事务
-            print(f"[groups/sync] 准备提交事务, 成功: {success_count}, 失败: {error_count}")
-            connection.commit()
-            print(f"[groups/sync] 事务提交成功")
-            
-            app_logger.info(f"群组同步完成: 成功 {success_count} 个, 失败 {error_count} 个")
-            print(f"[groups/sync] 群组同步完成: 成功 {success_count} 个, 失败 {error_count} 个")
-            
-            tencent_sync_summary = await notify_tencent_group_sync(user_id, groups)
-            print(f"[groups/sync] 腾讯 REST API 同步结果: {tencent_sync_summary}")
+                        print(f"[groups/sync] 群组 {group_id} 没有 owner_identifier 字段")
+                
+                success_count += 1
+                print(f"[groups/sync] 群组 {group_id} 处理成功")
+            except Exception as e:
+                error_msg = f"处理群组 {group.get('group_id')} 时出错: {e}"
+                print(f"[groups/sync] {error_msg}")
+                import traceback
+                traceback_str = traceback.format_exc()
+                print(f"[groups/sync] 错误堆栈: {traceback_str}")
+                app_logger.error(f"{error_msg}\n{traceback_str}")
+                error_count += 1
+                continue
+        
+        # 提交事务
+        print(f"[groups/sync] 准备提交事务, 成功: {success_count}, 失败: {error_count}")
+        connection.commit()
+        print(f"[groups/sync] 事务提交成功")
+        
+        app_logger.info(f"群组同步完成: 成功 {success_count} 个, 失败 {error_count} 个")
+        print(f"[groups/sync] 群组同步完成: 成功 {success_count} 个, 失败 {error_count} 个")
+        
+        return None, success_count, error_count
+        
+    except mysql.connector.Error as e:
+        error_msg = f"数据库错误: {e}"
+        print(f"[groups/sync] {error_msg}")
+        import traceback
+        traceback_str = traceback.format_exc()
+        print(f"[groups/sync] 数据库错误堆栈: {traceback_str}")
+        connection.rollback()
+        print(f"[groups/sync] 事务已回滚")
+        app_logger.error(f"{error_msg}\n{traceback_str}")
+        return JSONResponse({
+            'data': {
+                'message': f'数据库操作失败: {str(e)}',
+                'code': 500
+            }
+        }, status_code=500), 0, 0
+    except Exception as e:
+        error_msg = f"同步群组时发生错误: {e}"
+        print(f"[groups/sync] {error_msg}")
+        import traceback
+        traceback_str = traceback.format_exc()
+        print(f"[groups/sync] 错误堆栈: {traceback_str}")
+        connection.rollback()
+        print(f"[groups/sync] 事务已回滚")
+        app_logger.error(f"{error_msg}\n{traceback_str}")
+        return JSONResponse({
+            'data': {
+                'message': f'同步失败: {str(e)}',
+                'code': 500
+            }
+        }, status_code=500), 0, 0
+    finally:
+        if cursor:
+            cursor.close()
+            print("[groups/sync] 游标已关闭")
+        if connection and connection.is_connected():
+            connection.close()
+            print("[groups/sync] 数据库连接已关闭")
+            app_logger.info("Database connection closed after groups sync.")
 
-            result = {
+
+@app.post("/groups/sync")
+async def sync_groups(request: Request):
+    """
+    同步腾讯群组数据到本地数据库
+    接收客户端发送的群组列表，插入到 groups 和 group_members 表
+    """
+    print("=" * 80)
+    print("[groups/sync] 收到同步请求")
+    try:
+        data = await request.json()
+        print(f"[groups/sync] 原始数据: {json.dumps(data, ensure_ascii=False, indent=2)}")
+        groups = data.get('groups', [])
+        user_id = data.get('user_id')
+        # 客户端发送的字段名：classid 和 schoolid（不再是 class_id 和 school_id）
+        classid = data.get('classid')  # 从请求中获取 classid
+        schoolid = data.get('schoolid')  # 从请求中获取 schoolid
+        print(f"[groups/sync] 解析结果 - user_id: {user_id}, groups数量: {len(groups)}, classid: {classid}, schoolid: {schoolid}")
+        
+        if not groups:
+            print("[groups/sync] 错误: 没有群组数据")
+            return JSONResponse({
                 'data': {
-                    'message': '群组同步完成',
-                    'code': 200,
-                    'success_count': success_count,
-                    'error_count': error_count,
-                    'tencent_sync': tencent_sync_summary
+                    'message': '没有群组数据需要同步',
+                    'code': 400
                 }
-            }
-            print(f"[groups/sync] 返回结果: {result}")
-            return JSONResponse(result, status_code=200)
-            
-        except mysql.connector.Error as e:
-            error_msg = f"数据库错误: {e}"
-            print(f"[groups/sync] {error_msg}")
-            import traceback
-            traceback_str = traceback.format_exc()
-            print(f"[groups/sync] 数据库错误堆栈: {traceback_str}")
-            connection.rollback()
-            print(f"[groups/sync] 事务已回滚")
-            app_logger.error(f"{error_msg}\n{traceback_str}")
+            }, status_code=400)
+        
+        if not user_id:
+            print("[groups/sync] 错误: 缺少 user_id")
             return JSONResponse({
                 'data': {
-                    'message': f'数据库操作失败: {str(e)}',
-                    'code': 500
+                    'message': '缺少 user_id 参数',
+                    'code': 400
                 }
-            }, status_code=500)
+            }, status_code=400)
+        
+        # 写库在数据库线程池中执行，提交并归还连接后再调腾讯 REST API
+        error_response, success_count, error_count = await run_db(sync_groups_to_db, groups, user_id, classid, schoolid)
+        if error_response is not None:
+            return error_response
+
+        try:
+            tencent_sync_summary = await notify_tencent_group_sync(user_id, groups)
         except Exception as e:
-            error_msg = f"同步群组时发生错误: {e}"
-            print(f"[groups/sync] {error_msg}")
-            import traceback
-            traceback_str = traceback.format_exc()
-            print(f"[groups/sync] 错误堆栈: {traceback_str}")
-            connection.rollback()
-            print(f"[groups/sync] 事务已回滚")
-            app_logger.error(f"{error_msg}\n{traceback_str}")
+            app_logger.error(f"同步群组时发生错误: {e}\n{traceback.format_exc()}")
             return JSONResponse({
                 'data': {
                     'message': f'同步失败: {str(e)}',
                     'code': 500
                 }
             }, status_code=500)
-        finally:
-            if cursor:
-                cursor.close()
-                print("[groups/sync] 游标已关闭")
-            if connection and connection.is_connected():
-                connection.close()
-                print("[groups/sync] 数据库连接已关闭")
-                app_logger.info("Database connection closed after groups sync.")
+        print(f"[groups/sync] 腾讯 REST API 同步结果: {tencent_sync_summary}")
+
+        result = {
+            'data': {
+                'message': '群组同步完成',
+                'code': 200,
+                'success_count': success_count,
+                'error_count': error_count,
+                'tencent_sync': tencent_sync_summary
+            }
+        }
+        print(f"[groups/sync] 返回结果: {result}")
+        return JSONResponse(result, status_code=200)
     
     except Exception as e:
         error_msg = f"解析请求数据时出错: {e}"
         print(f"[groups/sync] {error_msg}")
-        import traceback
         traceback_str = traceback.format_exc()
         print(f"[groups/sync] 解析错误堆栈: {traceback_str}")
         app_logger.error(f"{error_msg}\n{traceback_str}")
@@ -13529,334 +14839,2855 @@ async def sync_groups(request: Request):
     finally:
         print("=" * 80)
 
-@app.get("/friends")
-def get_friends(id_card: str = Query(..., description="教师身份证号")):
-    """根据教师 id_card 查询关联朋友信息"""
-    connection = get_db_connection()
-    if connection is None or not connection.is_connected():
-        app_logger.error("Database connection error in /friends API.")
-        return JSONResponse({
-            'data': {
-                'message': '数据库连接失败',
-                'code': 500
-            }
-        }, status_code=500)
+@app.get("/friends")
+def get_friends(id_card: str = Query(..., description="教师身份证号")):
+    """根据教师 id_card 查询关联朋友信息"""
+    connection = get_db_connection()
+    if connection is None or not connection.is_connected():
+        app_logger.error("Database connection error in /friends API.")
+        return JSONResponse({
+            'data': {
+                'message': '数据库连接失败',
+                'code': 500
+            }
+        }, status_code=500)
+
+    results: List[Dict] = []
+    try:
+        # ① 查 teacher_unique_id
+        with connection.cursor(dictionary=True) as cursor:
+            cursor.execute("SELECT teacher_unique_id FROM ta_teacher WHERE id_card=%s", (id_card,))
+            rows = cursor.fetchall()  # 保证取完数据
+            app_logger.info(f"📌 Step1: ta_teacher for id_card={id_card} -> {rows}")
+        if not rows:
+            return {"friends": []}
+
+        teacher_unique_id = rows[0]["teacher_unique_id"]
+
+        # ② 查 ta_friend 获取 friendcode
+        with connection.cursor(dictionary=True) as cursor:
+            cursor.execute("SELECT friendcode FROM ta_friend WHERE teacher_unique_id=%s", (teacher_unique_id,))
+            friend_rows = cursor.fetchall()
+            app_logger.info(f"📌 Step2: ta_friend for teacher_unique_id={teacher_unique_id} -> {friend_rows}")
+        if not friend_rows:
+            return {"friends": []}
+
+        # ③ 遍历每个 friendcode
+        for fr in friend_rows:
+            friendcode = fr["friendcode"]
+
+            # 查 ta_teacher
+            with connection.cursor(dictionary=True) as cursor:
+                cursor.execute("SELECT * FROM ta_teacher WHERE teacher_unique_id=%s", (friendcode,))
+                teacher_rows = cursor.fetchall()
+                # app_logger.info(f"📌 Step3: ta_teacher for friendcode={friendcode} -> {teacher_rows}")
+            if not teacher_rows:
+                continue
+            friend_teacher = teacher_rows[0]
+
+            # 查 ta_user_details
+            id_number = friend_teacher.get("id_card")
+            with connection.cursor(dictionary=True) as cursor:
+                cursor.execute("SELECT * FROM ta_user_details WHERE id_number=%s", (id_number,))
+                user_rows = cursor.fetchall()
+                # app_logger.info(f"📌 Step4: ta_user_details for id_number={id_number} -> {user_rows}")
+            user_details = user_rows[0] if user_rows else None
+
+            if user_details:
+                avatar_path = user_details.get("avatar")
+                if avatar_path:
+                    local_avatar_file = resolve_local_avatar_file_path(avatar_path)
+                    if local_avatar_file and os.path.exists(local_avatar_file):
+                        try:
+                            with open(local_avatar_file, "rb") as img:
+                                user_details["avatar_base64"] = base64.b64encode(img.read()).decode("utf-8")
+                        except Exception as e:
+                            app_logger.error(f"读取图片失败 {local_avatar_file}: {e}")
+                            user_details["avatar_base64"] = None
+                    else:
+                        user_details["avatar_base64"] = None
+                else:
+                    user_details["avatar_base64"] = None
+
+            combined = {
+                "teacher_info": friend_teacher,
+                "user_details": user_details
+            }
+            # 打印组合后的数据
+            # app_logger.info(f"📌 Step5: combined record -> {combined}")
+            results.append({
+                "teacher_info": friend_teacher,
+                "user_details": user_details
+            })
+        app_logger.info(f"✅ Finished. Total friends found: {len(results)}")
+        return {
+            "count": len(results),
+            "friends": results
+        }
+
+    finally:
+        if cursor:
+            cursor.close()
+        if connection and connection.is_connected():
+            connection.close()
+            app_logger.info(f"Database connection closed for id_card={id_card}")
+
+# if __name__ == '__main__':
+#     app_logger.info("Flask application starting...")
+#     app.run(host="0.0.0.0", port=5000, debug=True)
+
+#from datetime import datetime   # 注意这里！！！
+def convert_datetime(obj):
+    if isinstance(obj, datetime.datetime):
+        return obj.strftime("%Y-%m-%d %H:%M:%S")
+    raise TypeError(f"Type {type(obj)} not serializable")
+
+# ====== WebSocket 接口：聊天室 + 心跳 ======
+# 创建群
+ # data: { group_name, permission_level, headImage_path, group_type, nickname, owner_id, members: [{unique_member_id, member_name, group_role}] }
+ #
+def insert_group_records(data: Dict[str, Any], unique_group_id: str) -> None:
+    """create_group 的数据库部分：群和成员在一个事务里写入，在数据库线程池中执行"""
+    with db_connection() as connection:
+        cursor = connection.cursor()
+        try:
+            cursor.execute(
+                "INSERT INTO ta_group (permission_level, headImage_path, group_type, nickname, unique_group_id, group_admin_id, school_id, class_id, create_time)"
+                " VALUES (%s,%s,%s,%s,%s,%s,%s,%s,NOW())",
+                (data.get('permission_level'),
+                 data.get('headImage_path'),
+                 data.get('group_type'),
+                 data.get('nickname'),
+                 unique_group_id,
+                 data.get('owner_id'),
+                 data.get('school_id'),
+                 data.get('class_id'))
+            )
+
+            for m in data['members']:
+                cursor.execute(
+                    "INSERT INTO ta_group_member_relation (unique_member_id, unique_group_id, join_time, group_role, member_name)"
+                    " VALUES (%s,%s,NOW(),%s,%s)",
+                    (m['unique_member_id'], unique_group_id, m['group_role'], m['member_name'])
+                )
+
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+        finally:
+            cursor.close()
+
+
+async def create_group(data):
+    unique_group_id = str(uuid.uuid4())
+    try:
+        await run_db(insert_group_records, data, unique_group_id)
+
+        # 给在线成员推送（其他 worker 上的成员经 hub 转发）
+        targets = await hub.lookup_many([m['unique_member_id'] for m in data['members']])
+        if targets:
+            await hub.fan_out(targets, json.dumps({
+                "type":"notify",
+                "message":f"你已加入群: {data['nickname']}",
+                "group_id": unique_group_id
+            }))
+
+        return {"code":200, "message":"群创建成功", "group_id":unique_group_id}
+
+    except Exception as e:
+        print(f"create_group错误: {e}")
+        return {"code":500, "message":"群创建失败"}
+
+ # 邀请成员加入群
+ # data: { unique_group_id, group_name, new_members: [{unique_member_id, member_name, group_role}] }
+ #
+def insert_group_member_records(data: Dict[str, Any]) -> None:
+    """invite_members 的数据库部分：新成员在一个事务里写入，在数据库线程池中执行"""
+    with db_connection() as connection:
+        cursor = connection.cursor()
+        try:
+            for m in data['new_members']:
+                cursor.execute(
+                    "INSERT INTO ta_group_member_relation (unique_member_id, unique_group_id, join_time, group_role, member_name)"
+                    " VALUES (%s,%s,NOW(),%s,%s)",
+                    (m['unique_member_id'], data['unique_group_id'], m['group_role'], m['member_name'])
+                )
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+        finally:
+            cursor.close()
+
+
+async def invite_members(data):
+    try:
+        await run_db(insert_group_member_records, data)
+
+        # 提交后再通知在线的新成员
+        targets = await hub.lookup_many([m['unique_member_id'] for m in data['new_members']])
+        if targets:
+            await hub.fan_out(targets, json.dumps({
+                "type":"notify",
+                "message":f"你被邀请加入群: {data['group_name']}",
+                "group_id": data['unique_group_id']
+            }))
+        return {"code":200, "message":"成员邀请成功"}
+
+    except Exception as e:
+        print(f"invite_members错误: {e}")
+        return {"code":500, "message":"成员邀请失败"}
+    
+def safe_del(user_id: str):
+    conn = connections.pop(user_id, None)
+    return conn
+
+async def safe_send_text(ws: WebSocket, text: str):
+    try:
+        await ws.send_text(text)
+        return True
+    except Exception:
+        return False
+
+async def safe_send_bytes(ws: WebSocket, data: bytes):
+    try:
+        await ws.send_bytes(data)
+        return True
+    except Exception:
+        return False
+
+async def safe_close(ws: WebSocket, code: int = 1000, reason: str = ""):
+    # 只在连接仍处于 CONNECTED 时尝试关闭，避免重复 close 报错
+    try:
+        if getattr(ws, "client_state", None) == WebSocketState.CONNECTED:
+            await ws.close(code=code, reason=reason)
+        return True
+    except Exception:
+        return False
+
+
+# ===== 信令编码：默认 JSON 文本，客户端协商 msgpack 子协议后信令类消息改用 msgpack 二进制帧 =====
+# 客户端连接时带 Sec-WebSocket-Protocol: msgpack（服务端未安装 msgpack 时不协商，继续使用 JSON）：
+#   - 下行：send_json 发送的信令（WebRTC/SRS、临时房间、课前准备）为 msgpack 二进制帧，其它消息仍是文本
+#   - 上行：除文本消息外，可以发 msgpack 编码的 map 二进制帧，字段同 JSON 消息；
+#           带 "to" 字段等价于 to:<target_id>:<json> 定向消息。首字节为 6 的二进制帧仍按语音帧处理
+#           （msgpack 的 map 首字节不可能是 0x06）
+WS_MSGPACK_SUBPROTOCOL = "msgpack"
+WS_MSGPACK_ENABLED = HAS_MSGPACK and os.getenv("WS_MSGPACK_ENABLED", "true").lower() in ("1", "true", "yes")
+WS_PER_MESSAGE_DEFLATE = os.getenv("WS_PER_MESSAGE_DEFLATE", "true").lower() in ("1", "true", "yes")  # uvicorn permessage-deflate
+
+
+def encode_signal(obj: Any, codec: str = "json") -> Union[str, bytes]:
+    """按连接的编码序列化一条结构化消息：json 返回文本，msgpack 返回字节"""
+    if codec == WS_MSGPACK_SUBPROTOCOL:
+        return msgpack.packb(obj, default=convert_datetime, use_bin_type=True)
+    return json.dumps(obj, ensure_ascii=False, default=convert_datetime)
+
+
+# ===== 每连接发送队列 =====
+WS_SEND_QUEUE_SIZE = int(os.getenv("WS_SEND_QUEUE_SIZE", "256"))  # 每个连接最多排队的出站帧数
+WS_SEND_OVERFLOW_POLICY = os.getenv("WS_SEND_OVERFLOW_POLICY", "drop_oldest")  # drop_oldest / disconnect
+WS_SEND_TIMEOUT = float(os.getenv("WS_SEND_TIMEOUT", "10"))  # 单帧发送超时（秒），超时视为慢连接并断开
+
+
+class WebSocketSender:
+    """
+    每个 WebSocket 连接一个有界发送队列 + 独立写协程。
+    send_text/send_bytes 只入队立即返回，慢客户端不会拖住发送方的接收循环。
+    队列满时按 overflow_policy 处理：drop_oldest 丢弃最旧一帧，disconnect 断开慢连接。
+    其余属性（receive、client_state 等）透传给底层 WebSocket。
+    """
+
+    def __init__(self, ws: WebSocket, user_id: str, maxsize: int = WS_SEND_QUEUE_SIZE,
+                 overflow_policy: str = WS_SEND_OVERFLOW_POLICY, codec: str = "json"):
+        self.ws = ws
+        self.user_id = user_id
+        self.codec = codec
+        self._maxsize = max(1, maxsize)
+        self._policy = overflow_policy
+        self._queue = deque()
+        self._wakeup = asyncio.Event()
+        self._closed = False
+        self._task: Optional[asyncio.Task] = None
+        self._close_task: Optional[asyncio.Task] = None  # 队列溢出触发的断开，保留引用避免任务被回收
+        self.stats = {"enqueued": 0, "sent": 0, "dropped": 0, "max_depth": 0, "send_errors": 0}
+
+    def __getattr__(self, name):
+        return getattr(self.ws, name)
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._writer())
+
+    @property
+    def depth(self) -> int:
+        return len(self._queue)
+
+    async def send_text(self, text: str) -> None:
+        self._put(("text", text))
+
+    async def send_bytes(self, data: bytes) -> None:
+        self._put(("bytes", data))
+
+    async def send_json(self, obj: Any, cache: Optional[Dict[str, Any]] = None) -> None:
+        """
+        按本连接协商的编码发送结构化消息。同一条消息发给多人时传入同一个 cache，
+        每种编码只序列化一次。
+        """
+        payload = cache.get(self.codec) if cache is not None else None
+        if payload is None:
+            payload = encode_signal(obj, self.codec)
+            if cache is not None:
+                cache[self.codec] = payload
+        self._put(("text" if isinstance(payload, str) else "bytes", payload))
+
+    def _put(self, item) -> None:
+        if self._closed:
+            self.stats["dropped"] += 1
+            return
+        if len(self._queue) >= self._maxsize:
+            self.stats["dropped"] += 1
+            if self._policy == "disconnect":
+                app_logger.warning(f"[ws_send] 用户 {self.user_id} 发送队列溢出（{self._maxsize}），断开慢连接")
+                self._closed = True
+                self._queue.clear()
+                self._close_task = asyncio.create_task(self.close(1008, "send queue overflow"))
+                self._close_task.add_done_callback(self._on_close_done)
+                return
+            self._queue.popleft()
+        self._queue.append(item)
+        self.stats["enqueued"] += 1
+        if len(self._queue) > self.stats["max_depth"]:
+            self.stats["max_depth"] = len(self._queue)
+        self._wakeup.set()
+
+    def _on_close_done(self, task: asyncio.Task) -> None:
+        if task.cancelled():
+            return
+        exc = task.exception()
+        if exc is not None:
+            app_logger.error(f"[ws_send] 用户 {self.user_id} 断开慢连接失败: {exc!r}", exc_info=exc)
+
+    async def _writer(self) -> None:
+        try:
+            while True:
+                while not self._queue:
+                    if self._closed:
+                        return
+                    self._wakeup.clear()
+                    await self._wakeup.wait()
+                kind, payload = self._queue.popleft()
+                try:
+                    if kind == "text":
+                        await asyncio.wait_for(self.ws.send_text(payload), WS_SEND_TIMEOUT)
+                    else:
+                        await asyncio.wait_for(self.ws.send_bytes(payload), WS_SEND_TIMEOUT)
+                    self.stats["sent"] += 1
+                except Exception as e:
+                    self.stats["send_errors"] += 1
+                    app_logger.warning(f"[ws_send] 用户 {self.user_id} 发送失败，停止写协程: {e!r}")
+                    self._closed = True
+                    self._queue.clear()
+                    await safe_close(self.ws, 1011, "send failed")
+                    return
+        except asyncio.CancelledError:
+            pass
+
+    async def stop(self) -> None:
+        """停止写协程并丢弃未发送的帧（连接结束时调用）"""
+        self._closed = True
+        self._queue.clear()
+        self._wakeup.set()
+        if self._task and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    async def close(self, code: int = 1000, reason: str = "") -> None:
+        await self.stop()
+        await safe_close(self.ws, code, reason)
+
+    async def flush_and_close(self, code: int = 1000, reason: str = "", timeout: float = WS_SEND_TIMEOUT) -> None:
+        """不再接受新帧，等队列里已有的帧写完（最多 timeout 秒）再关闭"""
+        self._closed = True
+        self._wakeup.set()
+        if self._task and not self._task.done():
+            try:
+                await asyncio.wait_for(asyncio.shield(self._task), timeout)
+            except asyncio.TimeoutError:
+                pass
+        await self.close(code, reason)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {"user_id": self.user_id, "codec": self.codec, "depth": len(self._queue), **self.stats}
+
+
+@app.get("/metrics/ws_send_queues")
+async def ws_send_queue_metrics(top: int = Query(20, description="按当前队列深度返回前 N 个连接")):
+    """各连接发送队列深度与丢弃统计"""
+    senders = [conn["ws"] for conn in list(connections.values()) if isinstance(conn.get("ws"), WebSocketSender)]
+    snapshots = sorted((sender.snapshot() for sender in senders), key=lambda x: x["depth"], reverse=True)
+    return JSONResponse({
+        "data": {
+            "connections": len(senders),
+            "queue_size": WS_SEND_QUEUE_SIZE,
+            "overflow_policy": WS_SEND_OVERFLOW_POLICY,
+            "total_depth": sum(x["depth"] for x in snapshots),
+            "total_dropped": sum(x["dropped"] for x in snapshots),
+            "top": snapshots[:max(0, top)],
+        },
+        "code": 200
+    })
+
+
+# ===== 每连接接收限流：令牌桶（连接总消息数 / 按消息类型 / 二进制帧字节数） =====
+WS_RATE_LIMIT_ENABLED = os.getenv("WS_RATE_LIMIT_ENABLED", "true").lower() in ("1", "true", "yes")
+WS_RATE_LIMIT_POLICY = os.getenv("WS_RATE_LIMIT_POLICY", "drop")  # drop 丢弃 / delay 等待令牌 / disconnect 断开
+WS_RATE_LIMIT_MAX_DELAY = float(os.getenv("WS_RATE_LIMIT_MAX_DELAY", "1.0"))  # delay 模式最长等待（秒），超过仍丢弃
+WS_MSG_RATE = float(os.getenv("WS_MSG_RATE", "100"))  # 每连接每秒消息数（文本 + 二进制，ping 不计）
+WS_MSG_BURST = float(os.getenv("WS_MSG_BURST", "200"))
+WS_BINARY_BYTES_RATE = float(os.getenv("WS_BINARY_BYTES_RATE", str(256 * 1024)))  # 每连接二进制帧字节/秒
+WS_BINARY_BYTES_BURST = float(os.getenv("WS_BINARY_BYTES_BURST", str(1024 * 1024)))
+# 按消息 type 的 (每秒, 突发)，可用 WS_TYPE_RATE_LIMITS='{"webrtc_ice_candidate": [50, 200]}' 覆盖或追加
+WS_TYPE_RATE_LIMITS: Dict[str, tuple] = {
+    "webrtc_ice_candidate": (50, 200),
+    "webrtc_offer": (2, 10),
+    "webrtc_answer": (2, 10),
+    "srs_publish_offer": (1, 5),
+    "srs_play_offer": (2, 10),
+    "1": (5, 20),
+    "3": (0.5, 5),
+    "5": (10, 30),
+    "6": (0.5, 5),
+    "prepare_class": (0.5, 5),
+    "presence_subscribe": (0.5, 5),
+}
+try:
+    WS_TYPE_RATE_LIMITS.update({k: tuple(v) for k, v in json.loads(os.getenv("WS_TYPE_RATE_LIMITS", "{}")).items()})
+except (ValueError, TypeError) as e:
+    print(f"[启动检查] WS_TYPE_RATE_LIMITS 配置无效，使用默认值: {e}")
+
+
+ws_throttle_disconnects: deque = deque(maxlen=100)  # 最近因限流被断开的连接（断开后不在 connections 里，单独保留）
+
+
+class TokenBucket:
+    """令牌桶：rate 为每秒补充的令牌数，capacity 为桶容量（允许的突发量）"""
+
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = max(rate, 1e-9)
+        self.capacity = max(capacity, 1.0)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def take(self, amount: float = 1.0) -> float:
+        """令牌足够时扣除并返回 0，否则不扣除，返回还需等待的秒数。超过桶容量的请求按一整桶计。"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            self.tokens -= amount
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+
+class ConnectionRateLimiter:
+    """单个连接的接收限流：所有帧共用一个消息桶，二进制帧另有字节桶，配置了限额的消息类型各有一个桶"""
+
+    def __init__(self, user_id: str, policy: str = WS_RATE_LIMIT_POLICY):
+        self.user_id = user_id
+        self.policy = policy
+        self._messages = TokenBucket(WS_MSG_RATE, WS_MSG_BURST)
+        self._binary_bytes = TokenBucket(WS_BINARY_BYTES_RATE, WS_BINARY_BYTES_BURST)
+        self._types: Dict[str, TokenBucket] = {}
+        self.stats = {"dropped": 0, "delayed": 0, "delay_ms_total": 0.0, "disconnected": 0}
+        self.by_kind: Dict[str, int] = {}
+
+    def _buckets(self, msg_type: Optional[str], nbytes: int):
+        if msg_type is None:
+            yield "message", self._messages, 1
+            if nbytes:
+                yield "binary_bytes", self._binary_bytes, nbytes
+            return
+        limit = WS_TYPE_RATE_LIMITS.get(msg_type)
+        if limit:
+            bucket = self._types.get(msg_type)
+            if bucket is None:
+                bucket = self._types[msg_type] = TokenBucket(*limit)
+            yield f"type:{msg_type}", bucket, 1
+
+    async def admit(self, msg_type: Optional[str] = None, nbytes: int = 0) -> str:
+        """
+        msg_type 为 None 时检查连接级消息桶（nbytes > 0 时同时检查二进制字节桶），否则检查该类型的桶。
+        返回 "ok" / "drop" / "disconnect"。
+        """
+        if not WS_RATE_LIMIT_ENABLED:
+            return "ok"
+        for kind, bucket, amount in self._buckets(msg_type, nbytes):
+            wait = bucket.take(amount)
+            if not wait:
+                continue
+            if self.policy == "delay" and wait <= WS_RATE_LIMIT_MAX_DELAY:
+                self.stats["delayed"] += 1
+                self.stats["delay_ms_total"] += wait * 1000
+                await asyncio.sleep(wait)
+                bucket.take(amount)
+                continue
+            self.by_kind[kind] = self.by_kind.get(kind, 0) + 1
+            if self.policy == "disconnect":
+                self.stats["disconnected"] += 1
+                ws_throttle_disconnects.append({"user_id": self.user_id, "kind": kind, "at": time.time()})
+                app_logger.warning(f"[ws_throttle] 用户 {self.user_id} 超出限流（{kind}），断开连接")
+                return "disconnect"
+            self.stats["dropped"] += 1
+            if self.stats["dropped"] & (self.stats["dropped"] - 1) == 0:
+                # 只在第 1、2、4、8... 次丢弃时记日志，避免刷屏
+                app_logger.warning(f"[ws_throttle] 用户 {self.user_id} 超出限流（{kind}），已丢弃 {self.stats['dropped']} 条")
+            return "drop"
+        return "ok"
+
+    def throttled(self) -> int:
+        return self.stats["dropped"] + self.stats["delayed"] + self.stats["disconnected"]
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {"user_id": self.user_id, "throttled": self.throttled(), **self.stats, "by_kind": dict(self.by_kind)}
+
+
+@app.get("/metrics/ws_throttle")
+async def ws_throttle_metrics(top: int = Query(20, description="按被限流次数返回前 N 个连接")):
+    """各连接接收限流统计（丢弃 / 延迟 / 断开次数，按触发的桶分类）"""
+    limiters = [conn["limiter"] for conn in list(connections.values()) if conn.get("limiter") is not None]
+    snapshots = sorted((limiter.snapshot() for limiter in limiters), key=lambda x: x["throttled"], reverse=True)
+    return JSONResponse({
+        "data": {
+            "enabled": WS_RATE_LIMIT_ENABLED,
+            "policy": WS_RATE_LIMIT_POLICY,
+            "message_rate": [WS_MSG_RATE, WS_MSG_BURST],
+            "binary_bytes_rate": [WS_BINARY_BYTES_RATE, WS_BINARY_BYTES_BURST],
+            "type_rates": {k: list(v) for k, v in WS_TYPE_RATE_LIMITS.items()},
+            "connections": len(limiters),
+            "total_dropped": sum(x["dropped"] for x in snapshots),
+            "total_delayed": sum(x["delayed"] for x in snapshots),
+            "top": [x for x in snapshots[:max(0, top)] if x["throttled"]],
+            "recent_disconnects": list(ws_throttle_disconnects),
+        },
+        "code": 200
+    })
+
+
+# ===== 二进制语音帧（flag 协议）编解码 =====
+# 帧格式（小端）：frameType(1)=6 | flag(1) | group_len(4) group | sender_len(4) sender
+#                | name_len(4) name | ts(8) | aac_len(4) aac
+VOICE_FRAME_TYPE = 6
+_VOICE_HEAD = struct.Struct("<BB")
+_VOICE_U32 = struct.Struct("<I")
+_VOICE_TAIL = struct.Struct("<QI")  # ts + aac_len
+
+
+class VoiceFrameError(ValueError):
+    """语音帧长度字段越界或文本字段不是合法 UTF-8"""
+
+
+class VoiceFrame(NamedTuple):
+    """解析后的语音帧。raw 为原始帧（转发时原样发送），aac 是指向 raw 的 memoryview，不复制音频数据。"""
+
+    raw: bytes
+    flag: int
+    group_id: str
+    sender_id: str
+    sender_name: str
+    ts: int
+    aac: memoryview
+
+
+_new_voice_frame = functools.partial(tuple.__new__, VoiceFrame)  # 跳过 NamedTuple 的 Python 层 __new__，热路径上省一半构造开销
+
+
+def parse_voice_frame(data) -> Optional[VoiceFrame]:
+    """
+    解析 flag 协议语音帧。frameType 不是 6 时返回 None（不是语音帧，调用方忽略）；
+    长度字段越界时抛出 VoiceFrameError，不会读到帧外或悄悄截断。
+    只有短文本字段会被解码复制，音频负载以 memoryview 返回。
+    """
+    size = len(data)
+    try:
+        frame_type, flag = _VOICE_HEAD.unpack_from(data, 0)
+        if frame_type != VOICE_FRAME_TYPE:
+            return None
+        unpack_u32 = _VOICE_U32.unpack_from
+        (length,) = unpack_u32(data, 2)
+        start = 6
+        end = start + length
+        group_id = data[start:end].decode("utf-8")
+        (length,) = unpack_u32(data, end)
+        start = end + 4
+        end = start + length
+        sender_id = data[start:end].decode("utf-8")
+        (length,) = unpack_u32(data, end)
+        start = end + 4
+        end = start + length
+        sender_name = data[start:end].decode("utf-8")
+        ts, aac_len = _VOICE_TAIL.unpack_from(data, end)
+    except struct.error:
+        raise VoiceFrameError(f"长度字段越界（帧长度 {size}）") from None
+    except UnicodeDecodeError as e:
+        raise VoiceFrameError(f"文本字段不是 UTF-8: {e}") from None
+    start = end + 12
+    end = start + aac_len
+    if end > size:
+        raise VoiceFrameError(f"aac 长度 {aac_len} 超出帧长度 {size}")
+    return _new_voice_frame((data, flag, group_id, sender_id, sender_name, ts, memoryview(data)[start:end]))
+
+
+def encode_voice_frame(flag: int, group_id: str, sender_id: str, sender_name: str, ts: int, aac: bytes = b"") -> bytes:
+    """按 flag 协议组帧（压测脚本、服务端下发用）"""
+    group_b = group_id.encode("utf-8")
+    sender_b = sender_id.encode("utf-8")
+    name_b = sender_name.encode("utf-8")
+    return b"".join((
+        _VOICE_HEAD.pack(VOICE_FRAME_TYPE, flag),
+        _VOICE_U32.pack(len(group_b)), group_b,
+        _VOICE_U32.pack(len(sender_b)), sender_b,
+        _VOICE_U32.pack(len(name_b)), name_b,
+        _VOICE_TAIL.pack(ts, len(aac)), aac,
+    ))
+
+
+# ===== 语音录制：每段录音一个缓冲写入器，磁盘 I/O 不在事件循环上做 =====
+VOICE_RECORD_DIR = os.getenv("VOICE_RECORD_DIR", "/tmp")  # 录制中的临时文件目录
+VOICE_OFFLINE_DIR = os.getenv("VOICE_OFFLINE_DIR", "/var/offline_voice")  # 录制完成后的离线语音目录
+VOICE_RECORD_FLUSH_BYTES = int(os.getenv("VOICE_RECORD_FLUSH_BYTES", str(64 * 1024)))  # 缓冲达到该大小时落盘
+VOICE_RECORD_MAX_BUFFER = int(os.getenv("VOICE_RECORD_MAX_BUFFER", str(2 * 1024 * 1024)))  # 每个发送者最多缓冲的字节数，磁盘跟不上时丢帧
+VOICE_IO_WORKERS = int(os.getenv("VOICE_IO_WORKERS", "4"))
+
+
+class VoiceRecording:
+    """一段录音：内存缓冲 + 一个打开的文件句柄，同一时刻最多一个落盘任务在跑，保证写入顺序"""
+
+    def __init__(self, sender_id: str, temp_path: str):
+        self.sender_id = sender_id
+        self.temp_path = temp_path
+        self.buffer = bytearray()
+        self.file = None
+        self.flushing: Optional[asyncio.Future] = None
+        self.bytes_written = 0
+        self.dropped_bytes = 0
+
+
+class VoiceRecorder:
+    """
+    flag 协议语音的录制：flag==0 start()，flag==1 append()，flag==2 finalize()。
+    append() 只往内存缓冲追加；文件打开、写入、关闭、移动到离线目录都在独立的 I/O 线程池里完成。
+    每个发送者同时只有一段录音，缓冲超过 max_buffer 时丢弃新帧（记入 dropped_bytes）。
+    """
+
+    def __init__(self, record_dir: str = VOICE_RECORD_DIR, offline_dir: str = VOICE_OFFLINE_DIR,
+                 flush_bytes: int = VOICE_RECORD_FLUSH_BYTES, max_buffer: int = VOICE_RECORD_MAX_BUFFER,
+                 workers: int = VOICE_IO_WORKERS):
+        self._record_dir = record_dir
+        self._offline_dir = offline_dir
+        self._flush_bytes = flush_bytes
+        self._max_buffer = max(max_buffer, flush_bytes)
+        self._executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="voice-io")
+        self._recordings: Dict[str, VoiceRecording] = {}
+        self.stats = {"started": 0, "finalized": 0, "aborted": 0, "flushes": 0, "dropped_bytes": 0, "io_errors": 0}
+
+    def _run_io(self, func, *args):
+        return asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    def is_recording(self, sender_id: str) -> bool:
+        return sender_id in self._recordings
+
+    async def start(self, group_id: str, sender_id: str, ts: int, data=b"") -> str:
+        """开始一段新录音；同一发送者未结束的旧录音直接丢弃。返回临时文件路径。"""
+        await self.abort(sender_id)
+        name = f"{group_id}_{sender_id}_{ts}.aac".replace("/", "_")
+        recording = VoiceRecording(sender_id, os.path.join(self._record_dir, name))
+        self._recordings[sender_id] = recording
+        self.stats["started"] += 1
+        if data:
+            recording.buffer += data
+        # 原先 flag==0 就会创建文件，这里同样立即落盘一次，保证 finalize 时文件一定存在
+        self._schedule_flush(recording)
+        return recording.temp_path
+
+    def append(self, sender_id: str, data) -> bool:
+        """追加一帧音频，不做任何 I/O；没有进行中的录音或缓冲已满时返回 False"""
+        recording = self._recordings.get(sender_id)
+        if recording is None:
+            return False
+        if len(recording.buffer) + len(data) > self._max_buffer:
+            recording.dropped_bytes += len(data)
+            self.stats["dropped_bytes"] += len(data)
+            return False
+        recording.buffer += data
+        if len(recording.buffer) >= self._flush_bytes:
+            self._schedule_flush(recording)
+        return True
+
+    def _schedule_flush(self, recording: VoiceRecording) -> None:
+        if recording.flushing is not None and not recording.flushing.done():
+            return  # 上一次落盘还没结束，继续攒在缓冲里，结束后会接着写
+        chunk = bytes(recording.buffer)
+        recording.buffer.clear()
+        recording.flushing = asyncio.ensure_future(self._flush(recording, chunk))
+
+    async def _flush(self, recording: VoiceRecording, chunk: bytes) -> None:
+        try:
+            await self._run_io(self._write_chunk, recording, chunk)
+            self.stats["flushes"] += 1
+        except Exception as e:
+            self.stats["io_errors"] += 1
+            app_logger.error(f"[voice_recorder] 写入 {recording.temp_path} 失败: {e}")
+            return
+        if len(recording.buffer) >= self._flush_bytes and self._recordings.get(recording.sender_id) is recording:
+            chunk = bytes(recording.buffer)
+            recording.buffer.clear()
+            await self._flush(recording, chunk)
+
+    @staticmethod
+    def _write_chunk(recording: VoiceRecording, chunk: bytes) -> None:
+        if recording.file is None:
+            recording.file = open(recording.temp_path, "wb")
+        if chunk:
+            recording.file.write(chunk)
+            recording.bytes_written += len(chunk)
+
+    async def _drain(self, recording: VoiceRecording) -> None:
+        if recording.flushing is not None:
+            await recording.flushing
+
+    def finalize(self, sender_id: str) -> Optional[asyncio.Future]:
+        """
+        结束录音：立即从进行中的录音里摘下（之后的 flag==0 会开始新录音），
+        返回一个 Future，写完剩余缓冲、关闭文件并移动到离线目录后得到最终路径。
+        移动失败时保底得到临时文件路径，写入失败得到 None；没有进行中的录音时直接返回 None。
+        """
+        recording = self._recordings.pop(sender_id, None)
+        if recording is None:
+            return None
+        return asyncio.ensure_future(self._finalize(recording))
+
+    async def _finalize(self, recording: VoiceRecording) -> Optional[str]:
+        sender_id = recording.sender_id
+        await self._drain(recording)
+        chunk = bytes(recording.buffer)
+        recording.buffer.clear()
+        try:
+            path = await self._run_io(self._finish, recording, chunk)
+        except Exception as e:
+            self.stats["io_errors"] += 1
+            app_logger.error(f"[voice_recorder] 完成录音 {recording.temp_path} 失败: {e}")
+            return None
+        self.stats["finalized"] += 1
+        if recording.dropped_bytes:
+            app_logger.warning(f"[voice_recorder] {sender_id} 本段录音因缓冲已满丢弃 {recording.dropped_bytes} 字节")
+        return path
+
+    def _finish(self, recording: VoiceRecording, chunk: bytes) -> str:
+        self._write_chunk(recording, chunk)
+        recording.file.close()
+        offline_path = os.path.join(self._offline_dir, os.path.basename(recording.temp_path))
+        try:
+            os.makedirs(self._offline_dir, exist_ok=True)
+            shutil.move(recording.temp_path, offline_path)
+        except Exception as e:
+            print(f"拷贝离线语音失败: {e}")
+            return recording.temp_path  # 保底使用原路径
+        return offline_path
+
+    async def abort(self, sender_id: str) -> None:
+        """丢弃进行中的录音并删除临时文件（重新开始录音、连接断开时调用）"""
+        recording = self._recordings.pop(sender_id, None)
+        if recording is None:
+            return
+        self.stats["aborted"] += 1
+        recording.buffer.clear()
+        try:
+            await self._drain(recording)
+            await self._run_io(self._discard, recording)
+        except Exception as e:
+            print(f"删除临时语音文件失败: {e}")
+
+    @staticmethod
+    def _discard(recording: VoiceRecording) -> None:
+        if recording.file is not None:
+            recording.file.close()
+        if os.path.exists(recording.temp_path):
+            os.remove(recording.temp_path)
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=True)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "active": len(self._recordings),
+            "buffered_bytes": sum(len(x.buffer) for x in self._recordings.values()),
+            **self.stats,
+        }
+
+
+voice_recorder = VoiceRecorder()
+
+
+@app.get("/metrics/voice_recorder")
+async def voice_recorder_metrics():
+    """进行中的录音数、缓冲字节数与丢帧统计"""
+    return JSONResponse({"data": voice_recorder.snapshot(), "code": 200})
+
+
+# ===== 离线语音：一条语音记录 + 接收人映射 =====
+# 表结构（与 class_preparation / class_preparation_receiver 同样的主记录 + 接收人模式）：
+#   CREATE TABLE voice_message (
+#       voice_id BIGINT AUTO_INCREMENT PRIMARY KEY,
+#       group_id VARCHAR(64) NOT NULL,
+#       sender_id VARCHAR(64) NOT NULL,
+#       sender_name VARCHAR(128),
+#       file_path VARCHAR(512) NOT NULL,
+#       created_at DATETIME NOT NULL,
+#       KEY idx_group (group_id)
+#   );
+#   CREATE TABLE voice_message_receiver (
+#       voice_id BIGINT NOT NULL,
+#       receiver_id VARCHAR(64) NOT NULL,
+#       is_read TINYINT NOT NULL DEFAULT 0,
+#       read_at DATETIME NULL,
+#       created_at DATETIME NOT NULL,
+#       PRIMARY KEY (voice_id, receiver_id),
+#       KEY idx_receiver_unread (receiver_id, is_read)
+#   );
+
+_voice_store_tasks: set = set()  # 持有后台任务引用，避免任务未完成就被回收
+
+
+def save_offline_voice(group_id: str, sender_id: str, sender_name: str, file_path: str,
+                       receivers: List[tuple]) -> int:
+    """
+    保存一段离线语音：一条 voice_message + 所有接收人的 voice_message_receiver，在同一个事务里提交。
+    receivers 为 [(receiver_id, is_read), ...]，发送时在线的成员已收到实时帧，直接记为已读。
+    接收人用 executemany 写入，mysql.connector 会把它合并成一条多行 INSERT。
+    """
+    with db_connection() as connection:
+        cursor = connection.cursor()
+        try:
+            cursor.execute("""
+                INSERT INTO voice_message (group_id, sender_id, sender_name, file_path, created_at)
+                VALUES (%s, %s, %s, %s, NOW())
+            """, (group_id, sender_id, sender_name, file_path))
+            voice_id = cursor.lastrowid
+            if receivers:
+                cursor.executemany("""
+                    INSERT INTO voice_message_receiver (voice_id, receiver_id, is_read, read_at, created_at)
+                    VALUES (%s, %s, %s, IF(%s = 1, NOW(), NULL), NOW())
+                """, [(voice_id, rid, is_read, is_read) for rid, is_read in receivers])
+            connection.commit()
+            return voice_id
+        except Exception:
+            connection.rollback()
+            raise
+        finally:
+            cursor.close()
+
+
+async def _store_offline_voice(offline_future: asyncio.Future, group_id: str, sender_id: str,
+                               sender_name: str, receivers: List[tuple]) -> None:
+    try:
+        offline_path = await offline_future
+        if not offline_path:
+            return
+        voice_id = await run_db(save_offline_voice, group_id, sender_id, sender_name, offline_path, receivers)
+        app_logger.info(f"[voice] 离线语音已保存 voice_id={voice_id}, group_id={group_id}, sender_id={sender_id}, 接收人={len(receivers)}")
+    except Exception as e:
+        app_logger.error(f"[voice] 保存离线语音失败 group_id={group_id}, sender_id={sender_id}: {e}")
+
+
+def schedule_offline_voice(offline_future: asyncio.Future, group_id: str, sender_id: str,
+                           sender_name: str, receivers: List[tuple]) -> None:
+    """录音落盘和入库都放到后台，发送方的接收循环不等待"""
+    task = asyncio.create_task(_store_offline_voice(offline_future, group_id, sender_id, sender_name, receivers))
+    _voice_store_tasks.add(task)
+    task.add_done_callback(_voice_store_tasks.discard)
+
+
+def fetch_unread_offline_voice(cursor, user_id: str) -> List[Dict[str, Any]]:
+    """
+    登录时取出未读离线语音，整理成与 ta_notification 一致的字段（content_text="6" 表示音频），并标记为已读。
+    表不存在等数据库错误只记日志，不影响登录流程。
+    """
+    try:
+        cursor.execute("""
+            SELECT vm.voice_id, vm.group_id, vm.sender_id, vm.sender_name, vm.file_path, vm.created_at
+            FROM voice_message_receiver vmr
+            INNER JOIN voice_message vm ON vm.voice_id = vmr.voice_id
+            WHERE vmr.receiver_id = %s AND vmr.is_read = 0
+            ORDER BY vm.created_at
+        """, (user_id,))
+        rows = cursor.fetchall()
+        if rows:
+            voice_ids = [row["voice_id"] for row in rows]
+            placeholders = ",".join(["%s"] * len(voice_ids))
+            cursor.execute(f"""
+                UPDATE voice_message_receiver SET is_read = 1, read_at = NOW()
+                WHERE receiver_id = %s AND voice_id IN ({placeholders})
+            """, (user_id, *voice_ids))
+    except Error as e:
+        app_logger.error(f"[voice] 查询离线语音失败 user_id={user_id}: {e}")
+        return []
+    return [{
+        "voice_id": row["voice_id"],
+        "sender_id": row["sender_id"],
+        "sender_name": row["sender_name"],
+        "receiver_id": user_id,
+        "unique_group_id": row["group_id"],
+        "group_name": "语音群聊",
+        "content": f"离线语音文件: {os.path.basename(row['file_path'])}",
+        "content_text": "6",
+        "is_read": 0,
+        "created_at": row["created_at"],
+    } for row in rows]
+
+
+def format_preparation_message(prep: Dict[str, Any]) -> Dict[str, Any]:
+    """class_preparation + receiver 查询行 -> 推送给客户端的课前准备消息"""
+    return {
+        "class_id": prep.get("class_id"),
+        "school_id": prep.get("school_id"),
+        "subject": prep.get("subject"),
+        "content": prep.get("content"),
+        "date": prep.get("date"),
+        "time": prep.get("time"),
+        "sender_id": prep.get("sender_id"),
+        "sender_name": prep.get("sender_name"),
+        "group_id": prep.get("group_id"),
+        "group_name": prep.get("group_name") or "",
+        "prepare_id": prep.get("prepare_id"),
+        "is_read": int(prep.get("is_read", 0)),
+        "created_at": convert_datetime(prep.get("created_at")) if prep.get("created_at") else None
+    }
+
+
+# ===== 课前准备下发：接收人先删后多行 INSERT，在线推送在后台并发进行 =====
+PREPARE_RECEIVER_BATCH = int(os.getenv("PREPARE_RECEIVER_BATCH", "500"))  # 每条多行 INSERT 的最大行数
+
+_prepare_class_tasks: set = set()  # 持有后台推送任务引用，避免任务未完成就被回收
+
+
+def load_prepare_class_group(group_id: str) -> Tuple[Optional[Dict[str, Any]], List[str]]:
+    """查询群组信息（groups）和成员 ID（group_members，已去重）；群组不存在时返回 (None, [])"""
+    with db_connection() as connection:
+        cursor = connection.cursor(dictionary=True)
+        try:
+            cursor.execute("""
+                SELECT group_id, group_name, owner_identifier
+                FROM `groups`
+                WHERE group_id = %s
+            """, (group_id,))
+            group_info = cursor.fetchone()
+            if not group_info:
+                return None, []
+            cursor.execute("""
+                SELECT user_id
+                FROM `group_members`
+                WHERE group_id = %s
+            """, (group_id,))
+            return group_info, list(dict.fromkeys(row["user_id"] for row in cursor.fetchall()))
+        finally:
+            cursor.close()
+
+
+def save_class_preparation(group_id: str, class_id, school_id, subject: str, content: str, date: str,
+                           class_time: str, sender_id: str, sender_name: str, receivers: List[tuple]) -> int:
+    """
+    保存课前准备主记录及所有接收人，一个事务提交。
+    相同 (group_id, class_id, school_id, subject, date, time) 已存在时删除旧记录及其接收人，以新的 prepare_id 重建
+    （保留首次下发的 created_at），不依赖 (prepare_id, receiver_id) 唯一键。
+    receivers 为 [(receiver_id, is_read), ...]，在线成员直接记为已读。
+    """
+    with db_connection() as connection:
+        cursor = connection.cursor(dictionary=True)
+        try:
+            cursor.execute("""
+                SELECT prepare_id, created_at FROM class_preparation
+                WHERE group_id = %s
+                  AND class_id = %s
+                  AND IFNULL(school_id, '') = %s
+                  AND subject = %s
+                  AND date = %s
+                  AND IFNULL(time, '') = %s
+                ORDER BY prepare_id DESC
+                LIMIT 1
+            """, (group_id, class_id, school_id or "", subject, date, class_time or ""))
+            existing_prepare = cursor.fetchone()
+
+            if existing_prepare:
+                # 重新下发换一个新的 prepare_id：增量同步按 prepare_id 游标推进，沿用旧 ID 时已同步过的接收人收不到
+                old_prepare_id = existing_prepare['prepare_id']
+                cursor.execute("DELETE FROM class_preparation_receiver WHERE prepare_id = %s", (old_prepare_id,))
+                cursor.execute("DELETE FROM class_preparation WHERE prepare_id = %s", (old_prepare_id,))
+                cursor.execute("""
+                    INSERT INTO class_preparation (
+                        group_id, class_id, school_id, subject, content, date, time, sender_id, sender_name,
+                        created_at, updated_at
+                    ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, IFNULL(%s, NOW()), NOW())
+                """, (group_id, class_id, school_id, subject, content, date, class_time, sender_id, sender_name,
+                      existing_prepare['created_at']))
+                prepare_id = cursor.lastrowid
+                app_logger.info(f"[prepare_class] 重新下发课前准备 prepare_id={old_prepare_id} -> {prepare_id}")
+            else:
+                cursor.execute("""
+                    INSERT INTO class_preparation (
+                        group_id, class_id, school_id, subject, content, date, time, sender_id, sender_name, created_at
+                    ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, NOW())
+                """, (group_id, class_id, school_id, subject, content, date, class_time, sender_id, sender_name))
+                prepare_id = cursor.lastrowid
+                app_logger.info(f"[prepare_class] 插入主记录成功，prepare_id={prepare_id}")
+
+            for start in range(0, len(receivers), PREPARE_RECEIVER_BATCH):
+                batch = receivers[start:start + PREPARE_RECEIVER_BATCH]
+                values = ",".join(["(%s, %s, %s, IF(%s = 1, NOW(), NULL), NOW())"] * len(batch))
+                params = [value for rid, is_read in batch for value in (prepare_id, rid, is_read, is_read)]
+                cursor.execute(f"""
+                    INSERT INTO class_preparation_receiver (prepare_id, receiver_id, is_read, read_at, created_at)
+                    VALUES {values}
+                """, params)
+            connection.commit()
+            return prepare_id
+        except Exception:
+            connection.rollback()
+            raise
+        finally:
+            cursor.close()
+
+
+def mark_preparation_unread(prepare_id: int, receiver_ids: List[str]) -> None:
+    """推送失败的在线成员改回未读，下次登录时补发"""
+    placeholders = ",".join(["%s"] * len(receiver_ids))
+    with db_connection() as connection:
+        cursor = connection.cursor()
+        try:
+            cursor.execute(f"""
+                UPDATE class_preparation_receiver SET is_read = 0, read_at = NULL
+                WHERE prepare_id = %s AND receiver_id IN ({placeholders})
+            """, (prepare_id, *receiver_ids))
+            connection.commit()
+        finally:
+            cursor.close()
+
+
+async def _deliver_prepare_class(prepare_id: int, group_id: str, targets: Dict[str, Dict[str, Any]],
+                                 prepare_message: Dict[str, Any]) -> None:
+    try:
+        result = await hub.fan_out(targets, prepare_message)
+        failed = result.failed + result.timed_out
+        if failed:
+            app_logger.warning(f"[prepare_class] 推送失败 prepare_id={prepare_id}, group_id={group_id}, 用户={failed}")
+            await run_db(mark_preparation_unread, prepare_id, failed)
+    except Exception as e:
+        app_logger.error(f"[prepare_class] 后台推送异常 prepare_id={prepare_id}, group_id={group_id}: {e}")
+
+
+def schedule_prepare_class_delivery(prepare_id: int, group_id: str, targets: Dict[str, Dict[str, Any]],
+                                    prepare_message: Dict[str, Any]) -> None:
+    """在线成员的推送放到后台，发送者的确认不等待最慢的接收方"""
+    task = asyncio.create_task(_deliver_prepare_class(prepare_id, group_id, targets, prepare_message))
+    _prepare_class_tasks.add(task)
+    task.add_done_callback(_prepare_class_tasks.discard)
+
+
+# ===== 登录增量同步：客户端带游标连接，分页拿增量，不再每次登录推送全部历史 =====
+# 协议：
+#   连接 /ws/{user_id}?sync_cursor=<游标>（首次同步传空串或 0），服务端推送第一页：
+#     {"type": "sync_page", "cursor": "<下一页游标>", "has_more": bool,
+#      "notifications": [...], "prepare_class": [...]}
+#   has_more 为 true 时客户端发送 {"type": "sync_more", "cursor": "<游标>"} 拉取下一页；
+#   客户端处理完一页后保存 cursor，下次登录带上即可只拿之后的新数据。
+#   游标格式 "<ta_notification.id>.<class_preparation.prepare_id>"，是两类数据各自已同步到的最大 ID。
+#   课前准备重新下发时分配新的 prepare_id（见 save_class_preparation），已同步过旧 ID 的客户端也能拿到。
+#   不带 sync_cursor 的老客户端仍按原来的方式一次性推送。
+# 建议索引（按游标范围扫描，避免 OR 条件全表扫描）：
+#   ALTER TABLE ta_notification ADD KEY idx_receiver_unread (receiver_id, is_read, id),
+#                               ADD KEY idx_sender_unread (sender_id, is_read, id);
+#   ALTER TABLE class_preparation_receiver ADD KEY idx_receiver_prepare (receiver_id, prepare_id);
+LOGIN_SYNC_PAGE_SIZE = int(os.getenv("LOGIN_SYNC_PAGE_SIZE", "100"))  # 每页每类数据的最大条数
+
+
+def parse_sync_cursor(raw: Optional[str]) -> Tuple[int, int]:
+    """解析同步游标，格式不对时从头同步"""
+    try:
+        notification_id, _, prepare_id = (raw or "").strip().partition(".")
+        return max(0, int(notification_id or 0)), max(0, int(prepare_id or 0))
+    except ValueError:
+        return 0, 0
+
+
+def load_login_sync_page(user_id: str, raw_cursor: Optional[str], limit: int = LOGIN_SYNC_PAGE_SIZE) -> Dict[str, Any]:
+    """
+    取游标之后的一页未读通知和课前准备（按 ID 升序），本页课前准备用一条 UPDATE 按 ID 范围标记已读。
+    在数据库线程池中执行。
+    """
+    after_notification, after_prepare = parse_sync_cursor(raw_cursor)
+    limit = max(1, limit)
+    with db_connection() as connection:
+        cursor = connection.cursor(dictionary=True)
+        try:
+            # 拆成两个可走索引的子查询，替代 (receiver_id = %s OR sender_id = %s)
+            cursor.execute("""
+                (SELECT * FROM ta_notification
+                 WHERE receiver_id = %s AND is_read = 0 AND id > %s ORDER BY id LIMIT %s)
+                UNION
+                (SELECT * FROM ta_notification
+                 WHERE sender_id = %s AND is_read = 0 AND id > %s ORDER BY id LIMIT %s)
+                ORDER BY id
+                LIMIT %s
+            """, (user_id, after_notification, limit + 1, user_id, after_notification, limit + 1, limit + 1))
+            notifications = cursor.fetchall()
+            has_more = len(notifications) > limit
+            notifications = notifications[:limit]
+            if notifications:
+                after_notification = notifications[-1]["id"]
+
+            cursor.execute("""
+                SELECT
+                    cp.prepare_id, cp.group_id, cp.class_id, cp.school_id, cp.subject, cp.content, cp.date, cp.time,
+                    cp.sender_id, cp.sender_name, cp.created_at, g.group_name, cpr.is_read
+                FROM class_preparation_receiver cpr
+                INNER JOIN class_preparation cp ON cp.prepare_id = cpr.prepare_id
+                LEFT JOIN `groups` g ON cp.group_id = g.group_id
+                WHERE cpr.receiver_id = %s AND cpr.prepare_id > %s
+                ORDER BY cpr.prepare_id
+                LIMIT %s
+            """, (user_id, after_prepare, limit + 1))
+            preparation_rows = cursor.fetchall()
+            has_more = has_more or len(preparation_rows) > limit
+            preparation_rows = preparation_rows[:limit]
+            if preparation_rows:
+                last_prepare = preparation_rows[-1]["prepare_id"]
+                if any(not row.get("is_read") for row in preparation_rows):
+                    cursor.execute("""
+                        UPDATE class_preparation_receiver
+                        SET is_read = 1, read_at = NOW()
+                        WHERE receiver_id = %s AND is_read = 0 AND prepare_id > %s AND prepare_id <= %s
+                    """, (user_id, after_prepare, last_prepare))
+                after_prepare = last_prepare
+
+            # 离线语音取出即标记已读，本身就是增量
+            notifications.extend(fetch_unread_offline_voice(cursor, user_id))
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+        finally:
+            cursor.close()
+
+    return {
+        "type": "sync_page",
+        "cursor": f"{after_notification}.{after_prepare}",
+        "has_more": has_more,
+        "notifications": notifications,
+        "prepare_class": [format_preparation_message(row) for row in preparation_rows],
+    }
+
+
+async def login_sync_page(user_id: str, raw_cursor: Optional[str], conn_entry: Optional[Dict[str, Any]] = None) -> str:
+    """增量同步的一页（JSON 文本）；查询失败返回 sync_error，客户端可带原游标重试。conn_entry 记录同步到的游标（恢复令牌用）"""
+    try:
+        page = await run_db(load_login_sync_page, user_id, raw_cursor)
+    except Exception as e:
+        app_logger.error(f"[sync] 增量同步失败 user_id={user_id}, cursor={raw_cursor}: {e}")
+        return json.dumps({"type": "sync_error", "cursor": raw_cursor or "", "message": "同步失败，请稍后重试"},
+                          ensure_ascii=False)
+    if conn_entry is not None:
+        conn_entry["sync_cursor"] = page["cursor"]
+    app_logger.info(f"[sync] user_id={user_id} cursor={raw_cursor} -> {page['cursor']}, 通知={len(page['notifications'])}, "
+                    f"课前准备={len(page['prepare_class'])}, has_more={page['has_more']}")
+    return json.dumps(page, default=convert_datetime, ensure_ascii=False)
+
+
+# ===== 群成员缓存：语音帧转发不再每帧查库 =====
+GROUP_MEMBER_CACHE_TTL = float(os.getenv("GROUP_MEMBER_CACHE_TTL", "300"))  # 成员列表缓存时间（秒），兜底未显式失效的改动
+GROUP_MEMBER_CACHE_REDIS = os.getenv("GROUP_MEMBER_CACHE_REDIS", "false").lower() in ("1", "true", "yes")  # 多进程部署时共享到 Redis
+GROUP_MEMBER_CACHE_LOCAL_TTL = float(os.getenv("GROUP_MEMBER_CACHE_LOCAL_TTL", "5"))  # 启用 Redis 时进程内缓存时间，限制其他进程失效后的滞后
+
+
+class GroupMemberCache:
+    """
+    group_id -> 成员 ID 集合的进程内缓存，可选 Redis 作为共享层；成员来源由 query 指定：
+    group_member_cache 读旧的 ta_group_member_relation（语音群发沿用），
+    group_roster_cache 读 /groups/* 维护的 group_members（在线状态统计和订阅用）。
+    未命中时在 DB 线程池里加载，同一个群的并发加载合并为一次查询。
+    /groups/join、/groups/invite、/groups/leave、/groups/remove-member、/groups/dismiss 提交后调用 invalidate()；
+    invalidate() 可在任意线程调用，用代际号丢弃失效前发起、失效后才返回的加载结果。
+    """
+
+    _REDIS_EMPTY = "__empty__"  # Redis 不能保存空集合，用占位成员表示“群里没人”
+
+    def __init__(self, ttl: float = GROUP_MEMBER_CACHE_TTL, use_redis: bool = GROUP_MEMBER_CACHE_REDIS,
+                 local_ttl: float = GROUP_MEMBER_CACHE_LOCAL_TTL,
+                 query: str = "SELECT unique_member_id FROM ta_group_member_relation WHERE unique_group_id=%s",
+                 redis_prefix: str = "group_members:"):
+        self._query = query
+        self._redis_prefix = redis_prefix
+        self._ttl = ttl
+        self._use_redis = use_redis
+        self._local_ttl = min(ttl, local_ttl) if use_redis else ttl
+        self._lock = threading.Lock()
+        self._entries: Dict[str, tuple] = {}  # group_id -> (过期时间, frozenset(member_ids))
+        self._generation: Dict[str, int] = {}
+        self._loading: Dict[str, asyncio.Future] = {}
+        self.stats = {"hits": 0, "misses": 0, "loads": 0, "redis_hits": 0, "invalidations": 0, "load_errors": 0}
+
+    async def get_members(self, group_id) -> frozenset:
+        group_id = str(group_id)
+        entry = self._entries.get(group_id)
+        if entry and entry[0] > time.monotonic():
+            self.stats["hits"] += 1
+            return entry[1]
+        self.stats["misses"] += 1
+        pending = self._loading.get(group_id)
+        if pending is None:
+            pending = asyncio.ensure_future(run_db(self._load, group_id))
+            self._loading[group_id] = pending
+            pending.add_done_callback(lambda _f, gid=group_id: self._loading.pop(gid, None))
+        return await asyncio.shield(pending)
+
+    def invalidate(self, group_id) -> None:
+        group_id = str(group_id)
+        with self._lock:
+            self._generation[group_id] = self._generation.get(group_id, 0) + 1
+            self._entries.pop(group_id, None)
+        self.stats["invalidations"] += 1
+        if self._use_redis:
+            try:
+                r.delete(self._redis_prefix + group_id)
+            except Exception as e:
+                app_logger.warning(f"[group_member_cache] Redis 失效 group_id={group_id} 失败: {e}")
+
+    def _load(self, group_id: str) -> frozenset:
+        with self._lock:
+            generation = self._generation.get(group_id, 0)
+        members = self._redis_get(group_id) if self._use_redis else None
+        if members is None:
+            try:
+                with db_connection() as connection:
+                    cursor = connection.cursor()
+                    try:
+                        cursor.execute(self._query, (group_id,))
+                        members = frozenset(str(row[0]) for row in cursor.fetchall() if row[0] is not None)
+                    finally:
+                        cursor.close()
+            except Exception:
+                self.stats["load_errors"] += 1
+                raise
+            self.stats["loads"] += 1
+        with self._lock:
+            if self._generation.get(group_id, 0) != generation:
+                # 加载期间成员发生变化，本次结果只给当前调用方用，不写回缓存
+                return members
+            self._entries[group_id] = (time.monotonic() + self._local_ttl, members)
+        if self._use_redis:
+            self._redis_put(group_id, members)
+        return members
+
+    def _redis_get(self, group_id: str) -> Optional[frozenset]:
+        try:
+            values = r.smembers(self._redis_prefix + group_id)
+        except Exception as e:
+            app_logger.warning(f"[group_member_cache] 读取 Redis group_id={group_id} 失败，回退数据库: {e}")
+            return None
+        if not values:
+            return None
+        self.stats["redis_hits"] += 1
+        return frozenset(v for v in values if v != self._REDIS_EMPTY)
+
+    def _redis_put(self, group_id: str, members: frozenset) -> None:
+        key = self._redis_prefix + group_id
+        try:
+            pipe = r.pipeline()
+            pipe.delete(key)
+            pipe.sadd(key, *(members or (self._REDIS_EMPTY,)))
+            pipe.expire(key, max(1, int(self._ttl)))
+            pipe.execute()
+        except Exception as e:
+            app_logger.warning(f"[group_member_cache] 写入 Redis group_id={group_id} 失败: {e}")
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {"groups": len(self._entries), "ttl": self._ttl, "local_ttl": self._local_ttl,
+                "redis": self._use_redis, **self.stats}
+
+
+group_member_cache = GroupMemberCache()
+group_roster_cache = GroupMemberCache(query="SELECT user_id FROM `group_members` WHERE group_id=%s",
+                                      redis_prefix="group_roster:")
+
+
+@app.get("/metrics/group_member_cache")
+async def group_member_cache_metrics():
+    """群成员缓存命中与失效统计（roster 为 group_members 表的缓存）"""
+    return JSONResponse({"data": {**group_member_cache.snapshot(), "roster": group_roster_cache.snapshot()}, "code": 200})
+
+
+# ===== 集群模式：多 worker / 多节点之间通过 Redis 投递 WebSocket 消息 =====
+HUB_CLUSTER_MODE = os.getenv("HUB_CLUSTER_MODE", "false").lower() in ("1", "true", "yes")
+HUB_WORKER_TTL = int(os.getenv("HUB_WORKER_TTL", "15"))  # worker 存活标记过期时间（秒），每 1/3 周期续期
+HUB_LOCATION_CACHE_TTL = float(os.getenv("HUB_LOCATION_CACHE_TTL", "2"))  # 用户所在 worker 的本地缓存时间（秒）
+HUB_LOCATION_CACHE_MAX = int(os.getenv("HUB_LOCATION_CACHE_MAX", "100000"))
+HUB_FANOUT_CONCURRENCY = int(os.getenv("HUB_FANOUT_CONCURRENCY", "64"))  # 一次群发中同时进行的可能阻塞的发送数
+HUB_FANOUT_TIMEOUT = float(os.getenv("HUB_FANOUT_TIMEOUT", "2.0"))  # 单个接收方（或一次跨 worker 发布）的发送超时（秒）
+_HUB_ENVELOPE_HEAD = struct.Struct(">I")
+
+
+class FanOutResult(NamedTuple):
+    """一次群发的投递结果"""
+    recipients: int
+    delivered: int
+    failed: List[str]
+    timed_out: List[str]
+    elapsed_ms: float
+
+
+class RemoteSocket:
+    """在其他 worker 上的连接：send_text/send_bytes 发布到该 worker 的投递频道，由它写给本地连接"""
+
+    def __init__(self, backplane: "HubBackplane", user_id: str, worker_id: str):
+        self._backplane = backplane
+        self.user_id = user_id
+        self.worker_id = worker_id
+
+    async def send_text(self, text: str) -> None:
+        await self._backplane.publish(self.worker_id, [self.user_id], text)
+
+    async def send_bytes(self, data: bytes) -> None:
+        await self._backplane.publish(self.worker_id, [self.user_id], data)
+
+    async def send_json(self, obj: Any, cache: Optional[Dict[str, Any]] = None) -> None:
+        # 对端连接的编码由所在 worker 决定，这里统一按 JSON 发布
+        await self._backplane.publish(self.worker_id, [self.user_id], obj)
+
+
+class HubBackplane:
+    """
+    集群模式下的用户定位与跨 worker 投递。
+    - hub:user:{user_id} -> worker_id：用户连上时登记，断开时仅当仍指向本 worker 才删除（重连到别的 worker 不会被误删）
+    - hub:worker:{worker_id}：带 TTL 的存活标记，worker 崩溃后其名下用户自动视为离线
+    - hub:deliver:{worker_id}：每个 worker 订阅自己的频道，消息体为 长度(4) + JSON 头 {"k": "t"/"b"/"j", "to": [...]} + 负载
+    lookup() 先查本地 connections，再查 Redis，返回的对象与 connections 中的条目一样可以 ["ws"].send_text()。
+    未开启集群模式时只查本地，不访问 Redis。
+    """
+
+    _UNREGISTER_LUA = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) end return 0"
+
+    def __init__(self, enabled: bool = HUB_CLUSTER_MODE):
+        if enabled and not HAS_REDIS_ASYNCIO:
+            app_logger.error("[hub] 已开启 HUB_CLUSTER_MODE，但 redis.asyncio 不可用，退回单进程模式")
+        self.enabled = enabled and HAS_REDIS_ASYNCIO
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        self._redis = None
+        self._tasks: List[asyncio.Task] = []
+        self._locations: Dict[str, tuple] = {}  # user_id -> (过期时间, worker_id 或 None)
+        self._alive: Dict[str, float] = {}  # worker_id -> 存活确认的过期时间
+        self.stats = {"published": 0, "publish_errors": 0, "received": 0, "delivered": 0, "undeliverable": 0,
+                      "lookups": 0, "location_hits": 0, "fanouts": 0, "fanout_recipients": 0,
+                      "fanout_failed": 0, "fanout_timeouts": 0}
+        self.fanout_latency = LatencyHistogram()
+
+    @staticmethod
+    def _user_key(user_id: str) -> str:
+        return f"hub:user:{user_id}"
+
+    @staticmethod
+    def _worker_key(worker_id: str) -> str:
+        return f"hub:worker:{worker_id}"
+
+    @staticmethod
+    def _channel(worker_id: str) -> str:
+        return f"hub:deliver:{worker_id}"
+
+    async def start(self) -> None:
+        if not self.enabled:
+            return
+        self._redis = aioredis.Redis(host=REDIS_HOST, port=REDIS_PORT)
+        await self._redis.set(self._worker_key(self.worker_id), 1, ex=HUB_WORKER_TTL)
+        self._tasks = [asyncio.create_task(self._keepalive()), asyncio.create_task(self._subscribe())]
+        app_logger.info(f"[hub] 集群模式已启动 worker_id={self.worker_id}")
+
+    async def stop(self) -> None:
+        if not self.enabled or self._redis is None:
+            return
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        try:
+            await self._redis.delete(self._worker_key(self.worker_id))
+            await self._redis.aclose()
+        except Exception as e:
+            app_logger.warning(f"[hub] 关闭 Redis 连接失败: {e}")
+
+    async def _keepalive(self) -> None:
+        while True:
+            await asyncio.sleep(max(1, HUB_WORKER_TTL // 3))
+            try:
+                await self._redis.set(self._worker_key(self.worker_id), 1, ex=HUB_WORKER_TTL)
+            except Exception as e:
+                app_logger.warning(f"[hub] 续期 worker 存活标记失败: {e}")
+
+    async def register(self, user_id: str) -> None:
+        if not self.enabled:
+            return
+        self._locations.pop(user_id, None)
+        try:
+            await self._redis.set(self._user_key(user_id), self.worker_id)
+        except Exception as e:
+            app_logger.error(f"[hub] 登记在线用户 {user_id} 失败: {e}")
+
+    async def unregister(self, user_id: str) -> None:
+        if not self.enabled:
+            return
+        try:
+            await self._redis.eval(self._UNREGISTER_LUA, 1, self._user_key(user_id), self.worker_id)
+        except Exception as e:
+            app_logger.error(f"[hub] 注销在线用户 {user_id} 失败: {e}")
+
+    async def lookup(self, user_id: str) -> Optional[Dict[str, Any]]:
+        """本地连接条目，或其他 worker 上的 {"ws": RemoteSocket}；不在线返回 None"""
+        conn = connections.get(user_id)
+        if conn is not None or not self.enabled:
+            return conn
+        return (await self.lookup_many([user_id])).get(user_id)
+
+    async def lookup_many(self, user_ids) -> Dict[str, Dict[str, Any]]:
+        """批量定位（群推送用），只对不在本地的用户访问一次 Redis"""
+        found: Dict[str, Dict[str, Any]] = {}
+        remote = []
+        for uid in user_ids:
+            conn = connections.get(uid)
+            if conn is not None:
+                found[uid] = conn
+            elif self.enabled:
+                remote.append(uid)
+        if remote:
+            for uid, worker_id in (await self._locate(remote)).items():
+                found[uid] = {"ws": RemoteSocket(self, uid, worker_id)}
+        return found
+
+    async def _locate(self, user_ids: List[str]) -> Dict[str, str]:
+        now = time.monotonic()
+        located: Dict[str, str] = {}
+        missing = []
+        self.stats["lookups"] += len(user_ids)
+        for uid in user_ids:
+            cached = self._locations.get(uid)
+            if cached and cached[0] > now:
+                self.stats["location_hits"] += 1
+                if cached[1]:
+                    located[uid] = cached[1]
+            else:
+                missing.append(uid)
+        if not missing:
+            return located
+        try:
+            values = await self._redis.mget([self._user_key(uid) for uid in missing])
+            workers = [v.decode() if v else None for v in values]
+            alive = await self._alive_workers({w for w in workers if w and w != self.worker_id})
+        except Exception as e:
+            app_logger.error(f"[hub] 查询用户所在 worker 失败: {e}")
+            return located
+        if len(self._locations) > HUB_LOCATION_CACHE_MAX:
+            self._locations.clear()
+        expires = now + HUB_LOCATION_CACHE_TTL
+        for uid, worker_id in zip(missing, workers):
+            # 指向本 worker 却不在本地 connections 里的是残留登记，按离线处理
+            worker_id = worker_id if worker_id in alive else None
+            self._locations[uid] = (expires, worker_id)
+            if worker_id:
+                located[uid] = worker_id
+        return located
+
+    async def _alive_workers(self, worker_ids: set) -> set:
+        now = time.monotonic()
+        alive = {w for w in worker_ids if self._alive.get(w, 0) > now}
+        unknown = [w for w in worker_ids if w not in alive]
+        if unknown:
+            flags = await self._redis.mget([self._worker_key(w) for w in unknown])
+            for worker_id, flag in zip(unknown, flags):
+                if flag:
+                    self._alive[worker_id] = now + HUB_LOCATION_CACHE_TTL
+                    alive.add(worker_id)
+        return alive
+
+    @staticmethod
+    def _send(ws, message, encoded: Dict[str, Any]):
+        if isinstance(message, str):
+            return ws.send_text(message)
+        if isinstance(message, (bytes, bytearray, memoryview)):
+            return ws.send_bytes(message)
+        return ws.send_json(message, encoded)
+
+    async def fan_out(self, targets: Dict[str, Dict[str, Any]], message, concurrency: int = HUB_FANOUT_CONCURRENCY,
+                      timeout: float = HUB_FANOUT_TIMEOUT) -> FanOutResult:
+        """
+        同一条消息发给多个已定位的连接（lookup_many 的结果）。message 为 str / bytes 原样发送，
+        为 dict 时按各连接协商的编码发送（send_json），每种编码只序列化一次。
+        本地连接的 WebSocketSender 只是入队，直接逐个写入；其余可能阻塞的发送（跨 worker 发布按 worker
+        合并为一次）并发执行，同时进行的不超过 concurrency 个，每个最多等 timeout 秒。
+        """
+        started = time.perf_counter()
+        encoded: Dict[str, Any] = {}
+        failed: List[str] = []
+        timed_out: List[str] = []
+        pending: List[tuple] = []  # (uids, 发送函数)
+        by_worker: Dict[str, List[str]] = {}
+        for uid, conn in targets.items():
+            ws = conn["ws"]
+            if isinstance(ws, RemoteSocket):
+                by_worker.setdefault(ws.worker_id, []).append(uid)
+            elif isinstance(ws, WebSocketSender):
+                try:
+                    await self._send(ws, message, encoded)
+                except Exception as e:
+                    failed.append(uid)
+                    app_logger.warning(f"[hub] 群发给 {uid} 失败: {e}")
+            else:
+                pending.append(([uid], functools.partial(self._send, ws, message, encoded)))
+        for worker_id, uids in by_worker.items():
+            pending.append((uids, functools.partial(self.publish, worker_id, uids, message)))
+
+        if pending:
+            semaphore = asyncio.Semaphore(max(1, concurrency))
+
+            async def run(send):
+                async with semaphore:
+                    return await asyncio.wait_for(send(), timeout)
+
+            results = await asyncio.gather(*(run(send) for _, send in pending), return_exceptions=True)
+            for (uids, _), result in zip(pending, results):
+                if isinstance(result, asyncio.TimeoutError):
+                    timed_out.extend(uids)
+                elif result is False or isinstance(result, BaseException):
+                    failed.extend(uids)
+
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        self.stats["fanouts"] += 1
+        self.stats["fanout_recipients"] += len(targets)
+        self.stats["fanout_failed"] += len(failed)
+        self.stats["fanout_timeouts"] += len(timed_out)
+        self.fanout_latency.observe(elapsed_ms)
+        return FanOutResult(len(targets), len(targets) - len(failed) - len(timed_out), failed, timed_out, elapsed_ms)
+
+    async def publish(self, worker_id: str, user_ids: List[str], payload) -> bool:
+        if isinstance(payload, str):
+            kind, body = "t", payload.encode("utf-8")
+        elif isinstance(payload, (bytes, bytearray, memoryview)):
+            kind, body = "b", bytes(payload)
+        else:
+            # 结构化消息按 JSON 发布，由目标 worker 按连接协商的编码发送
+            kind, body = "j", encode_signal(payload).encode("utf-8")
+        head = json.dumps({"k": kind, "to": list(user_ids)}).encode("utf-8")
+        try:
+            await self._redis.publish(self._channel(worker_id), _HUB_ENVELOPE_HEAD.pack(len(head)) + head + body)
+            self.stats["published"] += 1
+            return True
+        except Exception as e:
+            self.stats["publish_errors"] += 1
+            app_logger.error(f"[hub] 投递到 worker {worker_id} 失败: {e}")
+            return False
+
+    async def _subscribe(self) -> None:
+        while True:
+            pubsub = self._redis.pubsub()
+            try:
+                await pubsub.subscribe(self._channel(self.worker_id))
+                async for message in pubsub.listen():
+                    if message.get("type") == "message":
+                        await self._dispatch(message["data"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                app_logger.error(f"[hub] 订阅投递频道异常，1 秒后重连: {e}")
+                await asyncio.sleep(1)
+            finally:
+                try:
+                    await pubsub.aclose()
+                except Exception:
+                    pass
+
+    async def _dispatch(self, data: bytes) -> None:
+        self.stats["received"] += 1
+        try:
+            (head_len,) = _HUB_ENVELOPE_HEAD.unpack_from(data, 0)
+            head = json.loads(data[4:4 + head_len])
+            body = data[4 + head_len:]
+        except Exception as e:
+            app_logger.warning(f"[hub] 丢弃无法解析的投递消息: {e}")
+            return
+        for uid in head.get("to", ()):
+            conn = connections.get(uid)
+            if conn is None:
+                # 用户刚断开或已迁到别的 worker（定位缓存过期前的短暂窗口）
+                self.stats["undeliverable"] += 1
+                continue
+            if head.get("k") == "t":
+                await conn["ws"].send_text(body.decode("utf-8"))
+            elif head.get("k") == "j":
+                if conn["ws"].codec == "json":
+                    await conn["ws"].send_text(body.decode("utf-8"))
+                else:
+                    await conn["ws"].send_json(json.loads(body))
+            else:
+                await conn["ws"].send_bytes(body)
+            self.stats["delivered"] += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {"enabled": self.enabled, "worker_id": self.worker_id, "local_connections": len(connections),
+                "cached_locations": len(self._locations), **self.stats, "fanout_latency": self.fanout_latency.snapshot()}
+
+
+hub = HubBackplane()
+
+
+@app.get("/metrics/hub")
+async def hub_metrics():
+    """集群投递统计（未开启集群模式时只有本地连接数）"""
+    return JSONResponse({"data": hub.snapshot(), "code": 200})
+
+
+# ===== 在线状态（presence）：上下线记录、批量查询与订阅推送 =====
+PRESENCE_REDIS = os.getenv("PRESENCE_REDIS", "true" if HUB_CLUSTER_MODE else "false").lower() in ("1", "true", "yes")  # 多进程部署时在线状态记录到 Redis
+PRESENCE_TTL = int(os.getenv("PRESENCE_TTL", "90"))  # 在线标记过期时间（秒），每 1/3 周期批量续期，进程崩溃后自动视为离线
+PRESENCE_OFFLINE_GRACE = float(os.getenv("PRESENCE_OFFLINE_GRACE", "5"))  # 断开后等待多久才判定离线（秒），期间重连不产生上下线事件
+PRESENCE_QUERY_MAX = int(os.getenv("PRESENCE_QUERY_MAX", "1000"))  # /presence/query 单次最多查询的用户数
+PRESENCE_QUERY_MAX_GROUPS = int(os.getenv("PRESENCE_QUERY_MAX_GROUPS", "50"))  # /presence/query、presence_subscribe 单次最多的群数
+PRESENCE_SUBSCRIBE_MAX_MEMBERS = int(os.getenv("PRESENCE_SUBSCRIBE_MAX_MEMBERS", "5000"))  # 单个连接最多关注的成员数
+_PRESENCE_CHUNK = 500  # 批量读写 Redis 时每次的 key 数
+
+
+class PresenceService:
+    """
+    用户在线状态。本地 connections 是本 worker 的权威来源；开启 PRESENCE_REDIS 后上下线同时记到 Redis：
+    - presence:online:{user_id} -> worker_id，带 PRESENCE_TTL，本 worker 定时批量续期；
+      下线时仅当仍指向本 worker 才删除（重连到别的 worker 不会被误删）
+    - presence:last_seen（hash）user_id -> 最后在线时间（秒）
+    - presence:events 频道：上下线事件，每个 worker 订阅后推给自己名下的订阅者
+    断开后先等 PRESENCE_OFFLINE_GRACE 秒，期间重连既不改 Redis 也不推送，避免网络抖动造成状态闪烁。
+    订阅：连接发 presence_subscribe 关注若干群，成员上下线时推 {"type": "presence", ...}；
+    关注的成员集合在订阅时按群成员缓存展开，之后的成员变动需客户端重新订阅。
+    """
+
+    _ONLINE_KEY = "presence:online:"
+    _LAST_SEEN_KEY = "presence:last_seen"
+    _CHANNEL = "presence:events"
+    _OFFLINE_LUA = ("if redis.call('get', KEYS[1]) == ARGV[1] then redis.call('del', KEYS[1]) "
+                    "redis.call('hset', KEYS[2], ARGV[2], ARGV[3]) return 1 end return 0")
+
+    def __init__(self, use_redis: bool = PRESENCE_REDIS):
+        if use_redis and not HAS_REDIS_ASYNCIO:
+            app_logger.error("[presence] 已开启 PRESENCE_REDIS，但 redis.asyncio 不可用，只记录本进程的在线状态")
+        self.use_redis = use_redis and HAS_REDIS_ASYNCIO
+        self._redis = None
+        self._tasks: List[asyncio.Task] = []
+        self._pending_offline: Dict[str, asyncio.TimerHandle] = {}
+        self._offline_tasks: set = set()
+        self._last_seen: Dict[str, int] = {}  # 未开启 Redis 时的最后在线时间
+        self._watchers: Dict[str, set] = {}  # 被关注的 user_id -> 本 worker 上关注他的连接
+        self._watching: Dict[str, set] = {}  # 订阅者 -> 关注的 user_id
+        self.stats = {"online": 0, "offline": 0, "reconnects_in_grace": 0, "queries": 0, "queried_users": 0,
+                      "subscriptions": 0, "pushes": 0, "push_recipients": 0, "redis_errors": 0}
+
+    def _online_key(self, user_id: str) -> str:
+        return self._ONLINE_KEY + user_id
+
+    async def start(self) -> None:
+        if not self.use_redis:
+            return
+        self._redis = aioredis.Redis(host=REDIS_HOST, port=REDIS_PORT)
+        self._tasks = [asyncio.create_task(self._refresh_loop()), asyncio.create_task(self._subscribe())]
+        app_logger.info(f"[presence] Redis 在线状态已启动 ttl={PRESENCE_TTL}s")
+
+    async def stop(self, flush_offline: bool = True) -> None:
+        # 还在宽限期内的下线立即落地，不等定时器
+        for user_id, handle in list(self._pending_offline.items()):
+            handle.cancel()
+            if flush_offline:
+                self._spawn_offline(user_id)
+        if self._offline_tasks:
+            await asyncio.gather(*list(self._offline_tasks), return_exceptions=True)
+        if not self.use_redis or self._redis is None:
+            return
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        try:
+            await self._redis.aclose()
+        except Exception as e:
+            app_logger.warning(f"[presence] 关闭 Redis 连接失败: {e}")
+
+    async def went_online(self, user_id: str) -> None:
+        """连接登记后调用"""
+        handle = self._pending_offline.pop(user_id, None)
+        if handle is not None:
+            # 宽限期内重连：对外从未离线，只刷新一次在线标记
+            handle.cancel()
+            self.stats["reconnects_in_grace"] += 1
+            if self.use_redis:
+                await self._set_online(user_id)
+            return
+        previous = await self._set_online(user_id) if self.use_redis else None
+        if previous is None:
+            # Redis 里原本就有标记说明用户在别的 worker 上在线（迁移连接），不算上线
+            self.stats["online"] += 1
+            await self._announce(user_id, True)
+
+    async def _set_online(self, user_id: str) -> Optional[bytes]:
+        try:
+            return await self._redis.set(self._online_key(user_id), hub.worker_id, ex=PRESENCE_TTL, get=True)
+        except Exception as e:
+            self.stats["redis_errors"] += 1
+            app_logger.error(f"[presence] 记录用户 {user_id} 上线失败: {e}")
+            return None
+
+    def went_offline(self, user_id: str) -> None:
+        """连接移出 connections 后调用（会话 finally、心跳超时），宽限期后才真正判定离线"""
+        if user_id in self._pending_offline:
+            return
+        self.unsubscribe(user_id)
+        loop = asyncio.get_running_loop()
+        self._pending_offline[user_id] = loop.call_later(PRESENCE_OFFLINE_GRACE, self._spawn_offline, user_id)
+
+    def _spawn_offline(self, user_id: str) -> None:
+        self._pending_offline.pop(user_id, None)
+        task = asyncio.ensure_future(self._finish_offline(user_id))
+        self._offline_tasks.add(task)
+        task.add_done_callback(self._offline_tasks.discard)
+
+    async def _finish_offline(self, user_id: str) -> None:
+        if user_id in connections:
+            return
+        now = int(time.time())
+        if self.use_redis:
+            try:
+                removed = await self._redis.eval(self._OFFLINE_LUA, 2, self._online_key(user_id), self._LAST_SEEN_KEY,
+                                                 hub.worker_id, user_id, now)
+            except Exception as e:
+                self.stats["redis_errors"] += 1
+                app_logger.error(f"[presence] 记录用户 {user_id} 下线失败: {e}")
+                return
+            if not removed:
+                # 已在别的 worker 上重新登记
+                return
+        else:
+            self._last_seen[user_id] = now
+        self.stats["offline"] += 1
+        await self._announce(user_id, False, now)
+
+    async def _refresh_loop(self) -> None:
+        while True:
+            await asyncio.sleep(max(1, PRESENCE_TTL // 3))
+            user_ids = list(connections.keys())
+            try:
+                for start in range(0, len(user_ids), _PRESENCE_CHUNK):
+                    pipe = self._redis.pipeline(transaction=False)
+                    for uid in user_ids[start:start + _PRESENCE_CHUNK]:
+                        pipe.set(self._online_key(uid), hub.worker_id, ex=PRESENCE_TTL)
+                    await pipe.execute()
+            except Exception as e:
+                self.stats["redis_errors"] += 1
+                app_logger.warning(f"[presence] 续期在线标记失败: {e}")
+
+    def is_online_local(self, user_id: str) -> bool:
+        return user_id in connections or user_id in self._pending_offline
+
+    async def query(self, user_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+        """批量查询在线状态：本地连接直接判定，其余按 PRESENCE_TTL 标记批量 MGET，离线的再取最后在线时间"""
+        self.stats["queries"] += 1
+        self.stats["queried_users"] += len(user_ids)
+        result: Dict[str, Dict[str, Any]] = {}
+        remote = []
+        for uid in user_ids:
+            if self.is_online_local(uid):
+                result[uid] = {"online": True, "last_seen": None}
+            elif self.use_redis:
+                remote.append(uid)
+            else:
+                result[uid] = {"online": False, "last_seen": self._last_seen.get(uid)}
+        for start in range(0, len(remote), _PRESENCE_CHUNK):
+            chunk = remote[start:start + _PRESENCE_CHUNK]
+            try:
+                pipe = self._redis.pipeline(transaction=False)
+                pipe.mget([self._online_key(uid) for uid in chunk])
+                pipe.hmget(self._LAST_SEEN_KEY, chunk)
+                flags, seen = await pipe.execute()
+            except Exception as e:
+                self.stats["redis_errors"] += 1
+                app_logger.error(f"[presence] 批量查询在线状态失败: {e}")
+                flags, seen = [None] * len(chunk), [None] * len(chunk)
+            for uid, flag, last_seen in zip(chunk, flags, seen):
+                online = flag is not None
+                result[uid] = {"online": online, "last_seen": None if online or last_seen is None else int(last_seen)}
+        return result
+
+    async def group_online(self, group_ids: List[str]) -> Dict[str, Dict[str, int]]:
+        """群在线人数：成员取自群成员缓存，在线状态一次批量查询，不扫描连接表或数据库"""
+        members_by_group = {}
+        for gid in group_ids:
+            try:
+                members_by_group[gid] = await group_roster_cache.get_members(gid)
+            except Exception as e:
+                app_logger.error(f"[presence] 加载群 {gid} 成员失败: {e}")
+        all_members = set().union(*members_by_group.values()) if members_by_group else set()
+        states = await self.query(list(all_members))
+        return {
+            gid: {"member_num": len(members),
+                  "online_member_num": sum(1 for uid in members if states[uid]["online"])}
+            for gid, members in members_by_group.items()
+        }
+
+    async def subscribe(self, subscriber: str, group_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+        """订阅若干群成员的上下线推送（替换之前的订阅），返回这些成员当前的在线状态"""
+        self.unsubscribe(subscriber)
+        watched: set = set()
+        for gid in group_ids:
+            watched |= await group_roster_cache.get_members(gid)
+        watched.discard(subscriber)
+        if len(watched) > PRESENCE_SUBSCRIBE_MAX_MEMBERS:
+            watched = set(list(watched)[:PRESENCE_SUBSCRIBE_MAX_MEMBERS])
+        if connections.get(subscriber) is None:
+            # 加载成员期间连接已断开
+            return {}
+        for uid in watched:
+            self._watchers.setdefault(uid, set()).add(subscriber)
+        self._watching[subscriber] = watched
+        self.stats["subscriptions"] += 1
+        return await self.query(list(watched))
+
+    def unsubscribe(self, subscriber: str) -> None:
+        for uid in self._watching.pop(subscriber, ()):
+            watchers = self._watchers.get(uid)
+            if watchers is not None:
+                watchers.discard(subscriber)
+                if not watchers:
+                    del self._watchers[uid]
+
+    async def _announce(self, user_id: str, online: bool, ts: Optional[int] = None) -> None:
+        event = {"u": user_id, "o": 1 if online else 0, "ts": ts or int(time.time())}
+        if not self.use_redis:
+            await self._notify_watchers(event)
+            return
+        try:
+            await self._redis.publish(self._CHANNEL, json.dumps(event))
+        except Exception as e:
+            self.stats["redis_errors"] += 1
+            app_logger.warning(f"[presence] 发布上下线事件失败，只推本 worker 的订阅者: {e}")
+            await self._notify_watchers(event)
+
+    async def _notify_watchers(self, event: Dict[str, Any]) -> None:
+        user_id = event["u"]
+        watchers = self._watchers.get(user_id)
+        if not watchers:
+            return
+        # 关注者可能已经重连到别的 worker，按 hub 定位而不是只查本地 connections
+        targets = await hub.lookup_many(list(watchers))
+        if not targets:
+            return
+        self.stats["pushes"] += 1
+        self.stats["push_recipients"] += len(targets)
+        await hub.fan_out(targets, {"type": "presence", "user_id": user_id, "online": bool(event["o"]),
+                                    "ts": event["ts"]})
+
+    async def _subscribe(self) -> None:
+        while True:
+            pubsub = self._redis.pubsub()
+            try:
+                await pubsub.subscribe(self._CHANNEL)
+                async for message in pubsub.listen():
+                    if message.get("type") != "message":
+                        continue
+                    try:
+                        event = json.loads(message["data"])
+                    except ValueError:
+                        continue
+                    await self._notify_watchers(event)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                app_logger.error(f"[presence] 订阅上下线事件异常，1 秒后重连: {e}")
+                await asyncio.sleep(1)
+            finally:
+                try:
+                    await pubsub.aclose()
+                except Exception:
+                    pass
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {"redis": self.use_redis, "ttl": PRESENCE_TTL, "grace": PRESENCE_OFFLINE_GRACE,
+                "local_online": len(connections), "pending_offline": len(self._pending_offline),
+                "watched_users": len(self._watchers), "subscribers": len(self._watching), **self.stats}
+
+
+presence = PresenceService()
+
+
+def _clean_id_list(values) -> List[str]:
+    # 去重并保持顺序
+    return list(dict.fromkeys(str(v).strip() for v in values if v is not None and str(v).strip()))
+
+
+@app.post("/presence/query")
+async def query_presence(request: Request):
+    """
+    批量查询在线状态（一次最多 PRESENCE_QUERY_MAX 个用户），可同时查询群在线人数。
+    请求体示例：{"user_ids": ["110001", "110002"], "group_ids": ["65402939701"]}
+    返回示例：
+    {
+        "data": {
+            "message": "查询成功",
+            "code": 200,
+            "users": {"110001": {"online": true, "last_seen": null}, "110002": {"online": false, "last_seen": 1760000000}},
+            "groups": {"65402939701": {"member_num": 40, "online_member_num": 12}}
+        }
+    }
+    """
+    try:
+        body = await request.json()
+    except Exception:
+        return JSONResponse({"data": {"message": "请求体必须为 JSON", "code": 400}}, status_code=400)
+    if not isinstance(body, dict):
+        return JSONResponse({"data": {"message": "请求体必须为 JSON 对象", "code": 400}}, status_code=400)
+    user_ids = body.get("user_ids") or []
+    group_ids = body.get("group_ids") or []
+    if not isinstance(user_ids, list) or not isinstance(group_ids, list) or not (user_ids or group_ids):
+        return JSONResponse({"data": {"message": "user_ids 或 group_ids 必须为非空数组", "code": 400}}, status_code=400)
+    user_ids = _clean_id_list(user_ids)
+    group_ids = _clean_id_list(group_ids)
+    if len(user_ids) > PRESENCE_QUERY_MAX or len(group_ids) > PRESENCE_QUERY_MAX_GROUPS:
+        return JSONResponse({"data": {"message": f"单次最多查询 {PRESENCE_QUERY_MAX} 个用户、{PRESENCE_QUERY_MAX_GROUPS} 个群",
+                                      "code": 400}}, status_code=400)
+
+    users = await presence.query(user_ids) if user_ids else {}
+    groups = await presence.group_online(group_ids) if group_ids else {}
+    return JSONResponse({"data": {"message": "查询成功", "code": 200, "users": users, "groups": groups}})
+
+
+@app.get("/metrics/presence")
+async def presence_metrics():
+    """在线状态：本地在线数、宽限期内的连接、订阅与推送统计"""
+    return JSONResponse({"data": presence.snapshot(), "code": 200})
+
+
+# ===== 排空（drain）：发布/停机前让客户端错峰重连，并凭恢复令牌跳过登录全量补发 =====
+DRAIN_ON_SIGTERM = os.getenv("DRAIN_ON_SIGTERM", "true").lower() in ("1", "true", "yes")  # 收到 SIGTERM 先排空再交给 uvicorn 退出
+DRAIN_WINDOW = float(os.getenv("DRAIN_WINDOW", "10"))  # 把现有连接分批关闭的时间窗口（秒）
+DRAIN_TIMEOUT = float(os.getenv("DRAIN_TIMEOUT", "20"))  # 排空最长等待时间（秒），超时后照常退出
+DRAIN_RECONNECT_MIN_MS = int(os.getenv("DRAIN_RECONNECT_MIN_MS", "1000"))  # 重连提示中的退避下限
+DRAIN_RECONNECT_MAX_MS = int(os.getenv("DRAIN_RECONNECT_MAX_MS", "15000"))  # 重连提示中的退避上限，客户端在区间内随机等待
+DRAIN_RESUME_TTL = int(os.getenv("DRAIN_RESUME_TTL", "600"))  # 恢复令牌有效期（秒）
+DRAIN_ADMIN_TOKEN = os.getenv("DRAIN_ADMIN_TOKEN", "")  # /admin/drain 的口令；未配置时只允许本机调用
+
+
+def create_resume_token(user_id: str, sync_cursor: str) -> str:
+    """恢复令牌：记录断开时已同步到的游标，重连时只补发游标之后的内容"""
+    expire = datetime.datetime.utcnow() + datetime.timedelta(seconds=DRAIN_RESUME_TTL)
+    return jwt.encode({"sub": user_id, "typ": "ws_resume", "cur": sync_cursor, "exp": expire},
+                      app.secret_key, algorithm=ALGORITHM)
+
+
+def verify_resume_token(token: str, user_id: str) -> Optional[str]:
+    """校验通过返回同步游标，过期、签名不对或不是该用户的令牌返回 None"""
+    try:
+        claims = jwt.decode(token, app.secret_key, algorithms=[ALGORITHM])
+    except jwt.PyJWTError as e:
+        app_logger.info(f"[drain] 用户 {user_id} 的恢复令牌无效: {e}")
+        return None
+    if claims.get("typ") != "ws_resume" or claims.get("sub") != user_id:
+        return None
+    return str(claims.get("cur") or "")
+
+
+def reconnect_hint(user_id: Optional[str] = None, sync_cursor: Optional[str] = None) -> Dict[str, Any]:
+    hint = {"type": "reconnect", "reason": "server_restart",
+            "delay_ms": random.randint(DRAIN_RECONNECT_MIN_MS, max(DRAIN_RECONNECT_MIN_MS, DRAIN_RECONNECT_MAX_MS))}
+    if user_id is not None:
+        hint["resume_token"] = create_resume_token(user_id, sync_cursor or "")
+    return hint
+
+
+class SessionDrainer:
+    """
+    排空本 worker 的 WebSocket 连接：
+    - 排空开始后新连接收到重连提示后立即以 1013 关闭，由负载均衡转到其他 worker / 新进程
+    - 现有连接打乱顺序，在 DRAIN_WINDOW 内分批发送 {"type": "reconnect", "delay_ms", "resume_token"}，
+      写完后以 1012（服务重启）关闭；不认识提示的老客户端也会因分批关闭而错开重连
+    - 客户端带 ?resume=<token> 重连时只做游标之后的增量同步（与 sync_cursor 相同），不再补发全部未读和课前准备历史
+    触发方式：POST /admin/drain、SIGTERM（DRAIN_ON_SIGTERM），lifespan 关闭时兜底再执行一次。
+    """
+
+    def __init__(self):
+        self.draining = False
+        self._task: Optional[asyncio.Task] = None
+        self._exit_task: Optional[asyncio.Task] = None  # SIGTERM 触发的"排空后退出"任务
+        self._previous_sigterm = None
+        self.stats = {"hinted": 0, "closed": 0, "rejected": 0, "resumed": 0, "resume_rejected": 0,
+                      "started_at": None, "finished_at": None}
+
+    def start(self, reason: str = "") -> asyncio.Task:
+        """开始排空（重复调用返回同一个任务）"""
+        if self._task is None:
+            self.draining = True
+            self.stats["started_at"] = time.time()
+            app_logger.warning(f"[drain] 开始排空 reason={reason}, 当前连接={len(connections)}")
+            self._task = asyncio.create_task(self._drain())
+        return self._task
+
+    async def wait(self, timeout: float = DRAIN_TIMEOUT) -> None:
+        if self._task is None:
+            return
+        try:
+            await asyncio.wait_for(asyncio.shield(self._task), timeout)
+        except asyncio.TimeoutError:
+            app_logger.warning(f"[drain] 排空超时，剩余连接={len(connections)}")
+
+    async def _drain(self) -> None:
+        entries = list(connections.items())
+        random.shuffle(entries)
+        batches = max(1, min(len(entries), int(DRAIN_WINDOW * 10)))
+        batch_size = -(-len(entries) // batches) if entries else 0
+        interval = DRAIN_WINDOW / batches
+        for start in range(0, len(entries), batch_size or 1):
+            batch = entries[start:start + batch_size]
+            await asyncio.gather(*(self._hint_and_close(uid, conn) for uid, conn in batch), return_exceptions=True)
+            if start + batch_size < len(entries):
+                await asyncio.sleep(interval)
+        self.stats["finished_at"] = time.time()
+        app_logger.warning(f"[drain] 排空完成，已提示 {self.stats['hinted']} 个连接")
+
+    async def _hint_and_close(self, user_id: str, conn: Dict[str, Any]) -> None:
+        if connections.get(user_id) is not conn:
+            return
+        ws = conn["ws"]
+        await ws.send_json(reconnect_hint(user_id, conn.get("sync_cursor")))
+        self.stats["hinted"] += 1
+        await ws.flush_and_close(1012, "server restart")
+        self.stats["closed"] += 1
+
+    async def reject(self, outbound: "WebSocketSender") -> None:
+        """排空期间的新连接：给出重连提示后关闭"""
+        self.stats["rejected"] += 1
+        await outbound.send_json(reconnect_hint())
+        await outbound.flush_and_close(1013, "server draining")
+
+    def install_sigterm_handler(self) -> None:
+        """
+        包一层 uvicorn 已安装的 SIGTERM 处理：第一次 SIGTERM 先排空，完成（或超时）后再调用原处理函数退出；
+        排空期间再收到 SIGTERM 直接退出。需在 uvicorn 安装信号处理之后（lifespan 启动时）调用。
+        """
+        if not DRAIN_ON_SIGTERM or threading.current_thread() is not threading.main_thread():
+            return
+        previous = signal.getsignal(signal.SIGTERM)
+        if not callable(previous):
+            return
+        self._previous_sigterm = previous
+        loop = asyncio.get_running_loop()
+
+        def handler(signum, frame):
+            if self.draining:
+                previous(signum, frame)
+                return
+            loop.call_soon_threadsafe(self._drain_then_exit, signum, frame)
+
+        signal.signal(signal.SIGTERM, handler)
+
+    def _drain_then_exit(self, signum, frame) -> None:
+        self.start("SIGTERM")
+
+        async def finish():
+            try:
+                await self.wait()
+            finally:
+                # 排空出错也要交回 uvicorn 退出，不能卡在半关闭状态
+                self._previous_sigterm(signum, frame)
+
+        self._exit_task = asyncio.ensure_future(finish())
+        self._exit_task.add_done_callback(self._on_exit_done)
+
+    @staticmethod
+    def _on_exit_done(task: asyncio.Task) -> None:
+        if task.cancelled():
+            return
+        exc = task.exception()
+        if exc is not None:
+            app_logger.error(f"[drain] SIGTERM 排空后退出失败: {exc!r}", exc_info=exc)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {"draining": self.draining, "connections": len(connections), **self.stats}
+
+
+drainer = SessionDrainer()
+
+
+@app.post("/admin/drain")
+async def admin_drain(request: Request):
+    """开始排空本 worker 的连接（发布脚本在停进程前调用），返回排空状态"""
+    client_host = request.client.host if request.client else ""
+    if DRAIN_ADMIN_TOKEN:
+        if not hmac.compare_digest(request.headers.get("X-Admin-Token", ""), DRAIN_ADMIN_TOKEN):
+            return JSONResponse({"data": {"message": "无权限", "code": 403}}, status_code=403)
+    elif client_host not in ("127.0.0.1", "::1", "localhost"):
+        return JSONResponse({"data": {"message": "未配置 DRAIN_ADMIN_TOKEN，只允许本机调用", "code": 403}}, status_code=403)
+    drainer.start(f"admin {client_host}")
+    return JSONResponse({"data": {"message": "已开始排空", "code": 200, **drainer.snapshot()}})
+
+
+@app.get("/metrics/drain")
+async def drain_metrics():
+    """排空状态与恢复会话统计"""
+    return JSONResponse({"data": drainer.snapshot(), "code": 200})
+
+
+# ===== SRS HTTP 客户端：进程内共享连接池，offer 转发复用 keep-alive 连接 =====
+SRS_HTTP_CONNECT_TIMEOUT = float(os.getenv("SRS_HTTP_CONNECT_TIMEOUT", "3"))  # 建连（含 TLS 握手）超时（秒）
+SRS_HTTP_READ_TIMEOUT = float(os.getenv("SRS_HTTP_READ_TIMEOUT", "10"))  # 等待 SRS 返回 answer 的超时（秒）
+SRS_HTTP_POOL_TIMEOUT = float(os.getenv("SRS_HTTP_POOL_TIMEOUT", "5"))  # 连接池占满时排队等待的超时（秒）
+SRS_HTTP_MAX_CONNECTIONS = int(os.getenv("SRS_HTTP_MAX_CONNECTIONS", "100"))
+SRS_HTTP_MAX_KEEPALIVE = int(os.getenv("SRS_HTTP_MAX_KEEPALIVE", "20"))  # 保持的空闲连接数
+SRS_HTTP_KEEPALIVE_EXPIRY = float(os.getenv("SRS_HTTP_KEEPALIVE_EXPIRY", "60"))  # 空闲连接保留时间（秒），应小于 nginx keepalive_timeout
+SRS_HTTP2 = os.getenv("SRS_HTTP2", "false").lower() in ("1", "true", "yes")  # 需要安装 h2；一条连接多路复用所有 offer
+SRS_VERIFY_SSL = not SRS_USE_HTTPS or os.getenv('SRS_VERIFY_SSL', 'false').lower() == 'true'  # HTTPS 自签名证书时不校验
+# 多个 SRS 节点（逗号分隔的 API 地址，如 https://a:443,https://b:443），按顺序故障转移；默认只有 SRS_WEBRTC_API_URL
+SRS_API_NODES = [u.strip().rstrip("/") for u in os.getenv("SRS_API_NODES", SRS_WEBRTC_API_URL).split(",") if u.strip()]
+SRS_MAX_INFLIGHT = int(os.getenv("SRS_MAX_INFLIGHT", "64"))  # 全进程同时转发中的 offer 上限
+SRS_INFLIGHT_WAIT = float(os.getenv("SRS_INFLIGHT_WAIT", "0.5"))  # 等待转发名额的最长时间（秒），超时直接告诉客户端繁忙
+SRS_MAX_INFLIGHT_PER_CONNECTION = int(os.getenv("SRS_MAX_INFLIGHT_PER_CONNECTION", "4"))  # 单个连接同时转发中的 offer 上限
+SRS_BREAKER_WINDOW = float(os.getenv("SRS_BREAKER_WINDOW", "30"))  # 熔断器统计错误率的滑动窗口（秒）
+SRS_BREAKER_MIN_REQUESTS = int(os.getenv("SRS_BREAKER_MIN_REQUESTS", "5"))  # 窗口内请求数达到该值才判断错误率
+SRS_BREAKER_ERROR_RATE = float(os.getenv("SRS_BREAKER_ERROR_RATE", "0.5"))  # 错误率达到该值熔断
+SRS_BREAKER_COOLDOWN = float(os.getenv("SRS_BREAKER_COOLDOWN", "15"))  # 熔断后多久放一个探测请求（秒）
+SRS_STREAM_AFFINITY_TTL = float(os.getenv("SRS_STREAM_AFFINITY_TTL", "21600"))  # 记住流推到哪个节点的时间（秒）
+SRS_STREAMS_API_PATH = os.getenv("SRS_STREAMS_API_PATH", "/api/v1/streams/")  # SRS 流列表接口（经 nginx 代理时按实际路径配置）
+
+
+class SRSUnavailable(Exception):
+    """SRS 暂不可用（熔断、繁忙或所有节点失败），直接快速失败给客户端"""
+
+    def __init__(self, reason: str, message: str, retry_after: float = 0.0):
+        super().__init__(message)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """
+    按错误率熔断：滑动窗口内请求数够多且错误率超过阈值时打开，打开期间直接拒绝；
+    冷却后进入半开，只放一个探测请求，成功则关闭，失败则重新打开。
+    """
+
+    def __init__(self, window: float = SRS_BREAKER_WINDOW, min_requests: int = SRS_BREAKER_MIN_REQUESTS,
+                 error_rate: float = SRS_BREAKER_ERROR_RATE, cooldown: float = SRS_BREAKER_COOLDOWN):
+        self._window = window
+        self._min_requests = min_requests
+        self._error_rate = error_rate
+        self._cooldown = cooldown
+        self._outcomes: deque = deque()  # (时间, 是否成功)
+        self.state = "closed"
+        self._opened_at = 0.0
+        self._probing = False
+        self.stats = {"opened": 0, "rejected": 0}
+
+    def allow(self) -> bool:
+        if self.state == "closed":
+            return True
+        if self.state == "open" and time.monotonic() - self._opened_at >= self._cooldown:
+            self.state = "half_open"
+            self._probing = False
+        if self.state == "half_open" and not self._probing:
+            self._probing = True
+            return True
+        self.stats["rejected"] += 1
+        return False
+
+    def release_probe(self) -> None:
+        """探测请求没有结果就结束（被取消）时调用，让下一个请求重新探测，而不是一直卡在半开"""
+        self._probing = False
+
+    def retry_after(self) -> float:
+        if self.state != "open":
+            return 0.0
+        return max(0.0, self._cooldown - (time.monotonic() - self._opened_at))
+
+    def record(self, ok: bool) -> None:
+        now = time.monotonic()
+        if self.state == "half_open":
+            self._probing = False
+            if ok:
+                self.state = "closed"
+                self._outcomes.clear()
+            else:
+                self._open(now)
+            return
+        self._outcomes.append((now, ok))
+        while self._outcomes and self._outcomes[0][0] < now - self._window:
+            self._outcomes.popleft()
+        failures = sum(1 for _, success in self._outcomes if not success)
+        if (self.state == "closed" and len(self._outcomes) >= self._min_requests
+                and failures / len(self._outcomes) >= self._error_rate):
+            self._open(now)
+
+    def _open(self, now: float) -> None:
+        self.state = "open"
+        self._opened_at = now
+        self._outcomes.clear()
+        self.stats["opened"] += 1
+        app_logger.error(f"[srs] 熔断打开，{self._cooldown:.0f} 秒后探测")
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {"state": self.state, "retry_after_s": round(self.retry_after(), 1),
+                "window_requests": len(self._outcomes), **self.stats}
+
+
+class SRSNode:
+    """一个 SRS API 入口（nginx 或 SRS 本身），带独立熔断器和耗时统计"""
+
+    def __init__(self, base_url: str):
+        self.base_url = base_url
+        self.host = urllib.parse.urlparse(base_url).hostname or SRS_SERVER
+        self.breaker = CircuitBreaker()
+        self.latency = LatencyHistogram()
+        self.stats = {"requests": 0, "errors": 0}
+
+    def api_url(self, api_path: str) -> str:
+        return f"{self.base_url}{api_path}"
+
+    def stream_url(self, stream_name: str) -> str:
+        return f"webrtc://{self.host}/{SRS_APP}/{stream_name}"
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {"url": self.base_url, **self.stats, "breaker": self.breaker.snapshot(), "latency": self.latency.snapshot()}
+
+
+class SRSClient:
+    """
+    SRS WebRTC API（/rtc/v1/publish/、/rtc/v1/play/）的共享 HTTP 客户端。
+    httpx 可用时整个进程共用一个 AsyncClient：连接池 + keep-alive，可选 HTTP/2，一个班级几十人同时拉流
+    只需少量 TLS 握手；lifespan 启动时创建、关闭时释放，未启动就被调用时按需创建。
+    没有 httpx 时退回 urllib（默认线程池执行，每次新建连接）。
+    relay_offer() 外加一层保护：全进程同时转发的 offer 不超过 SRS_MAX_INFLIGHT，等不到名额就快速失败；
+    每个节点一个熔断器，按配置顺序故障转移（推流过的节点优先，拉流才能拉到同一个节点上的流）。
+    """
+
+    def __init__(self, nodes: Optional[List[str]] = None):
+        self._client = None
+        self.http2 = SRS_HTTP2 and HAS_H2
+        if SRS_HTTP2 and not HAS_H2:
+            app_logger.warning("[srs] 已开启 SRS_HTTP2，但未安装 h2，使用 HTTP/1.1 keep-alive")
+        self.nodes = [SRSNode(url) for url in (nodes or SRS_API_NODES)]
+        self._inflight = asyncio.Semaphore(SRS_MAX_INFLIGHT)
+        self._inflight_count = 0
+        self._affinity: Dict[str, tuple] = {}  # stream_name -> (过期时间, SRSNode)
+        self.actions: Dict[str, Dict[str, Any]] = {}
+        self.stats = {"busy": 0, "circuit_open": 0, "all_failed": 0, "failovers": 0}
+
+    def _get_client(self):
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                http2=self.http2,
+                verify=SRS_VERIFY_SSL,
+                timeout=httpx.Timeout(connect=SRS_HTTP_CONNECT_TIMEOUT, read=SRS_HTTP_READ_TIMEOUT,
+                                      write=SRS_HTTP_READ_TIMEOUT, pool=SRS_HTTP_POOL_TIMEOUT),
+                limits=httpx.Limits(max_connections=SRS_HTTP_MAX_CONNECTIONS,
+                                    max_keepalive_connections=SRS_HTTP_MAX_KEEPALIVE,
+                                    keepalive_expiry=SRS_HTTP_KEEPALIVE_EXPIRY),
+            )
+        return self._client
+
+    async def start(self) -> None:
+        if HAS_HTTPX:
+            self._get_client()
+
+    async def stop(self) -> None:
+        if self._client is not None:
+            client, self._client = self._client, None
+            try:
+                await client.aclose()
+            except Exception as e:
+                app_logger.warning(f"[srs] 关闭 HTTP 客户端失败: {e}")
+
+    def _action_stats(self, action: str) -> Dict[str, Any]:
+        entry = self.actions.get(action)
+        if entry is None:
+            entry = self.actions[action] = {"requests": 0, "errors": 0, "timeouts": 0, "latency": LatencyHistogram()}
+        return entry
+
+    def _candidates(self, stream_name: str) -> List[SRSNode]:
+        cached = self._affinity.get(stream_name)
+        if cached and cached[0] > time.monotonic():
+            preferred = cached[1]
+            return [preferred] + [node for node in self.nodes if node is not preferred]
+        return list(self.nodes)
+
+    async def relay_offer(self, action: str, stream_name: str, sdp: str) -> Tuple[Dict[str, Any], SRSNode]:
+        """
+        把 publish/play offer 转发给 SRS，返回 (SRS 的 JSON 响应, 处理的节点)。
+        没有名额、所有节点熔断或全部失败时抛 SRSUnavailable；SRS 返回的业务错误（code != 0）照常返回。
+        """
+        try:
+            await asyncio.wait_for(self._inflight.acquire(), SRS_INFLIGHT_WAIT)
+        except asyncio.TimeoutError:
+            self.stats["busy"] += 1
+            raise SRSUnavailable("srs_busy", "当前连麦请求较多，请稍后重试", SRS_INFLIGHT_WAIT)
+        self._inflight_count += 1
+        try:
+            api_path = "/rtc/v1/publish/" if action == "publish" else "/rtc/v1/play/"
+            last_error: Optional[Exception] = None
+            tried = 0
+            for node in self._candidates(stream_name):
+                if not node.breaker.allow():
+                    continue
+                if tried:
+                    self.stats["failovers"] += 1
+                    app_logger.warning(f"[srs] {action} 故障转移到 {node.base_url}，上一个错误: {last_error}")
+                tried += 1
+                request_data = {"api": f"{node.base_url}/api/v1{api_path}", "streamurl": node.stream_url(stream_name),
+                                "sdp": sdp}
+                try:
+                    result = await self.post_offer(action, node, node.api_url(api_path), request_data)
+                except Exception as e:
+                    node.breaker.record(False)
+                    last_error = e
+                    continue
+                except BaseException:
+                    # 连接断开时取消的 offer 不计入成败，但要释放半开探测名额
+                    node.breaker.release_probe()
+                    raise
+                node.breaker.record(True)
+                if action == "publish":
+                    if len(self._affinity) > 10000:
+                        now = time.monotonic()
+                        self._affinity = {k: v for k, v in self._affinity.items() if v[0] > now}
+                    self._affinity[stream_name] = (time.monotonic() + SRS_STREAM_AFFINITY_TTL, node)
+                return result, node
+            if not tried:
+                self.stats["circuit_open"] += 1
+                retry_after = min(node.breaker.retry_after() for node in self.nodes)
+                raise SRSUnavailable("srs_circuit_open", "媒体服务器暂时不可用，请稍后重试", retry_after)
+            self.stats["all_failed"] += 1
+            raise SRSUnavailable("srs_unavailable", f"媒体服务器请求失败: {last_error}", SRS_BREAKER_COOLDOWN)
+        finally:
+            self._inflight_count -= 1
+            self._inflight.release()
+
+    async def post_offer(self, action: str, node: SRSNode, api_url: str, request_data: Dict[str, Any]) -> Dict[str, Any]:
+        """向单个节点发一次请求；网络错误、超时和非 2xx 抛异常"""
+        entry = self._action_stats(action)
+        entry["requests"] += 1
+        node.stats["requests"] += 1
+        started = time.perf_counter()
+        try:
+            if HAS_HTTPX:
+                response = await self._get_client().post(api_url, json=request_data)
+                response.raise_for_status()
+                return response.json()
+            return await asyncio.get_running_loop().run_in_executor(None, self._urllib_json, api_url, request_data)
+        except Exception as e:
+            node.stats["errors"] += 1
+            if (HAS_HTTPX and isinstance(e, httpx.TimeoutException)) or isinstance(e, socket.timeout):
+                entry["timeouts"] += 1
+            else:
+                entry["errors"] += 1
+            raise
+        finally:
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            entry["latency"].observe(elapsed_ms)
+            node.latency.observe(elapsed_ms)
+
+    async def list_streams(self, node: SRSNode, page_size: int) -> List[Dict[str, Any]]:
+        """分页拉取节点上的全部流（SRS_STREAMS_API_PATH），流不多时一次请求即可；网络错误或 SRS 报错抛异常"""
+        streams: List[Dict[str, Any]] = []
+        start = 0
+        while True:
+            url = f"{node.api_url(SRS_STREAMS_API_PATH)}?start={start}&count={page_size}"
+            if HAS_HTTPX:
+                response = await self._get_client().get(url)
+                response.raise_for_status()
+                result = response.json()
+            else:
+                result = await asyncio.get_running_loop().run_in_executor(None, self._urllib_json, url, None)
+            if result.get("code", 0) != 0:
+                raise RuntimeError(f"SRS 返回错误码 {result.get('code')}")
+            page = result.get("streams") or []
+            streams.extend(page)
+            if len(page) < page_size:
+                return streams
+            start += page_size
+
+    @staticmethod
+    def _urllib_json(api_url: str, request_data: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        """request_data 为 None 时发 GET，否则 POST JSON"""
+        import ssl
+        if request_data is None:
+            req = urllib.request.Request(api_url, method="GET")
+        else:
+            req = urllib.request.Request(api_url, data=json.dumps(request_data).encode('utf-8'),
+                                         headers={"Content-Type": "application/json"}, method="POST")
+        context = None
+        if not SRS_VERIFY_SSL:
+            context = ssl.create_default_context()
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+        with urllib.request.urlopen(req, timeout=SRS_HTTP_CONNECT_TIMEOUT + SRS_HTTP_READ_TIMEOUT,
+                                    context=context) as response:
+            return json.loads(response.read().decode('utf-8'))
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "transport": ("http2" if self.http2 else "http1.1-keepalive") if HAS_HTTPX else "urllib",
+            "connect_timeout": SRS_HTTP_CONNECT_TIMEOUT,
+            "read_timeout": SRS_HTTP_READ_TIMEOUT,
+            "max_connections": SRS_HTTP_MAX_CONNECTIONS,
+            "max_keepalive": SRS_HTTP_MAX_KEEPALIVE,
+            "inflight": self._inflight_count,
+            "max_inflight": SRS_MAX_INFLIGHT,
+            "stream_affinity": len(self._affinity),
+            **self.stats,
+            "nodes": [node.snapshot() for node in self.nodes],
+            "actions": {
+                action: {"requests": entry["requests"], "errors": entry["errors"], "timeouts": entry["timeouts"],
+                         "latency": entry["latency"].snapshot()}
+                for action, entry in self.actions.items()
+            },
+        }
+
+
+srs_client = SRSClient()
+
 
-    results: List[Dict] = []
-    try:
-        # ① 查 teacher_unique_id
-        with connection.cursor(dictionary=True) as cursor:
-            cursor.execute("SELECT teacher_unique_id FROM ta_teacher WHERE id_card=%s", (id_card,))
-            rows = cursor.fetchall()  # 保证取完数据
-            app_logger.info(f"📌 Step1: ta_teacher for id_card={id_card} -> {rows}")
-        if not rows:
-            return {"friends": []}
+@app.get("/metrics/srs")
+async def srs_metrics():
+    """SRS offer 转发：并发、熔断与故障转移状态，按节点和 publish/play 的请求数、失败、超时和耗时分布"""
+    return JSONResponse({"data": srs_client.snapshot(), "code": 200})
 
-        teacher_unique_id = rows[0]["teacher_unique_id"]
 
-        # ② 查 ta_friend 获取 friendcode
-        with connection.cursor(dictionary=True) as cursor:
-            cursor.execute("SELECT friendcode FROM ta_friend WHERE teacher_unique_id=%s", (teacher_unique_id,))
-            friend_rows = cursor.fetchall()
-            app_logger.info(f"📌 Step2: ta_friend for teacher_unique_id={teacher_unique_id} -> {friend_rows}")
-        if not friend_rows:
-            return {"friends": []}
+# ===== 临时房间对账：以 SRS 上实际在推的流为准，批量关闭已经没人推流的房间 =====
+SRS_RECONCILE_INTERVAL = float(os.getenv("SRS_RECONCILE_INTERVAL", "60"))  # 对账间隔（秒），0 表示关闭
+SRS_RECONCILE_GRACE = float(os.getenv("SRS_RECONCILE_GRACE", "120"))  # 房间创建多久后才参与对账，留给群主开始推流
+SRS_RECONCILE_MISSES = int(os.getenv("SRS_RECONCILE_MISSES", "2"))  # 连续几轮在 SRS 上找不到推流才关闭
+SRS_RECONCILE_MAX_CLOSE = int(os.getenv("SRS_RECONCILE_MAX_CLOSE", "500"))  # 单轮最多关闭的房间数，其余留到下一轮
+SRS_RECONCILE_PAGE = int(os.getenv("SRS_RECONCILE_PAGE", "1000"))  # 每次向 SRS 拉取的流数量
 
-        # ③ 遍历每个 friendcode
-        for fr in friend_rows:
-            friendcode = fr["friendcode"]
 
-            # 查 ta_teacher
-            with connection.cursor(dictionary=True) as cursor:
-                cursor.execute("SELECT * FROM ta_teacher WHERE teacher_unique_id=%s", (friendcode,))
-                teacher_rows = cursor.fetchall()
-                # app_logger.info(f"📌 Step3: ta_teacher for friendcode={friendcode} -> {teacher_rows}")
-            if not teacher_rows:
-                continue
-            friend_teacher = teacher_rows[0]
+class TempRoomReconciler:
+    """
+    临时房间原来只有 temp_room_owner_leave 才会关闭，群主断网、杀进程后房间一直留在 active_temp_rooms
+    和 temp_voice_rooms（status=1）里，/temp_rooms/query 越查越慢。
+    每 SRS_RECONCILE_INTERVAL 秒向每个 SRS 节点请求一次流列表，和内存中的房间、数据库中仍为活跃的房间做差集：
+    超过 SRS_RECONCILE_GRACE 且连续 SRS_RECONCILE_MISSES 轮没有推流的房间，数据库里一条 UPDATE 批量关闭，
+    内存中移除并通知成员停止推拉流。任一节点拉取失败时整轮跳过，SRS 不可达不会被当成"全部断流"。
+    """
 
-            # 查 ta_user_details
-            id_number = friend_teacher.get("id_card")
-            with connection.cursor(dictionary=True) as cursor:
-                cursor.execute("SELECT * FROM ta_user_details WHERE id_number=%s", (id_number,))
-                user_rows = cursor.fetchall()
-                # app_logger.info(f"📌 Step4: ta_user_details for id_number={id_number} -> {user_rows}")
-            user_details = user_rows[0] if user_rows else None
+    def __init__(self):
+        self._task: Optional[asyncio.Task] = None
+        self._lock = asyncio.Lock()
+        self._misses: Dict[str, int] = {}  # room_id -> 连续没有推流的轮数
+        self.latency = LatencyHistogram()
+        self.last: Dict[str, Any] = {}
+        self.stats = {"passes": 0, "skipped": 0, "closed_memory": 0, "closed_db": 0, "db_errors": 0}
+
+    async def start(self) -> None:
+        if SRS_RECONCILE_INTERVAL > 0 and self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            task, self._task = self._task, None
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+    async def _run(self) -> None:
+        # 首轮随机错开，多个 worker 不会同时请求 SRS
+        await asyncio.sleep(random.uniform(0, SRS_RECONCILE_INTERVAL))
+        while True:
+            try:
+                await self.reconcile_once()
+            except Exception as e:
+                app_logger.error(f"[temp_room][reconcile] 对账失败: {e}", exc_info=True)
+            await asyncio.sleep(SRS_RECONCILE_INTERVAL)
+
+    async def _live_streams(self) -> Optional[set]:
+        """所有节点上正在推流的 stream_name；任一节点失败返回 None"""
+        results = await asyncio.gather(*(srs_client.list_streams(node, SRS_RECONCILE_PAGE) for node in srs_client.nodes),
+                                       return_exceptions=True)
+        live = set()
+        for node, result in zip(srs_client.nodes, results):
+            if isinstance(result, Exception):
+                app_logger.warning(f"[temp_room][reconcile] 拉取 {node.base_url} 流列表失败，跳过本轮: {result}")
+                return None
+            for stream in result:
+                if stream.get("app", SRS_APP) != SRS_APP:
+                    continue
+                publish = stream.get("publish")
+                # 老版本 SRS 没有 publish 字段，列表里有就当作在推流
+                if publish is None or publish.get("active"):
+                    live.add(stream.get("name"))
+        return live
+
+    @staticmethod
+    def _load_db_rooms(grace: float) -> List[Dict[str, Any]]:
+        with db_connection() as connection:
+            cursor = connection.cursor(dictionary=True)
+            try:
+                cursor.execute("""
+                    SELECT room_id, group_id, stream_name
+                    FROM temp_voice_rooms
+                    WHERE status = 1 AND create_time < NOW() - INTERVAL %s SECOND
+                """, (int(grace),))
+                return cursor.fetchall() or []
+            finally:
+                cursor.close()
 
-            if user_details:
-                avatar_path = user_details.get("avatar")
-                if avatar_path:
-                    local_avatar_file = resolve_local_avatar_file_path(avatar_path)
-                    if local_avatar_file and os.path.exists(local_avatar_file):
-                        try:
-                            with open(local_avatar_file, "rb") as img:
-                                user_details["avatar_base64"] = base64.b64encode(img.read()).decode("utf-8")
-                        except Exception as e:
-                            app_logger.error(f"读取图片失败 {local_avatar_file}: {e}")
-                            user_details["avatar_base64"] = None
-                    else:
-                        user_details["avatar_base64"] = None
-                else:
-                    user_details["avatar_base64"] = None
+    @staticmethod
+    def _close_db_rooms(room_ids: List[str]) -> int:
+        """批量关闭房间及其成员记录，返回实际关闭的房间数"""
+        placeholders = ", ".join(["%s"] * len(room_ids))
+        with db_connection() as connection:
+            cursor = connection.cursor()
+            try:
+                cursor.execute(f"UPDATE `temp_voice_rooms` SET status = 0 WHERE status = 1 AND room_id IN ({placeholders})",
+                               room_ids)
+                closed = cursor.rowcount
+                cursor.execute(f"UPDATE `temp_voice_room_members` SET status = 0 WHERE status = 1 AND room_id IN ({placeholders})",
+                               room_ids)
+                connection.commit()
+                return closed
+            except Exception:
+                connection.rollback()
+                raise
+            finally:
+                cursor.close()
 
-            combined = {
-                "teacher_info": friend_teacher,
-                "user_details": user_details
-            }
-            # 打印组合后的数据
-            # app_logger.info(f"📌 Step5: combined record -> {combined}")
-            results.append({
-                "teacher_info": friend_teacher,
-                "user_details": user_details
-            })
-        app_logger.info(f"✅ Finished. Total friends found: {len(results)}")
-        return {
-            "count": len(results),
-            "friends": results
-        }
+    async def reconcile_once(self) -> Dict[str, Any]:
+        """执行一轮对账，返回本轮结果（也记在 last 里供 /metrics 查看）"""
+        async with self._lock:
+            started = time.perf_counter()
+            self.stats["passes"] += 1
+            live = await self._live_streams()
+            if live is None:
+                self.stats["skipped"] += 1
+                self.last = {"at": int(time.time()), "skipped": True}
+                return self.last
+
+            # 候选房间：内存中的 + 数据库中仍为活跃的（其他 worker 创建的，或内存里已解散但库里没改状态的）
+            now = time.time()
+            candidates: Dict[str, tuple] = {}  # room_id -> (group_id, stream_name)
+            for group_id, room_info in list(active_temp_rooms.items()):
+                room_id = room_info.get("room_id")
+                if room_id and now - room_info.get("timestamp", now) >= SRS_RECONCILE_GRACE:
+                    candidates[room_id] = (group_id, room_info.get("stream_name"))
+            try:
+                for row in await run_db(self._load_db_rooms, SRS_RECONCILE_GRACE):
+                    if row.get("room_id"):
+                        candidates.setdefault(row["room_id"], (row.get("group_id"), row.get("stream_name")))
+            except Exception as e:
+                self.stats["db_errors"] += 1
+                app_logger.error(f"[temp_room][reconcile] 查询活跃房间失败，只对账内存中的房间: {e}")
 
-    finally:
-        if cursor:
-            cursor.close()
-        if connection and connection.is_connected():
-            connection.close()
-            app_logger.info(f"Database connection closed for id_card={id_card}")
+            misses: Dict[str, int] = {}
+            dead: List[tuple] = []
+            for room_id, (group_id, stream_name) in candidates.items():
+                if stream_name in live:
+                    continue
+                misses[room_id] = self._misses.get(room_id, 0) + 1
+                if misses[room_id] >= SRS_RECONCILE_MISSES:
+                    dead.append((room_id, group_id))
+            # 恢复推流或已经关闭的房间不再出现在候选里，计数自然清零
+            self._misses = misses
+            dead = dead[:SRS_RECONCILE_MAX_CLOSE]
+
+            closed_rooms = []
+            for room_id, group_id in dead:
+                # 多个 worker 同时对账时只有真正解散了房间的那个通知成员
+                room_info = await temp_rooms.remove_room(group_id, room_id)
+                if room_info:
+                    closed_rooms.append((group_id, room_info))
+            closed_db = 0
+            if dead:
+                try:
+                    closed_db = await run_db(self._close_db_rooms, [room_id for room_id, _ in dead])
+                    for room_id, _ in dead:
+                        self._misses.pop(room_id, None)
+                except Exception as e:
+                    # 计数保留，下一轮从数据库候选里重新关闭
+                    self.stats["db_errors"] += 1
+                    app_logger.error(f"[temp_room][reconcile] 批量关闭房间失败 {len(dead)} 个: {e}")
+            if closed_rooms:
+                await asyncio.gather(*(notify_temp_room_closed(group_id, room_info, "stream_ended", "system")
+                                       for group_id, room_info in closed_rooms), return_exceptions=True)
 
-# if __name__ == '__main__':
-#     app_logger.info("Flask application starting...")
-#     app.run(host="0.0.0.0", port=5000, debug=True)
+            self.stats["closed_memory"] += len(closed_rooms)
+            self.stats["closed_db"] += closed_db
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            self.latency.observe(elapsed_ms)
+            self.last = {"at": int(now), "skipped": False, "live_streams": len(live), "candidates": len(candidates),
+                         "missing": len(misses), "closed_memory": len(closed_rooms), "closed_db": closed_db,
+                         "elapsed_ms": round(elapsed_ms, 1)}
+            if dead:
+                print(f"[temp_room][reconcile] 关闭无推流的临时房间 内存={len(closed_rooms)}, 数据库={closed_db}")
+                app_logger.info(f"[temp_room][reconcile] 关闭无推流的临时房间 {self.last}")
+            return self.last
 
-#from datetime import datetime   # 注意这里！！！
-def convert_datetime(obj):
-    if isinstance(obj, datetime.datetime):
-        return obj.strftime("%Y-%m-%d %H:%M:%S")
-    raise TypeError(f"Type {type(obj)} not serializable")
+    def snapshot(self) -> Dict[str, Any]:
+        return {"enabled": SRS_RECONCILE_INTERVAL > 0, "interval": SRS_RECONCILE_INTERVAL, "grace": SRS_RECONCILE_GRACE,
+                "misses_to_close": SRS_RECONCILE_MISSES, "pending": len(self._misses), **self.stats,
+                "last": self.last, "latency": self.latency.snapshot()}
 
-# ====== WebSocket 接口：聊天室 + 心跳 ======
-# 创建群
- # data: { group_name, permission_level, headImage_path, group_type, nickname, owner_id, members: [{unique_member_id, member_name, group_role}] }
- #
-async def create_group(data):
-    connection = get_db_connection()
-    if connection is None or not connection.is_connected():
-        app_logger.error("Database connection error in /friends API.")
-        return JSONResponse({
-            'data': {
-                'message': '数据库连接失败',
-                'code': 500
-            }
-        }, status_code=500)
 
-    cursor = connection.cursor()
-    unique_group_id = str(uuid.uuid4())
+temp_room_reconciler = TempRoomReconciler()
 
-    try:
-        cursor.execute(
-            "INSERT INTO ta_group (permission_level, headImage_path, group_type, nickname, unique_group_id, group_admin_id, school_id, class_id, create_time)"
-            " VALUES (%s,%s,%s,%s,%s,%s,%s,%s,NOW())",
-            (data.get('permission_level'),
-             data.get('headImage_path'),
-             data.get('group_type'),
-             data.get('nickname'),
-             unique_group_id,
-             data.get('owner_id'),
-             data.get('school_id'),
-             data.get('class_id'))
-        )
 
-        for m in data['members']:
-            cursor.execute(
-                "INSERT INTO ta_group_member_relation (unique_member_id, unique_group_id, join_time, group_role, member_name)"
-                " VALUES (%s,%s,NOW(),%s,%s)",
-                (m['unique_member_id'], unique_group_id, m['group_role'], m['member_name'])
-            )
+@app.get("/metrics/temp_room_reconcile")
+async def temp_room_reconcile_metrics():
+    """临时房间与 SRS 推流对账：轮数、跳过次数、关闭的房间数和上一轮结果"""
+    return JSONResponse({"data": temp_room_reconciler.snapshot(), "code": 200})
 
-        connection.commit()
-        cursor.close()
-        connection.close()
 
-        # 给在线成员推送
-        for m in data['members']:
-            if m['unique_member_id'] in clients:
-                await clients[m['unique_member_id']].send_text(json.dumps({
-                    "type":"notify",
-                    "message":f"你已加入群: {data['nickname']}",
-                    "group_id": unique_group_id
-                }))
+# WebSocket 文本消息 JSON 解析：装了 orjson 就用 orjson（两者解析失败都抛 ValueError 子类）
+ws_json_loads = orjson.loads if HAS_ORJSON else json.loads
 
-        return {"code":200, "message":"群创建成功", "group_id":unique_group_id}
 
-    except Exception as e:
-        print(f"create_group错误: {e}")
-        return {"code":500, "message":"群创建失败"}
+class WSMessageStats:
+    """按消息 type 统计 WebSocket 文本消息数量、失败数和处理耗时（只在事件循环内更新，无需加锁）"""
 
- # 邀请成员加入群
- # data: { unique_group_id, group_name, new_members: [{unique_member_id, member_name, group_role}] }
- #
-async def invite_members(data):
-    conn = await get_db_connection()
-    if conn is None:
-        return {"code":500, "message":"数据库连接失败"}
+    def __init__(self):
+        self.types: Dict[str, Dict[str, Any]] = {}
+        self.unhandled_counts: Dict[str, int] = {}
 
-    cursor = conn.cursor()
-    try:
-        for m in data['new_members']:
-            cursor.execute(
-                "INSERT INTO ta_group_member_relation (unique_member_id, unique_group_id, join_time, group_role, member_name)"
-                " VALUES (%s,%s,NOW(),%s,%s)",
-                (m['unique_member_id'], data['unique_group_id'], m['group_role'], m['member_name'])
-            )
+    def record(self, msg_type: str, ms: float, failed: bool = False) -> None:
+        entry = self.types.get(msg_type)
+        if entry is None:
+            entry = self.types[msg_type] = {"count": 0, "errors": 0, "latency": LatencyHistogram()}
+        entry["count"] += 1
+        if failed:
+            entry["errors"] += 1
+        entry["latency"].observe(ms)
 
-            if m['unique_member_id'] in clients:
-                await clients[m['unique_member_id']].send_text(json.dumps({
-                    "type":"notify",
-                    "message":f"你被邀请加入群: {data['group_name']}",
-                    "group_id": data['unique_group_id']
-                }))
+    def unhandled(self, reason: str) -> None:
+        self.unhandled_counts[reason] = self.unhandled_counts.get(reason, 0) + 1
 
-        conn.commit()
-        cursor.close()
-        conn.close()
-        return {"code":200, "message":"成员邀请成功"}
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "json_codec": "orjson" if HAS_ORJSON else "json",
+            "types": {
+                msg_type: {"count": entry["count"], "errors": entry["errors"], "latency": entry["latency"].snapshot()}
+                for msg_type, entry in self.types.items()
+            },
+            "unhandled": dict(self.unhandled_counts),
+        }
 
-    except Exception as e:
-        print(f"invite_members错误: {e}")
-        return {"code":500, "message":"成员邀请失败"}
-    
-def safe_del(user_id: str):
-    conn = connections.pop(user_id, None)
-    return conn
 
-async def safe_send_text(ws: WebSocket, text: str):
-    try:
-        await ws.send_text(text)
-        return True
-    except Exception:
-        return False
+ws_message_stats = WSMessageStats()
 
-async def safe_send_bytes(ws: WebSocket, data: bytes):
-    try:
-        await ws.send_bytes(data)
-        return True
-    except Exception:
-        return False
 
-async def safe_close(ws: WebSocket, code: int = 1000, reason: str = ""):
-    # 只在连接仍处于 CONNECTED 时尝试关闭，避免重复 close 报错
-    try:
-        if getattr(ws, "client_state", None) == WebSocketState.CONNECTED:
-            await ws.close(code=code, reason=reason)
-        return True
-    except Exception:
-        return False
+@app.get("/metrics/ws_messages")
+async def ws_message_metrics():
+    """WebSocket 文本消息按类型的计数与处理耗时分布"""
+    return JSONResponse({"data": ws_message_stats.snapshot(), "code": 200})
 
 @app.websocket("/ws/{user_id}")
 async def websocket_endpoint(websocket: WebSocket, user_id: str):
     current_online = len(connections)
     app_logger.info(f"[websocket] 即将接受连接 user_id={user_id}, 当前在线={current_online}")
     print(f"[websocket] 即将接受连接 user_id={user_id}, 当前在线={current_online}")
-    await websocket.accept()
-    connections[user_id] = {"ws": websocket, "last_heartbeat": time.time()}
+    # 客户端请求了 msgpack 子协议且服务端支持时协商 msgpack，否则保持 JSON
+    codec = "json"
+    if WS_MSGPACK_ENABLED and WS_MSGPACK_SUBPROTOCOL in websocket.scope.get("subprotocols", ()):
+        codec = WS_MSGPACK_SUBPROTOCOL
+    await websocket.accept(subprotocol=codec if codec != "json" else None)
+    # 所有发往该连接的消息都经过发送队列，由独立写协程按序写出
+    outbound = WebSocketSender(websocket, user_id, codec=codec)
+    outbound.start()
+    if drainer.draining:
+        # 本 worker 正在排空，不再接新会话
+        await drainer.reject(outbound)
+        return
+    rate_limiter = ConnectionRateLimiter(user_id)
+    conn_entry = {"ws": outbound, "last_heartbeat": time.time(), "limiter": rate_limiter}
+    connections[user_id] = conn_entry
+    heartbeat_scheduler.track(user_id, conn_entry)
+    await hub.register(user_id)
+    await presence.went_online(user_id)
     app_logger.info(f"[websocket] 用户 {user_id} 已连接，当前在线={len(connections)}")
     print(f"用户 {user_id} 已连接，当前在线={len(connections)}")
 
-    connection = get_db_connection()
-    if connection is None or not connection.is_connected():
-        app_logger.error("Database connection error in /friends API.")
-        print(f"[websocket][{user_id}] 数据库连接失败，立即关闭")
-        return JSONResponse({
-            'data': {
-                'message': '数据库连接失败',
-                'code': 500
-            }
-        }, status_code=500)
-    else:
-        app_logger.info(f"[websocket] 数据库连接成功，user_id={user_id}")
-
-    cursor = None
+    # 数据库连接按消息借用：需要查库时才从连接池借出，每条消息处理完归还
+    connection = LazyDBConnection()
+    srs_offer_tasks: set = set()  # 后台进行中的 SRS offer 转发
     try:
-        # 查询条件改为：receiver_id = user_id 或 sender_id = user_id，并且 is_read = 0
-        print(" xxx SELECT ta_notification")
-        update_query = """
-            SELECT *
-            FROM ta_notification
-            WHERE (receiver_id = %s OR sender_id = %s)
-            AND is_read = 0;
-        """
-        cursor = connection.cursor(dictionary=True)
-        cursor.execute(update_query, (user_id, user_id))
-        unread_notifications = cursor.fetchall()
-
-        if unread_notifications:
-            await websocket.send_text(json.dumps({
-                "type": "unread_notifications",
-                "data": unread_notifications
-            }, default=convert_datetime, ensure_ascii=False))
-        
-        # 查询所有课前准备（包含已读与未读）
-        cursor.execute("""
-            SELECT 
-                cp.prepare_id, cp.group_id, cp.class_id, cp.school_id, cp.subject, cp.content, cp.date, cp.time,
-                cp.sender_id, cp.sender_name, cp.created_at, g.group_name, cpr.is_read
-            FROM class_preparation cp
-            INNER JOIN class_preparation_receiver cpr ON cp.prepare_id = cpr.prepare_id
-            LEFT JOIN `groups` g ON cp.group_id = g.group_id
-            WHERE cpr.receiver_id = %s
-            ORDER BY cp.created_at DESC
-        """, (user_id,))
-        preparation_rows = cursor.fetchall()
+        sync_cursor = websocket.query_params.get("sync_cursor")
+        resume_token = websocket.query_params.get("resume")
+        if resume_token:
+            # 排空后带恢复令牌重连：从断开时的游标继续增量同步，令牌无效时退回完整登录
+            resume_cursor = verify_resume_token(resume_token, user_id)
+            if resume_cursor is None:
+                drainer.stats["resume_rejected"] += 1
+                await outbound.send_json({"type": "resume", "status": "rejected"})
+            else:
+                drainer.stats["resumed"] += 1
+                await outbound.send_json({"type": "resume", "status": "success"})
+                sync_cursor = resume_cursor
+        if sync_cursor is not None:
+            # 增量同步：只推第一页，后续页由客户端发 sync_more 拉取
+            await outbound.send_text(await login_sync_page(user_id, sync_cursor, conn_entry))
+        else:
+            # 查询条件改为：receiver_id = user_id 或 sender_id = user_id，并且 is_read = 0
+            print(" xxx SELECT ta_notification")
 
-        if preparation_rows:
-            preparation_payload: Dict[str, Any] = {
-                "type": "prepare_class_history",
-                "count": len(preparation_rows),
-                "data": []
-            }
-            unread_updates: List[int] = []
-
-            for prep in preparation_rows:
-                message = {
-                    "class_id": prep.get("class_id"),
-                    "school_id": prep.get("school_id"),
-                    "subject": prep.get("subject"),
-                    "content": prep.get("content"),
-                    "date": prep.get("date"),
-                    "time": prep.get("time"),
-                    "sender_id": prep.get("sender_id"),
-                    "sender_name": prep.get("sender_name"),
-                    "group_id": prep.get("group_id"),
-                    "group_name": prep.get("group_name") or "",
-                    "prepare_id": prep.get("prepare_id"),
-                    "is_read": int(prep.get("is_read", 0)),
-                    "created_at": convert_datetime(prep.get("created_at")) if prep.get("created_at") else None
+            def load_login_replay(conn):
+                """登录补发：未读通知 + 离线语音、全部课前准备，在数据库线程池中执行"""
+                replay_cursor = conn.cursor(dictionary=True)
+                try:
+                    replay_cursor.execute("""
+                        SELECT *
+                        FROM ta_notification
+                        WHERE (receiver_id = %s OR sender_id = %s)
+                        AND is_read = 0;
+                    """, (user_id, user_id))
+                    notifications = replay_cursor.fetchall()
+                    last_id = max((row["id"] for row in notifications), default=0)
+                    notifications.extend(fetch_unread_offline_voice(replay_cursor, user_id))
+                    conn.commit()
+
+                    # 查询所有课前准备（包含已读与未读）
+                    replay_cursor.execute("""
+                        SELECT 
+                            cp.prepare_id, cp.group_id, cp.class_id, cp.school_id, cp.subject, cp.content, cp.date, cp.time,
+                            cp.sender_id, cp.sender_name, cp.created_at, g.group_name, cpr.is_read
+                        FROM class_preparation cp
+                        INNER JOIN class_preparation_receiver cpr ON cp.prepare_id = cpr.prepare_id
+                        LEFT JOIN `groups` g ON cp.group_id = g.group_id
+                        WHERE cpr.receiver_id = %s
+                        ORDER BY cp.created_at DESC
+                    """, (user_id,))
+                    return notifications, last_id, replay_cursor.fetchall()
+                finally:
+                    replay_cursor.close()
+
+            def mark_preparations_read(conn, prepare_ids: List[int]) -> None:
+                placeholders = ",".join(["%s"] * len(prepare_ids))
+                update_cursor = conn.cursor()
+                try:
+                    update_cursor.execute(f"""
+                        UPDATE class_preparation_receiver
+                        SET is_read = 1, read_at = NOW()
+                        WHERE receiver_id = %s AND prepare_id IN ({placeholders})
+                    """, (user_id, *prepare_ids))
+                    conn.commit()
+                finally:
+                    update_cursor.close()
+
+            unread_notifications, last_notification_id, preparation_rows = await connection.run(load_login_replay)
+
+            if unread_notifications:
+                await outbound.send_text(json.dumps({
+                    "type": "unread_notifications",
+                    "data": unread_notifications
+                }, default=convert_datetime, ensure_ascii=False))
+
+            # 已补发到的位置，排空时写进恢复令牌
+            last_prepare_id = max((row["prepare_id"] for row in preparation_rows), default=0)
+            conn_entry["sync_cursor"] = f"{last_notification_id}.{last_prepare_id}"
+
+            if preparation_rows:
+                preparation_payload: Dict[str, Any] = {
+                    "type": "prepare_class_history",
+                    "count": len(preparation_rows),
+                    "data": []
                 }
-                preparation_payload["data"].append(message)
+                unread_updates: List[int] = []
 
-                if not prep.get("is_read"):
-                    unread_updates.append(prep.get("prepare_id"))
+                for prep in preparation_rows:
+                    preparation_payload["data"].append(format_preparation_message(prep))
 
-            payload_str = json.dumps(preparation_payload, ensure_ascii=False)
-            app_logger.info(f"[prepare_class] 用户 {user_id} 登录，推送课前准备数据: {payload_str}")
-            print(f"[prepare_class] 登录推送课前准备数据: {payload_str}")
-            await websocket.send_text(payload_str)
+                    if not prep.get("is_read"):
+                        unread_updates.append(prep.get("prepare_id"))
 
-            if unread_updates:
-                app_logger.info(f"[prepare_class] 标记 {len(unread_updates)} 条课前准备为已读，user_id={user_id}")
-                for prep_id in unread_updates:
-                    cursor.execute("""
-                        UPDATE class_preparation_receiver
-                        SET is_read = 1, read_at = NOW()
-                        WHERE prepare_id = %s AND receiver_id = %s
-                    """, (prep_id, user_id))
-                connection.commit()
+                payload_str = json.dumps(preparation_payload, ensure_ascii=False)
+                app_logger.info(f"[prepare_class] 用户 {user_id} 登录，推送课前准备数据: {payload_str}")
+                print(f"[prepare_class] 登录推送课前准备数据: {payload_str}")
+                await outbound.send_text(payload_str)
+
+                if unread_updates:
+                    app_logger.info(f"[prepare_class] 标记 {len(unread_updates)} 条课前准备为已读，user_id={user_id}")
+                    await connection.run(mark_preparations_read, unread_updates)
+
+        def load_owner_info(conn):
+            owner_cursor = conn.cursor(dictionary=True)
+            try:
+                owner_cursor.execute(
+                    "SELECT name, icon FROM ta_teacher WHERE teacher_unique_id = %s",
+                    (user_id,)
+                )
+                return owner_cursor.fetchone()
+            finally:
+                owner_cursor.close()
+
+        def save_temp_room(conn, room_id: str, group_id: str, owner_name: str, owner_icon: str,
+                           whip_url: str, whep_url: str, stream_name: str) -> None:
+            """房间和创建者（群主）成员记录一个事务写入，在数据库线程池中执行"""
+            room_cursor = conn.cursor()
+            try:
+                # 插入临时语音房间信息
+                room_cursor.execute("""
+                    INSERT INTO `temp_voice_rooms` (
+                        room_id, group_id, owner_id, owner_name, owner_icon,
+                        whip_url, whep_url, stream_name, status, create_time
+                    ) VALUES (
+                        %s, %s, %s, %s, %s, %s, %s, %s, %s, NOW()
+                    )
+                """, (
+                    room_id,
+                    group_id,
+                    user_id,
+                    owner_name if owner_name else None,
+                    owner_icon if owner_icon else None,
+                    whip_url,
+                    whep_url,
+                    stream_name,
+                    1  # status = 1 (活跃)
+                ))
+
+                # 插入房间创建者（群主）到成员表
+                room_cursor.execute("""
+                    INSERT INTO `temp_voice_room_members` (
+                        room_id, user_id, user_name, status, join_time
+                    ) VALUES (
+                        %s, %s, %s, %s, NOW()
+                    )
+                """, (
+                    room_id,
+                    user_id,
+                    owner_name if owner_name else None,
+                    1  # status = 1 (在线)
+                ))
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                room_cursor.close()
+
+        def load_group_row(conn, group_id: str):
+            group_cursor = conn.cursor(dictionary=True)
+            try:
+                group_cursor.execute("SELECT group_id FROM `groups` WHERE group_id = %s", (group_id,))
+                return group_cursor.fetchone()
+            finally:
+                group_cursor.close()
 
         async def handle_temp_room_creation(msg_data1: Dict[str, Any]):
             print(f"[temp_room] 创建请求 payload={msg_data1}")
             app_logger.info(f"[temp_room] 创建房间请求 - user_id={user_id}, payload={msg_data1}")
             
             try:
-                local_cursor = connection.cursor(dictionary=True)
-
                 owner_id = user_id
                 invited_users = msg_data1.get('invited_users', []) or []
                 if not isinstance(invited_users, list):
@@ -13872,15 +17703,14 @@ async def websocket_endpoint(websocket: WebSocket, user_id: str):
                     error_response_json = json.dumps(error_response, ensure_ascii=False)
                     app_logger.warning(f"[temp_room] 创建房间失败 - group_id 为空, user_id={user_id}, 消息内容: {error_response_json}")
                     print(f"[temp_room] 返回创建房间失败消息给用户 {user_id}: {error_response_json}")
-                    await websocket.send_text(error_response_json)
+                    await outbound.send_json(error_response)
                     return
 
                 # 检查用户是否已经在其他房间中
                 existing_room = None
-                for existing_group_id, existing_room_info in active_temp_rooms.items():
-                    members = existing_room_info.get("members", [])
-                    if user_id in members:
-                        existing_room = existing_room_info
+                for existing_group_id in temp_rooms.rooms_of(user_id):
+                    existing_room = active_temp_rooms.get(existing_group_id)
+                    if existing_room:
                         app_logger.warning(f"[temp_room] 用户 {user_id} 已在房间 {existing_group_id} 中，无法创建新房间")
                         print(f"[temp_room] 用户 {user_id} 已在房间 {existing_group_id} 中，无法创建新房间")
                         break
@@ -13894,7 +17724,7 @@ async def websocket_endpoint(websocket: WebSocket, user_id: str):
                     error_response_json = json.dumps(error_response, ensure_ascii=False)
                     app_logger.warning(f"[temp_room] 创建房间失败 - 用户已在其他房间, user_id={user_id}, 消息内容: {error_response_json}")
                     print(f"[temp_room] 返回创建房间失败消息给用户 {user_id}: {error_response_json}")
-                    await websocket.send_text(error_response_json)
+                    await outbound.send_json(error_response)
                     return
 
                 owner_name = msg_data1.get('owner_name', '') or ''
@@ -13903,11 +17733,7 @@ async def websocket_endpoint(websocket: WebSocket, user_id: str):
                 # 尝试从数据库获取创建者信息
                 try:
                     if not owner_name or not owner_icon:
-                        local_cursor.execute(
-                            "SELECT name, icon FROM ta_teacher WHERE teacher_unique_id = %s",
-                            (owner_id,)
-                        )
-                        owner_info = local_cursor.fetchone()
+                        owner_info = await connection.run(load_owner_info)
                         if owner_info:
                             if not owner_name:
                                 owner_name = owner_info.get('name', '') or owner_name
@@ -13941,40 +17767,36 @@ async def websocket_endpoint(websocket: WebSocket, user_id: str):
 
                 # 通知被邀请的用户
                 try:
-                    for invited_user_id in invited_users:
-                        target_conn = connections.get(invited_user_id)
-                        if target_conn:
-                            print(f"用户 {invited_user_id} 在线，发送拉流地址")
-                            online_users.append(invited_user_id)
-                            try:
-                                invite_response = {
-                                    "type": "6",
-                                    "room_id": room_id,
-                                    "owner_id": owner_id,
-                                    "owner_name": owner_name,
-                                    "owner_icon": owner_icon,
-                                    "publish_url": publish_url,  # 推流地址（传统 WebRTC API）
-                                    "play_url": play_url,  # 拉流地址（传统 WebRTC API）
-                                    "stream_name": stream_name,  # 流名称
-                                    "group_id": group_id,
-                                    "message": f"{owner_name or '群主'}邀请你加入临时房间"
-                                }
-                                invite_response_json = json.dumps(invite_response, ensure_ascii=False)
-                                app_logger.info(f"[temp_room] 返回房间邀请通知给用户 {invited_user_id}, 消息内容: {invite_response_json}")
-                                print(f"[temp_room] 返回房间邀请通知给用户 {invited_user_id}: {invite_response_json}")
-                                await target_conn["ws"].send_text(invite_response_json)
-                            except Exception as send_error:
-                                app_logger.warning(f"[temp_room] 发送邀请消息失败 - invited_user_id={invited_user_id}, error={send_error}")
-                                # 发送失败不影响房间创建
-                        else:
-                            print(f"用户 {invited_user_id} 不在线")
-                            offline_users.append(invited_user_id)
+                    targets = await hub.lookup_many(invited_users)
+                    online_users = [uid for uid in invited_users if uid in targets]
+                    offline_users = [uid for uid in invited_users if uid not in targets]
+                    if offline_users:
+                        print(f"用户 {offline_users} 不在线")
+                    if targets:
+                        invite_response = {
+                            "type": "6",
+                            "room_id": room_id,
+                            "owner_id": owner_id,
+                            "owner_name": owner_name,
+                            "owner_icon": owner_icon,
+                            "publish_url": publish_url,  # 推流地址（传统 WebRTC API）
+                            "play_url": play_url,  # 拉流地址（传统 WebRTC API）
+                            "stream_name": stream_name,  # 流名称
+                            "group_id": group_id,
+                            "message": f"{owner_name or '群主'}邀请你加入临时房间"
+                        }
+                        app_logger.info(f"[temp_room] 返回房间邀请通知给用户 {online_users}, 消息内容: {json.dumps(invite_response, ensure_ascii=False)}")
+                        print(f"[temp_room] 在线用户 {online_users}，发送拉流地址")
+                        result = await hub.fan_out(targets, invite_response)
+                        if result.failed or result.timed_out:
+                            # 发送失败不影响房间创建
+                            app_logger.warning(f"[temp_room] 发送邀请消息失败 - 失败={result.failed}, 超时={result.timed_out}")
                 except Exception as invite_error:
                     app_logger.error(f"[temp_room] 处理邀请用户时出错 - error={invite_error}")
                     # 邀请失败不影响房间创建，继续执行
 
                 # 初始化房间成员列表（包含创建者）
-                active_temp_rooms[group_id] = {
+                await temp_rooms.add_room(group_id, {
                     "room_id": room_id,
                     "owner_id": owner_id,
                     "owner_name": owner_name,
@@ -13987,54 +17809,18 @@ async def websocket_endpoint(websocket: WebSocket, user_id: str):
                     "group_id": group_id,
                     "timestamp": time.time(),
                     "members": [owner_id]  # 初始化成员列表，包含创建者
-                }
-                
-                # 保存临时语音房间到数据库
-                try:
-                    # 插入临时语音房间信息
-                    insert_room_sql = """
-                        INSERT INTO `temp_voice_rooms` (
-                            room_id, group_id, owner_id, owner_name, owner_icon,
-                            whip_url, whep_url, stream_name, status, create_time
-                        ) VALUES (
-                            %s, %s, %s, %s, %s, %s, %s, %s, %s, NOW()
-                        )
-                    """
-                    local_cursor.execute(insert_room_sql, (
-                        room_id,
-                        group_id,
-                        owner_id,
-                        owner_name if owner_name else None,
-                        owner_icon if owner_icon else None,
-                        whip_url,
-                        whep_url,
-                        stream_name,
-                        1  # status = 1 (活跃)
-                    ))
-                    
-                    # 插入房间创建者（群主）到成员表
-                    insert_member_sql = """
-                        INSERT INTO `temp_voice_room_members` (
-                            room_id, user_id, user_name, status, join_time
-                        ) VALUES (
-                            %s, %s, %s, %s, NOW()
-                        )
-                    """
-                    local_cursor.execute(insert_member_sql, (
-                        room_id,
-                        owner_id,
-                        owner_name if owner_name else None,
-                        1  # status = 1 (在线)
-                    ))
-                    
-                    connection.commit()
+                })
+                
+                # 保存临时语音房间到数据库
+                try:
+                    await connection.run(save_temp_room, room_id, group_id, owner_name, owner_icon,
+                                         whip_url, whep_url, stream_name)
                     print(f"[temp_room] 临时语音房间已保存到数据库 - room_id={room_id}, group_id={group_id}")
                     app_logger.info(f"[temp_room] 临时语音房间已保存到数据库 - room_id={room_id}, group_id={group_id}")
                 except Exception as db_save_error:
                     # 数据库保存失败不影响内存中的房间创建
                     print(f"[temp_room] 保存临时语音房间到数据库失败 - room_id={room_id}, error={db_save_error}")
                     app_logger.error(f"[temp_room] 保存临时语音房间到数据库失败 - room_id={room_id}, error={db_save_error}", exc_info=True)
-                    connection.rollback()
                 
                 print(f"[temp_room] 记录成功 group_id={group_id}, room_id={room_id}, stream_name={stream_name}, invited={invited_users}, active_total={len(active_temp_rooms)}")
                 app_logger.info(f"[temp_room] 房间创建成功 - group_id={group_id}, room_id={room_id}, stream_name={stream_name}, members={[owner_id]}")
@@ -14055,7 +17841,7 @@ async def websocket_endpoint(websocket: WebSocket, user_id: str):
                 response_json = json.dumps(create_room_response, ensure_ascii=False)
                 app_logger.info(f"[temp_room] 返回创建房间成功消息 - user_id={user_id}, 消息内容: {response_json}")
                 print(f"[temp_room] 返回创建房间成功消息给用户 {user_id}: {response_json}")
-                await websocket.send_text(response_json)
+                await outbound.send_json(create_room_response)
                 
             except Exception as e:
                 error_msg = f"创建房间失败: {str(e)}"
@@ -14064,11 +17850,11 @@ async def websocket_endpoint(websocket: WebSocket, user_id: str):
                 
                 # 返回错误信息给客户端
                 try:
-                    await websocket.send_text(json.dumps({
+                    await outbound.send_json({
                         "type": "6",
                         "status": "error",
                         "message": error_msg
-                    }, ensure_ascii=False))
+                    })
                 except Exception as send_error:
                     app_logger.error(f"[temp_room] 发送错误消息失败 - error={send_error}")
 
@@ -14092,10 +17878,10 @@ async def websocket_endpoint(websocket: WebSocket, user_id: str):
                     error_response_json = json.dumps(error_response, ensure_ascii=False)
                     app_logger.warning(f"[temp_room] 加入房间失败 - group_id 为空, user_id={user_id}, 消息内容: {error_response_json}")
                     print(f"[temp_room] 返回加入房间失败消息给用户 {user_id}: {error_response_json}")
-                    await websocket.send_text(error_response_json)
+                    await outbound.send_json(error_response)
                     return
 
-                room_info = active_temp_rooms.get(group_key)
+                room_info = await temp_rooms.get(group_key)
                 if not room_info:
                     not_found_response = {
                         "type": "6",
@@ -14106,7 +17892,7 @@ async def websocket_endpoint(websocket: WebSocket, user_id: str):
                     not_found_response_json = json.dumps(not_found_response, ensure_ascii=False)
                     app_logger.warning(f"[temp_room] 用户 {user_id} 尝试加入不存在的房间 group_id={group_key}, 消息内容: {not_found_response_json}")
                     print(f"[temp_room] 返回加入房间失败消息给用户 {user_id}: {not_found_response_json}")
-                    await websocket.send_text(not_found_response_json)
+                    await outbound.send_json(not_found_response)
                     print(f"[temp_room] group_id={group_key} 无匹配房间，active_total={len(active_temp_rooms)}")
                     return
 
@@ -14114,20 +17900,12 @@ async def websocket_endpoint(websocket: WebSocket, user_id: str):
                 app_logger.info(f"[temp_room] 🔵 检查用户是否已在房间 - user_id={user_id}, group_key={group_key}, room_exists={room_info is not None}")
                 print(f"[temp_room] 🔵 检查用户是否已在房间 - user_id={user_id}, group_key={group_key}")
 
-                was_member = False
-                if "members" not in room_info:
-                    room_info["members"] = []
-                    app_logger.info(f"[temp_room] 🔵 房间成员列表不存在，已初始化 - group_key={group_key}")
-                    print(f"[temp_room] 🔵 房间成员列表不存在，已初始化 - group_key={group_key}")
-                else:
-                    was_member = user_id in room_info["members"]
-                    app_logger.info(f"[temp_room] 🔵 检查成员状态 - user_id={user_id}, was_member={was_member}, current_members={room_info['members']}")
-                    print(f"[temp_room] 🔵 检查成员状态 - user_id={user_id}, was_member={was_member}, current_members={room_info['members']}")
-
                 # 将用户添加到房间成员列表（如果尚未加入）
+                was_member = False
                 try:
+                    was_member = not await temp_rooms.join(group_key, user_id)
+                    app_logger.info(f"[temp_room] 🔵 检查成员状态 - user_id={user_id}, was_member={was_member}, current_members={room_info['members']}")
                     if not was_member:
-                        room_info["members"].append(user_id)
                         print(f"[temp_room] 用户 {user_id} 加入成员列表，当前成员数={len(room_info['members'])}")
                         app_logger.info(f"[temp_room] ✅ 用户 {user_id} 首次加入房间 - group_id={group_key}, room_id={room_info['room_id']}, 当前成员={room_info['members']}")
                     else:
@@ -14150,11 +17928,10 @@ async def websocket_endpoint(websocket: WebSocket, user_id: str):
                     "play_url": room_info.get("play_url", ""),  # 拉流地址（传统 WebRTC API）
                     "stream_name": room_info.get("stream_name", ""),  # 流名称
                     "group_id": group_key,
-                    "members": room_info.get("members", []),
+                    "members": temp_rooms.members(group_key),
                     "status": "duplicate" if was_member else "success",
                     "message": "" if was_member else f"已加入临时房间（班级: {group_key}）"
                 }
-                join_room_response_json = json.dumps(join_room_response, ensure_ascii=False)
                 
                 # 记录日志（如果是重复加入，使用不同的日志级别，并减少日志输出）
                 if was_member:
@@ -14163,12 +17940,13 @@ async def websocket_endpoint(websocket: WebSocket, user_id: str):
                     print(f"[temp_room] ⚠️⚠️⚠️ 用户 {user_id} 重复加入房间 {group_key}，调用时间戳={call_timestamp}，时间差={time_module.time() - call_timestamp:.3f}秒")
                     print(f"[temp_room] ⚠️ 当前房间成员：{room_info.get('members', [])}")
                 else:
+                    join_room_response_json = json.dumps(join_room_response, ensure_ascii=False)
                     app_logger.info(f"[temp_room] ✅ 返回加入房间成功消息 - user_id={user_id}, 消息内容: {join_room_response_json}")
                     print(f"[temp_room] ✅ 返回加入房间成功消息给用户 {user_id}: {join_room_response_json}")
                 
                 app_logger.info(f"[temp_room] 🔵 准备发送加入房间响应 - user_id={user_id}, was_member={was_member}, timestamp={time_module.time()}")
                 print(f"[temp_room] 🔵 准备发送加入房间响应 - user_id={user_id}, was_member={was_member}")
-                await websocket.send_text(join_room_response_json)
+                await outbound.send_json(join_room_response)
                 app_logger.info(f"[temp_room] 🔵 已发送加入房间响应 - user_id={user_id}, was_member={was_member}")
                 print(f"[temp_room] 🔵 已发送加入房间响应 - user_id={user_id}, was_member={was_member}")
                 print(f"[temp_room] user_id={user_id} 加入 group_id={group_key}, room_id={room_info.get('room_id', '')}, stream_name={room_info.get('stream_name', '')}, 当前成员={room_info.get('members', [])}")
@@ -14187,7 +17965,7 @@ async def websocket_endpoint(websocket: WebSocket, user_id: str):
                     error_response_json = json.dumps(error_response, ensure_ascii=False)
                     app_logger.error(f"[temp_room] 返回加入房间失败消息 - user_id={user_id}, 消息内容: {error_response_json}")
                     print(f"[temp_room] 返回加入房间失败消息给用户 {user_id}: {error_response_json}")
-                    await websocket.send_text(error_response_json)
+                    await outbound.send_json(error_response)
                 except Exception as send_error:
                     app_logger.error(f"[temp_room] 发送错误消息失败 - error={send_error}")
 
@@ -14200,10 +17978,10 @@ async def websocket_endpoint(websocket: WebSocket, user_id: str):
                     "status": "error",
                     "message": "group_id 不能为空"
                 }
-                await websocket.send_text(json.dumps(error_response, ensure_ascii=False))
+                await outbound.send_json(error_response)
                 return
 
-            room_info = active_temp_rooms.get(group_key)
+            room_info = await temp_rooms.get(group_key)
             if not room_info:
                 error_response = {
                     "type": "temp_room_owner_leave",
@@ -14211,7 +17989,7 @@ async def websocket_endpoint(websocket: WebSocket, user_id: str):
                     "group_id": group_key,
                     "message": "未找到临时房间或已解散"
                 }
-                await websocket.send_text(json.dumps(error_response, ensure_ascii=False))
+                await outbound.send_json(error_response)
                 return
 
             owner_id = room_info.get("owner_id")
@@ -14222,11 +18000,11 @@ async def websocket_endpoint(websocket: WebSocket, user_id: str):
                     "group_id": group_key,
                     "message": "只有房间创建者才能解散临时房间"
                 }
-                await websocket.send_text(json.dumps(error_response, ensure_ascii=False))
+                await outbound.send_json(error_response)
                 return
 
             await notify_temp_room_closed(group_key, room_info, "owner_active_leave", user_id)
-            active_temp_rooms.pop(group_key, None)
+            await temp_rooms.remove_room(group_key, room_info.get("room_id"))
             app_logger.info(f"[temp_room] 房间创建者 {user_id} 主动解散临时房间 group_id={group_key}")
             print(f"[temp_room] 房间创建者 {user_id} 主动解散临时房间 group_id={group_key}")
 
@@ -14236,7 +18014,7 @@ async def websocket_endpoint(websocket: WebSocket, user_id: str):
                 "group_id": group_key,
                 "message": "临时房间已解散，已通知所有成员停止推流/拉流"
             }
-            await websocket.send_text(json.dumps(success_response, ensure_ascii=False))
+            await outbound.send_json(success_response)
 
         async def handle_srs_webrtc_offer(msg_data: Dict[str, Any], action_type: str):
             """
@@ -14258,7 +18036,7 @@ async def websocket_endpoint(websocket: WebSocket, user_id: str):
                     error_response_json = json.dumps(error_response, ensure_ascii=False)
                     app_logger.warning(f"[srs_webrtc] 返回 {action_type} 错误消息给用户 {user_id}, 消息内容: {error_response_json}")
                     print(f"[srs_webrtc] 返回 {action_type} 错误消息给用户 {user_id}: {error_response_json}")
-                    await websocket.send_text(error_response_json)
+                    await outbound.send_json(error_response)
                     return
                 
                 # 确定流名称（优先使用 stream_name，否则使用 room_id）
@@ -14280,24 +18058,11 @@ async def websocket_endpoint(websocket: WebSocket, user_id: str):
                         error_response_json = json.dumps(error_response, ensure_ascii=False)
                         app_logger.warning(f"[srs_webrtc] 返回 {action_type} 错误消息给用户 {user_id}, 消息内容: {error_response_json}")
                         print(f"[srs_webrtc] 返回 {action_type} 错误消息给用户 {user_id}: {error_response_json}")
-                        await websocket.send_text(error_response_json)
+                        await outbound.send_json(error_response)
                         return
                 
-                # 构建 SRS API URL
-                api_path = "/rtc/v1/publish/" if action_type == "publish" else "/rtc/v1/play/"
-                api_url = f"{SRS_WEBRTC_API_URL}{api_path}"
-                # api_control_url 用于 SRS API 的 api 参数（控制URL）
-                # 如果使用 HTTPS，通过 nginx 443 端口；如果使用 HTTP，直接使用 1985 端口
-                if SRS_USE_HTTPS:
-                    api_control_url = f"https://{SRS_SERVER}:{SRS_HTTPS_PORT}/api/v1{api_path}"
-                else:
-                    api_control_url = f"http://{SRS_SERVER}:{SRS_PORT}/api/v1{api_path}"
-                stream_url = f"webrtc://{SRS_SERVER}/live/{stream_name}"
-                
-                # 记录详细的请求信息，包括使用的协议和URL
-                protocol = "HTTPS" if SRS_USE_HTTPS else "HTTP"
-                app_logger.info(f"[srs_webrtc] 转发 {action_type} offer - 协议={protocol}, API_URL={api_url}, user_id={user_id}, stream_name={stream_name}, stream_url={stream_url}")
-                print(f"[srs_webrtc] 转发 {action_type} offer - 协议={protocol}, API_URL={api_url}, user_id={user_id}, stream_name={stream_name}, stream_url={stream_url}")
+                app_logger.info(f"[srs_webrtc] 转发 {action_type} offer - 节点={[node.base_url for node in srs_client.nodes]}, user_id={user_id}, stream_name={stream_name}")
+                print(f"[srs_webrtc] 转发 {action_type} offer - user_id={user_id}, stream_name={stream_name}")
                 
                 # 检查是否是拉流操作，如果是则记录可能的推流方信息
                 if action_type == "play":
@@ -14308,57 +18073,23 @@ async def websocket_endpoint(websocket: WebSocket, user_id: str):
                             app_logger.warning(f"[srs_webrtc] 警告：用户 {user_id} 正在拉取自己推流的流 {stream_name}，这可能导致问题")
                             print(f"[srs_webrtc] 警告：用户 {user_id} 正在拉取自己推流的流 {stream_name}")
                 
-                # 准备请求数据
-                request_data = {
-                    "api": api_control_url,
-                    "streamurl": stream_url,
-                    "sdp": sdp
-                }
-                
-                # 发送请求到 SRS（异步使用 httpx，否则使用 urllib）
-                if HAS_HTTPX:
-                    # 如果使用 HTTPS 自签名证书，需要禁用 SSL 验证
-                    verify_ssl = not SRS_USE_HTTPS or os.getenv('SRS_VERIFY_SSL', 'false').lower() == 'true'
-                    async with httpx.AsyncClient(timeout=30.0, verify=verify_ssl) as client:
-                        response = await client.post(
-                            api_url,
-                            json=request_data,
-                            headers={"Content-Type": "application/json"}
-                        )
-                        response.raise_for_status()
-                        result = response.json()
-                        # 记录 SRS 响应（用于调试）
-                        app_logger.info(f"[srs_webrtc] SRS {action_type} 响应 - code={result.get('code')}, has_sdp={bool(result.get('sdp'))}, 完整响应={json.dumps(result, ensure_ascii=False)}")
-                        print(f"[srs_webrtc] SRS {action_type} 响应: {result}")
-                else:
-                    # 同步方式（在异步环境中使用 run_in_executor 避免阻塞）
-                    def sync_http_request():
-                        import urllib.request
-                        import urllib.error
-                        import ssl
-                        request_json = json.dumps(request_data).encode('utf-8')
-                        req = urllib.request.Request(
-                            api_url,
-                            data=request_json,
-                            headers={"Content-Type": "application/json"},
-                            method="POST"
-                        )
-                        # 如果使用 HTTPS 自签名证书，创建不验证 SSL 的上下文
-                        if SRS_USE_HTTPS and os.getenv('SRS_VERIFY_SSL', 'false').lower() != 'true':
-                            ssl_context = ssl.create_default_context()
-                            ssl_context.check_hostname = False
-                            ssl_context.verify_mode = ssl.CERT_NONE
-                            with urllib.request.urlopen(req, timeout=30, context=ssl_context) as response:
-                                return json.loads(response.read().decode('utf-8'))
-                        else:
-                            with urllib.request.urlopen(req, timeout=30) as response:
-                                return json.loads(response.read().decode('utf-8'))
-                    
-                    loop = asyncio.get_event_loop()
-                    result = await loop.run_in_executor(None, sync_http_request)
-                    # 记录 SRS 响应（用于调试）
-                    app_logger.info(f"[srs_webrtc] SRS {action_type} 响应 - code={result.get('code')}, has_sdp={bool(result.get('sdp'))}, 完整响应={json.dumps(result, ensure_ascii=False)}")
-                    print(f"[srs_webrtc] SRS {action_type} 响应: {result}")
+                # 经共享连接池转发到 SRS：有并发上限和熔断，多个节点时按顺序故障转移
+                try:
+                    result, srs_node = await srs_client.relay_offer(action_type, stream_name, sdp)
+                except SRSUnavailable as e:
+                    app_logger.warning(f"[srs_webrtc] {action_type} 快速失败 - user_id={user_id}, reason={e.reason}, message={e}")
+                    await outbound.send_json({
+                        "type": "srs_error",
+                        "action": action_type,
+                        "code": e.reason,
+                        "message": str(e),
+                        "retry_after_ms": int(e.retry_after * 1000)
+                    })
+                    return
+                stream_url = srs_node.stream_url(stream_name)
+                # 记录 SRS 响应（用于调试）
+                app_logger.info(f"[srs_webrtc] SRS {action_type} 响应 - node={srs_node.base_url}, code={result.get('code')}, has_sdp={bool(result.get('sdp'))}, 完整响应={json.dumps(result, ensure_ascii=False)}")
+                print(f"[srs_webrtc] SRS {action_type} 响应: {result}")
                 
                 # 检查 SRS 响应
                 if result.get('code') != 0:
@@ -14382,7 +18113,7 @@ async def websocket_endpoint(websocket: WebSocket, user_id: str):
                     error_response_json = json.dumps(error_response, ensure_ascii=False)
                     app_logger.error(f"[srs_webrtc] 返回 {action_type} 错误消息给用户 {user_id}, 消息内容: {error_response_json}")
                     print(f"[srs_webrtc] 返回 {action_type} 错误消息给用户 {user_id}: {error_response_json}")
-                    await websocket.send_text(error_response_json)
+                    await outbound.send_json(error_response)
                     return
                 
                 # 返回 answer 给客户端
@@ -14398,7 +18129,7 @@ async def websocket_endpoint(websocket: WebSocket, user_id: str):
                     error_response_json = json.dumps(error_response, ensure_ascii=False)
                     app_logger.error(f"[srs_webrtc] 返回 {action_type} 错误消息给用户 {user_id}, 消息内容: {error_response_json}")
                     print(f"[srs_webrtc] 返回 {action_type} 错误消息给用户 {user_id}: {error_response_json}")
-                    await websocket.send_text(error_response_json)
+                    await outbound.send_json(error_response)
                     return
                 
                 app_logger.info(f"[srs_webrtc] {action_type} 成功 - user_id={user_id}, stream_name={stream_name}")
@@ -14412,10 +18143,9 @@ async def websocket_endpoint(websocket: WebSocket, user_id: str):
                     "stream_name": stream_name,
                     "stream_url": stream_url
                 }
-                answer_response_json = json.dumps(answer_response, ensure_ascii=False)
                 app_logger.info(f"[srs_webrtc] 返回 {action_type} answer 给用户 {user_id}, 消息内容（SDP已省略）: {json.dumps({**answer_response, 'sdp': '...' if answer_response.get('sdp') else None}, ensure_ascii=False)}")
                 print(f"[srs_webrtc] 返回 {action_type} answer 给用户 {user_id}, stream_name={stream_name}, sdp_length={len(answer_sdp) if answer_sdp else 0}")
-                await websocket.send_text(answer_response_json)
+                await outbound.send_json(answer_response)
                 
             except Exception as e:
                 error_msg = f"处理 SRS {action_type} offer 时出错: {str(e)}"
@@ -14429,7 +18159,17 @@ async def websocket_endpoint(websocket: WebSocket, user_id: str):
                 error_response_json = json.dumps(error_response, ensure_ascii=False)
                 app_logger.error(f"[srs_webrtc] 返回 {action_type} 错误消息给用户 {user_id}, 消息内容: {error_response_json}")
                 print(f"[srs_webrtc] 返回 {action_type} 错误消息给用户 {user_id}: {error_response_json}")
-                await websocket.send_text(error_response_json)
+                await outbound.send_json(error_response)
+
+        async def start_srs_offer(msg_data: Dict[str, Any], action_type: str):
+            """SRS 转发可能要等几秒，放到后台任务里执行，期间 ping、ICE 等消息照常处理"""
+            if len(srs_offer_tasks) >= SRS_MAX_INFLIGHT_PER_CONNECTION:
+                await outbound.send_json({"type": "srs_error", "action": action_type, "code": "srs_busy",
+                                          "message": "上一个请求还在处理中，请稍后重试", "retry_after_ms": 1000})
+                return
+            task = asyncio.create_task(handle_srs_webrtc_offer(msg_data, action_type))
+            srs_offer_tasks.add(task)
+            task.add_done_callback(srs_offer_tasks.discard)
 
         async def handle_webrtc_signal(msg_data: Dict[str, Any], signal_type: str):
             """处理 WebRTC 信令消息（offer/answer/ice_candidate）"""
@@ -14443,1341 +18183,1180 @@ async def websocket_endpoint(websocket: WebSocket, user_id: str):
             if not target_user_id:
                 error_msg = f"缺少目标用户ID (target_user_id)"
                 app_logger.warning(f"[webrtc] {error_msg}")
-                await websocket.send_text(json.dumps({
+                await outbound.send_json({
                     "type": "webrtc_error",
                     "signal_type": signal_type,
                     "message": error_msg
-                }, ensure_ascii=False))
+                })
                 return
             
             # 验证目标用户是否在线
-            target_conn = connections.get(target_user_id)
+            target_conn = await hub.lookup(target_user_id)
             if not target_conn:
                 error_msg = f"目标用户 {target_user_id} 不在线"
                 app_logger.warning(f"[webrtc] {error_msg}")
-                await websocket.send_text(json.dumps({
+                await outbound.send_json({
+                    "type": "webrtc_error",
+                    "signal_type": signal_type,
+                    "message": error_msg
+                })
+                return
+            
+            # 可选：验证房间和成员关系
+            if group_id:
+                if group_id in active_temp_rooms:
+                    if not temp_rooms.is_member(group_id, user_id):
+                        app_logger.warning(f"[webrtc] 用户 {user_id} 不在房间 {group_id} 的成员列表中")
+                    if not temp_rooms.is_member(group_id, target_user_id):
+                        app_logger.warning(f"[webrtc] 目标用户 {target_user_id} 不在房间 {group_id} 的成员列表中")
+            
+            # 构建转发消息
+            forward_message = {
+                "type": f"webrtc_{signal_type}",
+                "from_user_id": user_id,
+                "target_user_id": target_user_id,
+                "room_id": room_id,
+                "group_id": group_id
+            }
+            
+            # 根据信令类型添加特定字段
+            if signal_type == "offer":
+                forward_message["offer"] = msg_data.get('offer')
+                forward_message["sdp"] = msg_data.get('sdp')  # 兼容不同格式
+            elif signal_type == "answer":
+                forward_message["answer"] = msg_data.get('answer')
+                forward_message["sdp"] = msg_data.get('sdp')  # 兼容不同格式
+            elif signal_type == "ice_candidate":
+                forward_message["candidate"] = msg_data.get('candidate')
+                forward_message["sdpMLineIndex"] = msg_data.get('sdpMLineIndex')
+                forward_message["sdpMid"] = msg_data.get('sdpMid')
+            
+            # 转发给目标用户
+            try:
+                await target_conn["ws"].send_json(forward_message)
+                app_logger.info(f"[webrtc] {signal_type} 转发成功 - from={user_id} to={target_user_id}")
+                print(f"[webrtc] {signal_type} 转发成功 to={target_user_id}")
+                
+                # 给发送者返回成功确认
+                await outbound.send_json({
+                    "type": f"webrtc_{signal_type}_sent",
+                    "target_user_id": target_user_id,
+                    "status": "success"
+                })
+            except Exception as e:
+                error_msg = f"转发 {signal_type} 失败: {str(e)}"
+                app_logger.error(f"[webrtc] {error_msg}")
+                await outbound.send_json({
                     "type": "webrtc_error",
                     "signal_type": signal_type,
                     "message": error_msg
-                }, ensure_ascii=False))
+                })
+
+        async def handle_private_message(msg_data1: Dict[str, Any], target_id: str, msg: str):
+            """加好友 / 私信（type=1）：目标在线直接转发，不在线写入 ta_notification"""
+            print(" 加好友消息")
+            target_conn = await hub.lookup(target_id)
+            if target_conn:
+                print(target_id, " 在线", ", 来自:", user_id)
+                print(msg)
+                await target_conn["ws"].send_text(f"[私信来自 {user_id}] {msg}")
+            else:
+                print(target_id, " 不在线", ", 来自:", user_id)
+                print(msg)
+                await outbound.send_text(f"用户 {target_id} 不在线")
+
+                msg_data = msg_data1
+
+                def save_notification(conn):
+                    notify_cursor = conn.cursor()
+                    try:
+                        notify_cursor.execute("""
+                            INSERT INTO ta_notification (sender_id, receiver_id, content, content_text)
+                            VALUES (%s, %s, %s, %s)
+                        """, (user_id, msg_data['teacher_unique_id'], msg_data['text'], msg_data['type']))
+                        conn.commit()
+                    finally:
+                        notify_cursor.close()
+
+                await connection.run(save_notification)
+
+
+        async def handle_create_group(msg_data1: Dict[str, Any], target_id: str, msg: str):
+            """创建群（type=3）"""
+            print(" 创建群")   
+            app_logger.info(f"[创建群] 开始处理创建群组请求 - user_id={user_id}")
+            try:
+                # 获取当前时间
+                current_time = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+                # 字段映射：统一使用与 /groups/sync 相同的字段名
+                # 兼容旧字段名（nickname, headImage_path, owner_id, school_id, class_id）
+                group_name = msg_data1.get('group_name') or msg_data1.get('nickname', '')
+                face_url = msg_data1.get('face_url') or msg_data1.get('headImage_path', '')
+                detail_face_url = msg_data1.get('detail_face_url') or face_url
+                # 转换 group_type：数据库中是整数类型，需要将字符串转换为整数
+                group_type_raw = msg_data1.get('group_type', '')
+                group_type = convert_group_type_to_int(group_type_raw)
+                owner_identifier = msg_data1.get('owner_identifier') or msg_data1.get('owner_id', '')
+                schoolid = msg_data1.get('schoolid') or msg_data1.get('school_id')
+                classid = msg_data1.get('classid') or msg_data1.get('class_id')
+                is_class_group = msg_data1.get('is_class_group')
+                if is_class_group is None:
+                    is_class_group = 1 if classid else 0
+
+                # 生成群ID：优先使用客户端传过来的，如果没有则使用班级ID+01，否则使用UUID
+                unique_group_id = msg_data1.get('group_id')
+                print(f"[创建群] 收到客户端传入的 group_id={unique_group_id}, classid={classid}")
+                app_logger.info(f"[创建群] 收到客户端传入的 group_id={unique_group_id}, classid={classid}")
+
+                # 检查 classid 是否看起来像是一个群组ID（以"01"结尾），如果是则可能是客户端错误
+                if classid and str(classid).endswith("01"):
+                    # 检查这个 classid 是否在 groups 表中存在（说明是群组ID而不是班级ID）
+                    existing_group = await connection.run(load_group_row, str(classid))
+                    if existing_group:
+                        error_msg = f"classid={classid} 是一个已存在的群组ID，而不是班级ID。请使用正确的班级ID创建群组。"
+                        print(f"[创建群] 错误: {error_msg}")
+                        app_logger.error(f"[创建群] {error_msg}")
+                        # 拒绝创建，返回错误消息给客户端
+                        error_response = {
+                            "type": "error",
+                            "message": error_msg,
+                            "code": 400
+                        }
+                        error_response_json = json.dumps(error_response, ensure_ascii=False)
+                        await outbound.send_text(error_response_json)
+                        print(f"[创建群] 已拒绝创建请求并向客户端返回错误 - user_id={user_id}, classid={classid}")
+                        return  # 跳过后续处理
+
+                if not unique_group_id:
+                    if classid:
+                        # 班级群：使用班级ID + "01"
+                        unique_group_id = str(classid) + "01"
+                        print(f"[创建群] 使用班级ID生成群ID: {unique_group_id}")
+                    else:
+                        # 非班级群：使用UUID
+                        unique_group_id = str(uuid.uuid4())
+                        print(f"[创建群] 使用UUID生成群ID: {unique_group_id}")
+                else:
+                    print(f"[创建群] 使用客户端传入的群ID: {unique_group_id}")
+
+                members_list = msg_data1.get('members', [])
+                member_info = msg_data1.get('member_info')
+
+                def save_group(conn) -> None:
+                    """在数据库线程池中写入 groups 和 group_members 并提交，出错时回滚。"""
+                    cursor = conn.cursor(dictionary=True)
+                    try:
+                        # 插入 groups 表
+                        insert_group_sql = """
+                            INSERT INTO `groups` (
+                                group_id, group_name, group_type, face_url, detail_face_url,
+                                owner_identifier, create_time, max_member_num, member_num,
+                                introduction, notification, searchable, visible, add_option,
+                                is_shutup_all, next_msg_seq, latest_seq, last_msg_time,
+                                last_info_time, info_seq, detail_info_seq, detail_group_id,
+                                detail_group_name, detail_group_type, detail_is_shutup_all,
+                                online_member_num, classid, schoolid, is_class_group
+                            ) VALUES (
+                                %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s,
+                                %s, %s, %s, %s, %s, %s, %s, %s,
+                                %s, %s, %s, %s, %s, %s, %s, %s, %s, %s
+                            )
+                        """
+                        insert_group_params = (
+                            unique_group_id,  # group_id
+                            group_name,  # group_name
+                            group_type,  # group_type
+                            face_url,  # face_url
+                            detail_face_url,  # detail_face_url
+                            owner_identifier,  # owner_identifier
+                            current_time,  # create_time
+                            500,  # max_member_num (默认500)
+                            len(msg_data1.get('members', [])),  # member_num
+                            '',  # introduction
+                            '',  # notification
+                            1,  # searchable (默认可搜索)
+                            1,  # visible (默认可见)
+                            0,  # add_option (默认0)
+                            0,  # is_shutup_all (默认0)
+                            0,  # next_msg_seq
+                            0,  # latest_seq
+                            current_time,  # last_msg_time
+                            current_time,  # last_info_time
+                            0,  # info_seq
+                            0,  # detail_info_seq
+                            None,  # detail_group_id
+                            None,  # detail_group_name
+                            None,  # detail_group_type
+                            None,  # detail_is_shutup_all
+                            0,  # online_member_num
+                            classid,  # classid
+                            schoolid,  # schoolid
+                            is_class_group  # is_class_group
+                        )
+
+                        # 检查群组是否已存在
+                        cursor.execute(
+                            "SELECT group_id FROM `groups` WHERE group_id = %s",
+                            (unique_group_id,)
+                        )
+                        existing_group = cursor.fetchone()
+
+                        if existing_group:
+                            print(f"[创建群] 群组 {unique_group_id} 已存在，跳过插入 groups 表")
+                            app_logger.info(f"[创建群] 群组 {unique_group_id} 已存在，跳过插入 groups 表")
+                        else:
+                            print(f"[创建群] 插入 groups 表 - group_id={unique_group_id}, group_name={group_name}")
+                            app_logger.info(f"[创建群] 插入 groups 表 - group_id={unique_group_id}, group_name={group_name}, is_class_group={is_class_group}")
+                            try:
+                                cursor.execute(insert_group_sql, insert_group_params)
+                                affected_rows = cursor.rowcount
+                                print(f"[创建群] 插入 groups 表成功 - group_id={unique_group_id}, 影响行数: {affected_rows}")
+                                app_logger.info(f"[创建群] 插入 groups 表成功 - group_id={unique_group_id}, 影响行数: {affected_rows}")
+                            except Exception as insert_error:
+                                error_msg = f"插入 groups 表失败 - group_id={unique_group_id}, error={insert_error}"
+                                print(f"[创建群] {error_msg}")
+                                app_logger.error(f"[创建群] {error_msg}", exc_info=True)
+                                import traceback
+                                traceback_str = traceback.format_exc()
+                                print(f"[创建群] 错误堆栈: {traceback_str}")
+                                raise  # 重新抛出异常，让外层处理
+
+                        # 插入群成员到 group_members 表
+                        # 1. 优先处理 member_info（群主，必须存在）
+                        # 2. 然后处理 members 数组（管理员和其他成员）
+
+                        # 记录已处理的成员ID，避免重复插入
+                        processed_member_ids = set()
+
+                        # 第一步：处理 member_info（群主，必须存在）
+                        if member_info:
+                            member_user_id = member_info.get('user_id')
+                            if member_user_id:
+                                print(f"[创建群] 处理 member_info（群主）: user_id={member_user_id}")
+                                member_user_name = member_info.get('user_name', '')
+                                member_self_role = member_info.get('self_role', 400)  # 默认群主
+
+                                # 处理 join_time
+                                member_join_time = current_time
+                                if 'join_time' in member_info:
+                                    join_time_value = member_info.get('join_time')
+                                    if join_time_value:
+                                        try:
+                                            if isinstance(join_time_value, (int, float)):
+                                                if join_time_value > 2147483647:
+                                                    join_time_value = int(join_time_value / 1000)
+                                                dt = datetime.datetime.fromtimestamp(int(join_time_value))
+                                                member_join_time = dt.strftime('%Y-%m-%d %H:%M:%S')
+                                            else:
+                                                member_join_time = join_time_value
+                                        except (ValueError, OSError):
+                                            member_join_time = current_time
+
+                                insert_member_sql = """
+                                    INSERT INTO `group_members` (
+                                        group_id, user_id, user_name, self_role, join_time, msg_flag,
+                                        self_msg_flag, readed_seq, unread_num
+                                    ) VALUES (
+                                        %s, %s, %s, %s, %s, %s, %s, %s, %s
+                                    )
+                                """
+                                insert_member_params = (
+                                    unique_group_id,
+                                    member_user_id,
+                                    member_user_name if member_user_name else None,
+                                    member_self_role,
+                                    member_join_time,
+                                    member_info.get('msg_flag', 0),
+                                    member_info.get('self_msg_flag', 0),
+                                    member_info.get('readed_seq', 0),
+                                    member_info.get('unread_num', 0)
+                                )
+
+                                # 检查群主是否已在群组中
+                                cursor.execute(
+                                    "SELECT user_id FROM `group_members` WHERE group_id = %s AND user_id = %s",
+                                    (unique_group_id, member_user_id)
+                                )
+                                existing_owner = cursor.fetchone()
+
+                                if existing_owner:
+                                    print(f"[创建群] 群主 {member_user_id} 已在群组 {unique_group_id} 中，跳过插入")
+                                    app_logger.info(f"[创建群] 群主 {member_user_id} 已在群组 {unique_group_id} 中，跳过插入")
+                                else:
+                                    print(f"[创建群] 插入群主 - group_id={unique_group_id}, user_id={member_user_id}, user_name={member_user_name}, self_role={member_self_role}")
+                                    app_logger.info(f"[创建群] 插入群主 - group_id={unique_group_id}, user_id={member_user_id}, user_name={member_user_name}, self_role={member_self_role}")
+                                    cursor.execute(insert_member_sql, insert_member_params)
+                                processed_member_ids.add(member_user_id)
+                            else:
+                                print(f"[创建群] 警告: member_info 缺少 user_id，跳过")
+                        else:
+                            print(f"[创建群] 警告: 缺少 member_info（群主信息），这是必需的")
+
+                        # 第二步：处理 members 数组（管理员和其他成员）
+                        print(f"[创建群] 开始处理 members 数组 - group_id={unique_group_id}, members数量={len(members_list) if members_list else 0}")
+                        if members_list:
+                            print(f"[创建群] members 数组内容: {members_list}")
+                            for m in members_list:
+                                # 兼容新旧字段名
+                                member_user_id = m.get('user_id') or m.get('unique_member_id')
+                                member_user_name = m.get('user_name') or m.get('member_name', '')
+
+                                if not member_user_id:
+                                    print(f"[创建群] 警告: 成员信息缺少 user_id/unique_member_id，跳过")
+                                    continue
+
+                                # 如果该成员已经在 member_info 中处理过（群主），跳过避免重复
+                                if member_user_id in processed_member_ids:
+                                    print(f"[创建群] 跳过已处理的成员（群主）: user_id={member_user_id}")
+                                    continue
+
+                                # self_role 字段：优先使用 self_role，否则从 group_role 转换
+                                if 'self_role' in m:
+                                    self_role = m.get('self_role')
+                                else:
+                                    # 从 group_role 转换：400=群主，300=管理员，其他=普通成员(200)
+                                    group_role = m.get('group_role')
+                                    if isinstance(group_role, int):
+                                        if group_role == 400:
+                                            self_role = 400  # 群主（但应该已经在 member_info 中处理）
+                                        elif group_role == 300:
+                                            self_role = 300  # 管理员（保持300）
+                                        else:
+                                            self_role = 200  # 普通成员
+                                    elif isinstance(group_role, str):
+                                        # 字符串格式的角色
+                                        if group_role in ['owner', '群主', '400'] or member_user_id == owner_identifier:
+                                            self_role = 400  # 群主（但应该已经在 member_info 中处理）
+                                        elif group_role in ['admin', '管理员', '300']:
+                                            self_role = 300  # 管理员
+                                        else:
+                                            self_role = 200  # 普通成员
+                                    else:
+                                        # 默认：如果是创建者则为群主，否则为普通成员
+                                        if member_user_id == owner_identifier:
+                                            self_role = 400  # 群主（但应该已经在 member_info 中处理）
+                                        else:
+                                            self_role = 200  # 普通成员
+
+                                insert_member_sql = """
+                                    INSERT INTO `group_members` (
+                                        group_id, user_id, user_name, self_role, join_time, msg_flag,
+                                        self_msg_flag, readed_seq, unread_num
+                                    ) VALUES (
+                                        %s, %s, %s, %s, %s, %s, %s, %s, %s
+                                    )
+                                """
+                                # 处理 join_time：支持时间戳格式（与 /groups/sync 一致）或直接使用当前时间
+                                member_join_time = current_time
+                                if 'join_time' in m:
+                                    join_time_value = m.get('join_time')
+                                    if join_time_value:
+                                        # 如果是时间戳，转换为 datetime 字符串
+                                        try:
+                                            if isinstance(join_time_value, (int, float)):
+                                                if join_time_value > 2147483647:  # 毫秒级时间戳
+                                                    join_time_value = int(join_time_value / 1000)
+                                                dt = datetime.datetime.fromtimestamp(int(join_time_value))
+                                                member_join_time = dt.strftime('%Y-%m-%d %H:%M:%S')
+                                            else:
+                                                member_join_time = join_time_value
+                                        except (ValueError, OSError):
+                                            member_join_time = current_time
+
+                                # 获取其他成员字段（与 /groups/sync 一致）
+                                member_msg_flag = m.get('msg_flag', 0)
+                                member_self_msg_flag = m.get('self_msg_flag', 0)
+                                member_readed_seq = m.get('readed_seq', 0)
+                                member_unread_num = m.get('unread_num', 0)
+
+                                insert_member_params = (
+                                    unique_group_id,  # group_id
+                                    member_user_id,  # user_id
+                                    member_user_name if member_user_name else None,  # user_name
+                                    self_role,  # self_role
+                                    member_join_time,  # join_time
+                                    member_msg_flag,  # msg_flag
+                                    member_self_msg_flag,  # self_msg_flag
+                                    member_readed_seq,  # readed_seq
+                                    member_unread_num   # unread_num
+                                )
+
+                                # 检查成员是否已在群组中
+                                cursor.execute(
+                                    "SELECT user_id FROM `group_members` WHERE group_id = %s AND user_id = %s",
+                                    (unique_group_id, member_user_id)
+                                )
+                                existing_member = cursor.fetchone()
+
+                                if existing_member:
+                                    print(f"[创建群] 成员 {member_user_id} 已在群组 {unique_group_id} 中，跳过插入")
+                                    app_logger.info(f"[创建群] 成员 {member_user_id} 已在群组 {unique_group_id} 中，跳过插入")
+                                else:
+                                    print(f"[创建群] 插入成员 - group_id={unique_group_id}, user_id={member_user_id}, user_name={member_user_name}, self_role={self_role}")
+                                    app_logger.info(f"[创建群] 插入成员 - group_id={unique_group_id}, user_id={member_user_id}, user_name={member_user_name}, self_role={self_role}")
+                                    cursor.execute(insert_member_sql, insert_member_params)
+                                processed_member_ids.add(member_user_id)
+
+                        print(f"[创建群] 成员列表处理完成 - group_id={unique_group_id}, 已处理成员数={len(processed_member_ids)}")
+                        app_logger.info(f"[创建群] 成员列表处理完成 - group_id={unique_group_id}, 已处理成员数={len(processed_member_ids)}, 成员列表={list(processed_member_ids)}")
+
+                        print(f"[创建群] 准备提交事务 - group_id={unique_group_id}")
+                        app_logger.info(f"[创建群] 准备提交事务 - group_id={unique_group_id}")
+                        conn.commit()
+                    except Exception:
+                        conn.rollback()
+                        raise
+                    finally:
+                        cursor.close()
+
+                await connection.run(save_group)
+                print(f"[创建群] 事务提交成功 - group_id={unique_group_id}")
+                app_logger.info(f"[创建群] 事务提交成功 - group_id={unique_group_id}, group_name={group_name}")
+
+                # 同步到腾讯IM（异步执行，不阻塞响应）
+                try:
+                    # 构建腾讯IM需要的群组数据格式
+                    tencent_group_data = {
+                        "GroupId": unique_group_id,
+                        "group_id": unique_group_id,
+                        "Name": group_name,
+                        "group_name": group_name,
+                        "Type": group_type_raw,  # 使用原始字符串类型，build_group_payload 会转换
+                        "group_type": group_type_raw,
+                        "Owner_Account": owner_identifier,
+                        "owner_identifier": owner_identifier,
+                        "FaceUrl": face_url,
+                        "face_url": face_url,
+                        "Introduction": msg_data1.get('introduction', ''),
+                        "introduction": msg_data1.get('introduction', ''),
+                        "Notification": msg_data1.get('notification', ''),
+                        "notification": msg_data1.get('notification', ''),
+                        "MaxMemberCount": msg_data1.get('max_member_num', 500),
+                        "max_member_num": msg_data1.get('max_member_num', 500),
+                        "ApplyJoinOption": msg_data1.get('add_option', 0),
+                        "add_option": msg_data1.get('add_option', 0),
+                        "is_class_group": is_class_group,  # 添加 is_class_group 字段，用于区分班级群和普通群
+                        "classid": classid,  # 添加 classid 字段，用于辅助判断
+                        "member_info": member_info,  # 群主信息
+                        "MemberList": []  # 成员列表（包含群主和管理员）
+                    }
+
+                    # 构建成员列表（包含群主和管理员）
+                    member_list = []
+                    added_member_accounts = set()  # 用于跟踪已添加的成员，避免重复
+
+                    # 添加群主（从 member_info）
+                    if member_info:
+                        owner_user_id = member_info.get('user_id')
+                        if owner_user_id:
+                            member_list.append({
+                                "Member_Account": owner_user_id,
+                                "user_id": owner_user_id,
+                                "Role": "Owner",
+                                "self_role": 400
+                            })
+                            added_member_accounts.add(owner_user_id)
+                            print(f"[创建群] 腾讯IM数据：添加群主 - user_id={owner_user_id}")
+
+                    # 添加管理员和其他成员（从 members 数组）
+                    if members_list:
+                        for m in members_list:
+                            member_user_id = m.get('user_id') or m.get('unique_member_id')
+                            if not member_user_id:
+                                continue
+
+                            # 如果已经在 member_list 中添加过，跳过避免重复
+                            if member_user_id in added_member_accounts:
+                                print(f"[创建群] 腾讯IM数据：跳过重复成员 - user_id={member_user_id}")
+                                continue
+
+                            # 确定角色
+                            if 'self_role' in m:
+                                role_value = m.get('self_role')
+                            else:
+                                group_role = m.get('group_role')
+                                if isinstance(group_role, int):
+                                    if group_role == 400:
+                                        role_value = 400
+                                    elif group_role == 300:
+                                        role_value = 300
+                                    else:
+                                        role_value = 200
+                                else:
+                                    role_value = 200
+
+                            # 转换为腾讯IM的角色字符串
+                            if role_value == 400:
+                                role_str = "Owner"
+                            elif role_value == 300:
+                                role_str = "Admin"
+                            else:
+                                role_str = "Member"
+
+                            member_list.append({
+                                "Member_Account": member_user_id,
+                                "user_id": member_user_id,
+                                "Role": role_str,
+                                "self_role": role_value
+                            })
+                            added_member_accounts.add(member_user_id)
+                            print(f"[创建群] 腾讯IM数据：添加成员 - user_id={member_user_id}, Role={role_str}")
+
+                    tencent_group_data["MemberList"] = member_list
+                    print(f"[创建群] 腾讯IM数据构建完成 - group_id={unique_group_id}, 成员数={len(member_list)}")
+                    app_logger.info(f"[创建群] 腾讯IM数据构建完成 - group_id={unique_group_id}, 成员数={len(member_list)}, 成员列表={member_list}")
+
+                    # 异步调用同步函数（不阻塞当前流程）
+                    print(f"[创建群] 准备同步到腾讯IM - group_id={unique_group_id}")
+                    app_logger.info(f"[创建群] 准备同步到腾讯IM - group_id={unique_group_id}, group_name={group_name}")
+
+                    # 使用 asyncio.create_task 异步执行，不等待结果
+                    print(f"[创建群] 创建异步任务同步到腾讯IM - group_id={unique_group_id}")
+                    async def sync_to_tencent():
+                        try:
+                            print(f"[创建群] 异步任务开始 - group_id={unique_group_id}")
+                            # 调用同步函数（需要传入列表格式）
+                            result = await notify_tencent_group_sync(owner_identifier, [tencent_group_data])
+                            print(f"[创建群] 异步任务完成 - group_id={unique_group_id}, result_status={result.get('status')}")
+                            if result.get("status") == "success":
+                                print(f"[创建群] 腾讯IM同步成功 - group_id={unique_group_id}")
+                                app_logger.info(f"[创建群] 腾讯IM同步成功 - group_id={unique_group_id}")
+                            else:
+                                print(f"[创建群] 腾讯IM同步失败 - group_id={unique_group_id}, error={result.get('error')}")
+                                app_logger.warning(f"[创建群] 腾讯IM同步失败 - group_id={unique_group_id}, error={result.get('error')}")
+                        except Exception as sync_error:
+                            print(f"[创建群] 腾讯IM同步异常 - group_id={unique_group_id}, error={sync_error}")
+                            app_logger.error(f"[创建群] 腾讯IM同步异常 - group_id={unique_group_id}, error={sync_error}", exc_info=True)
+
+                    # 创建异步任务，不等待完成
+                    asyncio.create_task(sync_to_tencent())
+
+                except Exception as tencent_sync_error:
+                    # 同步失败不影响群组创建
+                    print(f"[创建群] 准备腾讯IM同步时出错 - group_id={unique_group_id}, error={tencent_sync_error}")
+                    app_logger.error(f"[创建群] 准备腾讯IM同步时出错 - group_id={unique_group_id}, error={tencent_sync_error}", exc_info=True)
+
+                # 如果是班级群（有 classid 或 class_id），自动创建临时语音群
+                temp_room_info = None
+                class_id = classid  # 使用统一后的 classid 变量
+                if class_id:
+                    # 检查是否已经有临时语音群（使用 unique_group_id 作为 group_id）
+                    existing_room = await temp_rooms.get(unique_group_id)
+                    if existing_room is None:
+                        try:
+                            print(f"[创建班级群] 检测到班级群，自动创建临时语音群 - group_id={unique_group_id}, class_id={class_id}")
+                            app_logger.info(f"[创建班级群] 自动创建临时语音群 - group_id={unique_group_id}, class_id={class_id}, owner_id={user_id}")
+
+                            # 获取创建者信息
+                            owner_id = user_id
+                            owner_name = msg_data1.get('owner_name', '') or ''
+                            owner_icon = msg_data1.get('owner_icon', '') or ''
+
+                            # 尝试从数据库获取创建者信息
+                            if not owner_name or not owner_icon:
+                                try:
+                                    owner_info = await connection.run(load_owner_info)
+                                    if owner_info:
+                                        if not owner_name:
+                                            owner_name = owner_info.get('name', '') or owner_name
+                                        if not owner_icon:
+                                            owner_icon = owner_info.get('icon', '') or owner_icon
+                                except Exception as db_error:
+                                    app_logger.error(f"[创建班级群] 查询创建者信息失败 - user_id={user_id}, error={db_error}")
+
+                            # 生成唯一的房间ID和流名称
+                            # 使用纯数字生成房间ID（时间戳毫秒 + 4位随机数）
+                            room_id = str(int(time.time() * 1000)) + str(random.randint(1000, 9999))
+                            stream_name = f"room_{unique_group_id}_{int(time.time())}"
+
+                            # 生成传统 WebRTC API 地址（推流和拉流）
+                            publish_url = f"{SRS_WEBRTC_API_URL}/rtc/v1/publish/?app={SRS_APP}&stream={stream_name}"
+                            play_url = f"{SRS_WEBRTC_API_URL}/rtc/v1/play/?app={SRS_APP}&stream={stream_name}"
+
+                            # 保留 WHIP/WHEP 地址用于向后兼容
+                            whip_url = f"{SRS_BASE_URL}/rtc/v1/whip/?app={SRS_APP}&stream={stream_name}"
+                            whep_url = f"{SRS_BASE_URL}/rtc/v1/whep/?app={SRS_APP}&stream={stream_name}"
+
+                            # 创建临时语音群
+                            await temp_rooms.add_room(unique_group_id, {
+                            "room_id": room_id,
+                            "owner_id": owner_id,
+                            "owner_name": owner_name,
+                            "owner_icon": owner_icon,
+                            "publish_url": publish_url,  # 推流地址（传统 WebRTC API）
+                            "play_url": play_url,  # 拉流地址（传统 WebRTC API）
+                            "whip_url": whip_url,  # WHIP 地址（向后兼容）
+                            "whep_url": whep_url,  # WHEP 地址（向后兼容）
+                            "stream_name": stream_name,
+                            "group_id": unique_group_id,
+                            "timestamp": time.time(),
+                            "members": [owner_id]  # 初始化成员列表，包含创建者
+                        })
+
+                            # 保存临时语音房间到数据库
+                            try:
+                                await connection.run(save_temp_room, room_id, unique_group_id, owner_name, owner_icon,
+                                                     whip_url, whep_url, stream_name)
+                                print(f"[创建班级群] 临时语音房间已保存到数据库 - room_id={room_id}, group_id={unique_group_id}")
+                                app_logger.info(f"[创建班级群] 临时语音房间已保存到数据库 - room_id={room_id}, group_id={unique_group_id}")
+                            except Exception as db_save_error:
+                                # 数据库保存失败不影响内存中的房间创建
+                                print(f"[创建班级群] 保存临时语音房间到数据库失败 - room_id={room_id}, error={db_save_error}")
+                                app_logger.error(f"[创建班级群] 保存临时语音房间到数据库失败 - room_id={room_id}, error={db_save_error}", exc_info=True)
+
+                            temp_room_info = {
+                            "room_id": room_id,
+                            "publish_url": publish_url,  # 推流地址（传统 WebRTC API）
+                            "play_url": play_url,  # 拉流地址（传统 WebRTC API）
+                            "stream_name": stream_name,
+                            "group_id": unique_group_id,
+                            "owner_id": owner_id,
+                            "owner_name": owner_name,
+                            "owner_icon": owner_icon
+                            }
+
+                            print(f"[创建班级群] 临时语音群创建成功 - group_id={unique_group_id}, room_id={room_id}, stream_name={stream_name}")
+                            app_logger.info(f"[创建班级群] 临时语音群创建成功 - group_id={unique_group_id}, room_id={room_id}")
+                        except Exception as temp_room_error:
+                            app_logger.error(f"[创建班级群] 创建临时语音群失败 - group_id={unique_group_id}, error={temp_room_error}")
+                            print(f"[创建班级群] 创建临时语音群失败: {temp_room_error}")
+                            # 临时语音群创建失败不影响班级群创建
+                    else:
+                        # 如果已存在临时语音群，获取其信息
+                        temp_room_info = {
+                            "room_id": existing_room.get("room_id"),
+                            "publish_url": existing_room.get("publish_url"),  # 推流地址（传统 WebRTC API）
+                            "play_url": existing_room.get("play_url"),  # 拉流地址（传统 WebRTC API）
+                            "stream_name": existing_room.get("stream_name"),
+                            "group_id": unique_group_id,
+                            "owner_id": existing_room.get("owner_id"),
+                            "owner_name": existing_room.get("owner_name"),
+                            "owner_icon": existing_room.get("owner_icon")
+                        }
+                        print(f"[创建班级群] 临时语音群已存在 - group_id={unique_group_id}, room_id={temp_room_info.get('room_id')}")
+
+                # 给在线成员推送
+                # 兼容新旧字段名：user_id 或 unique_member_id
+                members_to_notify = msg_data1.get('members', [])
+                # 兼容新旧字段名
+                notify_ids = [m.get('user_id') or m.get('unique_member_id') for m in members_to_notify]
+                notify_ids = list(dict.fromkeys(member_id for member_id in notify_ids if member_id))
+                notify_targets = await hub.lookup_many(notify_ids)
+                unreached = [member_id for member_id in notify_ids if member_id not in notify_targets]
+                if notify_targets:
+                    result = await hub.fan_out(notify_targets, json.dumps({
+                        "type":"notify",
+                        "message":f"你已加入群: {msg_data1.get('group_name') or msg_data1.get('nickname', '')}",
+                        "group_id": unique_group_id,
+                        "groupname": msg_data1.get('group_name') or msg_data1.get('nickname', '')
+                    }))
+                    unreached += result.failed + result.timed_out
+                if unreached:
+                    print(f"[创建群] 成员 {unreached} 不在线，插入通知")
+
+                    def save_invite_notifications(conn) -> None:
+                        notify_cursor = conn.cursor()
+                        try:
+                            update_query = """
+                                    INSERT INTO ta_notification (sender_id, sender_name, receiver_id, unique_group_id, group_name, content, content_text)
+                                    VALUES (%s, %s, %s, %s, %s, %s, %s)
+                                """
+                            notify_cursor.executemany(update_query, [
+                                (user_id, msg_data1.get('owner_name'), member_id, unique_group_id, msg_data1.get("group_name") or msg_data1.get("nickname", ""), "邀请你加入了群", msg_data1['type'])
+                                for member_id in unreached
+                            ])
+                            conn.commit()
+                        finally:
+                            notify_cursor.close()
+
+                    await connection.run(save_invite_notifications)
+
+                #把创建成功的群信息发回给创建者（包含临时语音群信息）
+                print(f"[创建群] 准备构建返回给客户端的响应 - group_id={unique_group_id}")
+                # 兼容新旧字段名：group_name 或 nickname
+                group_name_for_response = msg_data1.get('group_name') or msg_data1.get('nickname', '')
+                response_data = {
+                    "type":"3",
+                    "message":f"你创建了群: {group_name_for_response}",
+                    "group_id": unique_group_id,
+                    "groupname": group_name_for_response
+                }
+
+                # 如果有临时语音群信息，添加到响应中
+                if temp_room_info:
+                    response_data["temp_room"] = temp_room_info
+
+                # 打印返回给客户端的消息
+                response_json = json.dumps(response_data, ensure_ascii=False)
+                print(f"[创建群] 返回给客户端 - user_id={user_id}, group_id={unique_group_id}, response={response_json}")
+                app_logger.info(f"[创建群] 返回给客户端 - user_id={user_id}, group_id={unique_group_id}, response={response_json}")
+
+                print(f"[创建群] 准备发送响应给客户端 - group_id={unique_group_id}")
+                await outbound.send_text(response_json)
+                print(f"[创建群] 响应已发送给客户端 - group_id={unique_group_id}")
+                print(f"[创建群] 创建群组流程完成 - group_id={unique_group_id}")
+                app_logger.info(f"[创建群] 创建群组流程完成 - group_id={unique_group_id}, user_id={user_id}")
+            except Exception as create_group_error:
+                error_msg = f"创建群组时发生异常 - user_id={user_id}, error={create_group_error}"
+                print(f"[创建群] {error_msg}")
+                app_logger.error(f"[创建群] {error_msg}", exc_info=True)
+                import traceback
+                traceback_str = traceback.format_exc()
+                print(f"[创建群] 错误堆栈: {traceback_str}")
+                # 发送错误消息给客户端
+                try:
+                    error_response = {
+                        "type": "3",
+                        "status": "error",
+                        "message": f"创建群组失败: {str(create_group_error)}",
+                        "group_id": msg_data1.get('group_id', '')
+                    }
+                    await outbound.send_text(json.dumps(error_response, ensure_ascii=False))
+                except Exception as send_error:
+                    app_logger.error(f"[创建群] 发送错误消息失败: {send_error}")
+
+
+        async def handle_group_message(msg_data1: Dict[str, Any], target_id: str, msg: str):
+            """群消息（type=5）：发给除发送者外的所有群成员，离线成员写入通知"""
+            print("群消息发送")
+            print(msg_data1)
+            unique_group_id = msg_data1.get('unique_group_id')
+            sender_id = user_id  # 当前发送者（可能是群主，也可能是群成员）
+            groupowner_flag = msg_data1.get('groupowner', False)  # bool 或字符串
+
+            def load_group_and_members(conn):
+                """查询群信息和除发送者外的成员，在数据库线程池中执行"""
+                group_cursor = conn.cursor(dictionary=True)
+                try:
+                    # 查询群信息
+                    group_cursor.execute("""
+                        SELECT group_admin_id, nickname 
+                        FROM ta_group 
+                        WHERE unique_group_id = %s
+                    """, (unique_group_id,))
+                    group_row = group_cursor.fetchone()
+                    if not group_row:
+                        return None, []
+                    # 查成员（排除发送者）
+                    group_cursor.execute("""
+                        SELECT unique_member_id 
+                        FROM ta_group_member_relation
+                        WHERE unique_group_id = %s AND unique_member_id != %s
+                    """, (unique_group_id, sender_id))
+                    return group_row, group_cursor.fetchall()
+                finally:
+                    group_cursor.close()
+
+            row, members = await connection.run(load_group_and_members)
+            if not row:
+                await outbound.send_text(f"群 {unique_group_id} 不存在")
+                return
+
+            group_admin_id = row['group_admin_id']
+            group_name = row['nickname'] or ""  # 群名
+
+            if str(groupowner_flag).lower() in ("true", "1", "yes"):
+                # --------------------------- 群主发送 ---------------------------
+                if group_admin_id != sender_id:
+                    await outbound.send_text(f"不是群主，不能发送群消息")
+                    return
+
+                if not members:
+                    await outbound.send_text("群没有其他成员")
+                    return
+                receivers = [m['unique_member_id'] for m in members]
+            else:
+                # --------------------------- 群成员发送 ---------------------------
+                print("群成员发送群消息")
+
+                # 找到所有需要接收的人：群主 + 其他成员（去掉发送者）
+                receivers = []
+
+                # 添加群主
+                if group_admin_id != sender_id:
+                    receivers.append(group_admin_id)
+
+                # 其他成员（已排除自己）
+                for r in members:
+                    receivers.append(r['unique_member_id'])
+
+                # 去重（以防群主也在成员列表里）
+                receivers = list(set(receivers))
+
+                if not receivers:
+                    await outbound.send_text("群没有其他成员可以接收此消息")
+                    return
+
+            # 给在线的接收者并发推送，离线或推送失败的存通知
+            targets = await hub.lookup_many(receivers)
+            unreached = [rid for rid in receivers if rid not in targets]
+            if targets:
+                print(f"{list(targets)} 在线，发送群消息")
+                result = await hub.fan_out(targets, json.dumps({
+                    "type": "5",
+                    "group_id": unique_group_id,
+                    "from": sender_id,
+                    "content": msg_data1.get("content", ""),
+                    "groupname": group_name,
+                    "sender_name": msg_data1.get("sender_name", "")
+                }, ensure_ascii=False))
+                unreached += result.failed + result.timed_out
+            if unreached:
+                print(f"{unreached} 不在线，插入通知")
+
+                def save_group_notifications(conn) -> None:
+                    notify_cursor = conn.cursor()
+                    try:
+                        notify_cursor.executemany("""
+                            INSERT INTO ta_notification (
+                            sender_id, sender_name, receiver_id, unique_group_id, group_name, content, content_text
+                            ) VALUES (%s, %s, %s, %s, %s, %s, %s)
+                        """, [(
+                            sender_id, msg_data1.get("sender_name", ""), rid, unique_group_id, group_name,
+                            msg_data1.get("content", ""), msg_data1['type']
+                        ) for rid in unreached])
+                        conn.commit()
+                    finally:
+                        notify_cursor.close()
+
+                await connection.run(save_group_notifications)
+
+
+        async def handle_prepare_class(msg_data1: Dict[str, Any], target_id: str, msg: str):
+            """课前准备（type=prepare_class）：target_id 为群组ID，发送给群组所有成员"""
+            app_logger.info(f"[prepare_class] 收到课前准备消息，user_id={user_id}, target_id={target_id}")
+            print(f"[prepare_class] 收到课前准备消息，user_id={user_id}, target_id={target_id}")
+
+            group_id = target_id  # 群组ID就是target_id
+            class_id = msg_data1.get('class_id')
+            school_id = msg_data1.get('school_id')
+            subject = msg_data1.get('subject', '')
+            content = msg_data1.get('content', '')
+            date = msg_data1.get('date', '')
+            class_time = msg_data1.get('time', '')  # 上课时间
+            sender_id = msg_data1.get('sender_id') or user_id
+            sender_name = msg_data1.get('sender_name', '')
+
+            app_logger.info(
+                f"[prepare_class] 参数解析 - group_id={group_id}, class_id={class_id}, school_id={school_id}, "
+                f"subject={subject}, sender_id={sender_id}, sender_name={sender_name}, "
+                f"date={date}, time={class_time}, content_length={len(content)}"
+            )
+            print(f"[prepare_class] group_id={group_id}, class_id={class_id}, school_id={school_id}, subject={subject}, sender_id={sender_id}, time={class_time}")
+
+            # 验证群组是否存在（groups 表）并获取所有成员（group_members 表）
+            group_info, member_ids = await run_db(load_prepare_class_group, group_id)
+            if not group_info:
+                error_msg = f"群组 {group_id} 不存在"
+                app_logger.warning(f"[prepare_class] {error_msg}, user_id={user_id}")
+                await outbound.send_json({
+                    "type": "error",
+                    "message": error_msg
+                })
                 return
-            
-            # 可选：验证房间和成员关系
-            if group_id:
-                room_info = active_temp_rooms.get(group_id)
-                if room_info:
-                    members = room_info.get("members", [])
-                    if user_id not in members:
-                        app_logger.warning(f"[webrtc] 用户 {user_id} 不在房间 {group_id} 的成员列表中")
-                    if target_user_id not in members:
-                        app_logger.warning(f"[webrtc] 目标用户 {target_user_id} 不在房间 {group_id} 的成员列表中")
-            
-            # 构建转发消息
-            forward_message = {
-                "type": f"webrtc_{signal_type}",
-                "from_user_id": user_id,
-                "target_user_id": target_user_id,
-                "room_id": room_id,
-                "group_id": group_id
+
+            group_name = group_info.get('group_name', '')
+            owner_identifier = group_info.get('owner_identifier', '')
+            app_logger.info(f"[prepare_class] 群组验证成功 - group_id={group_id}, group_name={group_name}, owner_identifier={owner_identifier}, 总成员数={len(member_ids)}")
+
+            # 构建消息内容
+            prepare_message = {
+                "type": "prepare_class",
+                "class_id": class_id,
+                "school_id": school_id,
+                "subject": subject,
+                "content": content,
+                "date": date,
+                "time": class_time,
+                "sender_id": sender_id,
+                "sender_name": sender_name,
+                "group_id": group_id,
+                "group_name": group_name
             }
-            
-            # 根据信令类型添加特定字段
-            if signal_type == "offer":
-                forward_message["offer"] = msg_data.get('offer')
-                forward_message["sdp"] = msg_data.get('sdp')  # 兼容不同格式
-            elif signal_type == "answer":
-                forward_message["answer"] = msg_data.get('answer')
-                forward_message["sdp"] = msg_data.get('sdp')  # 兼容不同格式
-            elif signal_type == "ice_candidate":
-                forward_message["candidate"] = msg_data.get('candidate')
-                forward_message["sdpMLineIndex"] = msg_data.get('sdpMLineIndex')
-                forward_message["sdpMid"] = msg_data.get('sdpMid')
-            
-            # 转发给目标用户
+
+            # 先定位在线成员，在线的直接记为已读，所有接收人一次写入数据库
+            targets = await hub.lookup_many(member_ids)
+            receivers = [(member_id, 1 if member_id in targets else 0) for member_id in member_ids]
+            online_members = [member_id for member_id in member_ids if member_id in targets]
+            offline_members = [member_id for member_id in member_ids if member_id not in targets]
+            online_count = len(online_members)
+            offline_count = len(offline_members)
+
             try:
-                await target_conn["ws"].send_text(json.dumps(forward_message, ensure_ascii=False))
-                app_logger.info(f"[webrtc] {signal_type} 转发成功 - from={user_id} to={target_user_id}")
-                print(f"[webrtc] {signal_type} 转发成功 to={target_user_id}")
-                
-                # 给发送者返回成功确认
-                await websocket.send_text(json.dumps({
-                    "type": f"webrtc_{signal_type}_sent",
-                    "target_user_id": target_user_id,
-                    "status": "success"
-                }, ensure_ascii=False))
+                prepare_id = await run_db(save_class_preparation, group_id, class_id, school_id, subject, content,
+                                          date, class_time, sender_id, sender_name, receivers)
             except Exception as e:
-                error_msg = f"转发 {signal_type} 失败: {str(e)}"
-                app_logger.error(f"[webrtc] {error_msg}")
-                await websocket.send_text(json.dumps({
-                    "type": "webrtc_error",
-                    "signal_type": signal_type,
-                    "message": error_msg
-                }, ensure_ascii=False))
+                app_logger.error(f"[prepare_class] 保存课前准备失败 - group_id={group_id}, class_id={class_id}: {e}")
+                await outbound.send_json({
+                    "type": "prepare_class",
+                    "status": "error",
+                    "message": "课前准备消息保存失败，请稍后重试"
+                })
+                return
+            app_logger.info(f"[prepare_class] 已为所有 {len(member_ids)} 个成员保存课前准备数据，prepare_id={prepare_id}")
+
+            # 在线成员后台并发推送；推送失败的会被改回未读，等登录时获取
+            if targets:
+                schedule_prepare_class_delivery(prepare_id, group_id, targets, prepare_message)
+
+            # 给发送者返回结果
+            result_message = f"课前准备消息已发送，在线: {online_count} 人，离线: {offline_count} 人"
+            app_logger.info(f"[prepare_class] 完成 - group_id={group_id}, class_id={class_id}, subject={subject}, time={class_time}, 在线={online_count}, 离线={offline_count}, 在线成员={online_members}, 离线成员={offline_members}")
+            print(f"[prepare_class] 完成，在线={online_count}, 离线={offline_count}, time={class_time}")
+
+            await outbound.send_json({
+                "type": "prepare_class",
+                "status": "success",
+                "message": result_message,
+                "online_count": online_count,
+                "offline_count": offline_count
+            })
+
+        async def handle_join_temp_room_message(msg_data: Dict[str, Any], target_id: Optional[str], msg: str):
+            group_id_from_msg = msg_data.get("group_id")
+            app_logger.info(f"[temp_room] 🔵 收到 JSON 格式的加入房间请求 - user_id={user_id}, type={msg_data.get('type')}, group_id={group_id_from_msg}, 原始消息={msg[:200]}")
+            print(f"[temp_room] 🔵 收到 JSON 格式的加入房间请求 - user_id={user_id}, type={msg_data.get('type')}, group_id={group_id_from_msg}")
+            await handle_join_temp_room(group_id_from_msg)
+
+        async def handle_sync_more(msg_data: Dict[str, Any], target_id: Optional[str], msg: str):
+            await outbound.send_text(await login_sync_page(user_id, str(msg_data.get("cursor") or ""), conn_entry))
+
+        async def handle_presence_subscribe(msg_data: Dict[str, Any], target_id: Optional[str], msg: str):
+            group_ids = msg_data.get("group_ids")
+            if not isinstance(group_ids, list):
+                await outbound.send_json({"type": "presence_snapshot", "status": "error", "message": "group_ids 必须为数组"})
+                return
+            group_ids = _clean_id_list(group_ids)[:PRESENCE_QUERY_MAX_GROUPS]
+            states = await presence.subscribe(user_id, group_ids)
+            await outbound.send_json({"type": "presence_snapshot", "status": "success", "group_ids": group_ids,
+                                      "users": states})
+
+        async def handle_presence_unsubscribe(msg_data: Dict[str, Any], target_id: Optional[str], msg: str):
+            presence.unsubscribe(user_id)
+
+        # 文本消息路由表：handler(msg_data, target_id, 原始 JSON 文本)
+        # to:<target_id>:<json> 与纯 JSON 两种格式共用的类型
+        shared_routes = {
+            "6": lambda m, target_id, msg: handle_temp_room_creation(m),
+            "temp_room_owner_leave": lambda m, target_id, msg: handle_temp_room_owner_leave(m.get("group_id") or target_id),
+            # WebRTC 信令消息处理
+            "webrtc_offer": lambda m, target_id, msg: handle_webrtc_signal(m, "offer"),
+            "webrtc_answer": lambda m, target_id, msg: handle_webrtc_signal(m, "answer"),
+            "webrtc_ice_candidate": lambda m, target_id, msg: handle_webrtc_signal(m, "ice_candidate"),
+            # 通过服务器转发到 SRS 的 offer（推流 / 拉流），在后台等待 SRS，不占用接收循环
+            "srs_publish_offer": lambda m, target_id, msg: start_srs_offer(m, "publish"),
+            "srs_play_offer": lambda m, target_id, msg: start_srs_offer(m, "play"),
+        }
+        direct_routes = {
+            "1": handle_private_message,
+            "3": handle_create_group,
+            "5": handle_group_message,
+            "prepare_class": handle_prepare_class,
+            **shared_routes,
+        }
+        json_routes = {
+            "join_temp_room": handle_join_temp_room_message,
+            "temp_room_join": handle_join_temp_room_message,
+            "sync_more": handle_sync_more,
+            "presence_subscribe": handle_presence_subscribe,
+            "presence_unsubscribe": handle_presence_unsubscribe,
+            **shared_routes,
+        }
+
+        async def throttle(msg_type: Optional[str] = None, nbytes: int = 0) -> bool:
+            """接收限流；返回 False 表示这条消息不处理（已丢弃，或按策略断开了连接）"""
+            verdict = await rate_limiter.admit(msg_type, nbytes)
+            if verdict == "disconnect":
+                await outbound.close(1008, "rate limit exceeded")
+            return verdict == "ok"
+
+        async def dispatch_text_message(data: str) -> None:
+            """每帧只解析一次 JSON，按 type 查表分发；单条消息处理失败不影响整个会话"""
+            target_id = None
+            routes = json_routes
+            payload = data
+            if data.startswith("to:"):
+                parts = data.split(":", 2)
+                if len(parts) != 3:
+                    print(" 格式错误")
+                    ws_message_stats.unhandled("bad_format")
+                    await outbound.send_text("格式错误: to:<target_id>:<消息>")
+                    return
+                target_id, payload = parts[1], parts[2]
+                routes = direct_routes
+
+            try:
+                msg_data = ws_json_loads(payload)
+            except ValueError:
+                msg_data = None
+            msg_type = msg_data.get("type") if isinstance(msg_data, dict) else None
+            handler = routes.get(msg_type) if isinstance(msg_type, str) else None
+
+            if handler is None:
+                # 处理字符串格式的加入房间请求
+                stripped_data = (data or "").strip() if target_id is None else ""
+                if stripped_data and stripped_data in active_temp_rooms:
+                    app_logger.info(f"[temp_room] 🔵 收到字符串格式的加入房间请求 - user_id={user_id}, stripped_data={stripped_data}, 原始消息={data[:200]}, active_rooms={list(active_temp_rooms.keys())}")
+                    print(f"[temp_room] 🔵 收到字符串格式的加入房间请求 - user_id={user_id}, stripped_data={stripped_data}")
+                    await handle_join_temp_room(stripped_data)
+                    return
+                ws_message_stats.unhandled("invalid_json" if msg_data is None else "unknown_type")
+                print(f"[websocket][{user_id}] 未处理的消息: {data[:200]}")
+                # 未识别的帧（非 JSON、未知 type）保持原有行为：广播给本 worker 上的其他在线用户
+                targets = {uid: conn for uid, conn in connections.items() if uid != user_id}
+                if targets:
+                    await hub.fan_out(targets, f"[{user_id} 广播] {data}")
+                return
+
+            await run_handler(handler, msg_type, msg_data, target_id, payload)
+
+        async def dispatch_packed_message(data: bytes) -> None:
+            """msgpack 子协议的二进制消息：解码成 map 后与 JSON 消息走同一张路由表，"to" 字段对应定向消息"""
+            try:
+                msg_data = msgpack.unpackb(data, raw=False)
+            except Exception:
+                msg_data = None
+            if not isinstance(msg_data, dict):
+                ws_message_stats.unhandled("invalid_msgpack")
+                return
+            target_id = msg_data.get("to")
+            routes = direct_routes if target_id else json_routes
+            msg_type = msg_data.get("type")
+            handler = routes.get(msg_type) if isinstance(msg_type, str) else None
+            if handler is None:
+                ws_message_stats.unhandled("unknown_type")
+                print(f"[websocket][{user_id}] 未处理的 msgpack 消息: type={msg_type}")
+                return
+            # 处理函数的 msg 参数约定为原始 JSON 文本（私信原样转发），这里按 JSON 补一份
+            await run_handler(handler, msg_type, msg_data, str(target_id) if target_id else None,
+                              json.dumps(msg_data, ensure_ascii=False, default=convert_datetime))
+
+        async def run_handler(handler, msg_type: str, msg_data: Dict[str, Any], target_id: Optional[str], payload: str) -> None:
+            if not await throttle(msg_type):
+                return
+
+            started = time.perf_counter()
+            failed = False
+            try:
+                await handler(msg_data, target_id, payload)
+            except Exception as e:
+                failed = True
+                app_logger.error(f"[websocket][{user_id}] 处理消息失败 type={msg_type}: {e}", exc_info=True)
+                print(f"[websocket][{user_id}] 处理消息失败 type={msg_type}: {e}")
+            finally:
+                ws_message_stats.record(msg_type, (time.perf_counter() - started) * 1000, failed)
 
-        print(f"[websocket][{user_id}] 数据库连接成功，开始监听消息")
+        print(f"[websocket][{user_id}] 开始监听消息")
 
         while True:
             try:
-                print(f"[websocket][{user_id}] 等待消息... 当前在线={len(connections)}")
+                # 上一条消息已处理完：归还数据库连接，空闲等待期间不占用连接
+                connection.release()
                 message = await websocket.receive()
-                print(f"[websocket][{user_id}] receive() 返回: {message.get('type') if isinstance(message, dict) else type(message)}, 内容预览={str(message)[:200]}")
             except WebSocketDisconnect as exc:
                 # 正常断开
                 print(f"用户 {user_id} 断开（WebSocketDisconnect），详情: {exc}")
-                # 清理用户从所有临时房间的成员列表中移除
-                for group_id, room_info in list(active_temp_rooms.items()):
-                    members = room_info.get("members", [])
-                    if user_id in members:
-                        members.remove(user_id)
-                        app_logger.info(f"[webrtc] 用户 {user_id} 离开房间 {group_id}（WebSocketDisconnect），当前成员数={len(members)}")
-                        print(f"[webrtc] 用户 {user_id} 离开房间 {group_id}（WebSocketDisconnect），当前成员数={len(members)}")
                 break
             except RuntimeError as e:
                 # 已收到 disconnect 后再次 receive 会到这里
                 print(f"用户 {user_id} receive RuntimeError: {e}")
-                # 清理用户从所有临时房间的成员列表中移除
-                for group_id, room_info in list(active_temp_rooms.items()):
-                    members = room_info.get("members", [])
-                    if user_id in members:
-                        members.remove(user_id)
-                        app_logger.info(f"[webrtc] 用户 {user_id} 离开房间 {group_id}（RuntimeError），当前成员数={len(members)}")
-                        print(f"[webrtc] 用户 {user_id} 离开房间 {group_id}（RuntimeError），当前成员数={len(members)}")
                 break
 
             # starlette 会在断开时 raise WebSocketDisconnect，保险起见也判断 type
             if message.get("type") == "websocket.disconnect":
                 print(f"用户 {user_id} 断开（disconnect event）")
-                # 清理用户从所有临时房间的成员列表中移除
-                for group_id, room_info in list(active_temp_rooms.items()):
-                    members = room_info.get("members", [])
-                    if user_id in members:
-                        members.remove(user_id)
-                        app_logger.info(f"[webrtc] 用户 {user_id} 离开房间 {group_id}（disconnect event），当前成员数={len(members)}")
-                        print(f"[webrtc] 用户 {user_id} 离开房间 {group_id}（disconnect event），当前成员数={len(members)}")
                 break
             
             if "text" in message:
                 data = message["text"]
-                print(f"[websocket][{user_id}] recv text -> {data}")
                 if data == "ping":
-                    if user_id in connections:
-                        connections[user_id]["last_heartbeat"] = time.time()
-                    else:
+                    if connections.get(user_id) is not conn_entry:
                         print(f"收到 {user_id} 的 ping，但该用户已不在连接列表")
                         continue
-                    await websocket.send_text("pong")
+                    conn_entry["last_heartbeat"] = time.time()
+                    await outbound.send_text("pong")
                     continue
 
+                if not await throttle():
+                    continue
+                print(f"[websocket][{user_id}] recv text -> {data}")
+                await dispatch_text_message(data)
 
-                # 定向发送：to:目标ID:消息
-                if data.startswith("to:"):
-                    parts = data.split(":", 2)
-                    if len(parts) == 3:
-                        target_id, msg = parts[1], parts[2]
-                        msg_data1 = json.loads(msg)
-                        print(msg)
-                        print(msg_data1['type'])
-                        if msg_data1['type'] == "1":
-                            print(" 加好友消息")
-                            target_conn = connections.get(target_id)
-                            if target_conn:
-                                print(target_id, " 在线", ", 来自:", user_id)
-                                print(data)
-                                await target_conn["ws"].send_text(f"[私信来自 {user_id}] {msg}")
-                            else:
-                                print(target_id, " 不在线", ", 来自:", user_id)
-                                print(data)
-                                await websocket.send_text(f"用户 {target_id} 不在线")
-
-                                # 解析 JSON
-                                msg_data = json.loads(msg)
-                                #print(msg_data['type'])
-                                cursor = connection.cursor(dictionary=True)
-
-                                update_query = """
-                                            INSERT INTO ta_notification (sender_id, receiver_id, content, content_text)
-                                            VALUES (%s, %s, %s, %s)
-                                        """
-                                cursor.execute(update_query, (user_id, msg_data['teacher_unique_id'], msg_data['text'], msg_data['type']))
-                                connection.commit()
-                        elif msg_data1['type'] == "3": 
-                            print(" 创建群")   
-                            app_logger.info(f"[创建群] 开始处理创建群组请求 - user_id={user_id}")
-                            try:
-                                cursor = connection.cursor(dictionary=True)
-                                
-                                # 获取当前时间
-                                current_time = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                                
-                                # 字段映射：统一使用与 /groups/sync 相同的字段名
-                                # 兼容旧字段名（nickname, headImage_path, owner_id, school_id, class_id）
-                                group_name = msg_data1.get('group_name') or msg_data1.get('nickname', '')
-                                face_url = msg_data1.get('face_url') or msg_data1.get('headImage_path', '')
-                                detail_face_url = msg_data1.get('detail_face_url') or face_url
-                                # 转换 group_type：数据库中是整数类型，需要将字符串转换为整数
-                                group_type_raw = msg_data1.get('group_type', '')
-                                group_type = convert_group_type_to_int(group_type_raw)
-                                owner_identifier = msg_data1.get('owner_identifier') or msg_data1.get('owner_id', '')
-                                schoolid = msg_data1.get('schoolid') or msg_data1.get('school_id')
-                                classid = msg_data1.get('classid') or msg_data1.get('class_id')
-                                is_class_group = msg_data1.get('is_class_group')
-                                if is_class_group is None:
-                                    is_class_group = 1 if classid else 0
-                                
-                                # 生成群ID：优先使用客户端传过来的，如果没有则使用班级ID+01，否则使用UUID
-                                unique_group_id = msg_data1.get('group_id')
-                                print(f"[创建群] 收到客户端传入的 group_id={unique_group_id}, classid={classid}")
-                                app_logger.info(f"[创建群] 收到客户端传入的 group_id={unique_group_id}, classid={classid}")
-                                
-                                # 检查 classid 是否看起来像是一个群组ID（以"01"结尾），如果是则可能是客户端错误
-                                if classid and str(classid).endswith("01"):
-                                    # 检查这个 classid 是否在 groups 表中存在（说明是群组ID而不是班级ID）
-                                    cursor.execute("SELECT group_id FROM `groups` WHERE group_id = %s", (str(classid),))
-                                    existing_group = cursor.fetchone()
-                                    if existing_group:
-                                        error_msg = f"classid={classid} 是一个已存在的群组ID，而不是班级ID。请使用正确的班级ID创建群组。"
-                                        print(f"[创建群] 错误: {error_msg}")
-                                        app_logger.error(f"[创建群] {error_msg}")
-                                        # 拒绝创建，返回错误消息给客户端
-                                        error_response = {
-                                            "type": "error",
-                                            "message": error_msg,
-                                            "code": 400
-                                        }
-                                        error_response_json = json.dumps(error_response, ensure_ascii=False)
-                                        await websocket.send_text(error_response_json)
-                                        print(f"[创建群] 已拒绝创建请求并向客户端返回错误 - user_id={user_id}, classid={classid}")
-                                        continue  # 跳过后续处理
-                                
-                                if not unique_group_id:
-                                    if classid:
-                                        # 班级群：使用班级ID + "01"
-                                        unique_group_id = str(classid) + "01"
-                                        print(f"[创建群] 使用班级ID生成群ID: {unique_group_id}")
-                                    else:
-                                        # 非班级群：使用UUID
-                                        unique_group_id = str(uuid.uuid4())
-                                        print(f"[创建群] 使用UUID生成群ID: {unique_group_id}")
-                                else:
-                                    print(f"[创建群] 使用客户端传入的群ID: {unique_group_id}")
-                                
-                                # 插入 groups 表
-                                insert_group_sql = """
-                                    INSERT INTO `groups` (
-                                        group_id, group_name, group_type, face_url, detail_face_url,
-                                        owner_identifier, create_time, max_member_num, member_num,
-                                        introduction, notification, searchable, visible, add_option,
-                                        is_shutup_all, next_msg_seq, latest_seq, last_msg_time,
-                                        last_info_time, info_seq, detail_info_seq, detail_group_id,
-                                        detail_group_name, detail_group_type, detail_is_shutup_all,
-                                        online_member_num, classid, schoolid, is_class_group
-                                    ) VALUES (
-                                        %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s,
-                                        %s, %s, %s, %s, %s, %s, %s, %s,
-                                        %s, %s, %s, %s, %s, %s, %s, %s, %s, %s
-                                    )
-                                """
-                                insert_group_params = (
-                                    unique_group_id,  # group_id
-                                    group_name,  # group_name
-                                    group_type,  # group_type
-                                    face_url,  # face_url
-                                    detail_face_url,  # detail_face_url
-                                    owner_identifier,  # owner_identifier
-                                    current_time,  # create_time
-                                    500,  # max_member_num (默认500)
-                                    len(msg_data1.get('members', [])),  # member_num
-                                    '',  # introduction
-                                    '',  # notification
-                                    1,  # searchable (默认可搜索)
-                                    1,  # visible (默认可见)
-                                    0,  # add_option (默认0)
-                                    0,  # is_shutup_all (默认0)
-                                    0,  # next_msg_seq
-                                    0,  # latest_seq
-                                    current_time,  # last_msg_time
-                                    current_time,  # last_info_time
-                                    0,  # info_seq
-                                    0,  # detail_info_seq
-                                    None,  # detail_group_id
-                                    None,  # detail_group_name
-                                    None,  # detail_group_type
-                                    None,  # detail_is_shutup_all
-                                    0,  # online_member_num
-                                    classid,  # classid
-                                    schoolid,  # schoolid
-                                    is_class_group  # is_class_group
-                                )
-                                
-                                # 检查群组是否已存在
-                                cursor.execute(
-                                    "SELECT group_id FROM `groups` WHERE group_id = %s",
-                                    (unique_group_id,)
-                                )
-                                existing_group = cursor.fetchone()
-                                
-                                if existing_group:
-                                    print(f"[创建群] 群组 {unique_group_id} 已存在，跳过插入 groups 表")
-                                    app_logger.info(f"[创建群] 群组 {unique_group_id} 已存在，跳过插入 groups 表")
-                                else:
-                                    print(f"[创建群] 插入 groups 表 - group_id={unique_group_id}, group_name={group_name}")
-                                    app_logger.info(f"[创建群] 插入 groups 表 - group_id={unique_group_id}, group_name={group_name}, is_class_group={is_class_group}")
-                                    try:
-                                        cursor.execute(insert_group_sql, insert_group_params)
-                                        affected_rows = cursor.rowcount
-                                        print(f"[创建群] 插入 groups 表成功 - group_id={unique_group_id}, 影响行数: {affected_rows}")
-                                        app_logger.info(f"[创建群] 插入 groups 表成功 - group_id={unique_group_id}, 影响行数: {affected_rows}")
-                                    except Exception as insert_error:
-                                        error_msg = f"插入 groups 表失败 - group_id={unique_group_id}, error={insert_error}"
-                                        print(f"[创建群] {error_msg}")
-                                        app_logger.error(f"[创建群] {error_msg}", exc_info=True)
-                                        import traceback
-                                        traceback_str = traceback.format_exc()
-                                        print(f"[创建群] 错误堆栈: {traceback_str}")
-                                        raise  # 重新抛出异常，让外层处理
-                                
-                                # 插入群成员到 group_members 表
-                                # 1. 优先处理 member_info（群主，必须存在）
-                                # 2. 然后处理 members 数组（管理员和其他成员）
-                                members_list = msg_data1.get('members', [])
-                                member_info = msg_data1.get('member_info')
-                                
-                                # 记录已处理的成员ID，避免重复插入
-                                processed_member_ids = set()
-                                
-                                # 第一步：处理 member_info（群主，必须存在）
-                                if member_info:
-                                    member_user_id = member_info.get('user_id')
-                                    if member_user_id:
-                                        print(f"[创建群] 处理 member_info（群主）: user_id={member_user_id}")
-                                        member_user_name = member_info.get('user_name', '')
-                                        member_self_role = member_info.get('self_role', 400)  # 默认群主
-                                        
-                                        # 处理 join_time
-                                        member_join_time = current_time
-                                        if 'join_time' in member_info:
-                                            join_time_value = member_info.get('join_time')
-                                            if join_time_value:
-                                                try:
-                                                    if isinstance(join_time_value, (int, float)):
-                                                        if join_time_value > 2147483647:
-                                                            join_time_value = int(join_time_value / 1000)
-                                                        dt = datetime.datetime.fromtimestamp(int(join_time_value))
-                                                        member_join_time = dt.strftime('%Y-%m-%d %H:%M:%S')
-                                                    else:
-                                                        member_join_time = join_time_value
-                                                except (ValueError, OSError):
-                                                    member_join_time = current_time
-                                        
-                                        insert_member_sql = """
-                                            INSERT INTO `group_members` (
-                                                group_id, user_id, user_name, self_role, join_time, msg_flag,
-                                                self_msg_flag, readed_seq, unread_num
-                                            ) VALUES (
-                                                %s, %s, %s, %s, %s, %s, %s, %s, %s
-                                            )
-                                        """
-                                        insert_member_params = (
-                                            unique_group_id,
-                                            member_user_id,
-                                            member_user_name if member_user_name else None,
-                                            member_self_role,
-                                            member_join_time,
-                                            member_info.get('msg_flag', 0),
-                                            member_info.get('self_msg_flag', 0),
-                                            member_info.get('readed_seq', 0),
-                                            member_info.get('unread_num', 0)
-                                        )
-                                        
-                                        # 检查群主是否已在群组中
-                                        cursor.execute(
-                                            "SELECT user_id FROM `group_members` WHERE group_id = %s AND user_id = %s",
-                                            (unique_group_id, member_user_id)
-                                        )
-                                        existing_owner = cursor.fetchone()
-                                        
-                                        if existing_owner:
-                                            print(f"[创建群] 群主 {member_user_id} 已在群组 {unique_group_id} 中，跳过插入")
-                                            app_logger.info(f"[创建群] 群主 {member_user_id} 已在群组 {unique_group_id} 中，跳过插入")
-                                        else:
-                                            print(f"[创建群] 插入群主 - group_id={unique_group_id}, user_id={member_user_id}, user_name={member_user_name}, self_role={member_self_role}")
-                                            app_logger.info(f"[创建群] 插入群主 - group_id={unique_group_id}, user_id={member_user_id}, user_name={member_user_name}, self_role={member_self_role}")
-                                            cursor.execute(insert_member_sql, insert_member_params)
-                                        processed_member_ids.add(member_user_id)
-                                    else:
-                                        print(f"[创建群] 警告: member_info 缺少 user_id，跳过")
-                                else:
-                                    print(f"[创建群] 警告: 缺少 member_info（群主信息），这是必需的")
-                                
-                                # 第二步：处理 members 数组（管理员和其他成员）
-                                print(f"[创建群] 开始处理 members 数组 - group_id={unique_group_id}, members数量={len(members_list) if members_list else 0}")
-                                if members_list:
-                                    print(f"[创建群] members 数组内容: {members_list}")
-                                    for m in members_list:
-                                        # 兼容新旧字段名
-                                        member_user_id = m.get('user_id') or m.get('unique_member_id')
-                                        member_user_name = m.get('user_name') or m.get('member_name', '')
-                                        
-                                        if not member_user_id:
-                                            print(f"[创建群] 警告: 成员信息缺少 user_id/unique_member_id，跳过")
-                                            continue
-                                        
-                                        # 如果该成员已经在 member_info 中处理过（群主），跳过避免重复
-                                        if member_user_id in processed_member_ids:
-                                            print(f"[创建群] 跳过已处理的成员（群主）: user_id={member_user_id}")
-                                            continue
-                                        
-                                        # self_role 字段：优先使用 self_role，否则从 group_role 转换
-                                        if 'self_role' in m:
-                                            self_role = m.get('self_role')
-                                        else:
-                                            # 从 group_role 转换：400=群主，300=管理员，其他=普通成员(200)
-                                            group_role = m.get('group_role')
-                                            if isinstance(group_role, int):
-                                                if group_role == 400:
-                                                    self_role = 400  # 群主（但应该已经在 member_info 中处理）
-                                                elif group_role == 300:
-                                                    self_role = 300  # 管理员（保持300）
-                                                else:
-                                                    self_role = 200  # 普通成员
-                                            elif isinstance(group_role, str):
-                                                # 字符串格式的角色
-                                                if group_role in ['owner', '群主', '400'] or member_user_id == owner_identifier:
-                                                    self_role = 400  # 群主（但应该已经在 member_info 中处理）
-                                                elif group_role in ['admin', '管理员', '300']:
-                                                    self_role = 300  # 管理员
-                                                else:
-                                                    self_role = 200  # 普通成员
-                                            else:
-                                                # 默认：如果是创建者则为群主，否则为普通成员
-                                                if member_user_id == owner_identifier:
-                                                    self_role = 400  # 群主（但应该已经在 member_info 中处理）
-                                                else:
-                                                    self_role = 200  # 普通成员
-                                        
-                                        insert_member_sql = """
-                                            INSERT INTO `group_members` (
-                                                group_id, user_id, user_name, self_role, join_time, msg_flag,
-                                                self_msg_flag, readed_seq, unread_num
-                                            ) VALUES (
-                                                %s, %s, %s, %s, %s, %s, %s, %s, %s
-                                            )
-                                        """
-                                        # 处理 join_time：支持时间戳格式（与 /groups/sync 一致）或直接使用当前时间
-                                        member_join_time = current_time
-                                        if 'join_time' in m:
-                                            join_time_value = m.get('join_time')
-                                            if join_time_value:
-                                                # 如果是时间戳，转换为 datetime 字符串
-                                                try:
-                                                    if isinstance(join_time_value, (int, float)):
-                                                        if join_time_value > 2147483647:  # 毫秒级时间戳
-                                                            join_time_value = int(join_time_value / 1000)
-                                                        dt = datetime.datetime.fromtimestamp(int(join_time_value))
-                                                        member_join_time = dt.strftime('%Y-%m-%d %H:%M:%S')
-                                                    else:
-                                                        member_join_time = join_time_value
-                                                except (ValueError, OSError):
-                                                    member_join_time = current_time
-                                        
-                                        # 获取其他成员字段（与 /groups/sync 一致）
-                                        member_msg_flag = m.get('msg_flag', 0)
-                                        member_self_msg_flag = m.get('self_msg_flag', 0)
-                                        member_readed_seq = m.get('readed_seq', 0)
-                                        member_unread_num = m.get('unread_num', 0)
-                                        
-                                        insert_member_params = (
-                                            unique_group_id,  # group_id
-                                            member_user_id,  # user_id
-                                            member_user_name if member_user_name else None,  # user_name
-                                            self_role,  # self_role
-                                            member_join_time,  # join_time
-                                            member_msg_flag,  # msg_flag
-                                            member_self_msg_flag,  # self_msg_flag
-                                            member_readed_seq,  # readed_seq
-                                            member_unread_num   # unread_num
-                                        )
-                                        
-                                        # 检查成员是否已在群组中
-                                        cursor.execute(
-                                            "SELECT user_id FROM `group_members` WHERE group_id = %s AND user_id = %s",
-                                            (unique_group_id, member_user_id)
-                                        )
-                                        existing_member = cursor.fetchone()
-                                        
-                                        if existing_member:
-                                            print(f"[创建群] 成员 {member_user_id} 已在群组 {unique_group_id} 中，跳过插入")
-                                            app_logger.info(f"[创建群] 成员 {member_user_id} 已在群组 {unique_group_id} 中，跳过插入")
-                                        else:
-                                            print(f"[创建群] 插入成员 - group_id={unique_group_id}, user_id={member_user_id}, user_name={member_user_name}, self_role={self_role}")
-                                            app_logger.info(f"[创建群] 插入成员 - group_id={unique_group_id}, user_id={member_user_id}, user_name={member_user_name}, self_role={self_role}")
-                                            cursor.execute(insert_member_sql, insert_member_params)
-                                        processed_member_ids.add(member_user_id)
-                                
-                                print(f"[创建群] 成员列表处理完成 - group_id={unique_group_id}, 已处理成员数={len(processed_member_ids)}")
-                                app_logger.info(f"[创建群] 成员列表处理完成 - group_id={unique_group_id}, 已处理成员数={len(processed_member_ids)}, 成员列表={list(processed_member_ids)}")
-                                
-                                print(f"[创建群] 准备提交事务 - group_id={unique_group_id}")
-                                app_logger.info(f"[创建群] 准备提交事务 - group_id={unique_group_id}")
-                                connection.commit()
-                                print(f"[创建群] 事务提交成功 - group_id={unique_group_id}")
-                                app_logger.info(f"[创建群] 事务提交成功 - group_id={unique_group_id}, group_name={group_name}")
-                                
-                                # 同步到腾讯IM（异步执行，不阻塞响应）
-                                try:
-                                    # 构建腾讯IM需要的群组数据格式
-                                    tencent_group_data = {
-                                        "GroupId": unique_group_id,
-                                        "group_id": unique_group_id,
-                                        "Name": group_name,
-                                        "group_name": group_name,
-                                        "Type": group_type_raw,  # 使用原始字符串类型，build_group_payload 会转换
-                                        "group_type": group_type_raw,
-                                        "Owner_Account": owner_identifier,
-                                        "owner_identifier": owner_identifier,
-                                        "FaceUrl": face_url,
-                                        "face_url": face_url,
-                                        "Introduction": msg_data1.get('introduction', ''),
-                                        "introduction": msg_data1.get('introduction', ''),
-                                        "Notification": msg_data1.get('notification', ''),
-                                        "notification": msg_data1.get('notification', ''),
-                                        "MaxMemberCount": msg_data1.get('max_member_num', 500),
-                                        "max_member_num": msg_data1.get('max_member_num', 500),
-                                        "ApplyJoinOption": msg_data1.get('add_option', 0),
-                                        "add_option": msg_data1.get('add_option', 0),
-                                        "is_class_group": is_class_group,  # 添加 is_class_group 字段，用于区分班级群和普通群
-                                        "classid": classid,  # 添加 classid 字段，用于辅助判断
-                                        "member_info": member_info,  # 群主信息
-                                        "MemberList": []  # 成员列表（包含群主和管理员）
-                                    }
-                                    
-                                    # 构建成员列表（包含群主和管理员）
-                                    member_list = []
-                                    added_member_accounts = set()  # 用于跟踪已添加的成员，避免重复
-                                    
-                                    # 添加群主（从 member_info）
-                                    if member_info:
-                                        owner_user_id = member_info.get('user_id')
-                                        if owner_user_id:
-                                            member_list.append({
-                                                "Member_Account": owner_user_id,
-                                                "user_id": owner_user_id,
-                                                "Role": "Owner",
-                                                "self_role": 400
-                                            })
-                                            added_member_accounts.add(owner_user_id)
-                                            print(f"[创建群] 腾讯IM数据：添加群主 - user_id={owner_user_id}")
-                                    
-                                    # 添加管理员和其他成员（从 members 数组）
-                                    if members_list:
-                                        for m in members_list:
-                                            member_user_id = m.get('user_id') or m.get('unique_member_id')
-                                            if not member_user_id:
-                                                continue
-                                            
-                                            # 如果已经在 member_list 中添加过，跳过避免重复
-                                            if member_user_id in added_member_accounts:
-                                                print(f"[创建群] 腾讯IM数据：跳过重复成员 - user_id={member_user_id}")
-                                                continue
-                                            
-                                            # 确定角色
-                                            if 'self_role' in m:
-                                                role_value = m.get('self_role')
-                                            else:
-                                                group_role = m.get('group_role')
-                                                if isinstance(group_role, int):
-                                                    if group_role == 400:
-                                                        role_value = 400
-                                                    elif group_role == 300:
-                                                        role_value = 300
-                                                    else:
-                                                        role_value = 200
-                                                else:
-                                                    role_value = 200
-                                            
-                                            # 转换为腾讯IM的角色字符串
-                                            if role_value == 400:
-                                                role_str = "Owner"
-                                            elif role_value == 300:
-                                                role_str = "Admin"
-                                            else:
-                                                role_str = "Member"
-                                            
-                                            member_list.append({
-                                                "Member_Account": member_user_id,
-                                                "user_id": member_user_id,
-                                                "Role": role_str,
-                                                "self_role": role_value
-                                            })
-                                            added_member_accounts.add(member_user_id)
-                                            print(f"[创建群] 腾讯IM数据：添加成员 - user_id={member_user_id}, Role={role_str}")
-                                    
-                                    tencent_group_data["MemberList"] = member_list
-                                    print(f"[创建群] 腾讯IM数据构建完成 - group_id={unique_group_id}, 成员数={len(member_list)}")
-                                    app_logger.info(f"[创建群] 腾讯IM数据构建完成 - group_id={unique_group_id}, 成员数={len(member_list)}, 成员列表={member_list}")
-                                    
-                                    # 异步调用同步函数（不阻塞当前流程）
-                                    print(f"[创建群] 准备同步到腾讯IM - group_id={unique_group_id}")
-                                    app_logger.info(f"[创建群] 准备同步到腾讯IM - group_id={unique_group_id}, group_name={group_name}")
-                                    
-                                    # 使用 asyncio.create_task 异步执行，不等待结果
-                                    print(f"[创建群] 创建异步任务同步到腾讯IM - group_id={unique_group_id}")
-                                    async def sync_to_tencent():
-                                        try:
-                                            print(f"[创建群] 异步任务开始 - group_id={unique_group_id}")
-                                            # 调用同步函数（需要传入列表格式）
-                                            result = await notify_tencent_group_sync(owner_identifier, [tencent_group_data])
-                                            print(f"[创建群] 异步任务完成 - group_id={unique_group_id}, result_status={result.get('status')}")
-                                            if result.get("status") == "success":
-                                                print(f"[创建群] 腾讯IM同步成功 - group_id={unique_group_id}")
-                                                app_logger.info(f"[创建群] 腾讯IM同步成功 - group_id={unique_group_id}")
-                                            else:
-                                                print(f"[创建群] 腾讯IM同步失败 - group_id={unique_group_id}, error={result.get('error')}")
-                                                app_logger.warning(f"[创建群] 腾讯IM同步失败 - group_id={unique_group_id}, error={result.get('error')}")
-                                        except Exception as sync_error:
-                                            print(f"[创建群] 腾讯IM同步异常 - group_id={unique_group_id}, error={sync_error}")
-                                            app_logger.error(f"[创建群] 腾讯IM同步异常 - group_id={unique_group_id}, error={sync_error}", exc_info=True)
-                                    
-                                    # 创建异步任务，不等待完成
-                                    asyncio.create_task(sync_to_tencent())
-                                    
-                                except Exception as tencent_sync_error:
-                                    # 同步失败不影响群组创建
-                                    print(f"[创建群] 准备腾讯IM同步时出错 - group_id={unique_group_id}, error={tencent_sync_error}")
-                                    app_logger.error(f"[创建群] 准备腾讯IM同步时出错 - group_id={unique_group_id}, error={tencent_sync_error}", exc_info=True)
-                                
-                                # 如果是班级群（有 classid 或 class_id），自动创建临时语音群
-                                temp_room_info = None
-                                class_id = classid  # 使用统一后的 classid 变量
-                                if class_id:
-                                    # 检查是否已经有临时语音群（使用 unique_group_id 作为 group_id）
-                                    if unique_group_id not in active_temp_rooms:
-                                        try:
-                                            print(f"[创建班级群] 检测到班级群，自动创建临时语音群 - group_id={unique_group_id}, class_id={class_id}")
-                                            app_logger.info(f"[创建班级群] 自动创建临时语音群 - group_id={unique_group_id}, class_id={class_id}, owner_id={user_id}")
-                                            
-                                            # 获取创建者信息
-                                            owner_id = user_id
-                                            owner_name = msg_data1.get('owner_name', '') or ''
-                                            owner_icon = msg_data1.get('owner_icon', '') or ''
-                                            
-                                            # 尝试从数据库获取创建者信息
-                                            if not owner_name or not owner_icon:
-                                                try:
-                                                    cursor.execute(
-                                                        "SELECT name, icon FROM ta_teacher WHERE teacher_unique_id = %s",
-                                                        (owner_id,)
-                                                    )
-                                                    owner_info = cursor.fetchone()
-                                                    if owner_info:
-                                                        if not owner_name:
-                                                            owner_name = owner_info.get('name', '') or owner_name
-                                                        if not owner_icon:
-                                                            owner_icon = owner_info.get('icon', '') or owner_icon
-                                                except Exception as db_error:
-                                                    app_logger.error(f"[创建班级群] 查询创建者信息失败 - user_id={user_id}, error={db_error}")
-                                            
-                                            # 生成唯一的房间ID和流名称
-                                            # 使用纯数字生成房间ID（时间戳毫秒 + 4位随机数）
-                                            room_id = str(int(time.time() * 1000)) + str(random.randint(1000, 9999))
-                                            stream_name = f"room_{unique_group_id}_{int(time.time())}"
-                                            
-                                            # 生成传统 WebRTC API 地址（推流和拉流）
-                                            publish_url = f"{SRS_WEBRTC_API_URL}/rtc/v1/publish/?app={SRS_APP}&stream={stream_name}"
-                                            play_url = f"{SRS_WEBRTC_API_URL}/rtc/v1/play/?app={SRS_APP}&stream={stream_name}"
-                                            
-                                            # 保留 WHIP/WHEP 地址用于向后兼容
-                                            whip_url = f"{SRS_BASE_URL}/rtc/v1/whip/?app={SRS_APP}&stream={stream_name}"
-                                            whep_url = f"{SRS_BASE_URL}/rtc/v1/whep/?app={SRS_APP}&stream={stream_name}"
-                                            
-                                            # 创建临时语音群
-                                            active_temp_rooms[unique_group_id] = {
-                                            "room_id": room_id,
-                                            "owner_id": owner_id,
-                                            "owner_name": owner_name,
-                                            "owner_icon": owner_icon,
-                                            "publish_url": publish_url,  # 推流地址（传统 WebRTC API）
-                                            "play_url": play_url,  # 拉流地址（传统 WebRTC API）
-                                            "whip_url": whip_url,  # WHIP 地址（向后兼容）
-                                            "whep_url": whep_url,  # WHEP 地址（向后兼容）
-                                            "stream_name": stream_name,
-                                            "group_id": unique_group_id,
-                                            "timestamp": time.time(),
-                                            "members": [owner_id]  # 初始化成员列表，包含创建者
-                                        }
-                                        
-                                            # 保存临时语音房间到数据库
-                                            try:
-                                                # 插入临时语音房间信息
-                                                insert_room_sql = """
-                                                INSERT INTO `temp_voice_rooms` (
-                                                    room_id, group_id, owner_id, owner_name, owner_icon,
-                                                    whip_url, whep_url, stream_name, status, create_time
-                                                ) VALUES (
-                                                    %s, %s, %s, %s, %s, %s, %s, %s, %s, NOW()
-                                                )
-                                            """
-                                                cursor.execute(insert_room_sql, (
-                                                    room_id,
-                                                    unique_group_id,
-                                                    owner_id,
-                                                    owner_name if owner_name else None,
-                                                    owner_icon if owner_icon else None,
-                                                    whip_url,
-                                                    whep_url,
-                                                    stream_name,
-                                                    1  # status = 1 (活跃)
-                                                ))
-                                                
-                                                # 插入房间创建者（群主）到成员表
-                                                insert_member_sql = """
-                                                    INSERT INTO `temp_voice_room_members` (
-                                                        room_id, user_id, user_name, status, join_time
-                                                    ) VALUES (
-                                                        %s, %s, %s, %s, NOW()
-                                                    )
-                                                """
-                                                cursor.execute(insert_member_sql, (
-                                                    room_id,
-                                                    owner_id,
-                                                    owner_name if owner_name else None,
-                                                    1  # status = 1 (在线)
-                                                ))
-                                                
-                                                connection.commit()
-                                                print(f"[创建班级群] 临时语音房间已保存到数据库 - room_id={room_id}, group_id={unique_group_id}")
-                                                app_logger.info(f"[创建班级群] 临时语音房间已保存到数据库 - room_id={room_id}, group_id={unique_group_id}")
-                                            except Exception as db_save_error:
-                                                # 数据库保存失败不影响内存中的房间创建
-                                                print(f"[创建班级群] 保存临时语音房间到数据库失败 - room_id={room_id}, error={db_save_error}")
-                                                app_logger.error(f"[创建班级群] 保存临时语音房间到数据库失败 - room_id={room_id}, error={db_save_error}", exc_info=True)
-                                                connection.rollback()
-                                            
-                                            temp_room_info = {
-                                            "room_id": room_id,
-                                            "publish_url": publish_url,  # 推流地址（传统 WebRTC API）
-                                            "play_url": play_url,  # 拉流地址（传统 WebRTC API）
-                                            "stream_name": stream_name,
-                                            "group_id": unique_group_id,
-                                            "owner_id": owner_id,
-                                            "owner_name": owner_name,
-                                            "owner_icon": owner_icon
-                                            }
-                                            
-                                            print(f"[创建班级群] 临时语音群创建成功 - group_id={unique_group_id}, room_id={room_id}, stream_name={stream_name}")
-                                            app_logger.info(f"[创建班级群] 临时语音群创建成功 - group_id={unique_group_id}, room_id={room_id}")
-                                        except Exception as temp_room_error:
-                                            app_logger.error(f"[创建班级群] 创建临时语音群失败 - group_id={unique_group_id}, error={temp_room_error}")
-                                            print(f"[创建班级群] 创建临时语音群失败: {temp_room_error}")
-                                            # 临时语音群创建失败不影响班级群创建
-                                    else:
-                                        # 如果已存在临时语音群，获取其信息
-                                        existing_room = active_temp_rooms[unique_group_id]
-                                        temp_room_info = {
-                                            "room_id": existing_room.get("room_id"),
-                                            "publish_url": existing_room.get("publish_url"),  # 推流地址（传统 WebRTC API）
-                                            "play_url": existing_room.get("play_url"),  # 拉流地址（传统 WebRTC API）
-                                            "stream_name": existing_room.get("stream_name"),
-                                            "group_id": unique_group_id,
-                                            "owner_id": existing_room.get("owner_id"),
-                                            "owner_name": existing_room.get("owner_name"),
-                                            "owner_icon": existing_room.get("owner_icon")
-                                        }
-                                        print(f"[创建班级群] 临时语音群已存在 - group_id={unique_group_id}, room_id={temp_room_info.get('room_id')}")
-                                
-                                # 给在线成员推送
-                                # 兼容新旧字段名：user_id 或 unique_member_id
-                                members_to_notify = msg_data1.get('members', [])
-                                for m in members_to_notify:
-                                    # 兼容新旧字段名
-                                    member_id = m.get('user_id') or m.get('unique_member_id')
-                                    if not member_id:
-                                        continue
-                                    
-                                    target_conn = connections.get(member_id)
-                                    if target_conn:
-                                        await target_conn["ws"].send_text(json.dumps({
-                                            "type":"notify",
-                                            "message":f"你已加入群: {msg_data1.get('group_name') or msg_data1.get('nickname', '')}",
-                                            "group_id": unique_group_id,
-                                            "groupname": msg_data1.get('group_name') or msg_data1.get('nickname', '')
-                                        }))
-                                    else:
-                                        print(f"[创建群] 成员 {member_id} 不在线，插入通知")
-                                        cursor = connection.cursor(dictionary=True)
-
-                                        update_query = """
-                                                INSERT INTO ta_notification (sender_id, sender_name, receiver_id, unique_group_id, group_name, content, content_text)
-                                                VALUES (%s, %s, %s, %s, %s, %s, %s)
-                                            """
-                                        cursor.execute(update_query, (user_id, msg_data1.get('owner_name'), member_id, unique_group_id, msg_data1.get("group_name") or msg_data1.get("nickname", ""), "邀请你加入了群", msg_data1['type']))
-                                        connection.commit()
-
-                                #把创建成功的群信息发回给创建者（包含临时语音群信息）
-                                print(f"[创建群] 准备构建返回给客户端的响应 - group_id={unique_group_id}")
-                                # 兼容新旧字段名：group_name 或 nickname
-                                group_name_for_response = msg_data1.get('group_name') or msg_data1.get('nickname', '')
-                                response_data = {
-                                    "type":"3",
-                                    "message":f"你创建了群: {group_name_for_response}",
-                                    "group_id": unique_group_id,
-                                    "groupname": group_name_for_response
-                                }
-                                
-                                # 如果有临时语音群信息，添加到响应中
-                                if temp_room_info:
-                                    response_data["temp_room"] = temp_room_info
-                                
-                                # 打印返回给客户端的消息
-                                response_json = json.dumps(response_data, ensure_ascii=False)
-                                print(f"[创建群] 返回给客户端 - user_id={user_id}, group_id={unique_group_id}, response={response_json}")
-                                app_logger.info(f"[创建群] 返回给客户端 - user_id={user_id}, group_id={unique_group_id}, response={response_json}")
-                                
-                                print(f"[创建群] 准备发送响应给客户端 - group_id={unique_group_id}")
-                                await websocket.send_text(response_json)
-                                print(f"[创建群] 响应已发送给客户端 - group_id={unique_group_id}")
-                                print(f"[创建群] 创建群组流程完成 - group_id={unique_group_id}")
-                                app_logger.info(f"[创建群] 创建群组流程完成 - group_id={unique_group_id}, user_id={user_id}")
-                            except Exception as create_group_error:
-                                error_msg = f"创建群组时发生异常 - user_id={user_id}, error={create_group_error}"
-                                print(f"[创建群] {error_msg}")
-                                app_logger.error(f"[创建群] {error_msg}", exc_info=True)
-                                import traceback
-                                traceback_str = traceback.format_exc()
-                                print(f"[创建群] 错误堆栈: {traceback_str}")
-                                # 回滚事务
-                                if connection and connection.is_connected():
-                                    connection.rollback()
-                                    print(f"[创建群] 已回滚事务")
-                                # 发送错误消息给客户端
-                                try:
-                                    error_response = {
-                                        "type": "3",
-                                        "status": "error",
-                                        "message": f"创建群组失败: {str(create_group_error)}",
-                                        "group_id": msg_data1.get('group_id', '')
-                                    }
-                                    await websocket.send_text(json.dumps(error_response, ensure_ascii=False))
-                                except Exception as send_error:
-                                    app_logger.error(f"[创建群] 发送错误消息失败: {send_error}")
-
-                        # 群消息: 群主发消息，发给除群主外的所有群成员
-                        elif msg_data1['type'] == "5":
-                            print("群消息发送")
-                            cursor = connection.cursor(dictionary=True)
-                            print(msg_data1)
-                            unique_group_id = msg_data1.get('unique_group_id')
-                            sender_id = user_id  # 当前发送者（可能是群主，也可能是群成员）
-                            groupowner_flag = msg_data1.get('groupowner', False)  # bool 或字符串
-
-                            # 查询群信息
-                            cursor.execute("""
-                                SELECT group_admin_id, nickname 
-                                FROM ta_group 
-                                WHERE unique_group_id = %s
-                            """, (unique_group_id,))
-                            row = cursor.fetchone()
-                            if not row:
-                                await websocket.send_text(f"群 {unique_group_id} 不存在")
-                                return
-
-                            group_admin_id = row['group_admin_id']
-                            group_name = row['nickname'] or ""  # 群名
-
-                            if str(groupowner_flag).lower() in ("true", "1", "yes"):
-                                # --------------------------- 群主发送 ---------------------------
-                                if group_admin_id != sender_id:
-                                    await websocket.send_text(f"不是群主，不能发送群消息")
-                                    return
-
-                                # 查成员（排除群主）
-                                cursor.execute("""
-                                    SELECT unique_member_id 
-                                    FROM ta_group_member_relation
-                                    WHERE unique_group_id = %s AND unique_member_id != %s
-                                """, (unique_group_id, sender_id))
-                                members = cursor.fetchall()
-
-                                if not members:
-                                    await websocket.send_text("群没有其他成员")
-                                    return
-
-                                for m in members:
-                                    member_id = m['unique_member_id']
-                                    target_conn = connections.get(member_id)
-                                    if target_conn:
-                                        print(member_id, "在线，发送群消息")
-                                        await target_conn["ws"].send_text(json.dumps({
-                                            "type": "5",
-                                            "group_id": unique_group_id,
-                                            "from": sender_id,
-                                            "content": msg_data1.get("content", ""),
-                                            "groupname": group_name,
-                                            "sender_name": msg_data1.get("sender_name", "")
-                                        }, ensure_ascii=False))
-                                    else:
-                                        print(member_id, "不在线，插入通知")
-                                        cursor.execute("""
-                                            INSERT INTO ta_notification (
-                                            sender_id, sender_name, receiver_id, unique_group_id, group_name, content, content_text
-                                            ) VALUES (%s, %s, %s, %s, %s, %s, %s)
-                                        """, (
-                                            sender_id, msg_data1.get("sender_name", ""), member_id, unique_group_id, group_name,
-                                            msg_data1.get("content", ""), msg_data1['type']
-                                        ))
-                                        connection.commit()
-                            else:
-                                # --------------------------- 群成员发送 ---------------------------
-                                print("群成员发送群消息")
-
-                                # 找到所有需要接收的人：群主 + 其他成员（去掉发送者）
-                                receivers = []
-
-                                # 添加群主
-                                if group_admin_id != sender_id:
-                                    receivers.append(group_admin_id)
-
-                                # 查其他成员（排除自己）
-                                cursor.execute("""
-                                    SELECT unique_member_id 
-                                    FROM ta_group_member_relation
-                                    WHERE unique_group_id = %s AND unique_member_id != %s
-                                """, (unique_group_id, sender_id))
-                                member_rows = cursor.fetchall()
-                                for r in member_rows:
-                                    receivers.append(r['unique_member_id'])
-
-                                # 去重（以防群主也在成员列表里）
-                                receivers = list(set(receivers))
-
-                                if not receivers:
-                                    await websocket.send_text("群没有其他成员可以接收此消息")
-                                    return
-
-                                # 给这些接收者发消息 / 存通知
-                                for rid in receivers:
-                                    target_conn = connections.get(rid)
-                                    if target_conn:
-                                        print(rid, "在线，发送群成员消息")
-                                        await target_conn["ws"].send_text(json.dumps({
-                                            "type": "5",
-                                            "group_id": unique_group_id,
-                                            "from": sender_id,
-                                            "content": msg_data1.get("content", ""),
-                                            "groupname": group_name,
-                                            "sender_name": msg_data1.get("sender_name", "")
-                                        }, ensure_ascii=False))
-                                    else:
-                                        print(rid, "不在线，插入通知")
-                                        cursor.execute("""
-                                            INSERT INTO ta_notification (
-                                            sender_id, sender_name, receiver_id, unique_group_id, group_name, content, content_text
-                                            ) VALUES (%s, %s, %s, %s, %s, %s, %s)
-                                        """, (
-                                            sender_id, msg_data1.get("sender_name", ""), rid, unique_group_id, group_name,
-                                            msg_data1.get("content", ""), msg_data1['type']
-                                        ))
-                                        connection.commit()
-                        
-                        # 创建临时房间: 群主创建临时房间，下发拉流地址给被邀请的人
-                        elif msg_data1['type'] == "6":
-                            await handle_temp_room_creation(msg_data1)
-                            continue
-                        elif msg_data1['type'] == "temp_room_owner_leave":
-                            await handle_temp_room_owner_leave(msg_data1.get("group_id") or target_id)
-                            continue
-                        # 课前准备消息: 发送给群组所有成员
-                        elif msg_data1['type'] == "prepare_class":
-                            app_logger.info(f"[prepare_class] 收到课前准备消息，user_id={user_id}, target_id={target_id}")
-                            print(f"[prepare_class] 收到课前准备消息，user_id={user_id}, target_id={target_id}")
-                            cursor = connection.cursor(dictionary=True)
-                            
-                            group_id = target_id  # 群组ID就是target_id
-                            class_id = msg_data1.get('class_id')
-                            school_id = msg_data1.get('school_id')
-                            subject = msg_data1.get('subject', '')
-                            content = msg_data1.get('content', '')
-                            date = msg_data1.get('date', '')
-                            class_time = msg_data1.get('time', '')  # 上课时间
-                            sender_id = msg_data1.get('sender_id') or user_id
-                            sender_name = msg_data1.get('sender_name', '')
-                            
-                            app_logger.info(
-                                f"[prepare_class] 参数解析 - group_id={group_id}, class_id={class_id}, school_id={school_id}, "
-                                f"subject={subject}, sender_id={sender_id}, sender_name={sender_name}, "
-                                f"date={date}, time={class_time}, content_length={len(content)}"
-                            )
-                            print(f"[prepare_class] group_id={group_id}, class_id={class_id}, school_id={school_id}, subject={subject}, sender_id={sender_id}, time={class_time}")
-                            
-                            # 验证群组是否存在（使用 groups 表）
-                            cursor.execute("""
-                                SELECT group_id, group_name, owner_identifier 
-                                FROM `groups` 
-                                WHERE group_id = %s
-                            """, (group_id,))
-                            group_info = cursor.fetchone()
-                            
-                            if not group_info:
-                                error_msg = f"群组 {group_id} 不存在"
-                                app_logger.warning(f"[prepare_class] {error_msg}, user_id={user_id}")
-                                await websocket.send_text(json.dumps({
-                                    "type": "error",
-                                    "message": error_msg
-                                }, ensure_ascii=False))
-                                continue
-                            
-                            group_name = group_info.get('group_name', '')
-                            owner_identifier = group_info.get('owner_identifier', '')
-                            app_logger.info(f"[prepare_class] 群组验证成功 - group_id={group_id}, group_name={group_name}, owner_identifier={owner_identifier}")
-                            
-                            # 获取群组所有成员（使用 group_members 表）
-                            cursor.execute("""
-                                SELECT user_id 
-                                FROM `group_members`
-                                WHERE group_id = %s
-                            """, (group_id,))
-                            members = cursor.fetchall()
-                            total_members = len(members)
-                            app_logger.info(f"[prepare_class] 获取群组成员 - group_id={group_id}, 总成员数={total_members}")
-                            
-                            # 构建消息内容
-                            prepare_message = json.dumps({
-                                "type": "prepare_class",
-                                "class_id": class_id,
-                                "school_id": school_id,
-                                "subject": subject,
-                                "content": content,
-                                "date": date,
-                                "time": class_time,
-                                "sender_id": sender_id,
-                                "sender_name": sender_name,
-                                "group_id": group_id,
-                                "group_name": group_name
-                            }, ensure_ascii=False)
-                            
-                            # 先为所有成员保存到数据库（不管是否在线）
-                            app_logger.info(f"[prepare_class] 开始保存课前准备数据到数据库，成员数={total_members}")
-                            prepare_id: Optional[int] = None
-
-                            # 判断是否存在相同 (group_id, class_id, school_id, subject, date, time) 的记录
-                            cursor.execute("""
-                                SELECT prepare_id FROM class_preparation
-                                WHERE group_id = %s
-                                  AND class_id = %s
-                                  AND IFNULL(school_id, '') = %s
-                                  AND subject = %s
-                                  AND date = %s
-                                  AND IFNULL(time, '') = %s
-                                ORDER BY prepare_id DESC
-                                LIMIT 1
-                            """, (group_id, class_id, school_id or "", subject, date, class_time or ""))
-                            existing_prepare = cursor.fetchone()
-
-                            if existing_prepare:
-                                prepare_id = existing_prepare['prepare_id']
-                                cursor.execute("""
-                                    UPDATE class_preparation
-                                    SET content = %s,
-                                        school_id = %s,
-                                        sender_id = %s,
-                                        sender_name = %s,
-                                        updated_at = NOW()
-                                    WHERE prepare_id = %s
-                                """, (content, school_id, sender_id, sender_name, prepare_id))
-                                cursor.execute(
-                                    "DELETE FROM class_preparation_receiver WHERE prepare_id = %s",
-                                    (prepare_id,)
-                                )
-                                app_logger.info(f"[prepare_class] 更新已有课前准备记录 prepare_id={prepare_id}")
-                            else:
-                                cursor.execute("""
-                                    INSERT INTO class_preparation (
-                                        group_id, class_id, school_id, subject, content, date, time, sender_id, sender_name, created_at
-                                    ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, NOW())
-                                """, (group_id, class_id, school_id, subject, content, date, class_time, sender_id, sender_name))
-                                prepare_id = cursor.lastrowid
-                                app_logger.info(f"[prepare_class] 插入主记录成功，prepare_id={prepare_id}")
-                            
-                            # 为每个成员插入接收记录（is_read=0 表示未读）
-                            for member in members:
-                                member_id = member['user_id']
-                                cursor.execute("""
-                                    INSERT INTO class_preparation_receiver (
-                                        prepare_id, receiver_id, is_read, created_at
-                                    ) VALUES (%s, %s, 0, NOW())
-                                """, (prepare_id, member_id))
-                            
-                            connection.commit()
-                            app_logger.info(f"[prepare_class] 已为所有 {total_members} 个成员保存课前准备数据")
-                            
-                            online_count = 0
-                            offline_count = 0
-                            online_members = []
-                            offline_members = []
-                            
-                            # 然后推送在线的成员
-                            for member in members:
-                                member_id = member['user_id']
-                                target_conn = connections.get(member_id)
-                                
-                                if target_conn:
-                                    app_logger.debug(f"[prepare_class] 用户 {member_id} 在线，推送消息并标记为已读")
-                                    print(f"[prepare_class] 用户 {member_id} 在线，推送消息")
-                                    online_count += 1
-                                    online_members.append(member_id)
-                                    await target_conn["ws"].send_text(prepare_message)
-                                    # 标记为已读（因为已经实时推送了）
-                                    cursor.execute("""
-                                        UPDATE class_preparation_receiver 
-                                        SET is_read = 1, read_at = NOW() 
-                                        WHERE prepare_id = %s AND receiver_id = %s
-                                    """, (prepare_id, member_id))
-                                else:
-                                    app_logger.debug(f"[prepare_class] 用户 {member_id} 不在线，已保存到数据库，等待登录时获取")
-                                    print(f"[prepare_class] 用户 {member_id} 不在线，已保存到数据库")
-                                    offline_count += 1
-                                    offline_members.append(member_id)
-                            
-                            # 提交已读标记的更新
-                            connection.commit()
-                            app_logger.info(f"[prepare_class] 已推送并标记 {online_count} 个在线成员为已读")
-                            
-                            # 给发送者返回结果
-                            result_message = f"课前准备消息已发送，在线: {online_count} 人，离线: {offline_count} 人"
-                            app_logger.info(f"[prepare_class] 完成 - group_id={group_id}, class_id={class_id}, subject={subject}, time={class_time}, 在线={online_count}, 离线={offline_count}, 在线成员={online_members}, 离线成员={offline_members}")
-                            print(f"[prepare_class] 完成，在线={online_count}, 离线={offline_count}, time={class_time}")
-                            
-                            await websocket.send_text(json.dumps({
-                                "type": "prepare_class",
-                                "status": "success",
-                                "message": result_message,
-                                "online_count": online_count,
-                                "offline_count": offline_count
-                            }, ensure_ascii=False))
-                            continue
-                        # WebRTC 信令消息处理
-                        elif msg_data1['type'] == "webrtc_offer":
-                            await handle_webrtc_signal(msg_data1, "offer")
-                            continue
-                        elif msg_data1['type'] == "webrtc_answer":
-                            await handle_webrtc_signal(msg_data1, "answer")
-                            continue
-                        elif msg_data1['type'] == "webrtc_ice_candidate":
-                            await handle_webrtc_signal(msg_data1, "ice_candidate")
-                            continue
-                        # 处理通过服务器转发到 SRS 的 offer（推流）
-                        elif msg_data1['type'] == "srs_publish_offer":
-                            await handle_srs_webrtc_offer(msg_data1, "publish")
-                            continue
-                        # 处理通过服务器转发到 SRS 的 offer（拉流）
-                        elif msg_data1['type'] == "srs_play_offer":
-                            await handle_srs_webrtc_offer(msg_data1, "play")
-                            continue
-        
-                    else:
-                        print(" 格式错误")
-                        await websocket.send_text("格式错误: to:<target_id>:<消息>")
-                else:
-                    msg_data_raw = None
-                    try:
-                        msg_data_raw = json.loads(data)
-                    except Exception:
-                        msg_data_raw = None
-
-                    if isinstance(msg_data_raw, dict) and msg_data_raw.get("type") == "6":
-                        await handle_temp_room_creation(msg_data_raw)
-                        continue
-                    if isinstance(msg_data_raw, dict) and msg_data_raw.get("type") == "temp_room_owner_leave":
-                        await handle_temp_room_owner_leave(msg_data_raw.get("group_id"))
-                        continue
-                    # WebRTC 信令消息处理（纯 JSON 格式）
-                    if isinstance(msg_data_raw, dict) and msg_data_raw.get("type") == "webrtc_offer":
-                        await handle_webrtc_signal(msg_data_raw, "offer")
-                        continue
-                    if isinstance(msg_data_raw, dict) and msg_data_raw.get("type") == "webrtc_answer":
-                        await handle_webrtc_signal(msg_data_raw, "answer")
-                        continue
-                    if isinstance(msg_data_raw, dict) and msg_data_raw.get("type") == "webrtc_ice_candidate":
-                        await handle_webrtc_signal(msg_data_raw, "ice_candidate")
-                        continue
-                    # 处理通过服务器转发到 SRS 的 offer（推流）
-                    if isinstance(msg_data_raw, dict) and msg_data_raw.get("type") == "srs_publish_offer":
-                        await handle_srs_webrtc_offer(msg_data_raw, "publish")
-                        continue
-                    # 处理通过服务器转发到 SRS 的 offer（拉流）
-                    if isinstance(msg_data_raw, dict) and msg_data_raw.get("type") == "srs_play_offer":
-                        await handle_srs_webrtc_offer(msg_data_raw, "play")
-                        continue
-                    # 处理加入临时房间请求
-                    if isinstance(msg_data_raw, dict) and msg_data_raw.get("type") in ("join_temp_room", "temp_room_join"):
-                        group_id_from_msg = msg_data_raw.get("group_id")
-                        app_logger.info(f"[temp_room] 🔵 收到 JSON 格式的加入房间请求 - user_id={user_id}, type={msg_data_raw.get('type')}, group_id={group_id_from_msg}, 原始消息={data[:200]}")
-                        print(f"[temp_room] 🔵 收到 JSON 格式的加入房间请求 - user_id={user_id}, type={msg_data_raw.get('type')}, group_id={group_id_from_msg}")
-                        await handle_join_temp_room(group_id_from_msg)
-                        continue
-
-                    # 处理字符串格式的加入房间请求
-                    stripped_data = (data or "").strip()
-                    if stripped_data and stripped_data in active_temp_rooms:
-                        app_logger.info(f"[temp_room] 🔵 收到字符串格式的加入房间请求 - user_id={user_id}, stripped_data={stripped_data}, 原始消息={data[:200]}, active_rooms={list(active_temp_rooms.keys())}")
-                        print(f"[temp_room] 🔵 收到字符串格式的加入房间请求 - user_id={user_id}, stripped_data={stripped_data}")
-                        await handle_join_temp_room(stripped_data)
-                        continue
-                    elif stripped_data:
-                        app_logger.debug(f"[temp_room] 🔵 字符串数据不在 active_temp_rooms 中 - user_id={user_id}, stripped_data={stripped_data}, active_rooms={list(active_temp_rooms.keys())}")
-                        print(f"[temp_room] 🔵 字符串数据不在 active_temp_rooms 中 - user_id={user_id}, stripped_data={stripped_data}")
-                        continue
-
-                    # 如果都不匹配，打印原始数据用于调试
-                    print(f"[websocket][{user_id}] 未处理的消息: {data[:200]}")
-                # 广播
-                for uid, conn in connections.items():
-                    if uid != user_id:
-                        await conn["ws"].send_text(f"[{user_id} 广播] {data}")
-                        
             # 二进制音频消息处理 (flag协议)
             elif "bytes" in message:
                 audio_bytes = message["bytes"]
+                if codec != "json" and audio_bytes and audio_bytes[0] != VOICE_FRAME_TYPE:
+                    if await throttle():
+                        await dispatch_packed_message(audio_bytes)
+                    continue
                 try:
-                    frameType = audio_bytes[0]
-                    flag = audio_bytes[1]
-                    offset = 2
-                    if frameType != 6:
+                    frame = parse_voice_frame(audio_bytes)
+                    if frame is None:
+                        continue
+                    # 字节数只按语音数据帧（flag=1）计，开始/结束帧只占消息数
+                    if not await throttle(nbytes=len(audio_bytes) if frame.flag == 1 else 0):
                         continue
-                    group_len = struct.unpack("<I", audio_bytes[offset:offset+4])[0]
-                    offset += 4
-                    group_id = audio_bytes[offset:offset+group_len].decode("utf-8")
-                    offset += group_len
-                    sender_len = struct.unpack("<I", audio_bytes[offset:offset+4])[0]
-                    offset += 4
-                    sender_id = audio_bytes[offset:offset+sender_len].decode("utf-8")
-                    offset += sender_len
-                    name_len = struct.unpack("<I", audio_bytes[offset:offset+4])[0]
-                    offset += 4
-                    sender_name = audio_bytes[offset:offset+name_len].decode("utf-8")
-                    offset += name_len
-                    ts = struct.unpack("<Q", audio_bytes[offset:offset+8])[0]
-                    offset += 8
-                    aac_len = struct.unpack("<I", audio_bytes[offset:offset+4])[0]
-                    offset += 4
-                    aac_data = audio_bytes[offset:offset+aac_len]
+                    flag = frame.flag
+                    group_id = frame.group_id
+                    sender_id = frame.sender_id
+                    sender_name = frame.sender_name
+                    ts = frame.ts
+                    aac_data = frame.aac
 
                     if flag == 0:
-                        temp_filename = f"/tmp/{group_id}_{sender_id}_{ts}.aac"
-                        with open(temp_filename, "wb") as f:
-                            if aac_len > 0:
-                                f.write(aac_data)
-                        connections[sender_id]["voice_file"] = temp_filename
+                        temp_filename = await voice_recorder.start(group_id, sender_id, ts, aac_data)
                         print(" init acc flag:", temp_filename)
 
                     elif flag == 1:
-                        if "voice_file" in connections[sender_id]:
-                            with open(connections[sender_id]["voice_file"], "ab") as f:
-                                f.write(aac_data)
-                        cursor.execute("""
-                            SELECT unique_member_id FROM ta_group_member_relation
-                            WHERE unique_group_id=%s AND unique_member_id!=%s
-                        """, (group_id, sender_id))
-                        for m in cursor.fetchall():
-                            tc = connections.get(m['unique_member_id'])
-                            if tc:
-                                await tc["ws"].send_bytes(audio_bytes)
+                        voice_recorder.append(sender_id, aac_data)
+                        members = await group_member_cache.get_members(group_id)
+                        targets = await hub.lookup_many(members)
+                        targets.pop(sender_id, None)
+                        if targets:
+                            await hub.fan_out(targets, audio_bytes)
 
                     elif flag == 2:
-                        voice_file_path = connections[sender_id].pop("voice_file", None)
-                        cursor.execute("""
-                            SELECT unique_member_id FROM ta_group_member_relation
-                            WHERE unique_group_id=%s AND unique_member_id!=%s
-                        """, (group_id, sender_id))
-                        for m in cursor.fetchall():
-                            rid = m["unique_member_id"]
-                            tc = connections.get(rid)
-                            
-                            if voice_file_path and os.path.exists(voice_file_path):
-                                offline_path = f"/var/offline_voice/{os.path.basename(voice_file_path)}"
-                                os.makedirs(os.path.dirname(offline_path), exist_ok=True)
-
-                                try:
-                                    shutil.move(voice_file_path, offline_path)
-                                except Exception as e:
-                                    print(f"拷贝离线语音失败: {e}")
-                                    offline_path = voice_file_path  # 保底使用原路径
-
-                                # 写数据库通知
-                                cursor.execute("""
-                                    INSERT INTO ta_notification (
-                                        sender_id, sender_name, receiver_id, unique_group_id, group_name, content, content_text
-                                    ) VALUES (%s, %s, %s, %s, %s, %s, %s)
-                                """, (
-                                    sender_id,
-                                    sender_name,
-                                    rid,
-                                    group_id,
-                                    "语音群聊",
-                                    f"离线语音文件: {os.path.basename(offline_path)}",
-                                    "6"  # type=6 表示音频消息
-                                ))
-                                connection.commit()
-                            
-                            if tc:
-                                await tc["ws"].send_bytes(audio_bytes)
-                            
-
-                        # 清理临时文件
-                        if voice_file_path and os.path.exists(voice_file_path):
-                            try:
-                                os.remove(voice_file_path)
-                            except Exception as e:
-                                print(f"删除临时语音文件失败: {e}")
+                        offline_future = voice_recorder.finalize(sender_id)
+                        members = await group_member_cache.get_members(group_id)
+                        targets = await hub.lookup_many(members)
+                        targets.pop(sender_id, None)
+                        # 在线成员已实时收到语音帧，接收记录直接记为已读
+                        receivers = [(rid, 1 if rid in targets else 0) for rid in members if rid != sender_id]
+                        if targets:
+                            await hub.fan_out(targets, audio_bytes)
+                        if offline_future is not None:
+                            schedule_offline_voice(offline_future, group_id, sender_id, sender_name, receivers)
 
                 except Exception as e:
                     print(f"解析音频包失败: {e}")
 
     except WebSocketDisconnect as exc:
-        if user_id in connections:
-            connections.pop(user_id, None)
-            print(f"用户 {user_id} 离线（外层捕获），当前在线={len(connections)}，详情: {exc}")
-        
-        # 清理用户从所有临时房间的成员列表中移除
-        # 注意：不再因为 WebSocket 断开而自动解散房间，只移除成员，房间是否解散由业务消息控制（如 temp_room_owner_leave）
-        for group_id, room_info in list(active_temp_rooms.items()):
-            members = room_info.get("members", [])
-            if user_id in members:
-                members.remove(user_id)
-                app_logger.info(f"[webrtc] 用户 {user_id} 离开房间 {group_id}（外层捕获），当前成员数={len(members)}")
-                print(f"[webrtc] 用户 {user_id} 离开房间 {group_id}（外层捕获），当前成员数={len(members)}")
-        
-        if connection:
-            connection.rollback()
+        print(f"用户 {user_id} 离线（外层捕获），当前在线={len(connections)}，详情: {exc}")
     except Exception as e:
         # 捕获其他未预期的异常
         app_logger.error(f"[websocket][{user_id}] 未预期的异常: {e}", exc_info=True)
         print(f"[websocket][{user_id}] 未预期的异常: {e}")
-        # 确保清理用户从临时房间中移除
-        for group_id, room_info in list(active_temp_rooms.items()):
-            members = room_info.get("members", [])
-            if user_id in members:
-                members.remove(user_id)
-                app_logger.info(f"[webrtc] 用户 {user_id} 离开房间 {group_id}（异常清理），当前成员数={len(members)}")
-                print(f"[webrtc] 用户 {user_id} 离开房间 {group_id}（异常清理），当前成员数={len(members)}")
     finally:
-        # 最终清理：确保用户从连接列表和临时房间中移除
-        if user_id in connections:
+        # 最终清理：确保用户从连接列表和临时房间中移除。
+        # 同一用户已经重连（connections 里是新会话的条目）时，旧会话不能清掉新会话的状态
+        still_current = connections.get(user_id) is conn_entry
+        if still_current:
             connections.pop(user_id, None)
             print(f"[websocket][{user_id}] 从连接列表中移除（finally块）")
-        
-        # 再次检查并清理临时房间成员（防止遗漏）
-        for group_id, room_info in list(active_temp_rooms.items()):
-            members = room_info.get("members", [])
-            if user_id in members:
-                members.remove(user_id)
-                app_logger.info(f"[webrtc] 用户 {user_id} 离开房间 {group_id}（finally清理），当前成员数={len(members)}")
-                print(f"[webrtc] 用户 {user_id} 离开房间 {group_id}（finally清理），当前成员数={len(members)}")
-        
-        if cursor:
-            cursor.close()
-        if connection and connection.is_connected():
-            connection.close()
+            await hub.unregister(user_id)
+            presence.went_offline(user_id)
+
+            # 所有断开路径（正常断开、RuntimeError、disconnect 事件、异常）都在这里统一清理临时房间成员；
+            # 只移除成员，不因断开解散房间，房间是否解散由业务消息控制（如 temp_room_owner_leave）
+            await temp_rooms.leave_all(user_id, "断开连接")
+            # 录到一半断开的语音不会再收到 flag==2，丢弃临时文件
+            await voice_recorder.abort(user_id)
+
+        connection.release()
+        for task in list(srs_offer_tasks):
+            task.cancel()
+        await outbound.stop()
         closed = await safe_close(websocket)
         print(f"[websocket][{user_id}] safe_close called, closed={closed}，当前在线={len(connections)}")
         app_logger.info(f"WebSocket关闭，数据库连接已释放，user_id={user_id}。")
@@ -15792,5 +19371,10 @@ async def websocket_endpoint(websocket: WebSocket, user_id: str):
 # ====== 像 Flask 那样可直接运行 ======
 if __name__ == "__main__":
     import uvicorn
-    print("服务已启动: http://0.0.0.0:5000")
-    uvicorn.run("app:app", host="0.0.0.0", port=5000, reload=True)
+    # UVICORN_WORKERS>1 时以多进程运行（不支持 reload），各 worker 通过 Redis 集群模式互相投递消息
+    workers = int(os.getenv("UVICORN_WORKERS", "1"))
+    if workers > 1:
+        os.environ.setdefault("HUB_CLUSTER_MODE", "true")
+    print(f"服务已启动: http://0.0.0.0:5000 (workers={workers})")
+    uvicorn.run("app:app", host="0.0.0.0", port=5000, reload=workers == 1, workers=workers,
+                ws_per_message_deflate=WS_PER_MESSAGE_DEFLATE)
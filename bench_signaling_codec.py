@@ -0,0 +1,107 @@
+"""
+信令编码微基准：对比 JSON 文本（当前默认）与 msgpack 子协议的编码字节数和每条消息的编解码耗时。
+
+用法：python bench_signaling_codec.py [--iterations 20000] [--repeat 5]
+"deflate" 列为单条消息 raw deflate 后的字节数，近似 permessage-deflate（不保留上下文）的线上大小。
+"""
+import argparse
+import json
+import time
+import zlib
+
+from app import HAS_MSGPACK, HAS_ORJSON, encode_signal
+
+if HAS_MSGPACK:
+    import msgpack
+if HAS_ORJSON:
+    import orjson
+
+
+def sample_sdp(media_count: int = 2, candidates: int = 6) -> str:
+    # 结构接近浏览器生成的 offer：每个 m= 段带编解码、扩展头和若干 candidate
+    lines = ["v=0", "o=- 4611731400430051336 2 IN IP4 127.0.0.1", "s=-", "t=0 0",
+             "a=group:BUNDLE " + " ".join(str(i) for i in range(media_count)), "a=msid-semantic: WMS stream"]
+    for mid in range(media_count):
+        kind = "audio" if mid == 0 else "video"
+        lines += [f"m={kind} 9 UDP/TLS/RTP/SAVPF 111 103 104 9 0 8 106 105 13 110 112 113 126",
+                  "c=IN IP4 0.0.0.0", "a=rtcp:9 IN IP4 0.0.0.0",
+                  "a=ice-ufrag:Xy7a", "a=ice-pwd:h0Jk3l9s8d7f6g5h4j3k2l1q", "a=ice-options:trickle",
+                  "a=fingerprint:sha-256 5B:3E:9A:1C:7D:44:02:AA:19:F0:6E:8B:3C:21:D4:90:7A:55:E1:0F:C3:68:B2:4D:19:8E:F7:36:A0:5C:92:E4",
+                  "a=setup:actpass", f"a=mid:{mid}", "a=sendrecv", "a=rtcp-mux",
+                  "a=extmap:1 urn:ietf:params:rtp-hdrext:ssrc-audio-level",
+                  "a=extmap:2 http://www.webrtc.org/experiments/rtp-hdrext/abs-send-time",
+                  "a=extmap:3 http://www.ietf.org/id/draft-holmer-rmcat-transport-wide-cc-extensions-01",
+                  "a=rtpmap:111 opus/48000/2", "a=rtcp-fb:111 transport-cc", "a=fmtp:111 minptime=10;useinbandfec=1",
+                  "a=rtpmap:96 H264/90000", "a=fmtp:96 level-asymmetry-allowed=1;packetization-mode=1;profile-level-id=42e01f",
+                  f"a=ssrc:{1000 + mid} cname:4TOk42mSjXCkVIa6", f"a=ssrc:{1000 + mid} msid:stream track{mid}"]
+        for i in range(candidates):
+            lines.append(f"a=candidate:{842163049 + i} 1 udp 1677729535 192.168.{mid}.{i + 10} {50000 + i} typ srflx "
+                         f"raddr 0.0.0.0 rport 0 generation 0 network-cost 999")
+    return "\r\n".join(lines) + "\r\n"
+
+
+def sample_messages():
+    sdp = sample_sdp()
+    return {
+        "webrtc_offer": {"type": "webrtc_offer", "from_user_id": "13800000001", "target_user_id": "13800000002",
+                         "room_id": "room_G100200300", "group_id": "G100200300", "offer": None, "sdp": sdp},
+        "srs_publish_answer": {"type": "srs_publish_answer", "action": "publish", "sdp": sdp, "code": 0,
+                               "stream_name": "room_G100200300",
+                               "stream_url": "webrtc://47.100.126.194/live/room_G100200300"},
+        "temp_room_6": {"type": "6", "status": "success", "group_id": "G100200300", "room_id": "room_G100200300",
+                        "publish_url": "webrtc://47.100.126.194/live/room_G100200300",
+                        "play_url": "webrtc://47.100.126.194/live/room_G100200300",
+                        "stream_name": "room_G100200300", "owner_id": "13800000001", "owner_name": "王老师",
+                        "online_users": [f"1380000{i:04d}" for i in range(20)],
+                        "offline_users": [f"1390000{i:04d}" for i in range(20)]},
+        "prepare_class": {"type": "prepare_class", "class_id": "C2024001", "school_id": "S001", "subject": "语文",
+                          "content": "请同学们提前预习第三单元课文，准备好课本和练习册，课上会进行随堂小测验。" * 4,
+                          "date": "2026-10-18", "time": "08:00", "sender_id": "13800000001",
+                          "sender_name": "王老师", "group_id": "G100200300", "group_name": "三年级二班"},
+    }
+
+
+def bench(func, arg, n: int, repeat: int) -> float:
+    # 取多轮中最快的一轮，返回每条消息的微秒数
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(n):
+            func(arg)
+        best = min(best, time.perf_counter() - start)
+    return best / n * 1e6
+
+
+def deflated_size(payload) -> int:
+    data = payload.encode("utf-8") if isinstance(payload, str) else payload
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+    return len(compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)) - 4
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=20000, help="每种编码每条消息的编解码次数")
+    parser.add_argument("--repeat", type=int, default=5, help="重复轮数，取最快一轮")
+    args = parser.parse_args()
+
+    codecs = [("json", lambda obj: encode_signal(obj), json.loads)]
+    if HAS_ORJSON:
+        codecs.append(("orjson", orjson.dumps, orjson.loads))
+    if HAS_MSGPACK:
+        codecs.append(("msgpack", lambda obj: encode_signal(obj, "msgpack"), lambda data: msgpack.unpackb(data, raw=False)))
+    else:
+        print("msgpack 未安装，只对比 JSON")
+
+    print(f"{'message':<20} {'codec':<8} {'bytes':>7} {'deflate':>8} {'enc us':>8} {'dec us':>8}")
+    for name, obj in sample_messages().items():
+        for codec, encode, decode in codecs:
+            payload = encode(obj)
+            assert decode(payload) == obj
+            size = len(payload.encode("utf-8") if isinstance(payload, str) else payload)
+            enc = bench(encode, obj, args.iterations, args.repeat)
+            dec = bench(decode, payload, args.iterations, args.repeat)
+            print(f"{name:<20} {codec:<8} {size:>7} {deflated_size(payload):>8} {enc:>8.2f} {dec:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,572 @@
+"""
+WebSocket hub 压测工具：模拟 N 个客户端连接 /ws/{user_id}，按比例发送心跳、私信、临时房间、WebRTC 信令和语音帧，
+统计建连速率、消息往返/投递延迟分位数、语音群发完成时间，以及服务端事件循环延迟。
+
+两个子命令：
+  serve  在本进程内启动 app，可用本地替身代替外部依赖：
+         --fake-mysql   空数据库（查询返回空、写入成功，可加 --db-latency-ms 模拟 RDS 往返）
+         --fake-redis   fakeredis（需安装 fakeredis；多 worker / 集群压测请改用本地 Redis，设置 REDIS_HOST）
+         --srs-stub     本地 SRS 桩，/rtc/v1/publish/、/rtc/v1/play/ 直接返回 answer，
+                        /api/v1/streams/ 返回推过流的流（供临时房间对账，DELETE /api/v1/streams/<name> 模拟断流）
+         压测用的群 ID 形如 "lt-<首个编号>-<人数>"，替身数据库据此返回成员（lt0、lt1 ...），不需要建表造数据。
+         不用替身时，真实 MySQL 可通过 DB_HOST / DB_PORT / DB_NAME / DB_USER / DB_PASSWORD 指向本地实例。
+  run    对已启动的服务发起压测并输出报告。
+
+用法：
+  python loadtest_ws.py serve --fake-mysql --fake-redis --srs-stub --port 5000 --quiet
+  python loadtest_ws.py run --url ws://127.0.0.1:5000 --clients 500 --room-size 20 --duration 30
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import struct
+import sys
+import time
+import urllib.parse
+import urllib.request
+from typing import Any, Dict, List, Optional
+
+SAMPLE_SDP = "v=0\r\no=- 0 2 IN IP4 127.0.0.1\r\ns=-\r\nt=0 0\r\n" + "a=candidate:1 1 udp 1 127.0.0.1 9 typ host\r\n" * 6
+
+
+# ===== 本地替身 =====
+class NullCursor:
+    """替身数据库游标：查询返回空，写入视为成功；压测群的成员查询按群 ID 生成"""
+
+    def __init__(self, latency: float, dictionary: bool):
+        self._latency = latency
+        self._dictionary = dictionary
+        self._rows: List[Any] = []
+        self.rowcount = 0
+        self.lastrowid = 1
+
+    def execute(self, query, params=None):
+        if self._latency:
+            time.sleep(self._latency)
+        self._rows = []
+        self.rowcount = 1
+        if "ta_group_member_relation" in query and params:
+            members = loadtest_group_members(str(params[0]))
+            self._rows = [{"unique_member_id": uid} if self._dictionary else (uid,) for uid in members]
+
+    def executemany(self, query, seq_params):
+        if self._latency:
+            time.sleep(self._latency)
+        self.rowcount = len(list(seq_params))
+
+    def fetchall(self):
+        rows, self._rows = self._rows, []
+        return rows
+
+    def fetchmany(self, size=1):
+        rows, self._rows = self._rows[:size], self._rows[size:]
+        return rows
+
+    def fetchone(self):
+        return self._rows.pop(0) if self._rows else None
+
+    def close(self):
+        pass
+
+
+class NullConnection:
+    def __init__(self, latency: float):
+        self._latency = latency
+
+    def is_connected(self):
+        return True
+
+    def ping(self, reconnect=False, attempts=1, delay=0):
+        pass
+
+    def cursor(self, dictionary=False, **kwargs):
+        return NullCursor(self._latency, dictionary)
+
+    def start_transaction(self, **kwargs):
+        pass
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def loadtest_group_members(group_id: str, prefix: str = "lt") -> List[str]:
+    # "lt-<首个编号>-<人数>" -> ["lt<首个编号>", ...]
+    parts = group_id.split("-")
+    if len(parts) != 3 or parts[0] != prefix or not parts[1].isdigit() or not parts[2].isdigit():
+        return []
+    first, count = int(parts[1]), int(parts[2])
+    return [f"{prefix}{i}" for i in range(first, first + count)]
+
+
+async def srs_stub(host: str, port: int, latency: float) -> asyncio.AbstractServer:
+    """
+    最小化的 SRS HTTP API 桩（支持 keep-alive）：
+    - 任何 POST 都返回 code=0 和一段 answer SDP；publish 请求的 streamurl 记为正在推流
+    - GET /api/v1/streams/ 按 start/count 分页返回正在推流的流
+    - DELETE /api/v1/streams/<name> 模拟推流端断开（真实 SRS 没有这个接口）
+    """
+    streams: Dict[str, Dict[str, Any]] = {}
+
+    def streams_page(target: str) -> Dict[str, Any]:
+        query = urllib.parse.parse_qs(urllib.parse.urlparse(target).query)
+        start = int(query.get("start", ["0"])[0])
+        count = int(query.get("count", ["10"])[0])
+        return {"code": 0, "server": "srs-stub", "streams": list(streams.values())[start:start + count]}
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                head = await reader.readuntil(b"\r\n\r\n")
+                method, target = head.split(b"\r\n", 1)[0].decode().split(" ")[:2]
+                length = 0
+                for line in head.split(b"\r\n"):
+                    if line.lower().startswith(b"content-length:"):
+                        length = int(line.split(b":", 1)[1])
+                payload = await reader.readexactly(length) if length else b""
+                if latency:
+                    await asyncio.sleep(latency)
+                path = urllib.parse.urlparse(target).path
+                if method == "GET" and path.rstrip("/") == "/api/v1/streams":
+                    body = json.dumps(streams_page(target)).encode()
+                elif method == "DELETE" and path.startswith("/api/v1/streams/"):
+                    streams.pop(path.rsplit("/", 1)[-1], None)
+                    body = b'{"code": 0}'
+                else:
+                    if "/publish/" in path and payload:
+                        # streamurl 形如 webrtc://host/app/stream
+                        app_name, stream = json.loads(payload).get("streamurl", "").rsplit("/", 2)[-2:]
+                        streams[stream] = {"name": stream, "app": app_name, "publish": {"active": True}}
+                    body = json.dumps({"code": 0, "server": "srs-stub", "sessionid": os.urandom(4).hex(),
+                                       "sdp": SAMPLE_SDP.replace("o=- 0", "o=- 1")}).encode()
+                writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\nContent-Length: "
+                             + str(len(body)).encode() + b"\r\n\r\n" + body)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host, port)
+
+
+def serve(args) -> None:
+    if args.srs_stub:
+        # app 在导入时读取 SRS 配置，必须先设置环境变量
+        os.environ.update({"SRS_SERVER": "127.0.0.1", "SRS_PORT": str(args.srs_port), "SRS_USE_HTTPS": "false"})
+    if args.quiet:
+        sys.stdout = open(os.devnull, "w")
+
+    import uvicorn
+    import app as server
+
+    if args.fake_mysql:
+        latency = args.db_latency_ms / 1000
+        server.mysql.connector.connect = lambda **kwargs: NullConnection(latency)
+    if args.fake_redis:
+        import fakeredis
+        redis_server = fakeredis.FakeServer()
+        server.r = fakeredis.FakeRedis(server=redis_server, decode_responses=True)
+        if server.HAS_REDIS_ASYNCIO:
+            server.aioredis.Redis = lambda **kwargs: fakeredis.aioredis.FakeRedis(server=redis_server)
+
+    async def main():
+        stub = await srs_stub("127.0.0.1", args.srs_port, args.srs_latency_ms / 1000) if args.srs_stub else None
+        config = uvicorn.Config(server.app, host=args.host, port=args.port, log_level="warning",
+                                ws_per_message_deflate=server.WS_PER_MESSAGE_DEFLATE)
+        try:
+            await uvicorn.Server(config).serve()
+        finally:
+            if stub is not None:
+                stub.close()
+
+    print(f"[loadtest] serve http://{args.host}:{args.port} fake_mysql={args.fake_mysql} "
+          f"fake_redis={args.fake_redis} srs_stub={args.srs_stub}", file=sys.stderr)
+    asyncio.run(main())
+
+
+# ===== 压测客户端 =====
+_VOICE_LEN = struct.Struct("<I")
+_VOICE_TS = struct.Struct("<Q")
+
+
+def encode_voice(flag: int, group_id: str, sender_id: str, ts: int, aac: bytes) -> bytes:
+    # 与服务端 encode_voice_frame 相同的帧格式，这里单独实现，压测端不依赖 app 的运行环境
+    parts = [bytes((6, flag))]
+    for field in (group_id, sender_id, sender_id):
+        raw = field.encode("utf-8")
+        parts += [_VOICE_LEN.pack(len(raw)), raw]
+    parts += [_VOICE_TS.pack(ts), _VOICE_LEN.pack(len(aac)), aac]
+    return b"".join(parts)
+
+
+def decode_voice_key(frame: bytes) -> Optional[tuple]:
+    """(group_id, ts)，不是语音帧返回 None"""
+    if len(frame) < 2 or frame[0] != 6:
+        return None
+    offset = 2
+    fields = []
+    for _ in range(3):
+        (length,) = _VOICE_LEN.unpack_from(frame, offset)
+        offset += 4
+        fields.append(frame[offset:offset + length])
+        offset += length
+    (ts,) = _VOICE_TS.unpack_from(frame, offset)
+    return fields[0].decode("utf-8"), ts
+
+
+def percentile(sorted_values: List[float], q: float) -> float:
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * q))]
+
+
+class Recorder:
+    """各类延迟样本（毫秒）与计数"""
+
+    def __init__(self):
+        self.samples: Dict[str, List[float]] = {}
+        self.counts: Dict[str, int] = {}
+
+    def observe(self, kind: str, ms: float) -> None:
+        self.samples.setdefault(kind, []).append(ms)
+
+    def count(self, kind: str, n: int = 1) -> None:
+        self.counts[kind] = self.counts.get(kind, 0) + n
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        result = {}
+        for kind, values in sorted(self.samples.items()):
+            values = sorted(values)
+            result[kind] = {"count": len(values), "p50_ms": round(percentile(values, 0.5), 2),
+                            "p99_ms": round(percentile(values, 0.99), 2), "max_ms": round(values[-1], 2)}
+        return result
+
+
+class FanOutTracker:
+    """语音帧群发完成时间：从发送到房间内最后一个成员收到"""
+
+    def __init__(self, recorder: Recorder):
+        self._recorder = recorder
+        self._pending: Dict[tuple, list] = {}  # (group_id, ts) -> [发送时刻, 期望收到数, 已收到数]
+
+    def sent(self, group_id: str, ts: int, expected: int) -> None:
+        if expected > 0:
+            self._pending[(group_id, ts)] = [time.perf_counter(), expected, 0]
+
+    def received(self, key: tuple) -> None:
+        entry = self._pending.get(key)
+        if entry is None:
+            return
+        entry[2] += 1
+        if entry[2] >= entry[1]:
+            del self._pending[key]
+            self._recorder.observe("voice_fanout", (time.perf_counter() - entry[0]) * 1000)
+
+    def incomplete(self) -> int:
+        return len(self._pending)
+
+
+class SimClient:
+    def __init__(self, harness: "LoadTest", index: int):
+        self.harness = harness
+        self.user_id = f"{harness.args.prefix}{index}"
+        self.ws = None
+        self._reader: Optional[asyncio.Task] = None
+        self.room: Optional[str] = None
+        self.peers: List[str] = []
+        self._pings: List[float] = []
+        self._pending: Dict[str, float] = {}  # 等待回复的请求 -> 发送时刻
+
+    async def connect(self) -> bool:
+        import websockets
+
+        rec = self.harness.recorder
+        started = time.perf_counter()
+        try:
+            self.ws = await websockets.connect(f"{self.harness.args.url}/ws/{self.user_id}", max_size=None,
+                                               open_timeout=self.harness.args.connect_timeout, ping_interval=None)
+        except Exception:
+            rec.count("connect_failed")
+            return False
+        rec.observe("connect", (time.perf_counter() - started) * 1000)
+        rec.count("connected")
+        self._reader = asyncio.create_task(self.read_loop())
+        return True
+
+    async def send(self, data) -> None:
+        try:
+            await self.ws.send(data)
+            self.harness.recorder.count("sent")
+        except Exception:
+            self.harness.recorder.count("send_failed")
+
+    async def ping(self) -> None:
+        self._pings.append(time.perf_counter())
+        await self.send("ping")
+
+    async def request(self, key: str, payload: Dict[str, Any]) -> None:
+        self._pending[key] = time.perf_counter()
+        await self.send(json.dumps(payload))
+
+    def _reply(self, key: str, kind: str) -> None:
+        started = self._pending.pop(key, None)
+        if started is not None:
+            self.harness.recorder.observe(kind, (time.perf_counter() - started) * 1000)
+
+    async def read_loop(self) -> None:
+        rec = self.harness.recorder
+        try:
+            async for message in self.ws:
+                rec.count("received")
+                if isinstance(message, bytes):
+                    key = decode_voice_key(message)
+                    if key is not None:
+                        self.harness.fanout.received(key)
+                    continue
+                if message == "pong":
+                    if self._pings:
+                        rec.observe("ping_rtt", (time.perf_counter() - self._pings.pop(0)) * 1000)
+                    continue
+                if message.startswith("[私信来自 "):
+                    body = json.loads(message.split("] ", 1)[1])
+                    rec.observe("direct_message", (time.time() - body["lt_ts"]) * 1000)
+                    continue
+                try:
+                    msg = json.loads(message)
+                except ValueError:
+                    rec.count("other_text")
+                    continue
+                msg_type = msg.get("type") if isinstance(msg, dict) else None
+                if msg_type == "6":
+                    if msg.get("owner_id") and "status" not in msg:
+                        rec.count("room_invites")
+                    elif self._pending.get("create") and msg.get("online_users") is not None:
+                        self._reply("create", "room_create")
+                    else:
+                        self._reply("join", "room_join")
+                elif msg_type == "webrtc_offer":
+                    rec.observe("webrtc_relay", (time.time() - (msg.get("offer") or {}).get("lt_ts", time.time())) * 1000)
+                elif msg_type in ("srs_answer", "srs_error"):
+                    rec.count(msg_type)
+                    self._reply("srs", "srs_offer")
+                else:
+                    rec.count(f"other:{msg_type}")
+        except Exception:
+            pass
+        finally:
+            rec.count("closed")
+
+    async def traffic(self, deadline: float) -> None:
+        args = self.harness.args
+        clients = self.harness.clients
+        next_ping = time.monotonic() + random.uniform(0, args.ping_interval)
+        rate = args.dm_rate + args.signal_rate
+        next_event = time.monotonic() + (random.expovariate(rate) if rate else float("inf"))
+        while time.monotonic() < deadline:
+            now = time.monotonic()
+            if now >= next_ping:
+                await self.ping()
+                next_ping = now + args.ping_interval
+            if now >= next_event:
+                next_event = now + random.expovariate(rate)
+                if self.peers and random.random() < args.signal_rate / rate:
+                    offer = {"type": "offer", "sdp": SAMPLE_SDP, "lt_ts": time.time()}
+                    await self.send(json.dumps({"type": "webrtc_offer", "target_user_id": random.choice(self.peers),
+                                                "group_id": self.room, "offer": offer}))
+                else:
+                    target = random.choice(clients).user_id
+                    if target != self.user_id:
+                        body = json.dumps({"type": "1", "text": "loadtest", "lt_ts": time.time()})
+                        await self.send(f"to:{target}:{body}")
+            await asyncio.sleep(min(next_ping, next_event, deadline) - time.monotonic())
+
+    async def close(self) -> None:
+        if self.ws is not None:
+            try:
+                await self.ws.close()
+            except Exception:
+                pass
+
+
+class LoadTest:
+    def __init__(self, args):
+        self.args = args
+        self.recorder = Recorder()
+        self.fanout = FanOutTracker(self.recorder)
+        self.clients = [SimClient(self, i) for i in range(args.clients)]
+        self.http_url = args.url.replace("ws://", "http://").replace("wss://", "https://")
+        self.server_lag: List[Dict[str, Any]] = []
+
+    def fetch(self, path: str) -> Optional[Dict[str, Any]]:
+        try:
+            with urllib.request.urlopen(self.http_url + path, timeout=5) as response:
+                return json.loads(response.read()).get("data")
+        except Exception:
+            return None
+
+    async def sample_loop_lag(self, stop: asyncio.Event) -> None:
+        while not stop.is_set():
+            stats = await asyncio.to_thread(self.fetch, "/metrics/loop_lag")
+            if stats:
+                self.server_lag.append(stats)
+            try:
+                await asyncio.wait_for(stop.wait(), self.args.metrics_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def connect_all(self) -> float:
+        started = time.perf_counter()
+        interval = 1 / self.args.connect_rate if self.args.connect_rate else 0
+        tasks = []
+        for client in self.clients:
+            tasks.append(asyncio.create_task(client.connect()))
+            if interval:
+                await asyncio.sleep(interval)
+        await asyncio.gather(*tasks)
+        return time.perf_counter() - started
+
+    async def setup_rooms(self) -> List[SimClient]:
+        """按 room_size 分组：每组第一个客户端建临时房间，其余成员加入；返回房主列表"""
+        size = self.args.room_size
+        owners = []
+        if size < 2:
+            return owners
+        for first in range(0, len(self.clients) - size + 1, size):
+            group = self.clients[first:first + size]
+            group_id = f"{self.args.prefix}-{first}-{size}"
+            members = [c.user_id for c in group]
+            for client in group:
+                client.room = group_id
+                client.peers = [uid for uid in members if uid != client.user_id]
+            owners.append(group[0])
+            await group[0].request("create", {"type": "6", "group_id": group_id, "owner_name": "压测",
+                                              "invited_users": members[1:]})
+        await asyncio.sleep(self.args.settle)
+        owner_ids = {owner.user_id for owner in owners}
+        for client in self.clients:
+            if client.room and client.user_id not in owner_ids:
+                await client.request("join", {"type": "join_temp_room", "group_id": client.room})
+        if self.args.srs_offers:
+            for owner in owners:
+                await owner.request("srs", {"type": "srs_publish_offer", "sdp": SAMPLE_SDP, "group_id": owner.room,
+                                            "stream_name": f"loadtest_{owner.room}"})
+        await asyncio.sleep(self.args.settle)
+        return owners
+
+    async def voice(self, owner: SimClient, deadline: float) -> None:
+        interval = 1 / self.args.voice_fps
+        aac = os.urandom(self.args.voice_bytes)
+        expected = len(owner.peers)
+        ts = int(time.time() * 1000)
+        await owner.send(encode_voice(0, owner.room, owner.user_id, ts, aac))
+        while time.monotonic() < deadline:
+            ts = max(ts + 1, int(time.time() * 1000))
+            self.fanout.sent(owner.room, ts, expected)
+            await owner.send(encode_voice(1, owner.room, owner.user_id, ts, aac))
+            self.recorder.count("voice_frames")
+            await asyncio.sleep(interval)
+        await owner.send(encode_voice(2, owner.room, owner.user_id, ts + 1, b""))
+
+    async def run(self) -> Dict[str, Any]:
+        stop = asyncio.Event()
+        sampler = asyncio.create_task(self.sample_loop_lag(stop))
+        connect_s = await self.connect_all()
+        connected = [c for c in self.clients if c.ws is not None]
+        self.clients = connected
+        owners = await self.setup_rooms() if connected else []
+        deadline = time.monotonic() + self.args.duration
+        work = [client.traffic(deadline) for client in connected]
+        if self.args.voice_fps:
+            work += [self.voice(owner, deadline) for owner in owners]
+        await asyncio.gather(*work)
+        await asyncio.sleep(self.args.settle)
+        stop.set()
+        await sampler
+        hub_stats = await asyncio.to_thread(self.fetch, "/metrics/hub")
+        await asyncio.gather(*(client.close() for client in connected))
+        return self.report(connect_s, hub_stats)
+
+    def report(self, connect_s: float, hub_stats: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        counts = self.recorder.counts
+        lag = [s for s in self.server_lag if s.get("samples")]
+        return {
+            "clients": self.args.clients,
+            "connected": counts.get("connected", 0),
+            "connect_failed": counts.get("connect_failed", 0),
+            "connect_rate_per_s": round(counts.get("connected", 0) / connect_s, 1) if connect_s else None,
+            "latency": self.recorder.summary(),
+            "voice_fanout_incomplete": self.fanout.incomplete(),
+            "counts": dict(sorted(counts.items())),
+            "server_loop_lag": {
+                "p99_ms_max": max((s["p99_ms"] for s in lag), default=None),
+                "max_ms": max((s["max_ms"] for s in lag), default=None),
+                "samples": len(lag),
+            },
+            "server_fanout_latency": (hub_stats or {}).get("fanout_latency"),
+        }
+
+
+def print_report(report: Dict[str, Any]) -> None:
+    print(f"clients={report['clients']} connected={report['connected']} failed={report['connect_failed']} "
+          f"connect_rate={report['connect_rate_per_s']}/s")
+    print(f"{'metric':<16} {'count':>8} {'p50 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    for kind, s in report["latency"].items():
+        print(f"{kind:<16} {s['count']:>8} {s['p50_ms']:>9} {s['p99_ms']:>9} {s['max_ms']:>9}")
+    print(f"voice frames not fully delivered: {report['voice_fanout_incomplete']}")
+    print(f"server loop lag: {report['server_loop_lag']}")
+    print(f"server fan-out latency: {report['server_fanout_latency']}")
+    print(f"counts: {report['counts']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("serve", help="在本进程内启动服务，可选本地替身")
+    p.add_argument("--host", default="127.0.0.1")
+    p.add_argument("--port", type=int, default=5000)
+    p.add_argument("--fake-mysql", action="store_true", help="用空数据库替身代替 MySQL")
+    p.add_argument("--db-latency-ms", type=float, default=0, help="替身数据库每次 execute 的阻塞耗时")
+    p.add_argument("--fake-redis", action="store_true", help="用 fakeredis 代替 Redis")
+    p.add_argument("--srs-stub", action="store_true", help="启动本地 SRS 桩并让服务指向它")
+    p.add_argument("--srs-port", type=int, default=19850)
+    p.add_argument("--srs-latency-ms", type=float, default=0)
+    p.add_argument("--quiet", action="store_true", help="丢弃服务端 print 输出")
+
+    p = sub.add_parser("run", help="对已启动的服务发起压测")
+    p.add_argument("--url", default="ws://127.0.0.1:5000")
+    p.add_argument("--clients", type=int, default=200)
+    p.add_argument("--prefix", default="lt", help="模拟用户 ID 前缀（替身数据库按 lt 前缀生成群成员）")
+    p.add_argument("--connect-rate", type=float, default=200, help="每秒新建连接数，0 表示同时发起")
+    p.add_argument("--connect-timeout", type=float, default=10)
+    p.add_argument("--duration", type=float, default=20, help="稳定流量阶段持续秒数")
+    p.add_argument("--ping-interval", type=float, default=5)
+    p.add_argument("--dm-rate", type=float, default=0.2, help="每个客户端每秒私信数")
+    p.add_argument("--signal-rate", type=float, default=0.1, help="每个客户端每秒 WebRTC offer 数（发给同房间成员）")
+    p.add_argument("--room-size", type=int, default=10, help="每个临时房间人数，小于 2 不建房间")
+    p.add_argument("--voice-fps", type=float, default=10, help="每个房主每秒语音帧数，0 表示不发语音")
+    p.add_argument("--voice-bytes", type=int, default=512)
+    p.add_argument("--srs-offers", action="store_true", help="每个房主发一次 srs_publish_offer（需要 SRS 或桩）")
+    p.add_argument("--settle", type=float, default=1.0, help="阶段之间等待回复的秒数")
+    p.add_argument("--metrics-interval", type=float, default=2.0, help="采样服务端 /metrics/loop_lag 的间隔")
+    p.add_argument("--json", action="store_true", help="以 JSON 输出报告")
+
+    args = parser.parse_args()
+    if args.command == "serve":
+        serve(args)
+        return
+    report = asyncio.run(LoadTest(args).run())
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    else:
+        print_report(report)
+
+
+if __name__ == "__main__":
+    main()
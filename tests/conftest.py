@@ -0,0 +1,5 @@
+import os
+import sys
+
+# 测试直接 import app（仓库根目录下的单文件服务）
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,89 @@
+import pytest
+
+import app
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(app.time, "monotonic", lambda: now[0])
+    return now
+
+
+def open_breaker(breaker):
+    for _ in range(4):
+        assert breaker.allow()
+        breaker.record(False)
+    assert breaker.state == "open"
+
+
+def make_breaker():
+    return app.CircuitBreaker(window=30, min_requests=4, error_rate=0.5, cooldown=10)
+
+
+def test_opens_on_error_rate_and_rejects_during_cooldown(clock):
+    breaker = make_breaker()
+    breaker.record(True)
+    breaker.record(False)
+    breaker.record(True)
+    assert breaker.state == "closed"  # 请求数不够，不判断错误率
+    breaker.record(False)
+    assert breaker.state == "open"
+    assert not breaker.allow()
+    assert breaker.retry_after() == pytest.approx(10)
+    clock[0] += 4
+    assert not breaker.allow()
+    assert breaker.stats["rejected"] == 2
+
+
+def test_half_open_lets_one_probe_through(clock):
+    breaker = make_breaker()
+    open_breaker(breaker)
+    clock[0] += 10
+    assert breaker.allow()
+    assert breaker.state == "half_open"
+    assert not breaker.allow()  # 探测结果出来之前其他请求仍被拒绝
+
+
+def test_successful_probe_closes(clock):
+    breaker = make_breaker()
+    open_breaker(breaker)
+    clock[0] += 10
+    assert breaker.allow()
+    breaker.record(True)
+    assert breaker.state == "closed"
+    assert breaker.allow()
+    # 关闭后重新计数，之前的失败不再算进窗口
+    breaker.record(False)
+    assert breaker.state == "closed"
+
+
+def test_failed_probe_reopens(clock):
+    breaker = make_breaker()
+    open_breaker(breaker)
+    clock[0] += 10
+    assert breaker.allow()
+    breaker.record(False)
+    assert breaker.state == "open"
+    assert breaker.stats["opened"] == 2
+    assert not breaker.allow()
+    assert breaker.retry_after() == pytest.approx(10)
+
+
+def test_released_probe_allows_next_request(clock):
+    breaker = make_breaker()
+    open_breaker(breaker)
+    clock[0] += 10
+    assert breaker.allow()
+    breaker.release_probe()  # 探测请求被取消，没有结果
+    assert breaker.allow()
+    assert breaker.state == "half_open"
+
+
+def test_old_outcomes_leave_the_window(clock):
+    breaker = make_breaker()
+    for _ in range(3):
+        breaker.record(False)
+    clock[0] += 31
+    breaker.record(False)
+    assert breaker.state == "closed"
@@ -0,0 +1,82 @@
+import gc
+
+import pytest
+
+import app
+
+
+class FakeRawConnection:
+    def __init__(self):
+        self.closed = False
+        self.rollbacks = 0
+
+    def is_connected(self):
+        return not self.closed
+
+    def rollback(self):
+        self.rollbacks += 1
+
+    def ping(self, reconnect=False):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+def make_pool(size=1, max_overflow=0, timeout=0.05):
+    pool = app.DBConnectionPool({}, size=size, max_overflow=max_overflow, timeout=timeout,
+                                recycle=0, pre_ping=False, ping_interval=0)
+    created = []
+
+    def connect():
+        raw = FakeRawConnection()
+        created.append(raw)
+        return raw
+
+    pool._connect = connect
+    return pool, created
+
+
+def test_close_returns_connection_for_reuse():
+    pool, created = make_pool()
+    conn = pool.acquire()
+    conn.close()
+    conn.close()  # 重复 close 忽略
+    again = pool.acquire()
+    assert again._raw is created[0]
+    assert created[0].rollbacks == 1
+    again.close()
+    assert pool.stats()["in_use"] == 0
+
+
+def test_leaked_connection_is_reclaimed():
+    pool, created = make_pool()
+    conn = pool.acquire()
+    with pytest.raises(app.PoolError):
+        pool.acquire(timeout=0)
+
+    del conn  # 忘记 close()
+    gc.collect()
+
+    stats = pool.stats()
+    assert stats["leaked"] == 1
+    assert stats["in_use"] == 0
+    assert stats["total"] == 0
+    assert created[0].closed  # 会话状态未知，直接断开而不是放回空闲队列
+    replacement = pool.acquire(timeout=0)
+    assert replacement._raw is not created[0]
+    replacement.close()
+
+
+def test_failed_connect_releases_slot():
+    pool, _ = make_pool()
+
+    def broken():
+        raise app.Error("down")
+
+    pool._connect = broken
+    with pytest.raises(app.Error):
+        pool.acquire()
+    stats = pool.stats()
+    assert stats["in_use"] == 0
+    assert stats["total"] == 0
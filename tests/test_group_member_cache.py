@@ -0,0 +1,106 @@
+import asyncio
+import contextlib
+
+import pytest
+
+import app
+
+
+class FakeDB:
+    """按 group_id 返回成员；on_query 在查询执行时回调，用来模拟加载期间成员变化"""
+
+    def __init__(self, members):
+        self.members = members
+        self.queries = 0
+        self.on_query = None
+
+    @contextlib.contextmanager
+    def connection(self):
+        db = self
+
+        class Cursor:
+            def execute(self, query, params):
+                db.queries += 1
+                self.group_id = params[0]
+                if db.on_query:
+                    db.on_query(self.group_id)
+
+            def fetchall(self):
+                return [(m,) for m in db.members.get(self.group_id, [])]
+
+            def close(self):
+                pass
+
+        class Connection:
+            def cursor(self):
+                return Cursor()
+
+        yield Connection()
+
+
+@pytest.fixture
+def db(monkeypatch):
+    fake = FakeDB({"g1": ["a", "b"]})
+    monkeypatch.setattr(app, "db_connection", fake.connection)
+    return fake
+
+
+def make_cache():
+    return app.GroupMemberCache(ttl=300, use_redis=False)
+
+
+def test_hit_after_load(db):
+    cache = make_cache()
+
+    async def run():
+        assert await cache.get_members("g1") == frozenset({"a", "b"})
+        assert await cache.get_members("g1") == frozenset({"a", "b"})
+
+    asyncio.run(run())
+    assert db.queries == 1
+    assert cache.stats["hits"] == 1
+
+
+def test_concurrent_misses_share_one_load(db):
+    cache = make_cache()
+
+    async def run():
+        return await asyncio.gather(*(cache.get_members("g1") for _ in range(5)))
+
+    assert all(m == frozenset({"a", "b"}) for m in asyncio.run(run()))
+    assert db.queries == 1
+
+
+def test_invalidate_drops_cached_entry(db):
+    cache = make_cache()
+
+    async def run():
+        await cache.get_members("g1")
+        db.members["g1"] = ["a", "b", "c"]
+        cache.invalidate("g1")
+        return await cache.get_members("g1")
+
+    assert asyncio.run(run()) == frozenset({"a", "b", "c"})
+    assert db.queries == 2
+
+
+def test_load_racing_invalidate_is_not_cached(db):
+    cache = make_cache()
+
+    def change_during_load(group_id):
+        # 查询已经读到旧成员后，另一个线程提交了成员变更并失效缓存
+        db.on_query = None
+        cache.invalidate(group_id)
+
+    db.on_query = change_during_load
+
+    async def run():
+        first = await cache.get_members("g1")
+        db.members["g1"] = ["a"]
+        second = await cache.get_members("g1")
+        return first, second
+
+    first, second = asyncio.run(run())
+    assert first == frozenset({"a", "b"})  # 本次调用方仍拿到结果
+    assert second == frozenset({"a"})  # 但旧结果没有写回缓存
+    assert db.queries == 2
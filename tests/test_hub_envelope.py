@@ -0,0 +1,97 @@
+import asyncio
+import json
+
+import pytest
+
+import app
+
+
+class FakeRedis:
+    def __init__(self):
+        self.published = []
+
+    async def publish(self, channel, data):
+        self.published.append((channel, data))
+
+
+class FakeSocket:
+    def __init__(self, codec="json"):
+        self.codec = codec
+        self.sent = []
+
+    async def send_text(self, text):
+        self.sent.append(("text", text))
+
+    async def send_bytes(self, data):
+        self.sent.append(("bytes", data))
+
+    async def send_json(self, obj, cache=None):
+        self.sent.append(("json", obj))
+
+
+@pytest.fixture
+def hub():
+    backplane = app.HubBackplane(enabled=False)
+    backplane._redis = FakeRedis()
+    return backplane
+
+
+async def publish_async(hub, payload, to=("u1",)):
+    assert await hub.publish("w2", list(to), payload)
+    channel, data = hub._redis.published[-1]
+    assert channel == "hub:deliver:w2"
+    return data
+
+
+def publish(hub, payload, to=("u1",)):
+    return asyncio.run(publish_async(hub, payload, to))
+
+
+def split(data):
+    (head_len,) = app._HUB_ENVELOPE_HEAD.unpack_from(data, 0)
+    return json.loads(data[4:4 + head_len]), data[4 + head_len:]
+
+
+def test_envelope_layout(hub):
+    head, body = split(publish(hub, "你好", to=("u1", "u2")))
+    assert head == {"k": "t", "to": ["u1", "u2"]}
+    assert body == "你好".encode("utf-8")
+
+    head, body = split(publish(hub, memoryview(b"\x06\x01\x00")))
+    assert head["k"] == "b" and body == b"\x06\x01\x00"
+
+    head, body = split(publish(hub, {"type": "presence", "online": True}))
+    assert head["k"] == "j" and json.loads(body) == {"type": "presence", "online": True}
+
+
+def test_dispatch_round_trip(hub, monkeypatch):
+    text_ws, packed_ws = FakeSocket(), FakeSocket(codec="msgpack")
+    monkeypatch.setitem(app.connections, "u1", {"ws": text_ws})
+    monkeypatch.setitem(app.connections, "u2", {"ws": packed_ws})
+
+    async def run():
+        await hub._dispatch(await publish_async(hub, "hi", to=("u1", "u2")))
+        await hub._dispatch(await publish_async(hub, b"\x00\xff", to=("u1",)))
+        await hub._dispatch(await publish_async(hub, {"type": "5", "n": 1}, to=("u1", "u2")))
+
+    asyncio.run(run())
+    assert text_ws.sent[0] == ("text", "hi")
+    assert text_ws.sent[1] == ("bytes", b"\x00\xff")
+    assert text_ws.sent[2][0] == "text" and json.loads(text_ws.sent[2][1]) == {"type": "5", "n": 1}
+    # 非 JSON 编码的连接收到结构化消息时按自己的编码重新发送
+    assert packed_ws.sent == [("text", "hi"), ("json", {"type": "5", "n": 1})]
+    assert hub.stats["delivered"] == 5
+
+
+def test_dispatch_skips_gone_users_and_garbage(hub, monkeypatch):
+    ws = FakeSocket()
+    monkeypatch.setitem(app.connections, "u1", {"ws": ws})
+
+    async def run():
+        await hub._dispatch(await publish_async(hub, "hi", to=("u1", "gone")))
+        await hub._dispatch(b"\x00\x00\x00\x09{not json")
+
+    asyncio.run(run())
+    assert ws.sent == [("text", "hi")]
+    assert hub.stats["undeliverable"] == 1
+    assert hub.stats["received"] == 2
@@ -0,0 +1,130 @@
+import asyncio
+import time
+
+import pytest
+
+import app
+
+
+class FakeNode:
+    base_url = "http://srs-1"
+
+
+class FakeSRS:
+    def __init__(self):
+        self.nodes = [FakeNode()]
+        self.streams = []
+        self.fail = False
+
+    async def list_streams(self, node, count):
+        if self.fail:
+            raise RuntimeError("srs down")
+        return self.streams
+
+
+@pytest.fixture
+def env(monkeypatch):
+    rooms = {}
+    srs = FakeSRS()
+    state = {"db_rows": [], "closed_db": [], "notified": []}
+
+    def load_db_rooms(grace):
+        return list(state["db_rows"])
+
+    def close_db_rooms(room_ids):
+        state["closed_db"].append(sorted(room_ids))
+        return len(room_ids)
+
+    async def notify(group_id, room_info, reason, initiator):
+        state["notified"].append((group_id, room_info["room_id"], reason))
+
+    monkeypatch.setattr(app, "srs_client", srs)
+    monkeypatch.setattr(app, "active_temp_rooms", rooms)
+    monkeypatch.setattr(app, "temp_rooms", app.TempRoomRegistry(rooms, use_redis=False))
+    monkeypatch.setattr(app, "notify_temp_room_closed", notify)
+    monkeypatch.setattr(app, "SRS_RECONCILE_GRACE", 60)
+    monkeypatch.setattr(app, "SRS_RECONCILE_MISSES", 2)
+    monkeypatch.setattr(app, "SRS_RECONCILE_MAX_CLOSE", 500)
+    monkeypatch.setattr(app.TempRoomReconciler, "_load_db_rooms", staticmethod(load_db_rooms))
+    monkeypatch.setattr(app.TempRoomReconciler, "_close_db_rooms", staticmethod(close_db_rooms))
+    state["srs"] = srs
+    state["rooms"] = rooms
+    return state
+
+
+def add_room(group_id, room_id, age):
+    asyncio.run(app.temp_rooms.add_room(group_id, {
+        "room_id": room_id, "group_id": group_id, "stream_name": f"room_{group_id}",
+        "timestamp": time.time() - age, "members": ["owner"],
+    }))
+
+
+def stream(name, active=True):
+    return {"app": app.SRS_APP, "name": name, "publish": {"active": active}}
+
+
+def test_closes_room_after_consecutive_misses(env):
+    add_room("g1", "r1", age=600)
+    add_room("g2", "r2", age=600)
+    env["srs"].streams = [stream("room_g2")]
+    reconciler = app.TempRoomReconciler()
+
+    first = asyncio.run(reconciler.reconcile_once())
+    assert first["missing"] == 1 and first["closed_memory"] == 0
+    assert "g1" in env["rooms"]
+
+    second = asyncio.run(reconciler.reconcile_once())
+    assert second["closed_memory"] == 1 and second["closed_db"] == 1
+    assert "g1" not in env["rooms"] and "g2" in env["rooms"]
+    assert env["closed_db"] == [["r1"]]
+    assert env["notified"] == [("g1", "r1", "stream_ended")]
+
+
+def test_stream_coming_back_resets_miss_count(env):
+    add_room("g1", "r1", age=600)
+    reconciler = app.TempRoomReconciler()
+    asyncio.run(reconciler.reconcile_once())
+    env["srs"].streams = [stream("room_g1")]
+    asyncio.run(reconciler.reconcile_once())
+    env["srs"].streams = []
+    result = asyncio.run(reconciler.reconcile_once())
+    assert result["closed_memory"] == 0
+    assert "g1" in env["rooms"]
+
+
+def test_inactive_publish_and_other_apps_do_not_count_as_live(env):
+    add_room("g1", "r1", age=600)
+    env["srs"].streams = [stream("room_g1", active=False), {"app": "other", "name": "room_g1"}]
+    reconciler = app.TempRoomReconciler()
+    asyncio.run(reconciler.reconcile_once())
+    assert asyncio.run(reconciler.reconcile_once())["closed_memory"] == 1
+
+
+def test_young_rooms_are_left_alone(env):
+    add_room("g1", "r1", age=5)
+    reconciler = app.TempRoomReconciler()
+    for _ in range(3):
+        result = asyncio.run(reconciler.reconcile_once())
+    assert result["candidates"] == 0
+    assert "g1" in env["rooms"]
+
+
+def test_srs_failure_skips_the_pass(env):
+    add_room("g1", "r1", age=600)
+    env["srs"].fail = True
+    reconciler = app.TempRoomReconciler()
+    for _ in range(3):
+        assert asyncio.run(reconciler.reconcile_once())["skipped"]
+    assert "g1" in env["rooms"]
+    assert reconciler.stats["skipped"] == 3
+
+
+def test_db_only_rooms_are_closed_in_db(env):
+    # 其他 worker 创建、本 worker 内存里没有的房间：只改数据库，不通知
+    env["db_rows"] = [{"room_id": "r9", "group_id": "g9", "stream_name": "room_g9"}]
+    reconciler = app.TempRoomReconciler()
+    asyncio.run(reconciler.reconcile_once())
+    result = asyncio.run(reconciler.reconcile_once())
+    assert result["closed_db"] == 1 and result["closed_memory"] == 0
+    assert env["closed_db"] == [["r9"]]
+    assert env["notified"] == []
@@ -0,0 +1,43 @@
+import pytest
+
+import app
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(app.time, "monotonic", lambda: now[0])
+    return now
+
+
+def test_burst_then_wait(clock):
+    bucket = app.TokenBucket(rate=10, capacity=3)
+    assert [bucket.take() for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert bucket.take() == pytest.approx(0.1)
+    # 不足时不扣令牌，等够时间后可以拿到
+    clock[0] += 0.1
+    assert bucket.take() == 0.0
+    assert bucket.take() == pytest.approx(0.1)
+
+
+def test_refill_is_capped_at_capacity(clock):
+    bucket = app.TokenBucket(rate=10, capacity=3)
+    for _ in range(3):
+        bucket.take()
+    clock[0] += 60
+    assert [bucket.take() for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert bucket.take() > 0
+
+
+def test_request_larger_than_capacity_counts_as_full_bucket(clock):
+    bucket = app.TokenBucket(rate=100, capacity=50)
+    assert bucket.take(500) == 0.0
+    assert bucket.take(1) == pytest.approx(0.01)
+    clock[0] += 0.5
+    assert bucket.take(500) == 0.0
+
+
+def test_byte_bucket_waits_proportionally(clock):
+    bucket = app.TokenBucket(rate=1000, capacity=1000)
+    assert bucket.take(1000) == 0.0
+    assert bucket.take(250) == pytest.approx(0.25)
@@ -0,0 +1,45 @@
+import struct
+
+import pytest
+
+import app
+
+
+def test_round_trip():
+    aac = bytes(range(200))
+    frame = app.parse_voice_frame(app.encode_voice_frame(1, "群1", "u1", "张三", 1700000000123, aac))
+    assert (frame.flag, frame.group_id, frame.sender_id, frame.sender_name, frame.ts) == (1, "群1", "u1", "张三", 1700000000123)
+    assert isinstance(frame.aac, memoryview)
+    assert bytes(frame.aac) == aac
+
+
+def test_accepts_bytearray_and_empty_fields():
+    frame = app.parse_voice_frame(bytearray(app.encode_voice_frame(0, "", "", "", 0)))
+    assert frame.group_id == "" and frame.sender_name == ""
+    assert len(frame.aac) == 0
+
+
+def test_other_frame_type_is_ignored():
+    data = bytearray(app.encode_voice_frame(1, "g", "u", "n", 0, b"x"))
+    data[0] = 5
+    assert app.parse_voice_frame(bytes(data)) is None
+
+
+def test_truncated_frame_raises():
+    data = app.encode_voice_frame(1, "g", "u", "n", 0, b"abcdef")
+    for cut in (1, 7, len(data) - 7, len(data) - 1):
+        with pytest.raises(app.VoiceFrameError):
+            app.parse_voice_frame(data[:cut])
+
+
+def test_length_field_past_end_raises():
+    # group_len 声称 1000 字节，实际帧里没有这么多
+    data = struct.pack("<BBI", app.VOICE_FRAME_TYPE, 1, 1000) + b"g"
+    with pytest.raises(app.VoiceFrameError):
+        app.parse_voice_frame(data)
+
+
+def test_invalid_utf8_raises():
+    data = struct.pack("<BBI", app.VOICE_FRAME_TYPE, 1, 2) + b"\xff\xfe" + struct.pack("<I", 0) * 2 + struct.pack("<QI", 0, 0)
+    with pytest.raises(app.VoiceFrameError):
+        app.parse_voice_frame(data)